@@ -176,6 +176,7 @@ class Command(BaseCommand):
                             subject_id=sub.id,
                             component_id=None,
                             marks=mark,
+                            school_id=klass.school_id,
                         ))
 
                         # Bulk insert in batches
@@ -187,6 +188,8 @@ class Command(BaseCommand):
                 if to_create:
                     ExamResult.objects.bulk_create(to_create, ignore_conflicts=True)
                     results_created += len(to_create)
+                # bulk_create skips signals; flag the exam for a timeline rebuild
+                Exam.objects.filter(pk=exam.pk).update(timeline_stale=True)
 
         if dry_run:
             self.stdout.write(self.style.WARNING('Dry run complete. No changes were made.'))
@@ -0,0 +1,54 @@
+# Generated by Django 5.2.18 on 2026-10-19 08:28
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def mark_exams_with_results_stale(apps, schema_editor):
+    # Existing exams get their snapshots built on the first timeline read
+    Exam = apps.get_model('academics', 'Exam')
+    ExamResult = apps.get_model('academics', 'ExamResult')
+    Exam.objects.filter(id__in=ExamResult.objects.values('exam_id')).update(timeline_stale=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('academics', '0026_student_birth_certificate_no_student_guardian_name_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exam',
+            name='timeline_stale',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.CreateModel(
+            name='StudentExamSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('total', models.FloatField(default=0)),
+                ('average', models.FloatField(default=0)),
+                ('mean_percentage', models.FloatField(blank=True, null=True)),
+                ('subject_percentages', models.JSONField(default=dict)),
+                ('position', models.IntegerField(blank=True, null=True)),
+                ('class_size', models.IntegerField(default=0)),
+                ('delta_total', models.FloatField(blank=True, null=True)),
+                ('delta_percentage', models.FloatField(blank=True, null=True)),
+                ('delta_position', models.IntegerField(blank=True, null=True)),
+                ('subject_deltas', models.JSONField(default=dict)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('exam', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='snapshots', to='academics.exam')),
+                ('klass', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='academics.class')),
+                ('previous_exam', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='academics.exam')),
+                ('student', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='exam_snapshots', to='academics.student')),
+            ],
+            options={
+                'ordering': ['student', 'date', 'exam'],
+                'indexes': [models.Index(fields=['student', 'date', 'exam'], name='academics_s_student_3234c9_idx'), models.Index(fields=['klass', 'student', 'date'], name='academics_s_klass_i_d96a74_idx')],
+                'unique_together': {('student', 'exam')},
+            },
+        ),
+        migrations.RunPython(mark_exams_with_results_stale, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 5.2.18 on 2026-10-19 08:38
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_school(apps, schema_editor):
+    # Student.school is kept for graduated students; fall back to the class's school
+    Student = apps.get_model('academics', 'Student')
+    Exam = apps.get_model('academics', 'Exam')
+    Attendance = apps.get_model('academics', 'Attendance')
+    ExamResult = apps.get_model('academics', 'ExamResult')
+    student = Student.objects.filter(pk=OuterRef('student_id'))
+    Attendance.objects.filter(school__isnull=True).update(school_id=Coalesce(
+        Subquery(student.values('school_id')[:1]), Subquery(student.values('klass__school_id')[:1]),
+    ))
+    ExamResult.objects.filter(school__isnull=True).update(
+        school_id=Subquery(Exam.objects.filter(pk=OuterRef('exam_id')).values('klass__school_id')[:1])
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('academics', '0027_student_exam_snapshot'),
+        ('accounts', '0010_user_profile_picture'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='attendance',
+            name='school',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='accounts.school'),
+        ),
+        migrations.AddField(
+            model_name='examresult',
+            name='school',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='accounts.school'),
+        ),
+        migrations.RunPython(backfill_school, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='attendance',
+            index=models.Index(fields=['school', 'date', 'status'], name='att_school_date_status'),
+        ),
+        migrations.AddIndex(
+            model_name='examresult',
+            index=models.Index(fields=['school', 'exam'], name='er_school_exam'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 08:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('academics', '0028_tenant_school'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='student',
+            name='guardian_id',
+            field=models.CharField(blank=True, db_index=True, max_length=100),
+        ),
+    ]
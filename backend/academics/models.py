@@ -1,5 +1,4 @@
 from django.db import models
-from django.db import IntegrityError
 from django.conf import settings
 from django.core.exceptions import ValidationError as DjangoValidationError
 from django.utils import timezone
@@ -222,7 +221,8 @@ class Student(models.Model):
     dob = models.DateField()
     gender = models.CharField(max_length=20)
     upi_number = models.CharField(max_length=50, blank=True)
-    guardian_id = models.CharField(max_length=100, blank=True)
+    # Guardian phone; indexed for matching paybill/bank statement lines to students
+    guardian_id = models.CharField(max_length=100, blank=True, db_index=True)
     guardian_name = models.CharField(max_length=255, blank=True)
     guardian_passport_no = models.CharField(max_length=50, blank=True)
     birth_certificate_no = models.CharField(max_length=50, blank=True)
@@ -247,6 +247,12 @@ class Student(models.Model):
         help_text='Whether the student is a day scholar or a boarder.'
     )
 
+    def tenant_school_id(self):
+        """School used to stamp the student's attendance, invoices and results."""
+        if self.school_id:
+            return self.school_id
+        return self.klass.school_id if self.klass_id else None
+
 class Competency(models.Model):
     code = models.CharField(max_length=50, unique=True)
     title = models.CharField(max_length=255)
@@ -277,8 +283,16 @@ class Attendance(models.Model):
     date = models.DateField()
     status = models.CharField(max_length=20, choices=STATUS_CHOICES)
     recorded_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True)
+    # Denormalized tenant column (see accounts.tenancy); set from the student on save
+    school = models.ForeignKey('accounts.School', null=True, blank=True, on_delete=models.CASCADE, related_name='+', db_index=False)
     class Meta:
         unique_together = ("student","date")
+        indexes = [models.Index(fields=['school', 'date', 'status'], name='att_school_date_status')]
+
+    def save(self, *args, **kwargs):
+        if self.school_id is None and self.student_id:
+            self.school_id = self.student.tenant_school_id()
+        super().save(*args, **kwargs)
 
 
 # ===== Exams =====
@@ -322,6 +336,8 @@ class Exam(models.Model):
     published_at = models.DateTimeField(null=True, blank=True)
     # Snapshot the grade level at the time the exam was created to avoid issues after promotions
     grade_level_tag = models.CharField(max_length=20, blank=True, db_index=True, help_text="Grade level at the time the exam was set (e.g., 'Grade 4')")
+    # Set when results change; StudentExamSnapshot rows are rebuilt lazily on the next timeline read
+    timeline_stale = models.BooleanField(default=False, db_index=True)
 
     class Meta:
         ordering = ['name', 'year', 'term', 'klass__grade_level', 'klass__stream__name', 'date', 'id']
@@ -355,12 +371,8 @@ class Exam(models.Model):
                     yr = None
             # Fallback: infer from AcademicYear by date and school
             if yr is None and getattr(self, 'date', None) and getattr(self, 'klass', None) and getattr(self.klass, 'school_id', None):
-                from .models import AcademicYear
-                ay = AcademicYear.objects.filter(
-                    school_id=self.klass.school_id,
-                    start_date__lte=self.date,
-                    end_date__gte=self.date,
-                ).first()
+                from .services.calendar import resolve_date
+                ay, _ = resolve_date(self.klass.school_id, self.date)
                 if ay:
                     try:
                         yr = int(getattr(ay.end_date, 'year', None) or getattr(ay.start_date, 'year', None))
@@ -384,9 +396,52 @@ class ExamResult(models.Model):
     subject = models.ForeignKey(Subject, on_delete=models.CASCADE)
     component = models.ForeignKey('SubjectComponent', on_delete=models.CASCADE, null=True, blank=True, related_name='results')
     marks = models.FloatField()
+    # Denormalized tenant column (see accounts.tenancy); set from the exam's class on save
+    school = models.ForeignKey('accounts.School', null=True, blank=True, on_delete=models.CASCADE, related_name='+', db_index=False)
 
     class Meta:
         unique_together = ("exam","student","subject","component")
+        indexes = [models.Index(fields=['school', 'exam'], name='er_school_exam')]
+
+    def save(self, *args, **kwargs):
+        if self.school_id is None and self.exam_id:
+            self.school_id = self.exam.klass.school_id
+        super().save(*args, **kwargs)
+
+
+class StudentExamSnapshot(models.Model):
+    """Precomputed per-student exam performance, one row per (student, exam).
+    Rows form a student's timeline ordered by (date, exam); deltas are against the previous row.
+    Maintained by academics.services.timeline.
+    """
+    student = models.ForeignKey(Student, on_delete=models.CASCADE, related_name='exam_snapshots')
+    exam = models.ForeignKey(Exam, on_delete=models.CASCADE, related_name='snapshots')
+    klass = models.ForeignKey(Class, null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    date = models.DateField()
+    total = models.FloatField(default=0)
+    average = models.FloatField(default=0)
+    mean_percentage = models.FloatField(null=True, blank=True)
+    subject_percentages = models.JSONField(default=dict)  # {"<subject_id>": pct}
+    position = models.IntegerField(null=True, blank=True)
+    class_size = models.IntegerField(default=0)
+    # Deltas against the student's previous exam (null for the first one)
+    previous_exam = models.ForeignKey(Exam, null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    delta_total = models.FloatField(null=True, blank=True)
+    delta_percentage = models.FloatField(null=True, blank=True)
+    delta_position = models.IntegerField(null=True, blank=True)
+    subject_deltas = models.JSONField(default=dict)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ("student", "exam")
+        ordering = ["student", "date", "exam"]
+        indexes = [
+            models.Index(fields=["student", "date", "exam"]),
+            models.Index(fields=["klass", "student", "date"]),
+        ]
+
+    def __str__(self):
+        return f"{self.student_id} @ {self.exam_id}: {self.total}"
 
 
 # ===== Class Subject Teacher Assignment =====
@@ -449,186 +504,17 @@ class AcademicYear(models.Model):
             if overlap:
                 raise DjangoValidationError("Academic year dates overlap with an existing year for this school.")
 
-    def promote_classes(self):
+    def promote_classes(self, dry_run=False):
         """Promote all classes to the next grade level for the new academic year.
         - Increments the grade level number if it can be extracted
         - Skips classes that don't follow the expected format
+        - Grade 9 graduates, except students with an outstanding fee balance
+        With dry_run=True the plan is returned without touching the database.
+        See academics.services.promotion for the planning rules.
         """
-        from django.db import transaction
-        
-        # Get all classes from the previous academic year
-        classes = Class.objects.filter(school=self.school).select_related('stream')
-        
-        with transaction.atomic():
-            # Build a human-readable summary of actions for UI/debugging
-            summary = {
-                'school_id': getattr(self.school, 'id', None),
-                'label': getattr(self, 'label', None),
-                'graduated_classes': [],
-                'moved_classes': [],  # moved to existing target
-                'renamed_classes': [],  # in-place rename
-                'skipped': [],  # classes skipped with reason
-            }
-            for class_obj in classes:
-                try:
-                    # Skip if no grade level or stream
-                    if not class_obj.grade_level or not class_obj.stream:
-                        summary['skipped'].append({'class_id': class_obj.id, 'name': getattr(class_obj, 'name', ''), 'reason': 'missing grade_level or stream'})
-                        continue
-                        
-                    # Format the current grade level to ensure consistency
-                    current_grade = Class.format_grade_level(class_obj.grade_level)
-                    
-                    # Extract the numeric part from the formatted grade
-                    import re
-                    # Prefer explicit pattern 'Grade <num>'
-                    m_named = re.search(r'\bgrade\s*(\d{1,2})\b', current_grade, flags=re.IGNORECASE)
-                    match = m_named if m_named else re.search(r'\b(\d{1,2})\b', current_grade)
-                    if not match:
-                        summary['skipped'].append({'class_id': class_obj.id, 'name': getattr(class_obj, 'name', ''), 'reason': f'no numeric grade in "{current_grade}"'})
-                        continue
-                        
-                    # Increment the grade number
-                    try:
-                        current_grade_num = int(match.group(1) if match.lastindex else match.group())
-                    except Exception:
-                        summary['skipped'].append({'class_id': class_obj.id, 'name': getattr(class_obj, 'name', ''), 'reason': f'failed to parse grade from "{current_grade}"'})
-                        continue
-                    # Graduation rule: ONLY Grade 9 graduates. Others must be promoted.
-                    if current_grade_num == 9:
-                        grad_year = None
-                        try:
-                            # Prefer academic year end_date year
-                            if getattr(self, 'end_date', None):
-                                grad_year = int(self.end_date.year)
-                            else:
-                                # Fallback: try to parse label like "2024/2025" -> 2025
-                                parts = [int(p) for p in re.findall(r'\d{4}', str(getattr(self, 'label', '')))]
-                                if parts:
-                                    grad_year = parts[-1]
-                        except Exception:
-                            grad_year = None
-                        # Graduate students one-by-one, but block if fee balance > 0
-                        moved_count = 0
-                        not_cleared = []
-                        for stu in class_obj.student_set.select_for_update().all():
-                            try:
-                                from finance.models import Invoice, Payment
-                                from django.db.models import Sum
-                                total_billed = Invoice.objects.filter(student=stu).aggregate(s=Sum('amount'))['s'] or 0
-                                total_paid = Payment.objects.filter(invoice__student=stu).aggregate(s=Sum('amount'))['s'] or 0
-                                balance = float(total_billed or 0) - float(total_paid or 0)
-                            except Exception:
-                                balance = 0
-                            if balance > 0:
-                                # Do NOT graduate; keep in class to allow clearance
-                                not_cleared.append({'student_id': stu.id, 'name': stu.name, 'balance': balance})
-                                continue
-                            # Move to the special 'Graduated' class for the school
-                            grad_class = Class.get_or_create_graduated_class(class_obj.school)
-                            stu.klass = grad_class
-                            stu.is_graduated = True
-                            stu.graduation_year = grad_year
-                            stu.school = class_obj.school
-                            stu.save(update_fields=['klass','is_graduated','graduation_year','school'])
-                            moved_count += 1
-                        summary['graduated_classes'].append({
-                            'class_id': class_obj.id,
-                            'from': getattr(class_obj, 'name', ''),
-                            'students': moved_count,
-                            'graduation_year': grad_year,
-                        })
-                        if not_cleared:
-                            summary.setdefault('not_cleared', []).extend(not_cleared)
-                    else:
-                        new_grade_num = current_grade_num + 1
-                        # Check if a destination class already exists (same stream & school)
-                        target = Class.objects.filter(
-                            school=class_obj.school,
-                            stream=class_obj.stream,
-                            grade_level=Class.format_grade_level(str(new_grade_num))
-                        ).first()
-                        if target:
-                            # Reassign class teacher to the destination class and clear from the old class
-                            target.teacher = class_obj.teacher
-                            target.save(update_fields=['teacher'])
-                            class_obj.teacher = None
-                            class_obj.save(update_fields=['teacher'])
-                            # Move students one-by-one to the existing destination class
-                            moved_count = 0
-                            for stu in class_obj.student_set.select_for_update().all():
-                                stu.klass = target
-                                stu.is_graduated = False
-                                stu.school = class_obj.school
-                                stu.save(update_fields=['klass','is_graduated','school'])
-                                moved_count += 1
-                            summary['moved_classes'].append({
-                                'from_id': class_obj.id,
-                                'from': getattr(class_obj, 'name', ''),
-                                'to_id': target.id,
-                                'to': getattr(target, 'name', ''),
-                                'students': moved_count,
-                            })
-                        else:
-                            # In-place promote: update this class's grade_level so name regenerates
-                            try:
-                                class_obj.grade_level = str(new_grade_num)
-                                # Save triggers name regeneration in Class.save(); may raise IntegrityError if target exists
-                                class_obj.save(update_fields=['grade_level', 'name'])
-                                # Students stay in the same class (now renamed)
-                                summary['renamed_classes'].append({
-                                    'class_id': class_obj.id,
-                                    'from': f"{current_grade} {class_obj.stream.name}",
-                                    'to': class_obj.name,
-                                    'students': class_obj.student_set.count(),
-                                })
-                            except IntegrityError:
-                                # Fallback: destination exists, move students instead
-                                target = Class.objects.filter(
-                                    school=class_obj.school,
-                                    stream=class_obj.stream,
-                                    grade_level=Class.format_grade_level(str(new_grade_num))
-                                ).first()
-                                if not target:
-                                    raise
-                                # Reassign teacher during fallback as well
-                                target.teacher = class_obj.teacher
-                                target.save(update_fields=['teacher'])
-                                class_obj.teacher = None
-                                class_obj.save(update_fields=['teacher'])
-                                # Move students one-by-one
-                                moved_count = 0
-                                for stu in class_obj.student_set.select_for_update().all():
-                                    stu.klass = target
-                                    stu.is_graduated = False
-                                    stu.school = class_obj.school
-                                    stu.save(update_fields=['klass','is_graduated','school'])
-                                    moved_count += 1
-                                summary['moved_classes'].append({
-                                    'from_id': class_obj.id,
-                                    'from': getattr(class_obj, 'name', ''),
-                                    'to_id': target.id,
-                                    'to': getattr(target, 'name', ''),
-                                    'students': moved_count,
-                                })
-                    
-                    # Log the promotion
-                    import logging
-                    logger = logging.getLogger(__name__)
-                    if current_grade_num == 9:
-                        logger.info(f"Graduated students from {class_obj.name}; max grade reached")
-                    else:
-                        logger.info(f"Promoted class {class_obj.get_class_name()} to Grade {new_grade_num} {class_obj.stream.name}")
-                    
-                except Exception as e:
-                    # Log error but continue with other classes
-                    import logging
-                    logger = logging.getLogger(__name__)
-                    logger.error(f"Error promoting class {getattr(class_obj, 'id', 'unknown')}: {str(e)}", 
-                               exc_info=True)
-                    summary['skipped'].append({'class_id': getattr(class_obj, 'id', None), 'name': getattr(class_obj, 'name', ''), 'reason': f'error: {str(e)}'})
-
-            return summary
+        from .services.promotion import promote_academic_year
+        return promote_academic_year(self, dry_run=dry_run)
+
     def save(self, *args, **kwargs):
         # Check if this is an existing instance being set as current
         if self.pk:
@@ -724,6 +610,10 @@ class AcademicYear(models.Model):
                         # No room for holiday; next term starts next day
                         current_start = t.end_date + timedelta(days=1)
 
+        # Dates/current flags changed: refresh cached calendars for this school
+        from .services.calendar import invalidate_school_calendar
+        invalidate_school_calendar(self.school_id)
+
     def __str__(self):
         return f"{self.label} ({self.school})"
 
@@ -805,6 +695,9 @@ class Term(models.Model):
         except Exception:
             pass
 
+        from .services.calendar import invalidate_school_calendar
+        invalidate_school_calendar(getattr(self.academic_year, 'school_id', None))
+
     def __str__(self):
         return f"{self.academic_year.label} - T{self.number}"
 
@@ -7,6 +7,7 @@ from .models import (
     TeacherAvailability, TimetableVersion
 )
 from django.contrib.auth import get_user_model
+from .services.calendar import resolve_date
 
 User = get_user_model()
 
@@ -253,14 +254,11 @@ class ExamSerializer(serializers.ModelSerializer):
         fields = ['id','name','year','term','klass','date','total_marks','published','published_at','grade_level_tag','inferred_academic_year','inferred_term']
 
     def _infer_year_and_term(self, exam):
-        school = getattr(getattr(exam.klass, 'school', None), 'id', None)
+        school = getattr(exam.klass, 'school_id', None) if getattr(exam, 'klass_id', None) else None
         if not school or not exam.date:
             return None, None
-        ay = AcademicYear.objects.filter(school_id=school, start_date__lte=exam.date, end_date__gte=exam.date).first()
-        if not ay:
-            return None, None
-        term = Term.objects.filter(academic_year=ay, start_date__lte=exam.date, end_date__gte=exam.date).first()
-        return ay, term
+        # Served from the per-school in-memory calendar; no queries per row
+        return resolve_date(school, exam.date)
 
     def get_inferred_academic_year(self, obj):
         ay, _ = self._infer_year_and_term(obj)
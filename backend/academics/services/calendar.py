@@ -0,0 +1,158 @@
+from __future__ import annotations
+import threading
+import time
+import uuid
+from bisect import bisect_right
+from datetime import date
+from typing import Dict, List, Optional, Tuple
+from django.core.cache import cache
+from django.utils import timezone
+
+# Per-process snapshot of each school's calendar:
+# {school_id: (version, loaded_at, checked_at, SchoolCalendar)}. The version token lives in the
+# Django cache, so with the shared cache (settings.CACHES) a save in one worker invalidates the
+# snapshots of every other worker. The token is read at most every VERSION_RECHECK seconds per
+# school, since the default shared cache is a database table and lookups run per serialized
+# row; a save in this process drops its own snapshot at once. Snapshots are also reloaded
+# after CALENDAR_TTL seconds, which bounds staleness when the cache is per-process (local
+# development).
+CALENDAR_TTL = 300
+VERSION_RECHECK = 5
+_CALENDARS: Dict[int, Tuple[str, float, float, 'SchoolCalendar']] = {}
+_LOCK = threading.Lock()
+
+
+def _version_key(school_id: int) -> str:
+    return f"academics:calendar:v:{school_id}"
+
+
+def _current_version(school_id: int) -> str:
+    key = _version_key(school_id)
+    version = cache.get(key)
+    if version is None:
+        version = uuid.uuid4().hex
+        # add() keeps the first writer's token when several workers race here
+        if not cache.add(key, version, None):
+            version = cache.get(key) or version
+    return version
+
+
+def invalidate_school_calendar(school_id) -> None:
+    """Drop cached calendars for a school (this process and, via the version token, all others)."""
+    if not school_id:
+        return
+    cache.set(_version_key(school_id), uuid.uuid4().hex, None)
+    with _LOCK:
+        _CALENDARS.pop(school_id, None)
+
+
+class SchoolCalendar:
+    """Immutable snapshot of a school's academic years and terms with bisect-based lookups."""
+
+    def __init__(self, years, terms):
+        self.years = sorted(years, key=lambda y: y.start_date)
+        self._year_starts = [y.start_date for y in self.years]
+        self._terms: Dict[int, list] = {}
+        for t in terms:
+            self._terms.setdefault(t.academic_year_id, []).append(t)
+        self._term_starts: Dict[int, list] = {}
+        by_id = {y.id: y for y in self.years}
+        for ay_id, items in self._terms.items():
+            items.sort(key=lambda t: t.start_date)
+            self._term_starts[ay_id] = [t.start_date for t in items]
+            # Share the year instances so term.academic_year needs no query
+            for t in items:
+                if ay_id in by_id:
+                    t.academic_year = by_id[ay_id]
+
+    def year_for(self, d: Optional[date]):
+        """AcademicYear whose [start_date, end_date] contains d, or None."""
+        if not d or not self.years:
+            return None
+        i = bisect_right(self._year_starts, d) - 1
+        if i >= 0 and self.years[i].end_date >= d:
+            return self.years[i]
+        return None
+
+    def term_for(self, d: Optional[date], academic_year=None):
+        """Term containing d (optionally restricted to academic_year), or None."""
+        ay = academic_year or self.year_for(d)
+        if not d or not ay:
+            return None
+        starts = self._term_starts.get(ay.id) or []
+        i = bisect_right(starts, d) - 1
+        if i >= 0:
+            t = self._terms[ay.id][i]
+            if t.end_date >= d:
+                return t
+        return None
+
+    def resolve(self, d: Optional[date]):
+        """Return (AcademicYear, Term) for a date; either may be None."""
+        ay = self.year_for(d)
+        return ay, (self.term_for(d, ay) if ay else None)
+
+    def terms_of(self, academic_year) -> List:
+        if not academic_year:
+            return []
+        return sorted(self._terms.get(academic_year.id, []), key=lambda t: t.number)
+
+    def flagged_year(self):
+        """AcademicYear marked is_current=True, if any."""
+        return next((y for y in self.years if y.is_current), None)
+
+    def flagged_term(self, academic_year=None):
+        """Term marked is_current=True (within academic_year when given)."""
+        pool = self._terms.get(academic_year.id, []) if academic_year else [t for items in self._terms.values() for t in items]
+        return next((t for t in pool if t.is_current), None)
+
+    def current_year(self, today: Optional[date] = None):
+        """Year containing today, falling back to the is_current flag."""
+        today = today or timezone.localdate()
+        return self.year_for(today) or self.flagged_year()
+
+    def current_term(self, today: Optional[date] = None):
+        """Term containing today within the current year, falling back to the is_current flag."""
+        today = today or timezone.localdate()
+        ay = self.current_year(today)
+        if not ay:
+            return None
+        return self.term_for(today, ay) or self.flagged_term(ay)
+
+
+def _load(school_id: int) -> SchoolCalendar:
+    from academics.models import AcademicYear, Term
+    years = list(AcademicYear.objects.filter(school_id=school_id))
+    terms = list(Term.objects.filter(academic_year__school_id=school_id))
+    return SchoolCalendar(years, terms)
+
+
+def get_school_calendar(school) -> Optional[SchoolCalendar]:
+    """Return the cached SchoolCalendar for a school instance or id (None if no school)."""
+    school_id = getattr(school, 'id', school)
+    if not school_id:
+        return None
+    now = time.monotonic()
+    entry = _CALENDARS.get(school_id)
+    if entry and now - entry[1] < CALENDAR_TTL:
+        if now - entry[2] < VERSION_RECHECK:
+            return entry[3]
+        version = _current_version(school_id)
+        if entry[0] == version:
+            with _LOCK:
+                _CALENDARS[school_id] = (version, entry[1], now, entry[3])
+            return entry[3]
+    else:
+        version = _current_version(school_id)
+    cal = _load(school_id)
+    with _LOCK:
+        _CALENDARS[school_id] = (version, now, now, cal)
+    return cal
+
+
+def resolve_date(school, d: Optional[date]):
+    """Shortcut: (AcademicYear, Term) for a school and date."""
+    cal = get_school_calendar(school)
+    if not cal:
+        return None, None
+    return cal.resolve(d)
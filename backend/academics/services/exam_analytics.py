@@ -0,0 +1,217 @@
+from __future__ import annotations
+from typing import Dict, Iterable, List
+import numpy as np
+
+# Used when a subject has no SubjectGradingBand rows configured
+DEFAULT_GRADING_BANDS = [
+    {'grade': 'A', 'min': 80, 'max': 100},
+    {'grade': 'B', 'min': 70, 'max': 79},
+    {'grade': 'C', 'min': 60, 'max': 69},
+    {'grade': 'D', 'min': 50, 'max': 59},
+    {'grade': 'E', 'min': 0, 'max': 49},
+]
+
+PERCENTILES = (10, 25, 50, 75, 90)
+HISTOGRAM_EDGES = np.arange(0, 110, 10, dtype=float)  # 0-10, ..., 90-100 (last bin closed)
+
+
+def _get_models():
+    from academics.models import Exam, ExamResult, Student, Subject, SubjectGradingBand, Class
+    return {
+        'Exam': Exam,
+        'ExamResult': ExamResult,
+        'Student': Student,
+        'Subject': Subject,
+        'SubjectGradingBand': SubjectGradingBand,
+        'Class': Class,
+    }
+
+
+def grade_cohort_exams(exam):
+    """Exams sitting alongside `exam` across the grade's streams of its school: same
+    name/year/term and grade tag."""
+    from .merit_list import cohort_exams
+    tag = exam.grade_level_tag or getattr(exam.klass, 'grade_level', '')
+    return cohort_exams(exam.name, exam.year, exam.term, tag, getattr(exam.klass, 'school_id', None))
+
+
+def grading_bands_for(subject_ids: Iterable[int]) -> Dict[int, List[dict]]:
+    """{subject_id: [{'grade','min','max'}, ...]} sorted by min, falling back to DEFAULT_GRADING_BANDS."""
+    models = _get_models()
+    out: Dict[int, List[dict]] = {}
+    for sid, grade, lo, hi in (
+        models['SubjectGradingBand'].objects
+        .filter(subject_id__in=list(subject_ids))
+        .values_list('subject_id', 'grade', 'min', 'max')
+    ):
+        out.setdefault(sid, []).append({'grade': grade, 'min': lo, 'max': hi})
+    for sid in subject_ids:
+        out[sid] = sorted(out.get(sid) or DEFAULT_GRADING_BANDS, key=lambda b: b['min'])
+    return out
+
+
+def band_counts(values: np.ndarray, bands: List[dict]) -> List[dict]:
+    """Count values per band with searchsorted over the band minimums (bands sorted by min).
+    Values falling in a gap between bands (above a band's max) are not counted.
+    """
+    if not bands:
+        return []
+    mins = np.array([b['min'] for b in bands], dtype=float)
+    # Bands are integer ranges like 70-79; treat each as [min, max + 1) so 79.5 still lands in B
+    maxs = np.array([b['max'] for b in bands], dtype=float) + 1.0
+    maxs[-1] = max(maxs[-1], 100.0 + 1e-9)
+    idx = np.searchsorted(mins, values, side='right') - 1
+    ok = (idx >= 0)
+    ok[ok] &= values[ok] < maxs[idx[ok]]
+    counts = np.bincount(idx[ok], minlength=len(bands))
+    return [
+        {'grade': b['grade'], 'min': b['min'], 'max': b['max'], 'count': int(counts[i])}
+        for i, b in reversed(list(enumerate(bands)))
+    ]
+
+
+def _describe(values: np.ndarray) -> dict:
+    if values.size == 0:
+        return {'count': 0, 'mean': None, 'median': None, 'std': None, 'min': None, 'max': None,
+                'percentiles': {f'p{p}': None for p in PERCENTILES}}
+    pct = np.percentile(values, PERCENTILES)
+    return {
+        'count': int(values.size),
+        'mean': round(float(values.mean()), 2),
+        'median': round(float(np.median(values)), 2),
+        'std': round(float(values.std()), 2),
+        'min': round(float(values.min()), 2),
+        'max': round(float(values.max()), 2),
+        'percentiles': {f'p{p}': round(float(v), 2) for p, v in zip(PERCENTILES, pct)},
+    }
+
+
+def _histogram(values: np.ndarray) -> dict:
+    counts, _ = np.histogram(np.clip(values, 0, 100), bins=HISTOGRAM_EDGES)
+    return {'edges': HISTOGRAM_EDGES.astype(int).tolist(), 'counts': counts.astype(int).tolist()}
+
+
+def _performers(values: np.ndarray, rows: np.ndarray, students: list, top: int):
+    """Top and bottom `top` entries of values; rows index into students."""
+    if values.size == 0 or top <= 0:
+        return [], []
+    order = np.argsort(-values, kind='stable')
+
+    def pack(ix):
+        st = students[rows[ix]]
+        return {'student_id': st['id'], 'name': st['name'], 'klass': st['klass'], 'percentage': round(float(values[ix]), 2)}
+    return [pack(i) for i in order[:top]], [pack(i) for i in order[::-1][:top]]
+
+
+def compute_exam_analytics(exams, top: int = 5) -> dict:
+    """Analytics for one or more exams (e.g. all streams of a grade) from a single results query.
+
+    Each result is converted to a percentage of its component max (else exam total, else 100);
+    a student's subject score is the mean of its component percentages, matching the exam summary.
+    """
+    models = _get_models()
+    exams = list(exams)
+    exam_ids = [e.id for e in exams]
+    rows = list(
+        models['ExamResult'].objects
+        .filter(exam_id__in=exam_ids, subject__is_examinable=True)
+        .values_list('student_id', 'subject_id', 'exam_id', 'marks', 'component__max_marks', 'exam__total_marks')
+    )
+    klass_of_exam = {e.id: e.klass_id for e in exams}
+    class_names = {e.klass_id: getattr(e.klass, 'name', '') for e in exams}
+    base = {
+        'exams': [{'id': e.id, 'name': e.name, 'klass': e.klass_id, 'class_name': class_names.get(e.klass_id, '')} for e in exams],
+        'subjects': [],
+        'overall': None,
+        'by_class': [],
+    }
+    if not rows:
+        base['overall'] = {**_describe(np.empty(0)), 'histogram': _histogram(np.empty(0)), 'top': [], 'bottom': []}
+        return base
+
+    arr = np.array(
+        [(r[0], r[1], r[2], r[3],
+          r[4] if r[4] is not None else (r[5] if r[5] is not None else 100.0)) for r in rows],
+        dtype=float,
+    )
+    student_ids, s_idx = np.unique(arr[:, 0].astype(np.int64), return_inverse=True)
+    subject_ids, j_idx = np.unique(arr[:, 1].astype(np.int64), return_inverse=True)
+    n_s, n_j = len(student_ids), len(subject_ids)
+    denom = arr[:, 4]
+    pct = np.where(denom > 0, arr[:, 3] / np.where(denom > 0, denom, 1.0) * 100.0, np.nan)
+
+    # Mean component percentage and summed marks per (student, subject) cell
+    cell = s_idx * n_j + j_idx
+    valid = ~np.isnan(pct)
+    pct_sum = np.bincount(cell[valid], weights=pct[valid], minlength=n_s * n_j)
+    pct_cnt = np.bincount(cell[valid], minlength=n_s * n_j)
+    marks_sum = np.bincount(cell, weights=arr[:, 3], minlength=n_s * n_j)
+    has = np.bincount(cell, minlength=n_s * n_j) > 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        score = np.where(pct_cnt > 0, pct_sum / pct_cnt, np.nan).reshape(n_s, n_j)
+    marks = np.where(has, marks_sum, np.nan).reshape(n_s, n_j)
+
+    # Student's class: the class of the (first) exam they sat
+    exam_of_student = np.zeros(n_s, dtype=np.int64)
+    exam_of_student[s_idx] = arr[:, 2].astype(np.int64)
+    info = {
+        sid: (name, adm) for sid, name, adm in
+        models['Student'].objects.filter(id__in=student_ids.tolist()).values_list('id', 'name', 'admission_no')
+    }
+    students = []
+    for i, sid in enumerate(student_ids.tolist()):
+        name, adm = info.get(sid, ('', ''))
+        kid = klass_of_exam.get(int(exam_of_student[i]))
+        students.append({'id': sid, 'name': name, 'admission_no': adm, 'klass': kid})
+    student_class = np.array([st['klass'] or 0 for st in students], dtype=np.int64)
+    class_ids = sorted({k for k in klass_of_exam.values()})
+
+    subject_info = {
+        s['id']: s for s in models['Subject'].objects.filter(id__in=subject_ids.tolist()).values('id', 'code', 'name')
+    }
+    bands = grading_bands_for(subject_ids.tolist())
+    for j, sid in enumerate(subject_ids.tolist()):
+        col = score[:, j]
+        present = ~np.isnan(col)
+        vals = col[present]
+        rows_ix = np.nonzero(present)[0]
+        top_list, bottom_list = _performers(vals, rows_ix, students, top)
+        mcol = marks[:, j]
+        by_class = []
+        for kid in class_ids:
+            m = present & (student_class == kid)
+            if m.any():
+                by_class.append({'klass': kid, 'name': class_names.get(kid, ''), 'count': int(m.sum()), 'mean': round(float(col[m].mean()), 2)})
+        base['subjects'].append({
+            'subject': subject_info.get(sid, {'id': sid}),
+            **_describe(vals),
+            'mean_marks': round(float(np.nanmean(mcol)), 2) if present.any() else None,
+            'histogram': _histogram(vals),
+            'bands': band_counts(vals, bands[sid]),
+            'top': top_list,
+            'bottom': bottom_list,
+            'by_class': by_class,
+        })
+
+    # Overall: each student's mean subject percentage
+    sat = ~np.isnan(score)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        overall = np.nansum(score, axis=1) / np.maximum(sat.sum(axis=1), 1)
+    overall = np.where(sat.any(axis=1), overall, np.nan)
+    present = ~np.isnan(overall)
+    top_list, bottom_list = _performers(overall[present], np.nonzero(present)[0], students, top)
+    base['overall'] = {
+        **_describe(overall[present]),
+        'total_marks_mean': round(float(np.nansum(marks, axis=1)[present].mean()), 2) if present.any() else None,
+        'histogram': _histogram(overall[present]),
+        'top': top_list,
+        'bottom': bottom_list,
+    }
+    for kid in class_ids:
+        m = present & (student_class == kid)
+        base['by_class'].append({
+            'klass': kid,
+            'name': class_names.get(kid, ''),
+            **_describe(overall[m]),
+        })
+    return base
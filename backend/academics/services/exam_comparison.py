@@ -0,0 +1,146 @@
+from __future__ import annotations
+from typing import List, Optional
+import numpy as np
+
+
+def _get_models():
+    from academics.models import ExamResult, Student, Subject
+    return {'ExamResult': ExamResult, 'Student': Student, 'Subject': Subject}
+
+
+def _tolist(arr: np.ndarray, digits: int = 2):
+    """Nested lists with NaN mapped to None, for JSON."""
+    if arr.ndim == 1:
+        if digits == 0:
+            return [None if np.isnan(v) else int(round(float(v))) for v in arr]
+        return [None if np.isnan(v) else round(float(v), digits) for v in arr]
+    return [_tolist(row, digits) for row in arr]
+
+
+def _nanmean(arr: np.ndarray, axis: int) -> np.ndarray:
+    cnt = (~np.isnan(arr)).sum(axis=axis)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(cnt > 0, np.nansum(arr, axis=axis) / np.maximum(cnt, 1), np.nan)
+
+
+def _positions(totals: np.ndarray) -> np.ndarray:
+    """Competition rank (1, 2, 2, 4) of each column of a students x exams matrix; NaN stays NaN."""
+    out = np.full(totals.shape, np.nan)
+    for k in range(totals.shape[1]):
+        col = totals[:, k]
+        ok = ~np.isnan(col)
+        vals = np.sort(col[ok])
+        # Rank = 1 + number of strictly greater totals
+        out[ok, k] = 1 + vals.size - np.searchsorted(vals, col[ok], side='right')
+    return out
+
+
+def compare_exam_groups(groups: List[list], labels: Optional[List[str]] = None) -> dict:
+    """Compare N sittings from one results query.
+
+    Each group is a list of exams treated as one column (a single exam, or every stream of a
+    common exam). Columns keep the given order; deltas are against the previous column and
+    between the first and last. A student's column value comes from whichever exam of the
+    group they sat. Subject scores are component-averaged percentages, as in the exam summary.
+    """
+    models = _get_models()
+    # An exam may belong to several columns (overlapping cohorts); its results count in each
+    groups_of_exam = {}
+    for g, exams in enumerate(groups):
+        for e in exams:
+            groups_of_exam.setdefault(e.id, []).append(g)
+    n_e = len(groups)
+    columns = [{
+        'label': (labels[g] if labels and g < len(labels) else (exams[0].name if exams else '')),
+        'exams': [{'id': e.id, 'name': e.name, 'year': e.year, 'term': e.term, 'klass': e.klass_id} for e in exams],
+    } for g, exams in enumerate(groups)]
+    rows = list(
+        models['ExamResult'].objects
+        .filter(exam_id__in=list(groups_of_exam.keys()), subject__is_examinable=True)
+        .values_list('exam_id', 'student_id', 'subject_id', 'marks', 'component__max_marks', 'exam__total_marks')
+    )
+    out = {'columns': columns, 'subjects': [], 'students': {'ids': [], 'names': [], 'admission_nos': []}}
+    if not rows:
+        out.update({
+            'means': {'percentage': [None] * n_e, 'total': [None] * n_e, 'students': [0] * n_e},
+            'subject_means': [], 'subject_deltas': [], 'subject_change': [],
+            'totals': [], 'percentages': [], 'positions': [], 'total_deltas': [], 'percentage_deltas': [],
+            'position_deltas': [], 'change': {'total': [], 'percentage': [], 'position': []},
+        })
+        return out
+
+    arr = np.array(
+        [(g, r[1], r[2], r[3], r[4] if r[4] is not None else (r[5] if r[5] is not None else 100.0))
+         for r in rows for g in groups_of_exam[r[0]]],
+        dtype=float,
+    )
+    g_idx = arr[:, 0].astype(np.int64)
+    student_ids, s_idx = np.unique(arr[:, 1].astype(np.int64), return_inverse=True)
+    subject_ids, j_idx = np.unique(arr[:, 2].astype(np.int64), return_inverse=True)
+    n_s, n_j = len(student_ids), len(subject_ids)
+    marks = arr[:, 3]
+    denom = arr[:, 4]
+    pct = np.where(denom > 0, marks / np.where(denom > 0, denom, 1.0) * 100.0, np.nan)
+
+    # Scatter into (student, column, subject) cells with bincount; cost is linear in result rows
+    size = n_s * n_e * n_j
+    cell = (s_idx * n_e + g_idx) * n_j + j_idx
+    valid = ~np.isnan(pct)
+    pct_sum = np.bincount(cell[valid], weights=pct[valid], minlength=size)
+    pct_cnt = np.bincount(cell[valid], minlength=size)
+    has = np.bincount(cell, minlength=size) > 0
+    marks_sum = np.bincount(cell, weights=marks, minlength=size)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        score = np.where(pct_cnt > 0, pct_sum / np.maximum(pct_cnt, 1), np.nan).reshape(n_s, n_e, n_j)
+    sat = has.reshape(n_s, n_e, n_j)
+    total = np.where(sat.any(axis=2), np.where(sat, marks_sum.reshape(n_s, n_e, n_j), 0).sum(axis=2), np.nan)
+
+    student_pct = _nanmean(score, axis=2)          # students x columns
+    positions = _positions(total)
+    subject_means = _nanmean(score, axis=0)        # columns x subjects
+
+    info = {
+        sid: (name, adm) for sid, name, adm in
+        models['Student'].objects.filter(id__in=student_ids.tolist()).values_list('id', 'name', 'admission_no')
+    }
+    subjects = {
+        s['id']: s for s in models['Subject'].objects.filter(id__in=subject_ids.tolist()).values('id', 'code', 'name')
+    }
+    order = np.argsort([(info.get(sid, ('', ''))[0] or '').lower() for sid in student_ids.tolist()], kind='stable')
+    student_ids, total, student_pct, positions = student_ids[order], total[order], student_pct[order], positions[order]
+
+    def first_last(m):
+        """Per row: last non-missing value minus first non-missing value."""
+        ok = ~np.isnan(m)
+        first = np.argmax(ok, axis=1)
+        last = m.shape[1] - 1 - np.argmax(ok[:, ::-1], axis=1)
+        rows_ix = np.arange(m.shape[0])
+        return np.where(ok.sum(axis=1) >= 2, m[rows_ix, last] - m[rows_ix, first], np.nan)
+
+    out['subjects'] = [subjects.get(sid, {'id': sid}) for sid in subject_ids.tolist()]
+    out['students'] = {
+        'ids': student_ids.tolist(),
+        'names': [info.get(sid, ('', ''))[0] for sid in student_ids.tolist()],
+        'admission_nos': [info.get(sid, ('', ''))[1] for sid in student_ids.tolist()],
+    }
+    out['means'] = {
+        'percentage': _tolist(_nanmean(student_pct, axis=0)),
+        'total': _tolist(_nanmean(total, axis=0)),
+        'students': (~np.isnan(total)).sum(axis=0).astype(int).tolist(),
+    }
+    out['subject_means'] = _tolist(subject_means)                          # columns x subjects
+    out['subject_deltas'] = _tolist(np.diff(subject_means, axis=0)) if n_e > 1 else []
+    out['subject_change'] = _tolist(first_last(subject_means.T))           # per subject
+    out['totals'] = _tolist(total)                                         # students x columns
+    out['percentages'] = _tolist(student_pct)
+    out['positions'] = _tolist(positions, 0)
+    out['total_deltas'] = _tolist(np.diff(total, axis=1)) if n_e > 1 else []
+    out['percentage_deltas'] = _tolist(np.diff(student_pct, axis=1)) if n_e > 1 else []
+    # Positive position delta means the student moved up
+    out['position_deltas'] = _tolist(-np.diff(positions, axis=1), 0) if n_e > 1 else []
+    out['change'] = {
+        'total': _tolist(first_last(total)),
+        'percentage': _tolist(first_last(student_pct)),
+        'position': _tolist(-first_last(positions), 0),
+    }
+    return out
@@ -0,0 +1,314 @@
+from __future__ import annotations
+import hashlib
+import json
+import re
+from io import BytesIO, StringIO
+from typing import Optional
+
+from django.core.cache import cache
+
+# Marks upload is two-phase: the preview parses the file once (CSV/XLSX, or OCR for images)
+# and keeps the extracted rows under an upload token; the commit sends the token instead of
+# the file. Tokens are derived from the file content and column map, so re-uploading the same
+# file also skips the parse while the entry is alive. Images go through the OCR process pool
+# (services/ocr.py): the first preview returns a job to poll instead of blocking.
+# Entries live in the Django cache, which settings.CACHES shares between workers, so the commit
+# may land on a different worker than the preview. A commit whose token has expired can still
+# send the file again.
+
+UPLOAD_TTL = 60 * 30
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.webp', '.tif', '.tiff')
+
+
+class UploadParseError(Exception):
+    def __init__(self, detail: str, status: int = 400, hint: Optional[str] = None):
+        super().__init__(detail)
+        self.detail = detail
+        self.status = status
+        self.hint = hint
+
+    def as_response_data(self) -> dict:
+        data = {'detail': self.detail}
+        if self.hint:
+            data['hint'] = self.hint
+        return data
+
+
+def _resolve_columns(header, column_map):
+    """Pick the student_id/admission_no/name/marks columns from a header row."""
+    hmap = {str(k).strip().lower(): k for k in header}
+
+    def pick(*cands):
+        for c in cands:
+            if c in hmap:
+                return hmap[c]
+        return None
+    if column_map and isinstance(column_map, dict):
+        id_col = column_map.get('student_id')
+        adm_col = column_map.get('admission_no')
+        name_col = column_map.get('name')
+        marks_col = column_map.get('marks')
+    else:
+        id_col = pick('student_id', 'id')
+        adm_col = pick('admission_no', 'adm', 'adm_no', 'admission')
+        name_col = pick('name', 'student', 'student_name')
+        marks_col = pick('marks', 'score', 'points')
+    return id_col, adm_col, name_col, marks_col
+
+
+def _parse_csv(raw: bytes, column_map) -> list:
+    # Robust CSV handling: try utf-8-sig, fall back to utf-8/latin1, sniff delimiter
+    try:
+        text = raw.decode('utf-8-sig')
+    except Exception:
+        try:
+            text = raw.decode('utf-8')
+        except Exception:
+            text = raw.decode('latin1', errors='ignore')
+    import csv as _csv
+    try:
+        sniffer = _csv.Sniffer()
+        dialect = sniffer.sniff(text[:4096])
+        delim = dialect.delimiter
+    except Exception:
+        # Common alternates if sniff fails
+        if '\t' in text and text.count('\t') > text.count(','):
+            delim = '\t'
+        elif ';' in text and text.count(';') > text.count(','):
+            delim = ';'
+        else:
+            delim = ','
+    reader = _csv.DictReader(StringIO(text), delimiter=delim)
+    id_col, adm_col, name_col, marks_col = _resolve_columns(reader.fieldnames or [], column_map)
+    rows = []
+    for r in reader:
+        rows.append({
+            'student_id': r.get(id_col) if id_col else None,
+            'admission_no': r.get(adm_col) if adm_col else None,
+            'name': r.get(name_col) if name_col else None,
+            'marks': r.get(marks_col) if marks_col else None,
+        })
+    return rows
+
+
+def _parse_excel(raw: bytes, column_map) -> list:
+    try:
+        from openpyxl import load_workbook
+    except Exception:
+        raise UploadParseError('openpyxl is required to parse Excel files. Please install it on the server.', status=500)
+    wb = load_workbook(BytesIO(raw), read_only=True, data_only=True)
+    ws = wb.active
+    header = []
+    rows = []
+    id_col = adm_col = name_col = marks_col = None
+    for i, row in enumerate(ws.iter_rows(values_only=True), start=1):
+        if i == 1:
+            header = [str(c).strip() if c is not None else '' for c in row]
+            id_col, adm_col, name_col, marks_col = _resolve_columns(header, column_map)
+            continue
+        values = list(row)
+
+        def get(col_name):
+            if not col_name or col_name not in header:
+                return None
+            idx = header.index(col_name)
+            return values[idx] if idx < len(values) else None
+        rows.append({
+            'student_id': get(id_col),
+            'admission_no': get(adm_col),
+            'name': get(name_col),
+            'marks': get(marks_col),
+        })
+    return rows
+
+
+def _looks_like_admission(token: str) -> bool:
+    # simple heuristic: contains letters+digits
+    return any(c.isalpha() for c in token) and any(c.isdigit() for c in token)
+
+
+def parse_ocr_lines(text: str):
+    """Extract {student_id, admission_no, name, marks} rows from OCR text.
+    Strategy per non-empty line:
+      1) CSV/TSV-like: id,name,marks OR admission,name,marks
+      2) Free text with last number as marks: <anything name> <number>
+      3) Hyphen/colon separated: name - number, name: number
+    Returns (rows, raw_lines).
+    """
+    rows, raw_lines = [], []
+    number_re = re.compile(r"(?P<marks>\d+(?:\.\d+)?)\s*$")
+    # Common separators: commas, tabs, multiple spaces, dashes, colons
+    sep_re = re.compile(r"[,\t]|\s{2,}|\s-\s|\s–\s|\s—\s|:\s")
+    for raw in text.splitlines():
+        line = str(raw or '').strip()
+        if not line:
+            continue
+        raw_lines.append(line)
+        # Try CSV/TSV or obvious separators first
+        parts = [p.strip() for p in sep_re.split(line) if str(p).strip()]
+        sid = None; adm = None; nm = None; mk = None
+        if len(parts) >= 2 and parts[-1].replace('.', '', 1).isdigit():
+            mk = parts[-1]
+            # Reconstruct a plausible name from remaining parts, ignoring an initial numeric id
+            rest = parts[:-1]
+            if rest and str(rest[0]).isdigit():
+                sid = rest[0]
+                if len(rest) >= 2 and _looks_like_admission(rest[1]):
+                    adm = rest[1]
+                    nm = ' '.join(rest[2:])
+                else:
+                    nm = ' '.join(rest[1:])
+            elif rest and _looks_like_admission(rest[0]):
+                adm = rest[0]
+                nm = ' '.join(rest[1:])
+            else:
+                nm = ' '.join(rest)
+        # If still no marks, fallback: find trailing number with regex
+        if mk is None:
+            m = number_re.search(line)
+            if m:
+                mk = m.group('marks')
+                pre = line[:m.start()].strip()
+                # Tokenize on whitespace to extract id/admission/name
+                toks = [t for t in pre.split() if t]
+                if toks:
+                    if toks[0].isdigit():
+                        # Case A: first token numeric -> student_id
+                        sid = toks[0]
+                        rest = toks[1:]
+                        if rest and _looks_like_admission(rest[0]):
+                            adm = rest[0]
+                            nm = ' '.join(rest[1:])
+                        else:
+                            nm = ' '.join(rest)
+                    elif _looks_like_admission(toks[0]):
+                        # Case B: start with admission then name
+                        adm = toks[0]
+                        nm = ' '.join(toks[1:])
+                    else:
+                        # Case C: just name before number
+                        nm = pre
+        # Append if we extracted at least a name or id and marks
+        if mk is not None and (nm or adm or sid):
+            rows.append({'student_id': sid, 'admission_no': adm, 'name': nm, 'marks': mk})
+    return rows, raw_lines
+
+
+class OcrPending(Exception):
+    """The image is being read by the OCR pool; poll the job, then preview again."""
+
+    def __init__(self, job: dict):
+        super().__init__('OCR in progress')
+        self.job = job
+
+
+def is_image(filename: str) -> bool:
+    return (filename or '').lower().endswith(IMAGE_EXTENSIONS)
+
+
+def parse_marks_file(filename: str, raw: bytes, column_map=None) -> dict:
+    """Parse a CSV/XLSX marks file into {'rows', 'ocr_text', 'ocr_lines'}; raises UploadParseError."""
+    fname = (filename or 'upload').lower()
+    if fname.endswith('.csv'):
+        return {'rows': _parse_csv(raw, column_map), 'ocr_text': None, 'ocr_lines': []}
+    if fname.endswith('.xlsx') or fname.endswith('.xls'):
+        return {'rows': _parse_excel(raw, column_map), 'ocr_text': None, 'ocr_lines': []}
+    raise UploadParseError('Unsupported file type. Use CSV, XLSX/XLS, or an image.')
+
+
+def parsed_from_ocr_text(text: str) -> dict:
+    rows, lines = parse_ocr_lines(text)
+    return {'rows': rows, 'ocr_text': text, 'ocr_lines': lines}
+
+
+# ===== Upload tokens =====
+
+def _cache_key(user_id, token: str) -> str:
+    # Tokens are per user: parsed rows carry student names
+    return f"academics:marks_upload:{user_id}:{token}"
+
+
+def upload_token_for(filename: str, digest: str, column_map=None) -> str:
+    h = hashlib.sha256(digest.encode())
+    h.update(b'\0' + (filename or '').lower().rsplit('.', 1)[-1].encode())
+    h.update(b'\0' + json.dumps(column_map or {}, sort_keys=True, default=str).encode())
+    return h.hexdigest()[:40]
+
+
+def _store(user_id, token: str, parsed: dict) -> None:
+    cache.set(_cache_key(user_id, token), parsed, UPLOAD_TTL)  # (re)start the TTL on every preview
+
+
+def parse_upload_cached(user_id, filename: str, raw: bytes, column_map=None):
+    """(token, parsed) for the file, parsing only when no live entry exists for its content.
+    Images are read by the OCR pool; until their text is available this raises OcrPending.
+    """
+    from . import ocr
+    digest = ocr.image_digest(raw)
+    token = upload_token_for(filename, digest, column_map)
+    parsed = cache.get(_cache_key(user_id, token))
+    if parsed is None:
+        if is_image(filename):
+            text = ocr.cached_text(digest)
+            if text is None:
+                try:
+                    raise OcrPending(ocr.submit(raw, user_id=user_id, filename=filename))
+                except ocr.OcrUnavailable as e:
+                    raise UploadParseError(str(e), status=500)
+            parsed = parsed_from_ocr_text(text)
+        else:
+            parsed = parse_marks_file(filename, raw, column_map)
+        parsed['filename'] = filename
+    _store(user_id, token, parsed)
+    return token, parsed
+
+
+def parse_ocr_job(user_id, job: dict, column_map=None):
+    """(token, parsed) for a finished OCR job, as if its image had been uploaded again."""
+    from . import ocr
+    text = ocr.cached_text(job['digest'])
+    if text is None:
+        raise UploadParseError('OCR result expired. Please upload the image again.')
+    token = upload_token_for(job.get('filename') or 'image.png', job['digest'], column_map)
+    parsed = parsed_from_ocr_text(text)
+    parsed['filename'] = job.get('filename')
+    _store(user_id, token, parsed)
+    return token, parsed
+
+
+def get_parsed_upload(user_id, token: str) -> Optional[dict]:
+    if not token:
+        return None
+    return cache.get(_cache_key(user_id, str(token)))
+
+
+def discard_upload(user_id, token: str) -> None:
+    cache.delete(_cache_key(user_id, str(token)))
+
+
+def apply_row_overrides(rows: list, overrides) -> list:
+    """Apply commit-time corrections to parsed rows.
+    overrides: [{"index": i, "student": id?, "marks": value?, "skip": bool?}, ...]
+    A "student" override is matched by id (first matching rule); "skip" drops the row.
+    """
+    rows = [dict(r) for r in rows]
+    skipped = set()
+    for o in overrides or []:
+        if not isinstance(o, dict):
+            continue
+        try:
+            i = int(o.get('index'))
+        except (TypeError, ValueError):
+            continue
+        if not 0 <= i < len(rows):
+            continue
+        if o.get('skip'):
+            skipped.add(i)
+            continue
+        if o.get('student') not in (None, ''):
+            rows[i]['student_id'] = o['student']
+        if 'marks' in o:
+            rows[i]['marks'] = o['marks']
+    for i in skipped:
+        rows[i] = None
+    return rows
@@ -0,0 +1,146 @@
+from __future__ import annotations
+import hashlib
+from typing import Dict, List, Optional
+from django.core.cache import cache
+from django.db.models import Q, Sum
+
+from .results_cache import school_results_token
+
+CACHE_TTL = 600
+
+
+def _get_models():
+    from academics.models import Class, Exam, ExamResult, Student, Subject
+    return {'Class': Class, 'Exam': Exam, 'ExamResult': ExamResult, 'Student': Student, 'Subject': Subject}
+
+
+def cohort_exams(name: str, year, term, grade_level_tag: str, school_id=None):
+    """All streams' copies of a common exam: same name/year/term and grade tag.
+    Exams created before grade tags existed fall back to their class's grade_level.
+    """
+    models = _get_models()
+    grade = models['Class'].format_grade_level(grade_level_tag) if grade_level_tag else ''
+    qs = models['Exam'].objects.filter(name__iexact=name, year=year, term=term)
+    if grade:
+        missing_tag = Q(grade_level_tag__isnull=True) | Q(grade_level_tag='')
+        qs = qs.filter(Q(grade_level_tag=grade) | (missing_tag & Q(klass__grade_level=grade)))
+    if school_id:
+        qs = qs.filter(klass__school_id=school_id)
+    return qs.select_related('klass', 'klass__stream')
+
+
+def _assign_positions(entries: List[dict], key: str, field: str) -> None:
+    """Competition ranking (1, 2, 2, 4) on entries already sorted by `field` descending."""
+    position = 0
+    last = None
+    for idx, e in enumerate(entries, start=1):
+        if last is None or e[field] < last:
+            position = idx
+            last = e[field]
+        e[key] = position
+
+
+def build_merit_list(exams) -> dict:
+    """Merit list across the given exams (typically every stream of a grade) from one grouped query.
+    Each student's total is the sum of their examinable subject marks; average is total / subjects sat.
+    Returns {'exams', 'subjects', 'students', 'streams', 'subject_means', 'grade_mean'} where students
+    are sorted by total with 'position' (grade) and 'stream_position'.
+    """
+    models = _get_models()
+    exams = list(exams)
+    exam_class = {e.id: e.klass_id for e in exams}
+    classes = {e.klass_id: e.klass for e in exams}
+    rows = (
+        models['ExamResult'].objects
+        .filter(exam_id__in=list(exam_class.keys()), subject__is_examinable=True)
+        .values('student_id', 'exam_id', 'subject_id')
+        .annotate(marks=Sum('marks'))
+    )
+    per_student: Dict[int, dict] = {}
+    subject_ids = set()
+    for r in rows:
+        sid = r['student_id']
+        subject_ids.add(r['subject_id'])
+        e = per_student.setdefault(sid, {'id': sid, 'klass': exam_class.get(r['exam_id']), 'exam': r['exam_id'], 'marks': {}, 'total': 0.0})
+        m = float(r['marks'] or 0)
+        e['marks'][str(r['subject_id'])] = round(e['marks'].get(str(r['subject_id']), 0.0) + m, 2)
+        e['total'] += m
+
+    info = {
+        s[0]: s[1:] for s in models['Student'].objects.filter(id__in=list(per_student.keys())).values_list('id', 'name', 'admission_no')
+    }
+    students = []
+    for sid, e in per_student.items():
+        name, adm = info.get(sid, ('', ''))
+        k = classes.get(e['klass'])
+        students.append({
+            'id': sid,
+            'name': name,
+            'admission_no': adm,
+            'klass': e['klass'],
+            'stream': getattr(getattr(k, 'stream', None), 'name', ''),
+            'exam': e['exam'],
+            'total': round(e['total'], 2),
+            'average': round(e['total'] / len(e['marks']), 2) if e['marks'] else 0.0,
+            'marks': e['marks'],
+        })
+    students.sort(key=lambda x: (-x['total'], (x['name'] or '').lower()))
+    _assign_positions(students, 'position', 'total')
+    by_stream: Dict[int, List[dict]] = {}
+    for st in students:
+        by_stream.setdefault(st['klass'], []).append(st)
+    for members in by_stream.values():
+        _assign_positions(members, 'stream_position', 'total')
+
+    subjects = list(
+        models['Subject'].objects.filter(id__in=subject_ids).order_by('name', 'code').values('id', 'code', 'name')
+    )
+
+    def subject_means(members):
+        out = []
+        for s in subjects:
+            vals = [m['marks'][str(s['id'])] for m in members if str(s['id']) in m['marks']]
+            out.append({'subject': s['id'], 'mean': round(sum(vals) / len(vals), 2) if vals else None, 'count': len(vals)})
+        return out
+
+    streams = []
+    for kid, k in sorted(classes.items(), key=lambda kv: getattr(getattr(kv[1], 'stream', None), 'name', '')):
+        members = by_stream.get(kid, [])
+        streams.append({
+            'klass': kid,
+            'name': getattr(k, 'name', ''),
+            'stream': getattr(getattr(k, 'stream', None), 'name', ''),
+            'students': len(members),
+            'mean_total': round(sum(m['total'] for m in members) / len(members), 2) if members else None,
+            'mean_average': round(sum(m['average'] for m in members) / len(members), 2) if members else None,
+            'best_position': min((m['position'] for m in members), default=None),
+            'subject_means': subject_means(members),
+        })
+    ranked = sorted([s for s in streams if s['mean_total'] is not None], key=lambda s: -s['mean_total'])
+    _assign_positions(ranked, 'rank', 'mean_total')
+
+    return {
+        'exams': [{'id': e.id, 'klass': e.klass_id, 'name': e.name} for e in exams],
+        'subjects': subjects,
+        'students': students,
+        'streams': streams,
+        'subject_means': subject_means(students),
+        'grade_mean': round(sum(s['average'] for s in students) / len(students), 2) if students else 0.0,
+    }
+
+
+def grade_merit_list(name: str, year, term, grade_level_tag: str, school_id=None) -> dict:
+    """Cached merit list for a common exam; recomputed after any results write in the school."""
+    ident = hashlib.md5(f"{str(name).lower()}|{year}|{term}|{grade_level_tag}".encode()).hexdigest()
+    key = f"academics:merit:{school_id}:{ident}:{school_results_token(school_id)}"
+    data = cache.get(key)
+    if data is None:
+        data = build_merit_list(cohort_exams(name, year, term, grade_level_tag, school_id))
+        cache.set(key, data, CACHE_TTL)
+    return data
+
+
+def merit_list_for_exam(exam, school_id: Optional[int] = None) -> dict:
+    """Merit list of the grade cohort that `exam` belongs to."""
+    tag = exam.grade_level_tag or getattr(exam.klass, 'grade_level', '')
+    return grade_merit_list(exam.name, exam.year, exam.term, tag, school_id or getattr(exam.klass, 'school_id', None))
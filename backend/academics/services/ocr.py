@@ -0,0 +1,183 @@
+from __future__ import annotations
+import hashlib
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .ocr_worker import run_ocr
+
+logger = logging.getLogger(__name__)
+
+# OCR jobs run in a small process pool so a slow photo never pins a request worker.
+# Job state and OCR text live in the Django cache, which settings.CACHES shares between web
+# processes, so status polls find jobs started by another process. A worker crash breaks the
+# whole pool; the broken pool is dropped and the next submit starts a fresh one.
+
+TEXT_TTL = 60 * 60 * 24
+JOB_TTL = 60 * 60
+
+_LOCK = threading.Lock()
+_EXECUTOR: Optional[ProcessPoolExecutor] = None
+_PENDING = 0
+
+
+class OcrUnavailable(Exception):
+    pass
+
+
+class OcrBusy(Exception):
+    pass
+
+
+def _executor() -> ProcessPoolExecutor:
+    global _EXECUTOR
+    with _LOCK:
+        if _EXECUTOR is None:
+            # spawn: forking a threaded web worker is unsafe
+            _EXECUTOR = ProcessPoolExecutor(
+                max_workers=max(1, getattr(settings, 'OCR_MAX_WORKERS', 2)),
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+        return _EXECUTOR
+
+
+def _drop_executor(broken: ProcessPoolExecutor) -> None:
+    """Forget a broken pool (unless it was already replaced) so _executor() starts a new one."""
+    global _EXECUTOR
+    with _LOCK:
+        if _EXECUTOR is broken:
+            _EXECUTOR = None
+    broken.shutdown(wait=False, cancel_futures=True)
+
+
+def image_digest(raw: bytes) -> str:
+    return hashlib.sha256(raw).hexdigest()
+
+
+def _text_key(digest: str) -> str:
+    return f"academics:ocr_text:{digest}"
+
+
+def _job_key(job_id: str) -> str:
+    return f"academics:ocr_job:{job_id}"
+
+
+def _inflight_key(digest: str) -> str:
+    return f"academics:ocr_inflight:{digest}"
+
+
+def cached_text(digest: str) -> Optional[str]:
+    return cache.get(_text_key(digest))
+
+
+def get_job(job_id: str) -> Optional[dict]:
+    job = cache.get(_job_key(job_id)) if job_id else None
+    if job and job['status'] in ('queued', 'running'):
+        # A job whose worker died never reports back; fail it once well past its timeout
+        limit = getattr(settings, 'OCR_TIMEOUT', 30) * 3 + 60
+        if time.time() - job['submitted_at'] > limit:
+            job.update({'status': 'failed', 'error': 'OCR job did not finish in time'})
+            _save_job(job)
+    return job
+
+
+def _save_job(job: dict) -> None:
+    cache.set(_job_key(job['id']), job, JOB_TTL)
+
+
+def job_payload(job: dict) -> dict:
+    return {
+        'ocr_job': job['id'],
+        'status': job['status'],
+        'error': job.get('error'),
+        'hint': job.get('hint'),
+        'status_url': f"/api/academics/exam_results/ocr-jobs/{job['id']}/",
+    }
+
+
+def _finish(job_id: str, digest: str, executor: ProcessPoolExecutor, future) -> None:
+    global _PENDING
+    with _LOCK:
+        _PENDING = max(0, _PENDING - 1)
+    job = cache.get(_job_key(job_id)) or {'id': job_id, 'digest': digest, 'submitted_at': time.time()}
+    try:
+        text = future.result()
+        cache.set(_text_key(digest), text, TEXT_TTL)
+        job.update({'status': 'done', 'error': None})
+    except Exception as ex:
+        if isinstance(ex, BrokenProcessPool):
+            _drop_executor(executor)
+        msg = str(ex)
+        job.update({'status': 'failed', 'error': f'OCR failed: {msg}'})
+        if 'timeout' in msg.lower():
+            job['error'] = 'OCR timed out; try a smaller or clearer image'
+        elif 'tesseract' in msg.lower() and 'not installed' in msg.lower():
+            job['hint'] = 'Tesseract is not installed or not on PATH. Install Tesseract OCR and, if needed, set env var TESSERACT_CMD to the tesseract.exe full path.'
+        logger.warning("OCR job %s failed: %s", job_id, msg)
+    finally:
+        cache.delete(_inflight_key(digest))
+        _save_job(job)
+
+
+def submit(raw: bytes, user_id=None, filename: str = '') -> dict:
+    """Queue OCR for an image and return its job. Identical images share one job while it
+    runs, and images already read are returned as done without queueing.
+    """
+    try:
+        import PIL  # noqa: F401
+        import pytesseract  # noqa: F401
+    except Exception:
+        raise OcrUnavailable('OCR not available. Install pytesseract and the Tesseract OCR binary to read images.')
+    global _PENDING
+    digest = image_digest(raw)
+    job = {
+        'id': uuid.uuid4().hex, 'digest': digest, 'user_id': user_id, 'filename': filename,
+        'status': 'queued', 'error': None, 'hint': None, 'submitted_at': time.time(),
+    }
+    if cached_text(digest) is not None:
+        job['status'] = 'done'
+        _save_job(job)
+        return job
+    running = get_job(cache.get(_inflight_key(digest)))
+    if running and running['status'] in ('queued', 'running') and running.get('user_id') == user_id:
+        return running
+    with _LOCK:
+        if _PENDING >= getattr(settings, 'OCR_MAX_PENDING', 8):
+            raise OcrBusy('OCR is busy; please try again shortly')
+        _PENDING += 1
+    # Saved before submitting: a fast job may finish (and save 'done') before submit() returns
+    job['status'] = 'running'
+    _save_job(job)
+    cache.set(_inflight_key(digest), job['id'], JOB_TTL)
+    tesseract_cmd = os.environ.get('TESSERACT_CMD') or os.environ.get('TESSERACT_PATH') or ''
+    args = (run_ocr, raw, tesseract_cmd, getattr(settings, 'OCR_TIMEOUT', 30))
+    executor = None
+    try:
+        executor = _executor()
+        try:
+            future = executor.submit(*args)
+        except BrokenProcessPool:
+            # Broken by an earlier crash that no job has reported yet: retry on a fresh pool
+            _drop_executor(executor)
+            executor = _executor()
+            future = executor.submit(*args)
+    except Exception as ex:
+        with _LOCK:
+            _PENDING = max(0, _PENDING - 1)
+        if isinstance(ex, BrokenProcessPool) and executor is not None:
+            _drop_executor(executor)
+        cache.delete(_inflight_key(digest))
+        job.update({'status': 'failed', 'error': f'OCR failed: {ex}'})
+        _save_job(job)
+        raise
+    future.add_done_callback(lambda f: _finish(job['id'], digest, executor, f))
+    return job
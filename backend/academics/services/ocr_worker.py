@@ -0,0 +1,87 @@
+from __future__ import annotations
+from io import BytesIO
+
+# Runs inside the OCR process pool (spawned interpreters), so this module must not touch
+# Django settings, models or the cache; academics.services.ocr handles all of that.
+
+MAX_SIDE = 2500           # downscale large phone photos before OCR
+MIN_WIDTH = 1600          # upscale small screenshots
+DESKEW_MAX_ANGLE = 5.0
+DESKEW_STEP = 0.5
+
+
+def _otsu_threshold(arr) -> int:
+    import numpy as np
+    hist = np.bincount(arr.ravel(), minlength=256).astype(float)
+    total = arr.size
+    levels = np.arange(256)
+    w0 = np.cumsum(hist)
+    w1 = total - w0
+    mu0 = np.cumsum(hist * levels)
+    mu_t = mu0[-1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        between = (mu_t * w0 / total - mu0) ** 2 / (w0 * w1)
+    between[~np.isfinite(between)] = 0
+    return int(np.argmax(between))
+
+
+def _skew_angle(img) -> float:
+    """Angle (degrees) that best aligns text rows, found by maximising the variance of the
+    horizontal projection profile of a small binarized copy.
+    """
+    import numpy as np
+    from PIL import Image
+    small = img.copy()
+    small.thumbnail((800, 800))
+    arr = np.asarray(small, dtype=np.uint8)
+    ink = Image.fromarray(((arr < _otsu_threshold(arr)) * 255).astype(np.uint8))
+    best_angle, best_score = 0.0, -1.0
+    for angle in np.arange(-DESKEW_MAX_ANGLE, DESKEW_MAX_ANGLE + 1e-9, DESKEW_STEP):
+        rotated = np.asarray(ink.rotate(float(angle), resample=Image.NEAREST, expand=False), dtype=float)
+        score = float(rotated.sum(axis=1).var())
+        if score > best_score:
+            best_angle, best_score = float(angle), score
+    return best_angle
+
+
+def preprocess(img):
+    """Grayscale, resize, autocontrast, deskew and binarize an image for Tesseract."""
+    import numpy as np
+    from PIL import Image, ImageOps
+    img = ImageOps.exif_transpose(img)
+    img = img.convert('L')
+    if max(img.size) > MAX_SIDE:
+        img.thumbnail((MAX_SIDE, MAX_SIDE), Image.LANCZOS)
+    elif img.width < MIN_WIDTH:
+        scale = MIN_WIDTH / float(img.width)
+        img = img.resize((int(img.width * scale), int(img.height * scale)), Image.LANCZOS)
+    img = ImageOps.autocontrast(img)
+    angle = _skew_angle(img)
+    if abs(angle) >= DESKEW_STEP:
+        img = img.rotate(angle, resample=Image.BICUBIC, expand=True, fillcolor=255)
+    arr = np.asarray(img, dtype=np.uint8)
+    threshold = _otsu_threshold(arr)
+    return Image.fromarray(((arr > threshold) * 255).astype(np.uint8))
+
+
+def run_ocr(raw: bytes, tesseract_cmd: str = '', timeout: int = 30) -> str:
+    """OCR one image; raises RuntimeError when Tesseract exceeds the timeout."""
+    from PIL import Image
+    import pytesseract
+    if tesseract_cmd:
+        pytesseract.pytesseract.tesseract_cmd = tesseract_cmd
+    img = preprocess(Image.open(BytesIO(raw)))
+    config = '--oem 3 --psm 6'
+    text = pytesseract.image_to_string(img, lang='eng', config=config, timeout=timeout)
+    if not text or not text.strip():
+        # Fallback: reconstruct lines from word-level data
+        data = pytesseract.image_to_data(img, lang='eng', config=config, output_type=pytesseract.Output.DICT, timeout=timeout)
+        lines = {}
+        for i in range(len(data.get('text', []))):
+            word = str(data['text'][i] or '').strip()
+            if not word:
+                continue
+            key = (data.get('block_num', [0])[i], data.get('par_num', [0])[i], data.get('line_num', [0])[i])
+            lines.setdefault(key, []).append(word)
+        text = '\n'.join(' '.join(words) for _, words in sorted(lines.items()))
+    return text or ''
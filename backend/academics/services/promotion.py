@@ -0,0 +1,257 @@
+from __future__ import annotations
+import logging
+import re
+from typing import Dict, List, Optional, Tuple
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+# Highest grade in the school; classes at this level graduate instead of being promoted
+GRADUATING_GRADE = 9
+
+
+def _get_models():
+    from academics.models import Class, Student, Stream
+    from finance.models import Invoice, Payment
+    return {
+        'Class': Class,
+        'Student': Student,
+        'Stream': Stream,
+        'Invoice': Invoice,
+        'Payment': Payment,
+    }
+
+
+def _grade_number(grade_level) -> Optional[int]:
+    """Extract the numeric grade from a grade label ('Grade 4', '4', 'G4'). None if absent."""
+    from academics.models import Class
+    current = Class.format_grade_level(grade_level)
+    m_named = re.search(r'\bgrade\s*(\d{1,2})\b', current, flags=re.IGNORECASE)
+    match = m_named if m_named else re.search(r'\b(\d{1,2})\b', current)
+    if not match:
+        return None
+    try:
+        return int(match.group(1) if match.lastindex else match.group())
+    except Exception:
+        return None
+
+
+def _graduation_year(academic_year) -> Optional[int]:
+    try:
+        if getattr(academic_year, 'end_date', None):
+            return int(academic_year.end_date.year)
+        # Fallback: parse label like "2024/2025" -> 2025
+        parts = [int(p) for p in re.findall(r'\d{4}', str(getattr(academic_year, 'label', '')))]
+        return parts[-1] if parts else None
+    except Exception:
+        return None
+
+
+def _outstanding_balances(class_ids: List[int]) -> Dict[int, float]:
+    """Return {student_id: balance} for students in the given classes with a positive balance.
+    Billed and paid totals are computed as correlated subqueries in a single statement so
+    invoices and payments do not multiply each other.
+    """
+    if not class_ids:
+        return {}
+    from django.db.models import Sum, F, Value, DecimalField, OuterRef, Subquery
+    from django.db.models.functions import Coalesce
+    models = _get_models()
+    billed_sq = (
+        models['Invoice'].objects
+        .filter(student_id=OuterRef('pk'))
+        .values('student_id')
+        .annotate(s=Sum('amount'))
+        .values('s')[:1]
+    )
+    paid_sq = (
+        models['Payment'].objects
+        .filter(invoice__student_id=OuterRef('pk'))
+        .values('invoice__student_id')
+        .annotate(s=Sum('amount'))
+        .values('s')[:1]
+    )
+    zero = Value(0, output_field=DecimalField(max_digits=12, decimal_places=2))
+    rows = (
+        models['Student'].objects
+        .filter(klass_id__in=class_ids)
+        .annotate(billed=Coalesce(Subquery(billed_sq), zero), paid=Coalesce(Subquery(paid_sq), zero))
+        .annotate(balance=F('billed') - F('paid'))
+        .filter(balance__gt=0)
+        .values_list('id', 'balance')
+    )
+    return {sid: float(bal or 0) for sid, bal in rows}
+
+
+def build_promotion_plan(academic_year) -> dict:
+    """Compute the full promotion for a school without writing anything.
+
+    Classes are walked per stream from the highest grade down, so a student only ever
+    moves one grade even when several consecutive classes exist. Grade 9 students graduate
+    unless they still owe fees. A lower class moves its students (and class teacher) into
+    the next-grade class when one exists; otherwise the class itself is renamed in place.
+
+    The returned dict carries the public summary under 'summary' and the operations
+    to execute under 'ops'.
+    """
+    from django.db.models import Count
+    models = _get_models()
+    Class = models['Class']
+    Student = models['Student']
+    school = academic_year.school
+    summary = {
+        'school_id': getattr(school, 'id', None),
+        'label': getattr(academic_year, 'label', None),
+        'graduated_classes': [],
+        'moved_classes': [],  # moved to existing target
+        'renamed_classes': [],  # in-place rename
+        'skipped': [],  # classes skipped with reason
+        'not_cleared': [],  # graduating students held back by fee balance
+    }
+    ops = {
+        'graduate': [],  # (class_id, [student_ids])
+        'move': [],  # (from_class_id, to_class_id, teacher_id)
+        'rename': [],  # (class_id, grade_level, name)
+        'graduation_year': _graduation_year(academic_year),
+    }
+
+    classes = list(Class.objects.filter(school=school).select_related('stream'))
+    counts = dict(
+        Student.objects.filter(klass__school=school)
+        .values_list('klass_id')
+        .annotate(n=Count('id'))
+    )
+
+    # Group classes by stream and index by numeric grade
+    by_stream: Dict[int, Dict[int, object]] = {}
+    ambiguous: Dict[int, set] = {}
+    for c in classes:
+        if not c.grade_level or not c.stream_id:
+            summary['skipped'].append({'class_id': c.id, 'name': getattr(c, 'name', ''), 'reason': 'missing grade_level or stream'})
+            continue
+        num = _grade_number(c.grade_level)
+        if num is None:
+            summary['skipped'].append({'class_id': c.id, 'name': getattr(c, 'name', ''), 'reason': f'no numeric grade in "{Class.format_grade_level(c.grade_level)}"'})
+            continue
+        grades = by_stream.setdefault(c.stream_id, {})
+        if num in grades:
+            ambiguous.setdefault(c.stream_id, set()).add(num)
+        grades.setdefault(num, c)
+    # Two classes of one grade in a stream have no single target to move into; leave the
+    # whole stream alone rather than promote some of its classes into the wrong one.
+    for stream_id, nums in ambiguous.items():
+        labels = ', '.join(Class.format_grade_level(str(n)) for n in sorted(nums))
+        by_stream.pop(stream_id)
+        for c in classes:
+            if c.stream_id == stream_id and c.grade_level and _grade_number(c.grade_level) is not None:
+                summary['skipped'].append({
+                    'class_id': c.id, 'name': getattr(c, 'name', ''),
+                    'reason': f'stream has more than one class for {labels}',
+                })
+
+    graduating = [c.id for grades in by_stream.values() for n, c in grades.items() if n == GRADUATING_GRADE]
+    balances = _outstanding_balances(graduating)
+    grad_students: Dict[int, List[Tuple[int, str]]] = {}
+    if graduating:
+        for sid, name, kid in Student.objects.filter(klass_id__in=graduating).values_list('id', 'name', 'klass_id'):
+            grad_students.setdefault(kid, []).append((sid, name))
+
+    for stream_id, grades in by_stream.items():
+        # Labels as they will read after promotion; updated as renames are planned
+        occupied = dict(grades)
+        for num in sorted(grades.keys(), reverse=True):
+            c = grades[num]
+            if num == GRADUATING_GRADE:
+                cleared = []
+                for sid, name in grad_students.get(c.id, []):
+                    if sid in balances:
+                        summary['not_cleared'].append({'student_id': sid, 'name': name, 'balance': balances[sid]})
+                    else:
+                        cleared.append(sid)
+                ops['graduate'].append((c.id, cleared))
+                summary['graduated_classes'].append({
+                    'class_id': c.id,
+                    'from': getattr(c, 'name', ''),
+                    'students': len(cleared),
+                    'graduation_year': ops['graduation_year'],
+                })
+                continue
+            new_num = num + 1
+            target = occupied.get(new_num)
+            if target is not None:
+                ops['move'].append((c.id, target.id, c.teacher_id))
+                summary['moved_classes'].append({
+                    'from_id': c.id,
+                    'from': getattr(c, 'name', ''),
+                    'to_id': target.id,
+                    'to': getattr(target, 'name', ''),
+                    'students': counts.get(c.id, 0),
+                })
+            else:
+                grade_label = Class.format_grade_level(str(new_num))
+                new_name = f"{grade_label} {c.stream.name}".strip()
+                ops['rename'].append((c.id, grade_label, new_name))
+                occupied.pop(num, None)
+                occupied[new_num] = c
+                summary['renamed_classes'].append({
+                    'class_id': c.id,
+                    'from': f"{Class.format_grade_level(c.grade_level)} {c.stream.name}",
+                    'to': new_name,
+                    'students': counts.get(c.id, 0),
+                })
+
+    return {'summary': summary, 'ops': ops}
+
+
+def apply_promotion_plan(academic_year, plan: dict) -> dict:
+    """Execute a plan from build_promotion_plan with queryset UPDATEs.
+    Student post_save receivers do not run for these, so the class fee invoices of the
+    moved and graduated students are synced in bulk afterwards (sync_class_invoices).
+    """
+    from finance.services.class_invoices import sync_class_invoices
+    from .teacher_scope import invalidate_teacher_scopes
+    models = _get_models()
+    Class = models['Class']
+    Student = models['Student']
+    school = academic_year.school
+    ops = plan['ops']
+    with transaction.atomic():
+        # Graduations first so the Grade 9 class is cleared before Grade 8 moves in
+        grad_ids = [sid for _, ids in ops['graduate'] for sid in ids]
+        if grad_ids:
+            grad_class = Class.get_or_create_graduated_class(school)
+            Student.objects.filter(pk__in=grad_ids).update(
+                klass=grad_class,
+                is_graduated=True,
+                graduation_year=ops['graduation_year'],
+                school=school,
+            )
+        # Moves are planned highest grade first; applying them in that order keeps each
+        # student to a single step even though they are selected by class.
+        moved_ids = []
+        for from_id, to_id, teacher_id in ops['move']:
+            moving = Student.objects.filter(klass_id=from_id)
+            moved_ids.extend(moving.values_list('id', flat=True))
+            moving.update(klass_id=to_id, is_graduated=False, school=school)
+            Class.objects.filter(pk=to_id).update(teacher_id=teacher_id)
+            Class.objects.filter(pk=from_id).update(teacher_id=None)
+        for class_id, grade_label, new_name in ops['rename']:
+            Class.objects.filter(pk=class_id).update(grade_level=grade_label, name=new_name)
+        invoices = sync_class_invoices(school.id, moved_ids + grad_ids)
+        # Class teachers moved with queryset UPDATEs, which the scope receivers never see
+        if ops['move']:
+            transaction.on_commit(lambda: invalidate_teacher_scopes(school.id))
+    logger.info(
+        "Promotion applied for school %s (%s): %s graduated, %s moves, %s renames, %s invoices created",
+        getattr(school, 'id', None), getattr(academic_year, 'label', ''),
+        len(grad_ids), len(ops['move']), len(ops['rename']), invoices['created'],
+    )
+    return plan['summary']
+
+
+def promote_academic_year(academic_year, dry_run: bool = False) -> dict:
+    """Plan and (unless dry_run) apply the promotion. Returns the summary dict."""
+    plan = build_promotion_plan(academic_year)
+    if dry_run:
+        return {**plan['summary'], 'dry_run': True}
+    return {**apply_promotion_plan(academic_year, plan), 'dry_run': False}
@@ -0,0 +1,27 @@
+from __future__ import annotations
+import uuid
+from django.core.cache import cache
+
+# Per-school version token for exam results. Anything cached from ExamResult data
+# embeds the token in its cache key; writing results bumps it so stale entries are
+# simply never read again.
+
+
+def _key(school_id) -> str:
+    return f"academics:results:v:{school_id}"
+
+
+def school_results_token(school_id) -> str:
+    key = _key(school_id)
+    token = cache.get(key)
+    if token is None:
+        token = uuid.uuid4().hex[:12]
+        if not cache.add(key, token, None):
+            token = cache.get(key) or token
+    return token
+
+
+def invalidate_school_results(school_id) -> None:
+    # Unscoped (superuser) views are keyed under None and see every school's results
+    for sid in {school_id, None}:
+        cache.set(_key(sid), uuid.uuid4().hex[:12], None)
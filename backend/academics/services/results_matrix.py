@@ -0,0 +1,279 @@
+from __future__ import annotations
+import hashlib
+from typing import Dict, List, Optional, Tuple
+from django.db import transaction
+
+# Column key for a (subject, component) cell: "12" for whole-subject marks, "12:3" for a component
+ColumnKey = Tuple[int, Optional[int]]
+
+
+def _get_models():
+    from academics.models import Exam, ExamResult, Student, Subject, SubjectComponent
+    return {
+        'Exam': Exam,
+        'ExamResult': ExamResult,
+        'Student': Student,
+        'Subject': Subject,
+        'SubjectComponent': SubjectComponent,
+    }
+
+
+def column_key(subject_id: int, component_id: Optional[int]) -> str:
+    return f"{subject_id}:{component_id}" if component_id else str(subject_id)
+
+
+def parse_column_key(key) -> ColumnKey:
+    parts = str(key).split(':', 1)
+    subject_id = int(parts[0])
+    component_id = int(parts[1]) if len(parts) > 1 and parts[1] not in ('', 'None', 'null') else None
+    return subject_id, component_id
+
+
+def results_version(exam_id: int) -> str:
+    """Opaque token that changes whenever any result of the exam is added, changed or removed."""
+    models = _get_models()
+    h = hashlib.sha1()
+    rows = models['ExamResult'].objects.filter(exam_id=exam_id).order_by('id').values_list('id', 'marks')
+    for rid, marks in rows.iterator(chunk_size=2000):
+        h.update(f"{rid}={marks!r};".encode())
+    return h.hexdigest()[:16]
+
+
+def _target_max(exam, component) -> float:
+    if component is not None and getattr(component, 'max_marks', None) is not None:
+        return float(component.max_marks)
+    if getattr(exam, 'total_marks', None) is not None:
+        return float(exam.total_marks)
+    return 100.0
+
+
+def allowed_subject_ids(exam, user) -> Optional[set]:
+    """Subjects the user may enter marks for on this exam; None means unrestricted.
+    Same rules as ExamResultViewSet.perform_create, via the user's TeacherScope.
+    """
+    if not user or getattr(user, 'role', None) != 'teacher' or user.is_staff or user.is_superuser:
+        return None
+    from .teacher_scope import teacher_scope_for
+    allowed = teacher_scope_for(user).allowed_subject_ids(exam.klass_id)
+    return None if allowed is None else set(allowed)
+
+
+def build_matrix(exam) -> dict:
+    """Return roster, columns and marks for an exam as parallel arrays.
+    values[i][j] holds the mark of students.ids[i] for columns.keys[j], or None when missing.
+    """
+    models = _get_models()
+    ExamResult = models['ExamResult']
+    results = list(
+        ExamResult.objects.filter(exam=exam, subject__is_examinable=True)
+        .values_list('student_id', 'subject_id', 'component_id', 'marks')
+    )
+
+    # Roster: current class members plus anyone already holding a result (e.g. after a move)
+    result_student_ids = {r[0] for r in results}
+    roster = list(
+        models['Student'].objects
+        .filter(klass_id=exam.klass_id)
+        .values_list('id', 'name', 'admission_no')
+    )
+    missing = result_student_ids - {s[0] for s in roster}
+    if missing:
+        roster += list(models['Student'].objects.filter(id__in=missing).values_list('id', 'name', 'admission_no'))
+    roster.sort(key=lambda s: ((s[1] or '').lower(), s[0]))
+
+    # Columns: class subjects (one per component when the subject has components) + any extras in results
+    subjects = list(exam.klass.subjects.filter(is_examinable=True).values_list('id', 'code', 'name'))
+    seen_subjects = {s[0] for s in subjects}
+    extra_subject_ids = {r[1] for r in results} - seen_subjects
+    if extra_subject_ids:
+        subjects += list(models['Subject'].objects.filter(id__in=extra_subject_ids).values_list('id', 'code', 'name'))
+    components: Dict[int, list] = {}
+    for cid, sid, code, name, max_marks in (
+        models['SubjectComponent'].objects
+        .filter(subject_id__in=[s[0] for s in subjects])
+        .values_list('id', 'subject_id', 'code', 'name', 'max_marks')
+    ):
+        components.setdefault(sid, []).append((cid, code, name, max_marks))
+    used_keys = {(r[1], r[2]) for r in results}
+
+    exam_max = float(exam.total_marks) if getattr(exam, 'total_marks', None) is not None else 100.0
+    keys: List[ColumnKey] = []
+    labels: List[str] = []
+    max_marks: List[float] = []
+    for sid, code, name in subjects:
+        comps = components.get(sid) or []
+        if not comps or (sid, None) in used_keys:
+            keys.append((sid, None))
+            labels.append(name or code)
+            max_marks.append(exam_max)
+        for cid, ccode, cname, cmax in comps:
+            keys.append((sid, cid))
+            labels.append(f"{name or code} - {cname or ccode}")
+            max_marks.append(float(cmax) if cmax is not None else exam_max)
+
+    col_index = {k: j for j, k in enumerate(keys)}
+    row_index = {s[0]: i for i, s in enumerate(roster)}
+    values: List[List[Optional[float]]] = [[None] * len(keys) for _ in roster]
+    for student_id, subject_id, component_id, marks in results:
+        j = col_index.get((subject_id, component_id))
+        i = row_index.get(student_id)
+        if i is not None and j is not None:
+            values[i][j] = marks
+
+    return {
+        'exam': {
+            'id': exam.id, 'name': exam.name, 'year': exam.year, 'term': exam.term,
+            'klass': exam.klass_id, 'total_marks': exam.total_marks, 'published': exam.published,
+        },
+        'version': results_version(exam.id),
+        'students': {
+            'ids': [s[0] for s in roster],
+            'names': [s[1] for s in roster],
+            'admission_nos': [s[2] for s in roster],
+        },
+        'columns': {
+            'keys': [column_key(s, c) for s, c in keys],
+            'subject_ids': [s for s, _ in keys],
+            'component_ids': [c for _, c in keys],
+            'labels': labels,
+            'max_marks': max_marks,
+        },
+        'values': values,
+    }
+
+
+class MatrixConflict(Exception):
+    """Raised when the client's version token no longer matches the stored results."""
+
+    def __init__(self, version: str):
+        super().__init__('Results changed since they were loaded')
+        self.version = version
+
+
+def apply_matrix_changes(exam, cells: list, version: str, user=None) -> dict:
+    """Validate and write changed cells in one transaction.
+    Each cell: {"student": id, "column": "12" | "12:3"} or {"student", "subject", "component"},
+    plus "marks" (null deletes the result) and optional "out_of" to scale from.
+    Returns {'created', 'updated', 'deleted', 'version'} or {'errors': [...]} when any cell is invalid.
+    Raises MatrixConflict when version is stale.
+    """
+    models = _get_models()
+    Exam = models['Exam']
+    ExamResult = models['ExamResult']
+
+    # Resolve referenced subjects/components once
+    parsed = []
+    errors = []
+    for idx, cell in enumerate(cells):
+        if not isinstance(cell, dict):
+            errors.append({'index': idx, 'error': 'Invalid cell'})
+            continue
+        try:
+            student_id = int(cell.get('student'))
+            if cell.get('column') is not None:
+                subject_id, component_id = parse_column_key(cell.get('column'))
+            else:
+                subject_id = int(cell.get('subject'))
+                component_id = int(cell['component']) if cell.get('component') not in (None, '') else None
+        except (TypeError, ValueError, KeyError):
+            errors.append({'index': idx, 'error': {'detail': 'Invalid identifiers in cell'}})
+            continue
+        parsed.append((idx, student_id, subject_id, component_id, cell.get('marks'), cell.get('out_of')))
+
+    subject_ids = {p[2] for p in parsed}
+    component_ids = {p[3] for p in parsed if p[3]}
+    student_ids = {p[1] for p in parsed}
+    subjects = {s.id: s for s in models['Subject'].objects.filter(id__in=subject_ids)}
+    components = {c.id: c for c in models['SubjectComponent'].objects.filter(id__in=component_ids)}
+    valid_students = set(
+        models['Student'].objects.filter(id__in=student_ids, klass_id=exam.klass_id).values_list('id', flat=True)
+    ) | set(
+        ExamResult.objects.filter(exam=exam, student_id__in=student_ids).values_list('student_id', flat=True)
+    )
+    allowed = allowed_subject_ids(exam, user)
+
+    writes: Dict[Tuple[int, int, Optional[int]], Optional[float]] = {}
+    for idx, student_id, subject_id, component_id, marks, out_of in parsed:
+        subject = subjects.get(subject_id)
+        component = components.get(component_id) if component_id else None
+        if student_id not in valid_students:
+            errors.append({'index': idx, 'error': {'student': 'Student is not part of this exam'}})
+            continue
+        if subject is None:
+            errors.append({'index': idx, 'error': {'subject': 'Not found'}})
+            continue
+        if component_id and (component is None or component.subject_id != subject_id):
+            errors.append({'index': idx, 'error': {'component': 'Component does not belong to the selected subject'}})
+            continue
+        if not subject.is_examinable:
+            errors.append({'index': idx, 'error': {'subject': 'This subject is not examinable. Results cannot be recorded.'}})
+            continue
+        if allowed is not None and subject_id not in allowed:
+            errors.append({'index': idx, 'error': {'detail': 'You are not assigned to this class/subject for this exam'}})
+            continue
+        if marks in (None, ''):
+            writes[(student_id, subject_id, component_id)] = None
+            continue
+        try:
+            m = float(marks)
+        except (TypeError, ValueError):
+            errors.append({'index': idx, 'error': {'marks': 'Marks must be a number'}})
+            continue
+        if m < 0:
+            errors.append({'index': idx, 'error': {'marks': 'Marks cannot be negative'}})
+            continue
+        target_max = _target_max(exam, component)
+        if out_of not in (None, ''):
+            try:
+                oo = float(out_of)
+            except (TypeError, ValueError):
+                errors.append({'index': idx, 'error': {'out_of': 'out_of must be a number'}})
+                continue
+            if oo <= 0 or m > oo:
+                errors.append({'index': idx, 'error': {'marks': f'Marks must be between 0 and out_of ({oo})'}})
+                continue
+            m = (m / oo) * target_max
+        elif m > target_max:
+            errors.append({'index': idx, 'error': {'marks': f'Marks cannot exceed maximum ({target_max})'}})
+            continue
+        writes[(student_id, subject_id, component_id)] = m
+
+    if errors:
+        return {'errors': errors}
+
+    with transaction.atomic():
+        # Serialize writers on the exam row so the version check and the writes are atomic
+        Exam.objects.select_for_update().filter(pk=exam.pk).first()
+        current = results_version(exam.id)
+        if current != version:
+            raise MatrixConflict(current)
+        existing = {
+            (r.student_id, r.subject_id, r.component_id): r
+            for r in ExamResult.objects.filter(
+                exam=exam, student_id__in=student_ids, subject_id__in=subject_ids
+            )
+        }
+        to_create, to_update, to_delete = [], [], []
+        for (student_id, subject_id, component_id), m in writes.items():
+            row = existing.get((student_id, subject_id, component_id))
+            if m is None:
+                if row is not None:
+                    to_delete.append(row.id)
+            elif row is None:
+                to_create.append(ExamResult(exam=exam, student_id=student_id, subject_id=subject_id, component_id=component_id, marks=m, school_id=exam.klass.school_id))
+            elif row.marks != m:
+                row.marks = m
+                to_update.append(row)
+        if to_create:
+            ExamResult.objects.bulk_create(to_create)
+        if to_update:
+            ExamResult.objects.bulk_update(to_update, ['marks'])
+        if to_delete:
+            ExamResult.objects.filter(id__in=to_delete).delete()
+        new_version = results_version(exam.id)
+    # bulk_create/bulk_update bypass post_save, so bump the cached-results token here
+    from .results_cache import invalidate_school_results
+    from .timeline import mark_exam_stale
+    invalidate_school_results(getattr(exam.klass, 'school_id', None))
+    mark_exam_stale(exam.id)
+    return {'created': len(to_create), 'updated': len(to_update), 'deleted': len(to_delete), 'version': new_version}
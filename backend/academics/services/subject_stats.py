@@ -0,0 +1,106 @@
+from __future__ import annotations
+from typing import List
+from django.core.cache import cache
+from django.db.models import Avg, Count, F, Max, Subquery, Value, Window
+from django.db.models.functions import Coalesce, NullIf, RowNumber
+
+from accounts.tenancy import scope_to_school
+from .results_cache import school_results_token
+
+CACHE_TTL = 600
+
+
+def _get_models():
+    from academics.models import Exam, ExamResult
+    return {'Exam': Exam, 'ExamResult': ExamResult}
+
+
+def _grade_sort_key(g):
+    try:
+        import re
+        return (0, int(re.sub(r'\D', '', str(g))), str(g))
+    except Exception:
+        return (1, 0, str(g))
+
+
+def latest_exam_averages(subject, school_id=None) -> List[dict]:
+    """Average marks per grade over each class's latest exam, in one statement.
+    The latest exam per class is picked with ROW_NUMBER() over (klass ORDER BY date DESC, id DESC);
+    classes whose latest exam has no marks for the subject are left out, as before.
+    """
+    models = _get_models()
+    exams = models['Exam'].objects.filter(klass__subjects=subject)
+    if school_id is not None:
+        exams = exams.filter(klass__school_id=school_id)
+    latest = (
+        exams
+        .annotate(rn=Window(RowNumber(), partition_by=[F('klass_id')], order_by=[F('date').desc(), F('id').desc()]))
+        .filter(rn=1)
+        .values('id')
+    )
+    per_exam = (
+        models['ExamResult'].objects
+        .filter(subject=subject, exam_id__in=Subquery(latest))
+        .values('exam_id', grade=F('exam__klass__grade_level'))
+        .annotate(avg=Avg('marks'))
+    )
+    by_grade = {}
+    for row in per_exam:
+        agg = by_grade.setdefault(row['grade'], {'sum': 0.0, 'count': 0})
+        agg['sum'] += float(row['avg'] or 0)
+        agg['count'] += 1
+    out = [
+        {'grade_level': g, 'average': round(v['sum'] / v['count'], 2) if v['count'] else 0.0, 'classes': v['count']}
+        for g, v in by_grade.items()
+    ]
+    out.sort(key=lambda x: _grade_sort_key(x['grade_level']))
+    return out
+
+
+def grade_trend(subject, school_id=None, last_n: int = 5) -> List[dict]:
+    """Average marks for the subject over the last N exam sittings of each grade.
+    A sitting is (name, year, term) within a grade, so streams of a common exam count once.
+    """
+    models = _get_models()
+    grade = Coalesce(NullIf(F('exam__grade_level_tag'), Value('')), F('exam__klass__grade_level'))
+    qs = models['ExamResult'].objects.filter(subject=subject)
+    qs = scope_to_school(qs, school_id)
+    rows = (
+        qs.annotate(grade=grade)
+        .values('grade', 'exam__name', 'exam__year', 'exam__term')
+        .annotate(
+            average=Avg('marks'),
+            students=Count('student_id', distinct=True),
+            last_date=Max('exam__date'),
+        )
+        .annotate(rn=Window(RowNumber(), partition_by=[F('grade')], order_by=[F('last_date').desc()]))
+        .filter(rn__lte=last_n)
+    )
+    trends = {}
+    for r in rows:
+        trends.setdefault(r['grade'], []).append({
+            'name': r['exam__name'],
+            'year': r['exam__year'],
+            'term': r['exam__term'],
+            'date': r['last_date'],
+            'average': round(float(r['average'] or 0), 2),
+            'students': r['students'],
+        })
+    out = []
+    for g in sorted(trends.keys(), key=_grade_sort_key):
+        series = sorted(trends[g], key=lambda x: (x['date'] or x['year'], x['year'], x['term']))
+        out.append({'grade_level': g, 'exams': series})
+    return out
+
+
+def subject_stats(subject, school_id=None, last_n: int = 5) -> dict:
+    """Cached results section of SubjectViewSet.stats, keyed by subject, school and results token."""
+    key = f"academics:subject_stats:{subject.id}:{school_id}:{last_n}:{school_results_token(school_id)}"
+    data = cache.get(key)
+    if data is None:
+        data = {
+            'avg_by_grade': latest_exam_averages(subject, school_id),
+            'trend': grade_trend(subject, school_id, last_n=last_n),
+        }
+        cache.set(key, data, CACHE_TTL)
+    return data
@@ -0,0 +1,112 @@
+from __future__ import annotations
+import uuid
+from typing import Optional
+
+from django.conf import settings
+from django.core.cache import cache
+
+# What a teacher may see and edit: the classes they are class teacher of, and the
+# (class, subject) pairs they are mapped to through ClassSubjectTeacher. Computed once per
+# request (held on request.tenant) and cached per user under a per-school version token;
+# signals bump the token when Class.teacher, Class.subjects or ClassSubjectTeacher rows change,
+# and code changing them with queryset UPDATEs (promotion) calls invalidate_teacher_scopes().
+# The cross-request cache is only used when the Django cache is shared between workers: a
+# per-process cache would keep serving revoked access on the workers that missed the bump.
+
+SCOPE_TTL = 60 * 60
+
+
+def _get_models():
+    from academics.models import Class, ClassSubjectTeacher
+    return {'Class': Class, 'ClassSubjectTeacher': ClassSubjectTeacher}
+
+
+class TeacherScope:
+    __slots__ = ('user_id', 'homeroom_ids', 'subjects_by_class', 'class_subjects', 'class_ids')
+
+    def __init__(self, user_id, homeroom_ids=(), subjects_by_class=None, class_subjects=None):
+        self.user_id = user_id
+        self.homeroom_ids = frozenset(homeroom_ids)
+        # klass_id -> subject ids the teacher is mapped to in that class
+        self.subjects_by_class = {k: frozenset(v) for k, v in (subjects_by_class or {}).items()}
+        # klass_id -> the class's own subjects (only for classes with a mapping)
+        self.class_subjects = {k: frozenset(v) for k, v in (class_subjects or {}).items()}
+        self.class_ids = self.homeroom_ids | frozenset(self.subjects_by_class)
+
+    def is_class_teacher(self, klass_id) -> bool:
+        return klass_id in self.homeroom_ids
+
+    def teaches_class(self, klass_id) -> bool:
+        return klass_id in self.class_ids
+
+    def allowed_subject_ids(self, klass_id) -> Optional[frozenset]:
+        """Subjects the teacher may enter marks for in a class; None means unrestricted.
+        Class teacher -> all; exact mapping; or any mapping in the class plus the subject
+        being one of the class subjects.
+        """
+        if klass_id in self.homeroom_ids:
+            return None
+        exact = self.subjects_by_class.get(klass_id)
+        if not exact:
+            return frozenset()
+        return exact | self.class_subjects.get(klass_id, frozenset())
+
+    def can_enter(self, klass_id, subject_id) -> bool:
+        allowed = self.allowed_subject_ids(klass_id)
+        return allowed is None or subject_id in allowed
+
+
+def _cache_is_shared() -> bool:
+    backend = settings.CACHES.get('default', {}).get('BACKEND', '')
+    return not backend.endswith(('LocMemCache', 'DummyCache'))
+
+
+def _key(school_id) -> str:
+    return f"academics:teacher_scope:v:{school_id}"
+
+
+def _scope_token(school_id) -> str:
+    key = _key(school_id)
+    token = cache.get(key)
+    if token is None:
+        token = uuid.uuid4().hex[:12]
+        if not cache.add(key, token, None):
+            token = cache.get(key) or token
+    return token
+
+
+def invalidate_teacher_scopes(school_id) -> None:
+    # Teachers without a school are keyed under None; their classes may belong to any school
+    for sid in {school_id, None}:
+        cache.set(_key(sid), uuid.uuid4().hex[:12], None)
+
+
+def build_teacher_scope(user_id) -> TeacherScope:
+    models = _get_models()
+    homeroom = set(models['Class'].objects.filter(teacher_id=user_id).values_list('id', flat=True))
+    by_class = {}
+    for klass_id, subject_id in models['ClassSubjectTeacher'].objects.filter(teacher_id=user_id).values_list('klass_id', 'subject_id'):
+        by_class.setdefault(klass_id, set()).add(subject_id)
+    class_subjects = {}
+    if by_class:
+        through = models['Class'].subjects.through
+        for klass_id, subject_id in through.objects.filter(class_id__in=list(by_class)).values_list('class_id', 'subject_id'):
+            class_subjects.setdefault(klass_id, set()).add(subject_id)
+    return TeacherScope(user_id, homeroom, by_class, class_subjects)
+
+
+def teacher_scope_for(user) -> TeacherScope:
+    if not _cache_is_shared():
+        return build_teacher_scope(user.id)
+    key = f"academics:teacher_scope:{_scope_token(getattr(user, 'school_id', None))}:{user.id}"
+    scope = cache.get(key)
+    if scope is None:
+        scope = build_teacher_scope(user.id)
+        cache.set(key, scope, SCOPE_TTL)
+    return scope
+
+
+def teacher_scope(request) -> TeacherScope:
+    """The requesting user's scope, computed at most once per request (held on request.tenant)."""
+    from accounts.tenancy import get_tenant
+    return get_tenant(request).teacher_scope
@@ -0,0 +1,198 @@
+from __future__ import annotations
+from typing import Dict, Iterable, List, Optional
+from django.db import transaction
+
+# Snapshots are rebuilt per exam, lazily: result writes only flag the exam (Exam.timeline_stale,
+# once per exam when their transaction commits) and the next timeline read rebuilds flagged
+# exams it touches. This keeps bulk mark entry from recomputing the same exam hundreds of times.
+
+
+def _get_models():
+    from academics.models import Exam, ExamResult, StudentExamSnapshot
+    return {'Exam': Exam, 'ExamResult': ExamResult, 'StudentExamSnapshot': StudentExamSnapshot}
+
+
+def mark_exam_stale(exam_id) -> None:
+    if not exam_id:
+        return
+    mark_exams_stale([exam_id])
+
+
+def mark_exams_stale(exam_ids: Iterable[int]) -> None:
+    exam_ids = [i for i in exam_ids if i]
+    if exam_ids:
+        _get_models()['Exam'].objects.filter(pk__in=exam_ids, timeline_stale=False).update(timeline_stale=True)
+
+
+def _exam_performance(exam) -> Dict[int, dict]:
+    """Per-student totals, averages, subject percentages and class positions for one exam.
+    Same rules as ExamViewSet._build_summary: examinable subjects only, average is total over
+    result rows, subject percentage is the mean of its component percentages.
+    """
+    rows = (
+        _get_models()['ExamResult'].objects
+        .filter(exam_id=exam.id, subject__is_examinable=True)
+        .values_list('student_id', 'subject_id', 'marks', 'component__max_marks')
+    )
+    exam_max = float(exam.total_marks) if exam.total_marks is not None else 100.0
+    per: Dict[int, dict] = {}
+    for student_id, subject_id, marks, comp_max in rows:
+        e = per.setdefault(student_id, {'total': 0.0, 'count': 0, 'parts': {}})
+        m = float(marks)
+        e['total'] += m
+        e['count'] += 1
+        denom = float(comp_max) if comp_max is not None else exam_max
+        if denom > 0:
+            e['parts'].setdefault(str(subject_id), []).append(m / denom * 100.0)
+
+    ordered = sorted(per.items(), key=lambda kv: -kv[1]['total'])
+    position, last = 0, None
+    for idx, (student_id, e) in enumerate(ordered, start=1):
+        total = round(e['total'], 2)
+        if last is None or total < last:
+            position, last = idx, total
+        pcts = {sid: round(sum(p) / len(p), 2) for sid, p in e['parts'].items() if p}
+        per[student_id] = {
+            'total': total,
+            'average': round(e['total'] / e['count'], 2) if e['count'] else 0.0,
+            'mean_percentage': round(sum(pcts.values()) / len(pcts), 2) if pcts else None,
+            'subject_percentages': pcts,
+            'position': position,
+        }
+    return per
+
+
+def rebuild_exam_snapshots(exam) -> bool:
+    """Recompute every snapshot of an exam, then the deltas of the students involved.
+    Returns False when a concurrent reader rebuilt it first.
+    """
+    models = _get_models()
+    Exam, Snapshot = models['Exam'], models['StudentExamSnapshot']
+    with transaction.atomic():
+        # Serialize rebuilds on the exam row; whoever waited finds the flag cleared and skips.
+        # Result writes flagging the exam meanwhile wait for the lock and flag it again.
+        if not Exam.objects.select_for_update().filter(pk=exam.pk, timeline_stale=True).exists():
+            return False
+        Exam.objects.filter(pk=exam.pk).update(timeline_stale=False)
+        perf = _exam_performance(exam)
+        existing = {s.student_id: s for s in Snapshot.objects.filter(exam_id=exam.id)}
+        removed = [sid for sid in existing if sid not in perf]
+        to_create, to_update = [], []
+        fields = ['klass', 'date', 'total', 'average', 'mean_percentage', 'subject_percentages', 'position', 'class_size']
+        for student_id, p in perf.items():
+            snap = existing.get(student_id) or Snapshot(student_id=student_id, exam_id=exam.id)
+            snap.klass_id = exam.klass_id
+            snap.date = exam.date
+            snap.class_size = len(perf)
+            for f in ('total', 'average', 'mean_percentage', 'subject_percentages', 'position'):
+                setattr(snap, f, p[f])
+            (to_update if snap.pk else to_create).append(snap)
+        if removed:
+            Snapshot.objects.filter(exam_id=exam.id, student_id__in=removed).delete()
+        if to_create:
+            Snapshot.objects.bulk_create(to_create, batch_size=500, ignore_conflicts=True)
+        if to_update:
+            Snapshot.objects.bulk_update(to_update, fields, batch_size=500)
+        refresh_deltas(list(perf.keys()) + removed)
+    return True
+
+
+def _delta(cur, prev):
+    if cur is None or prev is None:
+        return None
+    return round(cur - prev, 2)
+
+
+def refresh_deltas(student_ids: Iterable[int]) -> int:
+    """Recompute previous-exam deltas along each student's timeline; returns rows changed."""
+    student_ids = list(set(student_ids))
+    if not student_ids:
+        return 0
+    Snapshot = _get_models()['StudentExamSnapshot']
+    changed = []
+    prev = None
+    for snap in Snapshot.objects.filter(student_id__in=student_ids).order_by('student_id', 'date', 'exam_id'):
+        if prev is None or prev.student_id != snap.student_id:
+            values = (None, None, None, None, {})
+        else:
+            values = (
+                prev.exam_id,
+                _delta(snap.total, prev.total),
+                _delta(snap.mean_percentage, prev.mean_percentage),
+                (prev.position - snap.position) if (prev.position and snap.position) else None,
+                {
+                    sid: round(pct - prev.subject_percentages[sid], 2)
+                    for sid, pct in (snap.subject_percentages or {}).items()
+                    if sid in (prev.subject_percentages or {})
+                },
+            )
+        current = (snap.previous_exam_id, snap.delta_total, snap.delta_percentage, snap.delta_position, snap.subject_deltas or {})
+        if values != current:
+            (snap.previous_exam_id, snap.delta_total, snap.delta_percentage,
+             snap.delta_position, snap.subject_deltas) = values
+            changed.append(snap)
+        prev = snap
+    if changed:
+        Snapshot.objects.bulk_update(
+            changed, ['previous_exam', 'delta_total', 'delta_percentage', 'delta_position', 'subject_deltas'], batch_size=500
+        )
+    return len(changed)
+
+
+def refresh_stale_for_students(student_ids: Iterable[int]) -> int:
+    """Rebuild flagged exams that any of the students sat; returns the number of exams rebuilt."""
+    Exam = _get_models()['Exam']
+    stale = list(
+        Exam.objects.filter(timeline_stale=True, results__student_id__in=list(student_ids))
+        .distinct().only('id', 'klass_id', 'date', 'total_marks')
+    )
+    return sum(1 for exam in stale if rebuild_exam_snapshots(exam))
+
+
+def _serialize(snap, visible: Optional[set] = None) -> dict:
+    exam = snap.exam
+    # Hide deltas that would reveal an exam the reader cannot see (e.g. unpublished for students)
+    show_delta = snap.previous_exam_id is not None and (visible is None or snap.previous_exam_id in visible)
+    return {
+        'exam': {'id': exam.id, 'name': exam.name, 'year': exam.year, 'term': exam.term, 'published': exam.published},
+        'date': snap.date,
+        'klass': snap.klass_id,
+        'total': snap.total,
+        'average': snap.average,
+        'mean_percentage': snap.mean_percentage,
+        'subject_percentages': snap.subject_percentages,
+        'position': snap.position,
+        'class_size': snap.class_size,
+        'previous_exam': snap.previous_exam_id if show_delta else None,
+        'delta_total': snap.delta_total if show_delta else None,
+        'delta_percentage': snap.delta_percentage if show_delta else None,
+        'delta_position': snap.delta_position if show_delta else None,
+        'subject_deltas': snap.subject_deltas if show_delta else {},
+    }
+
+
+def timelines_for_students(student_ids: Iterable[int], published_only: bool = False,
+                           year: Optional[int] = None) -> Dict[int, List[dict]]:
+    """{student_id: [exam points ordered by date]} from a single indexed read of the snapshots."""
+    student_ids = list(student_ids)
+    refresh_stale_for_students(student_ids)
+    qs = (
+        _get_models()['StudentExamSnapshot'].objects
+        .filter(student_id__in=student_ids)
+        .select_related('exam')
+        .order_by('student_id', 'date', 'exam_id')
+    )
+    if published_only:
+        qs = qs.filter(exam__published=True)
+    if year:
+        qs = qs.filter(exam__year=year)
+    rows = list(qs)
+    visible = {s.exam_id for s in rows} if published_only else None
+    out: Dict[int, List[dict]] = {sid: [] for sid in student_ids}
+    for snap in rows:
+        out[snap.student_id].append(_serialize(snap, visible))
+    return out
+
+
+def student_timeline(student, published_only: bool = False, year: Optional[int] = None) -> List[dict]:
+    return timelines_for_students([student.id], published_only=published_only, year=year)[student.id]
@@ -1,7 +1,9 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
 from django.dispatch import receiver
 from django.apps import apps
 from django.conf import settings
+from django.db import transaction
+from functools import lru_cache
 
 @receiver(post_save, sender='accounts.School')
 def create_default_subjects_for_school(sender, instance, created, **kwargs):
@@ -48,3 +50,122 @@ def notify_student_enrollment(sender, instance, created, **kwargs):
     except Exception:
         # Avoid breaking save flow
         pass
+
+
+@receiver(post_delete, sender='academics.AcademicYear')
+def invalidate_calendar_on_year_delete(sender, instance, **kwargs):
+    from academics.services.calendar import invalidate_school_calendar
+    invalidate_school_calendar(getattr(instance, 'school_id', None))
+
+
+@receiver(post_delete, sender='academics.Term')
+def invalidate_calendar_on_term_delete(sender, instance, **kwargs):
+    from academics.services.calendar import invalidate_school_calendar
+    try:
+        school_id = instance.academic_year.school_id
+    except Exception:
+        # Cascade from a deleted year; the year's own receiver covers it
+        return
+    invalidate_school_calendar(school_id)
+
+
+@lru_cache(maxsize=4096)
+def _school_of_exam(exam_id):
+    Exam = apps.get_model('academics', 'Exam')
+    return Exam.objects.filter(pk=exam_id).values_list('klass__school_id', flat=True).first()
+
+
+class _ExamResultChanges:
+    """on_commit callback for the exams whose results changed in one transaction: bumps each
+    school's results token and flags each exam's timeline once, after the marks are visible.
+    """
+
+    def __init__(self):
+        self.exam_ids = set()
+
+    def __call__(self):
+        from academics.services.results_cache import invalidate_school_results
+        from academics.services.timeline import mark_exams_stale
+        try:
+            for school_id in {_school_of_exam(exam_id) for exam_id in self.exam_ids}:
+                invalidate_school_results(school_id)
+            mark_exams_stale(self.exam_ids)
+        except Exception:
+            pass
+
+
+@receiver(post_save, sender='academics.ExamResult')
+@receiver(post_delete, sender='academics.ExamResult')
+def queue_exam_result_change(sender, instance, **kwargs):
+    """Entering a class of marks row by row costs one set insert per row, not cache writes and
+    an Exam UPDATE; the transaction's pending callback is reused while it is still registered.
+    """
+    connection = transaction.get_connection()
+    pending = next((entry[1] for entry in connection.run_on_commit if isinstance(entry[1], _ExamResultChanges)), None)
+    if pending is not None:
+        pending.exam_ids.add(instance.exam_id)
+        return
+    pending = _ExamResultChanges()
+    pending.exam_ids.add(instance.exam_id)
+    # Outside a transaction this runs at once
+    transaction.on_commit(pending)
+
+
+@receiver(post_save, sender='academics.Exam')
+@receiver(post_delete, sender='academics.Exam')
+def invalidate_results_cache_on_exam_change(sender, instance, **kwargs):
+    from academics.services.results_cache import invalidate_school_results
+    try:
+        invalidate_school_results(getattr(instance.klass, 'school_id', None))
+    except Exception:
+        pass
+
+
+@receiver(post_save, sender='academics.Exam')
+def flag_timeline_on_exam_change(sender, instance, created, **kwargs):
+    # Date/marks changes reorder timelines or change percentages; new exams have no results yet
+    if created:
+        return
+    from academics.services.timeline import mark_exam_stale
+    mark_exam_stale(instance.pk)
+
+
+@receiver(pre_delete, sender='academics.Exam')
+def remember_timeline_students(sender, instance, **kwargs):
+    StudentExamSnapshot = apps.get_model('academics', 'StudentExamSnapshot')
+    instance._timeline_student_ids = list(
+        StudentExamSnapshot.objects.filter(exam_id=instance.pk).values_list('student_id', flat=True)
+    )
+
+
+@receiver(post_delete, sender='academics.Exam')
+def refresh_timeline_deltas_on_exam_delete(sender, instance, **kwargs):
+    """Snapshots cascade with the exam; the students' next exams need new deltas."""
+    from academics.services.timeline import refresh_deltas
+    try:
+        refresh_deltas(getattr(instance, '_timeline_student_ids', []))
+    except Exception:
+        pass
+
+
+@receiver(post_save, sender='academics.Class')
+@receiver(post_delete, sender='academics.Class')
+@receiver(post_save, sender='academics.ClassSubjectTeacher')
+@receiver(post_delete, sender='academics.ClassSubjectTeacher')
+def invalidate_teacher_scopes_on_assignment_change(sender, instance, **kwargs):
+    """Class teacher or subject-teacher mapping changed; cached TeacherScopes are stale."""
+    from academics.services.teacher_scope import invalidate_teacher_scopes
+    try:
+        school_id = instance.school_id if sender.__name__ == 'Class' else instance.klass.school_id
+    except Exception:
+        # Cascade from a deleted class; the class's own receiver covers it
+        return
+    invalidate_teacher_scopes(school_id)
+
+
+@receiver(m2m_changed, sender='academics.Class_subjects')
+def invalidate_teacher_scopes_on_class_subjects(sender, instance, action, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    from academics.services.teacher_scope import invalidate_teacher_scopes
+    invalidate_teacher_scopes(getattr(instance, 'school_id', None))
@@ -23,6 +23,7 @@ except Exception:
     REPORTLAB_AVAILABLE = False
 import csv, io
 from django_filters.rest_framework import DjangoFilterBackend
+from accounts.tenancy import SchoolScopedMixin, get_tenant
 from .models import (
     Class, Student, Competency, Assessment, Attendance, TeacherProfile, Subject, SubjectComponent,
     Exam, ExamResult, AcademicYear, Term, Stream, LessonPlan, ClassSubjectTeacher, SubjectGradingBand,
@@ -36,6 +37,8 @@ from .serializers import (
     ExamSerializer, ExamResultSerializer, AcademicYearSerializer, TermSerializer, StreamSerializer, ClassSubjectTeacherSerializer, SubjectGradingBandSerializer, RoomSerializer, TimetableEntrySerializer,
     TimetableTemplateSerializer, PeriodSlotTemplateSerializer, TimetablePlanSerializer, TimetableClassConfigSerializer, ClassSubjectQuotaSerializer, TeacherAvailabilitySerializer, TimetableVersionSerializer
 )
+from .services.calendar import get_school_calendar
+from .services.teacher_scope import teacher_scope
 
 class IsTeacherOrAdmin(permissions.BasePermission):
     def has_permission(self, request, view):
@@ -75,16 +78,16 @@ class StreamViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         qs = super().get_queryset()
-        school = getattr(getattr(self.request, 'user', None), 'school', None)
-        if school:
-            qs = qs.filter(school=school)
+        school_id = get_tenant(self.request).school_id
+        if school_id:
+            qs = qs.filter(school_id=school_id)
         return qs
 
     def perform_create(self, serializer):
-        school = getattr(getattr(self.request, 'user', None), 'school', None)
-        if not school:
+        school_id = get_tenant(self.request).school_id
+        if not school_id:
             raise ValidationError({'school': 'School is required. Set your user.school in Django admin.'})
-        serializer.save(school=school)
+        serializer.save(school_id=school_id)
 
     @action(detail=True, methods=['post'], url_path='resync-classes')
     def resync_classes(self, request, pk=None):
@@ -108,9 +111,9 @@ class ClassSubjectTeacherViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         qs = super().get_queryset().select_related('klass','subject','teacher')
-        school = getattr(getattr(self.request, 'user', None), 'school', None)
-        if school:
-            qs = qs.filter(klass__school=school)
+        school_id = get_tenant(self.request).school_id
+        if school_id:
+            qs = qs.filter(klass__school_id=school_id)
         # Optional filters
         klass = self.request.query_params.get('klass')
         if klass:
@@ -122,9 +125,9 @@ class ClassSubjectTeacherViewSet(viewsets.ModelViewSet):
 
     def perform_create(self, serializer):
         # Validate the chosen class is in admin's school
-        school = getattr(getattr(self.request, 'user', None), 'school', None)
+        school_id = get_tenant(self.request).school_id
         klass = serializer.validated_data.get('klass')
-        if school and klass and klass.school_id != school.id:
+        if school_id and klass and klass.school_id != school_id:
             raise ValidationError({'klass': 'Class must belong to your school'})
         serializer.save()
 
@@ -135,15 +138,19 @@ class ClassViewSet(viewsets.ModelViewSet):
     filterset_fields = ['school']
     def perform_create(self, serializer):
         # Resolve school: prefer payload, else user's school
-        school = serializer.validated_data.get('school') or getattr(self.request.user, 'school', None)
-        if not school:
+        school = serializer.validated_data.get('school')
+        if school:
+            serializer.save(school=school)
+            return
+        school_id = get_tenant(self.request).school_id
+        if not school_id:
             raise ValidationError({'school': 'School is required. Set your user.school in Django admin or include "school" in the request.'})
-        serializer.save(school=school)
+        serializer.save(school_id=school_id)
     def get_queryset(self):
         qs = super().get_queryset()
-        school = getattr(getattr(self.request, 'user', None), 'school', None)
-        if school:
-            qs = qs.filter(school=school)
+        school_id = get_tenant(self.request).school_id
+        if school_id:
+            qs = qs.filter(school_id=school_id)
         # Hide only empty Grade 9 classes (graduated), keep other empty classes visible for enrollment
         try:
             from .models import Class as ClassModel
@@ -174,7 +181,7 @@ class ClassViewSet(viewsets.ModelViewSet):
         qs = self.get_queryset()
         user = request.user
         if getattr(user, 'role', None) == 'teacher' and not (user.is_staff or user.is_superuser):
-            qs = qs.filter(Q(teacher=user) | Q(subject_teachers__teacher=user)).distinct()
+            qs = qs.filter(id__in=teacher_scope(request).class_ids)
         ser = self.get_serializer(qs, many=True)
         return Response(ser.data)
 
@@ -199,6 +206,12 @@ class ExamViewSet(viewsets.ModelViewSet):
         u = getattr(request, 'user', None)
         return bool(u and (u.role == 'admin' or u.is_staff or u.is_superuser))
 
+    def _letterhead_school(self, request):
+        """The requester's School row, for exports that print its name, motto and logo."""
+        from accounts.models import School
+        school_id = get_tenant(request).school_id
+        return School.objects.filter(pk=school_id).only('name', 'motto', 'logo').first() if school_id else None
+
     def _can_manage_exam(self, request, exam=None):
         """Return True if requester can modify the given exam.
         Rules:
@@ -215,9 +228,9 @@ class ExamViewSet(viewsets.ModelViewSet):
         if exam is None:
             return False
         # Same school check
-        school = getattr(user, 'school', None)
+        school_id = get_tenant(request).school_id
         try:
-            if school and getattr(exam.klass, 'school_id', None) not in (None, getattr(school, 'id', None)):
+            if school_id and getattr(exam.klass, 'school_id', None) not in (None, school_id):
                 return False
         except Exception:
             # If we cannot determine, fail closed
@@ -226,31 +239,26 @@ class ExamViewSet(viewsets.ModelViewSet):
         if getattr(user, 'role', None) == 'teacher':
             return True
         # Fallback checks (kept for clarity)
-        if getattr(exam.klass, 'teacher_id', None) == getattr(user, 'id', None):
-            return True
-        try:
-            return ClassSubjectTeacher.objects.filter(klass=exam.klass, teacher=user).exists()
-        except Exception:
-            return False
+        return teacher_scope(request).teaches_class(exam.klass_id)
 
     def get_queryset(self):
         qs = super().get_queryset().select_related('klass')
-        school = getattr(getattr(self.request, 'user', None), 'school', None)
+        school_id = get_tenant(self.request).school_id
         # Admins can see all; others are scoped to their school
-        if school and not self._is_admin(self.request):
-            qs = qs.filter(klass__school=school)
+        if school_id and not self._is_admin(self.request):
+            qs = qs.filter(klass__school_id=school_id)
 
         # If requester is a teacher, restrict to classes they teach (class teacher or subject teacher)
         user = getattr(self.request, 'user', None)
         if user and getattr(user, 'role', None) == 'teacher' and not (user.is_staff or user.is_superuser):
-            qs = qs.filter(Q(klass__teacher=user) | Q(klass__subject_teachers__teacher=user)).distinct()
+            qs = qs.filter(klass_id__in=teacher_scope(self.request).class_ids)
 
         # Default: limit to current academic year unless include_history=true (SAFE methods only, non-admins)
         if self.request.method in permissions.SAFE_METHODS and not self._is_admin(self.request):
             include_history = str(self.request.query_params.get('include_history', 'false')).lower() in ('1','true','yes')
-            if not include_history and school:
+            if not include_history and school_id:
                 try:
-                    ay = AcademicYear.objects.filter(school=school, is_current=True).first()
+                    ay = get_school_calendar(school_id).flagged_year()
                     if ay:
                         qs = qs.filter(date__gte=ay.start_date, date__lte=ay.end_date)
                 except Exception:
@@ -327,6 +335,55 @@ class ExamViewSet(viewsets.ModelViewSet):
             })
         return Response({'name': name, 'items': data})
 
+    @action(detail=False, methods=['get'], permission_classes=[IsTeacherOrAdmin], url_path='merit-list')
+    def merit_list(self, request):
+        """Grade-wide merit list for a common exam across all streams.
+        Query params:
+          - name, year, term: required, identify the common exam
+          - grade: required grade level tag (e.g. 'Grade 4' or '4')
+          - stream: optional class id to only list that stream's students (positions stay grade-wide)
+          - export: optional 'csv' or 'xlsx' to download the full list instead of a JSON page
+        JSON response is paginated over students; summary sections are returned with every page.
+        """
+        name = request.query_params.get('name')
+        grade = request.query_params.get('grade') or request.query_params.get('grade_level_tag')
+        try:
+            year = int(request.query_params.get('year'))
+            term = int(request.query_params.get('term'))
+        except (TypeError, ValueError):
+            return Response({'detail': 'name, year, term and grade are required'}, status=status.HTTP_400_BAD_REQUEST)
+        if not (name and grade):
+            return Response({'detail': 'name, year, term and grade are required'}, status=status.HTTP_400_BAD_REQUEST)
+        from .services.merit_list import grade_merit_list
+        data = grade_merit_list(name, year, term, grade, get_tenant(request).school_id)
+        if not data['exams']:
+            return Response({'detail': 'No exams found for the given name/year/term/grade'}, status=status.HTTP_404_NOT_FOUND)
+        students = data['students']
+        stream = request.query_params.get('stream')
+        if stream:
+            students = [s for s in students if str(s['klass']) == str(stream)]
+
+        export = str(request.query_params.get('export', '')).lower()
+        if export in ('csv', 'xlsx'):
+            head = ['Position', 'Stream Position', 'Adm No', 'Student', 'Stream'] + [(s.get('name') or s.get('code')) for s in data['subjects']] + ['Total', 'Average']
+
+            def rows():
+                yield head
+                for st in students:
+                    yield [st['position'], st['stream_position'], st['admission_no'], st['name'], st['stream']] + \
+                        [st['marks'].get(str(s['id']), '') for s in data['subjects']] + [st['total'], st['average']]
+            from reports.exports import export_response
+            filename = f"merit_{Class.format_grade_level(grade).replace(' ', '_')}_{year}_T{term}"
+            return export_response(request, rows, filename, sheet_title='Merit List', default=export)
+
+        summary = {k: data[k] for k in ('exams', 'subjects', 'streams', 'subject_means', 'grade_mean')}
+        page = self.paginate_queryset(students)
+        if page is not None:
+            resp = self.get_paginated_response(page)
+            resp.data.update(summary)
+            return resp
+        return Response({**summary, 'results': students})
+
     @action(detail=False, methods=['post'], permission_classes=[IsAdmin], url_path='common-bulk-create')
     def common_bulk_create(self, request):
         """Admin-only: Create common exams across classes.
@@ -368,12 +425,12 @@ class ExamViewSet(viewsets.ModelViewSet):
                 return Response({'detail': 'total_marks must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
 
             # Resolve school scope
-            school = getattr(getattr(request, 'user', None), 'school', None)
-            if not school:
+            school_id = get_tenant(request).school_id
+            if not school_id:
                 return Response({'detail': 'Your user is not linked to a school'}, status=status.HTTP_400_BAD_REQUEST)
 
             # Build class queryset in scope
-            cls_qs = Class.objects.filter(school=school)
+            cls_qs = Class.objects.filter(school_id=school_id)
             if grade:
                 try:
                     from .models import Class as ClassModel
@@ -451,10 +508,10 @@ class ExamViewSet(viewsets.ModelViewSet):
             if not klass:
                 return Response({'detail': 'Class not found'}, status=404)
             # Scope check: admin must belong to same school
-            school = getattr(getattr(request, 'user', None), 'school', None)
-            if school and klass.school_id != getattr(school, 'id', None) and not (request.user.is_staff or request.user.is_superuser):
+            school_id = get_tenant(request).school_id
+            if school_id and klass.school_id != school_id and not (request.user.is_staff or request.user.is_superuser):
                 return Response({'detail': 'Class must belong to your school'}, status=403)
-            updated = Student.objects.filter(id__in=student_ids).update(klass=klass, is_graduated=False, school=klass.school)
+            updated = Student.objects.filter(id__in=student_ids).update(klass=klass, is_graduated=False, school_id=klass.school_id)
             return Response({'detail': 'Students assigned', 'updated': updated})
         except Exception as e:
             return Response({'detail': 'Bulk assign failed', 'error': str(e)}, status=500)
@@ -464,9 +521,9 @@ class ExamViewSet(viewsets.ModelViewSet):
         if not self._is_admin(self.request):
             raise ValidationError({'detail': 'Only admins can create exams'})
         # enforce school scoping by validating klass belongs to user's school
-        school = getattr(getattr(self.request, 'user', None), 'school', None)
+        school_id = get_tenant(self.request).school_id
         klass = serializer.validated_data.get('klass')
-        if school and klass and klass.school_id != school.id:
+        if school_id and klass and klass.school_id != school_id:
             raise ValidationError({'klass': 'Class must belong to your school'})
         serializer.save()
 
@@ -481,11 +538,11 @@ class ExamViewSet(viewsets.ModelViewSet):
         if not self._can_manage_exam(request, exam):
             return Response({'detail': 'You do not have permission to modify this exam'}, status=status.HTTP_403_FORBIDDEN)
         # If teacher changes klass, enforce same-school scoping
-        school = getattr(getattr(request, 'user', None), 'school', None)
+        school_id = get_tenant(request).school_id
         new_klass_id = request.data.get('klass')
-        if new_klass_id is not None and school:
+        if new_klass_id is not None and school_id:
             k = Class.objects.filter(id=new_klass_id).first()
-            if k and getattr(k, 'school_id', None) != getattr(school, 'id', None) and not self._is_admin(request):
+            if k and getattr(k, 'school_id', None) != school_id and not self._is_admin(request):
                 return Response({'klass': ['Class must belong to your school']}, status=status.HTTP_400_BAD_REQUEST)
         return super().partial_update(request, *args, **kwargs)
 
@@ -609,44 +666,10 @@ class ExamViewSet(viewsets.ModelViewSet):
                 class_pos = st.get('position')
                 break
 
-        # Grade cohort: same school, same grade_level, same (name, year, term)
-        school = getattr(getattr(request, 'user', None), 'school', None)
-        grade_level = getattr(getattr(exam, 'klass', None), 'grade_level', None)
-        same_grade_exams = Exam.objects.filter(
-            name=exam.name,
-            year=exam.year,
-            term=exam.term,
-            klass__grade_level=grade_level,
-        )
-        if school:
-            same_grade_exams = same_grade_exams.filter(klass__school=school)
-
-        # Build totals per student across subjects for each exam separately, then pick the exam this student belongs to
-        # For grade ranking, we compare students' totals within their respective classes but on the same exam definition
-        totals = {}
-        # Collect students for grade rank across all matching exams
-        res = (
-            ExamResult.objects
-            .filter(exam__in=same_grade_exams, subject__is_examinable=True)
-            .values('exam_id', 'student_id')
-            .annotate(total=Sum('marks'))
-        )
-        for row in res:
-            sid = row['student_id']
-            totals[sid] = float(row['total'] or 0)
-
-        # Sort by total desc and assign ranks with ties
-        ordered = sorted(([sid, sc] for sid, sc in totals.items()), key=lambda x: x[1], reverse=True)
-        grade_pos = None
-        last_total = None
-        position = 0
-        for idx, (sid, sc) in enumerate(ordered, start=1):
-            if last_total is None or sc < last_total:
-                position = idx
-                last_total = sc
-            if str(sid) == str(student_id):
-                grade_pos = position
-                break
+        # Grade cohort: every stream sitting the same (name, year, term) for this grade
+        from .services.merit_list import merit_list_for_exam
+        ordered = merit_list_for_exam(exam, get_tenant(request).school_id)['students']
+        grade_pos = next((st['position'] for st in ordered if str(st['id']) == str(student_id)), None)
 
         return Response({
             'class': {'position': class_pos, 'size': len(class_list)},
@@ -685,15 +708,12 @@ class ExamViewSet(viewsets.ModelViewSet):
 
         # Build subject means delta by subject id intersection
         subj_ids = set([s['id'] for s in sum_a['subjects']]) | set([s['id'] for s in sum_b['subjects']])
-        def find_mean(summary, sid):
-            for item in summary.get('subject_means', []):
-                if str(item.get('subject')) == str(sid) or item.get('subject') == sid:
-                    return item.get('mean')
-            return None
+        means_a = {str(item.get('subject')): item.get('mean') for item in sum_a.get('subject_means', [])}
+        means_b = {str(item.get('subject')): item.get('mean') for item in sum_b.get('subject_means', [])}
         deltas = []
         for sid in subj_ids:
-            ma = find_mean(sum_a, sid)
-            mb = find_mean(sum_b, sid)
+            ma = means_a.get(str(sid))
+            mb = means_b.get(str(sid))
             if ma is None and mb is None:
                 continue
             deltas.append({'subject': sid, 'mean_a': ma, 'mean_b': mb, 'delta': (None if (ma is None or mb is None) else round(mb - ma, 2))})
@@ -714,6 +734,50 @@ class ExamViewSet(viewsets.ModelViewSet):
             }
         })
 
+    @action(detail=False, methods=['get'], permission_classes=[IsTeacherOrAdmin], url_path='compare-many')
+    def compare_many(self, request):
+        """Compare N exams (e.g. CAT1..CAT5, or Term 1 vs Term 3) as compact matrices.
+        Query params:
+          - exams: comma-separated exam ids, in column order (2 to 20)
+          - scope: 'exam' (default) or 'grade' to widen each exam to every stream sitting it
+            that the requester can open
+        Returns columns, subjects and students plus subject_means [column][subject],
+        totals/percentages/positions [student][column], consecutive deltas and first-to-last change.
+        """
+        from .services.exam_comparison import compare_exam_groups
+        from .services.exam_analytics import grade_cohort_exams
+        raw = [x.strip() for x in str(request.query_params.get('exams', '')).split(',') if x.strip()]
+        try:
+            ids = list(dict.fromkeys(int(x) for x in raw))
+        except ValueError:
+            return Response({'detail': 'exams must be a comma-separated list of ids'}, status=status.HTTP_400_BAD_REQUEST)
+        if not 2 <= len(ids) <= 20:
+            return Response({'detail': 'Provide between 2 and 20 exam ids'}, status=status.HTTP_400_BAD_REQUEST)
+        found = {e.id: e for e in self.get_queryset().filter(pk__in=ids).select_related('klass')}
+        if len(found) != len(ids):
+            return Response({'detail': 'One or more exams not found or not accessible'}, status=status.HTTP_404_NOT_FOUND)
+        exams = [found[i] for i in ids]
+        scope = str(request.query_params.get('scope', 'exam')).lower()
+        if scope == 'grade':
+            visible = self.get_queryset().values('pk')
+            groups, labels, seen = [], [], set()
+            for e in exams:
+                # Streams of one common exam widen to the same cohort; compare it once.
+                # Only the streams the requester can open (teachers: classes they teach)
+                group = list(grade_cohort_exams(e).filter(pk__in=visible)) or [e]
+                key = frozenset(x.id for x in group)
+                if key in seen:
+                    continue
+                seen.add(key)
+                groups.append(group)
+                labels.append(f"{e.name} ({e.grade_level_tag or getattr(e.klass, 'grade_level', '')})")
+        else:
+            groups = [[e] for e in exams]
+            labels = [f"{e.name} - {getattr(e.klass, 'name', '')}" for e in exams]
+        data = compare_exam_groups(groups, labels)
+        data['scope'] = 'grade' if scope == 'grade' else 'exam'
+        return Response(data)
+
     @action(detail=True, methods=['get'], permission_classes=[IsTeacherOrAdmin], url_path='compare-subjects')
     def compare_subjects(self, request, pk=None):
         """Compare two subjects within a single exam.
@@ -771,45 +835,91 @@ class ExamViewSet(viewsets.ModelViewSet):
             return Response(self._build_summary(exam))
         # Teachers: allow if published or assigned to the class
         if getattr(user, 'role', None) == 'teacher':
-            is_class_teacher = getattr(exam.klass, 'teacher_id', None) == getattr(user, 'id', None)
-            is_subject_teacher = ClassSubjectTeacher.objects.filter(klass=exam.klass, teacher=user).exists()
+            is_assigned = teacher_scope(request).teaches_class(exam.klass_id)
             is_published = bool(getattr(exam, 'published', False)) or str(getattr(exam, 'status', '')).lower() == 'published'
-            if is_published or is_class_teacher or is_subject_teacher:
+            if is_published or is_assigned:
                 return Response(self._build_summary(exam))
             return Response({'detail': 'You do not have permission to perform this action.'}, status=status.HTTP_403_FORBIDDEN)
         # Default deny
         return Response({'detail': 'You do not have permission to perform this action.'}, status=status.HTTP_403_FORBIDDEN)
 
+    @action(detail=True, methods=['get'], permission_classes=[IsTeacherOrAdmin], url_path='analytics')
+    def analytics(self, request, pk=None):
+        """Per-subject distribution analytics for an exam.
+        Query params:
+          - scope: 'exam' (default) or 'grade' to include every stream sitting the same exam
+            that the requester can open
+          - top: number of top/bottom performers to list (default 5, max 50)
+        Returns per subject: count, mean, median, std, min, max, percentiles, histogram (10% bins),
+        grading-band counts (SubjectGradingBand, else the default A-E table), top/bottom and per-class means.
+        """
+        from .services.exam_analytics import compute_exam_analytics, grade_cohort_exams
+        exam = self.get_object()
+        scope = str(request.query_params.get('scope', 'exam')).lower()
+        try:
+            top = max(0, min(int(request.query_params.get('top', 5)), 50))
+        except (TypeError, ValueError):
+            top = 5
+        exams = [exam]
+        if scope == 'grade':
+            # Only the streams the requester can open (teachers: classes they teach)
+            exams = list(grade_cohort_exams(exam).filter(pk__in=self.get_queryset().values('pk'))) or [exam]
+        data = compute_exam_analytics(exams, top=top)
+        data['scope'] = 'grade' if scope == 'grade' else 'exam'
+        return Response(data)
+
+    @action(detail=True, methods=['get', 'patch'], permission_classes=[IsTeacherOrAdmin], url_path='matrix')
+    def matrix(self, request, pk=None):
+        """Marks grid for an exam as compact parallel arrays.
+        GET -> { exam, version, students: {ids, names, admission_nos},
+                 columns: {keys, subject_ids, component_ids, labels, max_marks}, values: [[marks|null]] }
+        PATCH { version, cells: [{student, column|subject+component, marks|null, out_of?}] }
+          writes only the given cells (null marks deletes). version is required; a stale one
+          returns 409 with the current one.
+        """
+        from .services.results_matrix import build_matrix, apply_matrix_changes, MatrixConflict
+        exam = self.get_object()
+        if request.method == 'GET':
+            return Response(build_matrix(exam))
+        if not self._can_manage_exam(request, exam):
+            return Response({'detail': 'You do not have permission to modify this exam'}, status=status.HTTP_403_FORBIDDEN)
+        cells = request.data.get('cells')
+        if not isinstance(cells, list):
+            return Response({'detail': 'cells must be an array'}, status=400)
+        version = request.data.get('version')
+        if not version or not isinstance(version, str):
+            return Response({'detail': 'version is required (from GET matrix)'}, status=400)
+        try:
+            result = apply_matrix_changes(exam, cells, version, user=request.user)
+        except MatrixConflict as e:
+            return Response({'detail': str(e), 'version': e.version}, status=status.HTTP_409_CONFLICT)
+        if result.get('errors'):
+            return Response({'detail': 'No changes saved', 'errors': result['errors']}, status=400)
+        return Response(result)
+
     @action(detail=True, methods=['get'], permission_classes=[IsAdmin], url_path='summary-csv')
     def summary_csv(self, request, pk=None):
         exam = self.get_object()
-        school = getattr(request.user, 'school', None)
+        school = self._letterhead_school(request)
         data = self._build_summary(exam)
-        # Build CSV
-        import csv
-        sio = StringIO()
-        writer = csv.writer(sio)
-        # Header section
-        writer.writerow([school.name if school else '', exam.name, f"Year {exam.year}", f"Term {exam.term}"])
-        if school and getattr(school, 'motto', ''):
-            writer.writerow([school.motto])
-        writer.writerow([])
-        # Table header
-        head = ['Position','Student'] + [(s.get('name') or s.get('code')) for s in data['subjects']] + ['Total','Average']
-        writer.writerow(head)
-        for st in data['students']:
-            row = [st['position'], st['name']]
-            for s in data['subjects']:
-                row.append(st['marks'].get(str(s['id']), ''))
-            row += [st['total'], st['average']]
-            writer.writerow(row)
-        writer.writerow([])
-        writer.writerow(['Class Mean', data['class_mean']])
-        writer.writerow(['Subject Means'] + [f"{(s.get('name') or s.get('code'))}:{next((m['mean'] for m in data['subject_means'] if m['subject']==s['id']),0)}" for s in data['subjects']])
-        csv_text = sio.getvalue()
-        resp = HttpResponse(csv_text, content_type='text/csv; charset=utf-8')
-        resp['Content-Disposition'] = f'attachment; filename="exam_{exam.id}_summary.csv"'
-        return resp
+        from reports.exports import export_response
+        means = {m['subject']: m['mean'] for m in data['subject_means']}
+
+        def rows():
+            # Header section
+            yield [school.name if school else '', exam.name, f"Year {exam.year}", f"Term {exam.term}"]
+            if school and getattr(school, 'motto', ''):
+                yield [school.motto]
+            yield []
+            # Table header
+            yield ['Position','Student'] + [(s.get('name') or s.get('code')) for s in data['subjects']] + ['Total','Average']
+            for st in data['students']:
+                yield [st['position'], st['name']] + [st['marks'].get(str(s['id']), '') for s in data['subjects']] + [st['total'], st['average']]
+            yield []
+            yield ['Class Mean', data['class_mean']]
+            yield ['Subject Means'] + [f"{(s.get('name') or s.get('code'))}:{means.get(s['id'], 0)}" for s in data['subjects']]
+
+        return export_response(request, rows, f'exam_{exam.id}_summary', sheet_title='Summary')
 
     @action(detail=True, methods=['get'], permission_classes=[permissions.IsAuthenticated], url_path='report-card-pdf')
     def report_card_pdf(self, request, pk=None):
@@ -829,10 +939,9 @@ class ExamViewSet(viewsets.ModelViewSet):
         user = request.user
         if not self._is_admin(request):
             if getattr(user, 'role', None) == 'teacher':
-                is_class_teacher = getattr(exam.klass, 'teacher_id', None) == getattr(user, 'id', None)
-                is_subject_teacher = ClassSubjectTeacher.objects.filter(klass=exam.klass, teacher=user).exists()
+                is_assigned = teacher_scope(request).teaches_class(exam.klass_id)
                 is_published = bool(getattr(exam, 'published', False)) or str(getattr(exam, 'status', '')).lower() == 'published'
-                if not (is_published or is_class_teacher or is_subject_teacher):
+                if not (is_published or is_assigned):
                     return Response({'detail': 'You do not have permission to perform this action.'}, status=status.HTTP_403_FORBIDDEN)
             elif getattr(user, 'role', None) == 'student':
                 is_published = bool(getattr(exam, 'published', False)) or str(getattr(exam, 'status', '')).lower() == 'published'
@@ -884,7 +993,7 @@ class ExamViewSet(viewsets.ModelViewSet):
             canvas.drawPath(p, fill=1, stroke=0)
             canvas.restoreState()
 
-        school = getattr(request.user, 'school', None)
+        school = self._letterhead_school(request)
         logo_path = None
         try:
             if school and getattr(school, 'logo', None) and getattr(school.logo, 'path', None):
@@ -928,9 +1037,9 @@ class ExamViewSet(viewsets.ModelViewSet):
                 term=exam.term,
                 klass__grade_level=grade_level,
             )
-            school_scope = getattr(getattr(self.request, 'user', None), 'school', None)
+            school_scope = get_tenant(self.request).school_id
             if school_scope:
-                same_grade_exams = same_grade_exams.filter(klass__school=school_scope)
+                same_grade_exams = same_grade_exams.filter(klass__school_id=school_scope)
             rows_ag = ExamResult.objects.filter(exam__in=same_grade_exams).values('student_id').annotate(total=Sum('marks'))
             totals_map = {r['student_id']: float(r['total'] or 0) for r in rows_ag}
             ordered = sorted(totals_map.items(), key=lambda x: x[1], reverse=True)
@@ -1110,7 +1219,9 @@ class ExamViewSet(viewsets.ModelViewSet):
             try:
                 exam_local = Exam.objects.select_related('klass','klass__school').get(pk=exam_id)
                 # Import here to avoid hard deps if communications app changes
-                from communications.utils import send_sms, send_email_with_attachment, send_email_safe, create_messages_for_users
+                from communications.utils import create_messages_for_users
+                from communications.models import DeliveryAttempt
+                from communications.services.delivery_log import DeliveryLog
 
                 # Gather results grouped by student
                 res = ExamResult.objects.filter(exam=exam_local).select_related('student','subject')
@@ -1129,6 +1240,8 @@ class ExamViewSet(viewsets.ModelViewSet):
 
                 # Build a simple subject list for column order
                 subjects = list(exam_local.klass.subjects.all())
+                # SMS/email outcomes are recorded per recipient and written in bulk after the loop
+                log = DeliveryLog(DeliveryAttempt.Source.EXAM, exam_local.id, school_id=exam_local.klass.school_id)
 
                 # Send messages per student
                 chat_user_ids = []
@@ -1161,19 +1274,16 @@ class ExamViewSet(viewsets.ModelViewSet):
                         + (f"{subj_summary}. " if subj_summary else "")
                         + f"Total: {round(total,2)}, Avg: {avg}. Login: {dashboard_url}"
                     )
-                    try:
-                        phone = getattr(s, 'guardian_id', None)
-                        if phone:
-                            send_sms(phone, sms)
-                    except Exception:
-                        pass
+                    phone = getattr(s, 'guardian_id', None)
+                    if phone:
+                        log.sms(phone, sms, user_id=getattr(s, 'user_id', None))
 
                     # Collect for chat mirror and in-app notifications
                     if getattr(s, 'user_id', None):
                         chat_user_ids.append(s.user_id)
                         try:
                             from communications.models import Notification
-                            notifications_bulk.append(Notification(user_id=s.user_id, message=sms, type='in_app'))
+                            notifications_bulk.append(Notification(user_id=s.user_id, message=sms, type='in_app', school_id=exam_local.klass.school_id))
                         except Exception:
                             pass
 
@@ -1322,21 +1432,12 @@ class ExamViewSet(viewsets.ModelViewSet):
                         except Exception:
                             attachment_bytes = None
                     # Send
-                    try:
-                        if recipient:
-                            if attachment_bytes:
-                                send_email_with_attachment(
-                                    subject=f"{exam_local.name} Results",
-                                    message=body,
-                                    recipient=recipient,
-                                    filename=filename,
-                                    content=attachment_bytes,
-                                    mimetype='application/pdf'
-                                )
-                            else:
-                                send_email_safe(f"{exam_local.name} Results", body, recipient)
-                    except Exception:
-                        pass
+                    if recipient:
+                        log.email(
+                            f"{exam_local.name} Results", body, recipient, user_id=getattr(s, 'user_id', None),
+                            attachment=(filename, attachment_bytes, 'application/pdf') if attachment_bytes else None,
+                        )
+                log.flush()
 
                 # Create in-app notifications in bulk (best-effort)
                 try:
@@ -1374,7 +1475,7 @@ class ExamViewSet(viewsets.ModelViewSet):
     @action(detail=True, methods=['get'], permission_classes=[IsAdmin], url_path='summary-pdf')
     def summary_pdf(self, request, pk=None):
         exam = self.get_object()
-        school = getattr(request.user, 'school', None)
+        school = self._letterhead_school(request)
         data = self._build_summary(exam)
         if not REPORTLAB_AVAILABLE:
             return Response({'detail': 'PDF generation library not installed. Please install reportlab.'}, status=500)
@@ -1514,7 +1615,7 @@ class ExamViewSet(viewsets.ModelViewSet):
         return resp
 
 
-class ExamResultViewSet(viewsets.ModelViewSet):
+class ExamResultViewSet(SchoolScopedMixin, viewsets.ModelViewSet):
     queryset = ExamResult.objects.all()
     serializer_class = ExamResultSerializer
     # Students should be able to read their own published results; teachers/admins can access as scoped in get_queryset
@@ -1522,9 +1623,6 @@ class ExamResultViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         qs = super().get_queryset().select_related('exam','student','subject')
-        school = getattr(getattr(self.request, 'user', None), 'school', None)
-        if school:
-            qs = qs.filter(exam__klass__school=school)
         # optional filters
         exam_id = self.request.query_params.get('exam')
         if exam_id:
@@ -1545,21 +1643,21 @@ class ExamResultViewSet(viewsets.ModelViewSet):
             if self.request.method in permissions.SAFE_METHODS:
                 qs = qs.filter(exam__published=True)
             else:
-                qs = qs.filter(Q(exam__klass__teacher=user) | Q(exam__klass__subject_teachers__teacher=user)).distinct()
+                qs = qs.filter(exam__klass_id__in=teacher_scope(self.request).class_ids)
         # If requester is a student (not staff), only show published exams and their own results
         if getattr(user, 'role', None) == 'student' and not (user.is_staff or user.is_superuser):
             qs = qs.filter(exam__published=True, student__user=user)
         return qs
 
     def perform_create(self, serializer):
-        school = getattr(getattr(self.request, 'user', None), 'school', None)
+        school_id = get_tenant(self.request).school_id
         exam = serializer.validated_data.get('exam')
         subject = serializer.validated_data.get('subject')
         component = serializer.validated_data.get('component')
         marks = serializer.validated_data.get('marks')
         out_of = serializer.validated_data.get('out_of')
         user = getattr(self.request, 'user', None)
-        if school and exam and exam.klass.school_id != school.id:
+        if school_id and exam and exam.klass.school_id != school_id:
             raise ValidationError({'exam': 'Exam must belong to your school'})
         # Component belongs to subject
         if component and subject and component.subject_id != subject.id:
@@ -1600,23 +1698,9 @@ class ExamResultViewSet(viewsets.ModelViewSet):
                     raise ValidationError({'marks': f'Marks cannot exceed maximum ({target_max})'})
         # If teacher, ensure they are allowed to submit for this class/subject
         if user and getattr(user, 'role', None) == 'teacher' and not (user.is_staff or user.is_superuser):
-            allowed = False
-            reason = ''
-            if exam and exam.klass and exam.klass.teacher_id == user.id:
-                allowed = True
-                reason = 'class_teacher'
-            if not allowed and exam and subject:
-                # Exact subject assignment
-                if ClassSubjectTeacher.objects.filter(klass=exam.klass, teacher=user, subject=subject).exists():
-                    allowed = True
-                    reason = 'subject_teacher_exact'
-                else:
-                    # Fallback: teacher mapped to the class for any subject and chosen subject belongs to the class
-                    mapped_any = ClassSubjectTeacher.objects.filter(klass=exam.klass, teacher=user).exists()
-                    subject_in_class = exam.klass.subjects.filter(pk=getattr(subject, 'id', None)).exists()
-                    if mapped_any and subject_in_class:
-                        allowed = True
-                        reason = 'subject_teacher_class_scope'
+            # Class teacher -> any subject; otherwise an exact subject mapping, or any mapping in
+            # the class when the chosen subject belongs to the class
+            allowed = bool(exam) and teacher_scope(self.request).can_enter(exam.klass_id, getattr(subject, 'id', None))
             if not allowed:
                 raise ValidationError({'detail': 'You are not assigned to this class/subject for this exam', 'code': 'not_assigned'})
         # Upsert to avoid unique_together conflicts (exam, student, subject)
@@ -1689,8 +1773,8 @@ class ExamResultViewSet(viewsets.ModelViewSet):
                 errors.append({'index': idx, 'error': {'component': 'Not found'}})
                 continue
             # Basic scope + marks validations (similar to perform_create)
-            school = getattr(getattr(request, 'user', None), 'school', None)
-            if school and exam and exam.klass.school_id != school.id:
+            school_id = get_tenant(request).school_id
+            if school_id and exam and exam.klass.school_id != school_id:
                 errors.append({'index': idx, 'error': {'exam': 'Exam must belong to your school'}})
                 continue
             # Component belongs to subject
@@ -1706,17 +1790,7 @@ class ExamResultViewSet(viewsets.ModelViewSet):
                 pass
             # Teacher permission: same rules as perform_create
             if user and getattr(user, 'role', None) == 'teacher' and not (user.is_staff or user.is_superuser):
-                allowed = False
-                if exam and exam.klass and exam.klass.teacher_id == user.id:
-                    allowed = True
-                if not allowed and exam and subject:
-                    if ClassSubjectTeacher.objects.filter(klass=exam.klass, teacher=user, subject=subject).exists():
-                        allowed = True
-                    else:
-                        mapped_any = ClassSubjectTeacher.objects.filter(klass=exam.klass, teacher=user).exists()
-                        subject_in_class = exam.klass.subjects.filter(pk=getattr(subject, 'id', None)).exists()
-                        if mapped_any and subject_in_class:
-                            allowed = True
+                allowed = bool(exam) and teacher_scope(request).can_enter(exam.klass_id, getattr(subject, 'id', None))
                 if not allowed:
                     errors.append({'index': idx, 'error': {'detail': 'You are not assigned to this class/subject for this exam'}})
                     continue
@@ -1786,6 +1860,11 @@ class ExamResultViewSet(viewsets.ModelViewSet):
         - component: optional subject component ID
         - out_of: optional numeric total marks to scale from
         - commit: boolean; if false or omitted, returns a preview; if true, saves
+        - upload_token: returned by the preview; send it instead of the file to commit without re-parsing
+        - ocr_job: images are OCR'd in the background; the first preview answers 202 with an ocr_job and
+                   status_url. Once the job is done, preview again with ocr_job (or the same image).
+        - overrides: optional JSON array of row fixes applied before matching,
+                     e.g. [{"index": 3, "student": 42}, {"index": 5, "marks": 61}, {"index": 7, "skip": true}]
         - column_map: optional JSON object mapping your headers to expected keys,
                        e.g. {"admission_no":"ADM", "name":"Student Name", "marks":"Score"}
 
@@ -1827,8 +1906,8 @@ class ExamResultViewSet(viewsets.ModelViewSet):
             return Response({'detail': 'invalid identifiers'}, status=400)
 
         # School scope and component-subject consistency
-        school = getattr(getattr(request, 'user', None), 'school', None)
-        if school and exam.klass.school_id != getattr(school, 'id', None):
+        school_id = get_tenant(request).school_id
+        if school_id and exam.klass.school_id != school_id:
             return Response({'detail': 'Exam must belong to your school'}, status=403)
         if component and component.subject_id != subject.id:
             return Response({'detail': 'Component does not belong to the selected subject'}, status=400)
@@ -1842,18 +1921,7 @@ class ExamResultViewSet(viewsets.ModelViewSet):
         # Teacher permissions (same as bulk)
         user = getattr(request, 'user', None)
         if user and getattr(user, 'role', None) == 'teacher' and not (user.is_staff or user.is_superuser):
-            allowed = False
-            if exam and exam.klass and exam.klass.teacher_id == user.id:
-                allowed = True
-            if not allowed and subject:
-                if ClassSubjectTeacher.objects.filter(klass=exam.klass, teacher=user, subject=subject).exists():
-                    allowed = True
-                else:
-                    mapped_any = ClassSubjectTeacher.objects.filter(klass=exam.klass, teacher=user).exists()
-                    subject_in_class = exam.klass.subjects.filter(pk=getattr(subject, 'id', None)).exists()
-                    if mapped_any and subject_in_class:
-                        allowed = True
-            if not allowed:
+            if not teacher_scope(request).can_enter(exam.klass_id, getattr(subject, 'id', None)):
                 return Response({'detail': 'You are not assigned to this class/subject for this exam'}, status=403)
 
         # Load roster for matching
@@ -1885,233 +1953,51 @@ class ExamResultViewSet(viewsets.ModelViewSet):
                 return None
         by_name = {_norm_name(getattr(s, 'name', '')): s for s in class_students if getattr(s, 'name', None)}
 
-        # Helper to normalize columns
-        def resolve_columns(header):
-            hmap = {str(k).strip().lower(): k for k in header}
-            def pick(*cands):
-                for c in cands:
-                    if c in hmap:
-                        return hmap[c]
-                return None
-            if column_map and isinstance(column_map, dict):
-                id_col = column_map.get('student_id')
-                adm_col = column_map.get('admission_no')
-                name_col = column_map.get('name')
-                marks_col = column_map.get('marks')
-            else:
-                id_col = pick('student_id','id')
-                adm_col = pick('admission_no','adm','adm_no','admission')
-                name_col = pick('name','student','student_name')
-                marks_col = pick('marks','score','points')
-            return id_col, adm_col, name_col, marks_col
-
-        # Parse incoming file (CSV/XLSX) or attempt OCR on images
-        rows = []  # list of dicts {student_id?, admission_no?, name?, marks?}
-        ocr_text = None
-        raw_lines = []
+        # Parse the file once; a commit may send the preview's upload_token instead of the file
+        from .services.marks_upload import (
+            OcrPending, UploadParseError, UPLOAD_TTL, apply_row_overrides, discard_upload, get_parsed_upload,
+            parse_ocr_job, parse_upload_cached,
+        )
+        from .services import ocr as ocr_service
+        user_id = getattr(user, 'id', None)
+        upload_token = request.data.get('upload_token')
+        ocr_job_id = request.data.get('ocr_job')
         if file:
-            fname = getattr(file, 'name', 'upload').lower()
-            if fname.endswith('.csv'):
-                # Robust CSV handling: try utf-8-sig, fall back to utf-8/latin1, sniff delimiter
-                raw = file.read()
-                try:
-                    text = raw.decode('utf-8-sig')
-                except Exception:
-                    try:
-                        text = raw.decode('utf-8')
-                    except Exception:
-                        text = raw.decode('latin1', errors='ignore')
-                import csv as _csv
-                try:
-                    sniffer = _csv.Sniffer()
-                    dialect = sniffer.sniff(text[:4096])
-                    delim = dialect.delimiter
-                except Exception:
-                    # Common alternates if sniff fails
-                    if '\t' in text and text.count('\t') > text.count(','):
-                        delim = '\t'
-                    elif ';' in text and text.count(';') > text.count(','):
-                        delim = ';'
-                    else:
-                        delim = ','
-                reader = _csv.DictReader(StringIO(text), delimiter=delim)
-                id_col, adm_col, name_col, marks_col = resolve_columns(reader.fieldnames or [])
-                for r in reader:
-                    rows.append({
-                        'student_id': r.get(id_col) if id_col else None,
-                        'admission_no': r.get(adm_col) if adm_col else None,
-                        'name': r.get(name_col) if name_col else None,
-                        'marks': r.get(marks_col) if marks_col else None,
-                    })
-            elif fname.endswith('.xlsx') or fname.endswith('.xls'):
-                try:
-                    from openpyxl import load_workbook
-                except Exception:
-                    return Response({'detail': 'openpyxl is required to parse Excel files. Please install it on the server.'}, status=500)
-                wb = load_workbook(file, read_only=True, data_only=True)
-                ws = wb.active
-                header = []
-                data_started = False
-                for i, row in enumerate(ws.iter_rows(values_only=True), start=1):
-                    if i == 1:
-                        header = [str(c).strip() if c is not None else '' for c in row]
-                        id_col, adm_col, name_col, marks_col = resolve_columns(header)
-                        data_started = True
-                        continue
-                    if not data_started:
-                        continue
-                    values = list(row)
-                    def get(col_name):
-                        if not col_name:
-                            return None
-                        idx = header.index(col_name)
-                        return values[idx] if idx < len(values) else None
-                    rows.append({
-                        'student_id': get(id_col),
-                        'admission_no': get(adm_col),
-                        'name': get(name_col),
-                        'marks': get(marks_col),
-                    })
-            elif any(fname.endswith(ext) for ext in ('.png','.jpg','.jpeg','.bmp','.webp','.tif','.tiff')):
-                # OCR via pytesseract if available
-                try:
-                    from PIL import Image as _Image
-                    import pytesseract as _pyt
-                    # Try to auto-configure tesseract path on Windows via env var
-                    import os as _os
-                    tpath = _os.environ.get('TESSERACT_CMD') or _os.environ.get('TESSERACT_PATH')
-                    if tpath:
-                        try:
-                            _pyt.pytesseract.tesseract_cmd = tpath
-                        except Exception:
-                            pass
-                except Exception:
-                    return Response({'detail': 'OCR not available. Install pytesseract and the Tesseract OCR binary to read images.'}, status=500)
-                try:
-                    img = _Image.open(file)
-                    # Basic pre-processing to improve OCR
-                    try:
-                        from PIL import ImageOps as _ImageOps, ImageFilter as _ImageFilter, ImageEnhance as _ImageEnhance
-                        img = img.convert('L')  # grayscale
-                        img = _ImageOps.autocontrast(img)
-                        # Slight upscale for small screenshots
-                        try:
-                            if img.width < 1600:
-                                scale = 1600 / float(img.width)
-                                img = img.resize((int(img.width*scale), int(img.height*scale)), _Image.LANCZOS)
-                        except Exception:
-                            pass
-                        img = img.filter(_ImageFilter.SHARPEN)
-                        img = _ImageEnhance.Contrast(img).enhance(1.2)
-                    except Exception:
-                        pass
-                    # If tesseract is not in PATH and not configured above, this will raise an error
-                    config = '--oem 3 --psm 6'
-                    text = _pyt.image_to_string(img, lang='eng', config=config)
-                    if not text or not text.strip():
-                        # Fallback: reconstruct lines from word-level data
-                        try:
-                            from pytesseract import Output as _Output
-                            data = _pyt.image_to_data(img, lang='eng', config=config, output_type=_Output.DICT)
-                            lines = {}
-                            for i in range(len(data.get('text', []))):
-                                word = str(data['text'][i] or '').strip()
-                                if not word:
-                                    continue
-                                key = (data.get('block_num',[0])[i], data.get('par_num',[0])[i], data.get('line_num',[0])[i])
-                                lines.setdefault(key, []).append(word)
-                            text = '\n'.join(' '.join(words) for _, words in sorted(lines.items()))
-                        except Exception:
-                            pass
-                    ocr_text = text
-                    import re as _re
-                    # Strategy:
-                    # - Split by lines
-                    # - For each non-empty line, attempt several patterns
-                    #   1) CSV/TSV-like: id,name,marks OR admission,name,marks
-                    #   2) Free text with last number as marks: <anything name> <number>
-                    #   3) Hyphen/colon separated: name - number, name: number
-                    number_re = _re.compile(r"(?P<marks>\d+(?:\.\d+)?)\s*$")
-                    # Common separators: commas, tabs, multiple spaces, dashes, colons
-                    sep_re = _re.compile(r"[,\t]|\s{2,}|\s-\s|\s–\s|\s—\s|:\s")
-                    for raw in text.splitlines():
-                        l = str(raw or '').strip()
-                        if not l:
-                            continue
-                        raw_lines.append(l)
-                        # Try CSV/TSV or obvious separators first
-                        parts = [p.strip() for p in sep_re.split(l) if str(p).strip()]
-                        sid = None; adm = None; nm = None; mk = None
-                        if len(parts) >= 2:
-                            # If the last part is numeric, take it as marks
-                            if parts[-1].replace('.', '', 1).isdigit():
-                                mk = parts[-1]
-                                # Reconstruct a plausible name from remaining parts, ignoring an initial numeric id
-                                rest = parts[:-1]
-                                if rest and str(rest[0]).isdigit():
-                                    # first token is student_id
-                                    sid = rest[0]
-                                    # if the next token looks like an admission number, take it
-                                    if len(rest) >= 2:
-                                        # simple heuristic: contains letters+digits or a hyphen
-                                        t1 = rest[1]
-                                        if any(c.isalpha() for c in t1) and any(c.isdigit() for c in t1):
-                                            adm = t1
-                                            nm = ' '.join(rest[2:])
-                                        else:
-                                            nm = ' '.join(rest[1:])
-                                    else:
-                                        nm = ''
-                                else:
-                                    # if first token looks like an admission, keep it and name is the rest
-                                    if rest and any(c.isalpha() for c in rest[0]) and any(c.isdigit() for c in rest[0]):
-                                        adm = rest[0]
-                                        nm = ' '.join(rest[1:])
-                                    else:
-                                        nm = ' '.join(rest)
-                        # If still no marks, fallback: find trailing number with regex
-                        if mk is None:
-                            m = number_re.search(l)
-                            if m:
-                                mk = m.group('marks')
-                                pre = l[:m.start()].strip()
-                                # Tokenize on whitespace to extract id/admission/name
-                                toks = [t for t in pre.split() if t]
-                                if toks:
-                                    # Case A: first token numeric -> student_id
-                                    if toks[0].isdigit():
-                                        sid = toks[0]
-                                        rest = toks[1:]
-                                        if rest:
-                                            # If next token looks like an admission (letters+digits or contains '-')
-                                            t1 = rest[0]
-                                            if any(c.isalpha() for c in t1) and any(c.isdigit() for c in t1):
-                                                adm = t1
-                                                nm = ' '.join(rest[1:])
-                                            else:
-                                                nm = ' '.join(rest)
-                                        else:
-                                            nm = ''
-                                    else:
-                                        # Case B: start with admission then name
-                                        if any(c.isalpha() for c in toks[0]) and any(c.isdigit() for c in toks[0]):
-                                            adm = toks[0]
-                                            nm = ' '.join(toks[1:])
-                                        else:
-                                            # Case C: just name before number
-                                            nm = pre
-                        # Append if we extracted at least a name or id and marks
-                        if mk is not None and (nm or adm or sid):
-                            rows.append({'student_id': sid, 'admission_no': adm, 'name': nm, 'marks': mk})
-                except Exception as ex:
-                    # Provide clearer guidance for missing binary
-                    msg = str(ex)
-                    help_hint = 'Tesseract is not installed or not on PATH. Install Tesseract OCR and, if needed, set env var TESSERACT_CMD to the tesseract.exe full path.'
-                    return Response({'detail': f'OCR parse failed: {msg}', 'hint': help_hint}, status=400)
-            else:
-                return Response({'detail': 'Unsupported file type. Use CSV, XLSX/XLS, or an image.'}, status=400)
+            try:
+                upload_token, parsed = parse_upload_cached(user_id, getattr(file, 'name', 'upload'), file.read(), column_map)
+            except OcrPending as p:
+                # Images are read in the OCR pool; poll status_url, then preview again with ocr_job
+                return Response(ocr_service.job_payload(p.job), status=202)
+            except ocr_service.OcrBusy as e:
+                return Response({'detail': str(e)}, status=503)
+            except UploadParseError as e:
+                return Response(e.as_response_data(), status=e.status)
+        elif ocr_job_id:
+            job = ocr_service.get_job(str(ocr_job_id))
+            if not job or job.get('user_id') != user_id:
+                return Response({'detail': 'OCR job not found'}, status=404)
+            if job['status'] != 'done':
+                return Response(ocr_service.job_payload(job), status=202 if job['status'] in ('queued', 'running') else 400)
+            try:
+                upload_token, parsed = parse_ocr_job(user_id, job, column_map)
+            except UploadParseError as e:
+                return Response(e.as_response_data(), status=e.status)
+        elif upload_token:
+            parsed = get_parsed_upload(user_id, upload_token)
+            if parsed is None:
+                return Response({'detail': 'Upload expired or not found. Please upload the file again.', 'code': 'upload_expired'}, status=400)
         else:
-            return Response({'detail': 'file is required'}, status=400)
+            return Response({'detail': 'file, ocr_job or upload_token is required'}, status=400)
+        overrides = request.data.get('overrides')
+        if isinstance(overrides, str):
+            try:
+                import json as _json
+                overrides = _json.loads(overrides)
+            except Exception:
+                return Response({'detail': 'overrides must be a JSON array'}, status=400)
+        rows = apply_row_overrides(parsed['rows'], overrides)  # list of dicts {student_id?, admission_no?, name?, marks?}; None = skipped
+        ocr_text = parsed.get('ocr_text')
+        raw_lines = parsed.get('ocr_lines') or []
 
         # Validate marks and compute scaling
         def coerce_float(val):
@@ -2170,6 +2056,8 @@ class ExamResultViewSet(viewsets.ModelViewSet):
             return best if best_ratio >= 0.8 else None
 
         for i, r in enumerate(rows):
+            if r is None:
+                continue
             raw_marks = coerce_float(r.get('marks'))
             sid_raw = r.get('student_id')
             adm_raw = r.get('admission_no')
@@ -2239,6 +2127,8 @@ class ExamResultViewSet(viewsets.ModelViewSet):
                 'rows': preview,
                 'would_save': len(to_save),
                 'total_rows': len(rows),
+                'upload_token': upload_token,
+                'expires_in': UPLOAD_TTL,
             }
             if debug_flag and ocr_text is not None:
                 resp['ocr_text'] = ocr_text
@@ -2264,9 +2154,20 @@ class ExamResultViewSet(viewsets.ModelViewSet):
             except Exception as ex:
                 errors.append({'index': idx, 'error': str(ex)})
 
+        if not errors:
+            discard_upload(user_id, upload_token)
         status_code = 200 if not errors else 207
         return Response({'saved': successes, 'failed': len(errors), 'errors': errors, 'ids': saved_ids})
 
+    @action(detail=False, methods=['get'], permission_classes=[IsTeacherOrAdmin], url_path=r'ocr-jobs/(?P<job_id>[0-9a-f]+)')
+    def ocr_job_status(self, request, job_id=None):
+        """Status of an OCR job started by an image upload: queued | running | done | failed."""
+        from .services import ocr as ocr_service
+        job = ocr_service.get_job(job_id)
+        if not job or job.get('user_id') != getattr(request.user, 'id', None):
+            return Response({'detail': 'OCR job not found'}, status=404)
+        return Response(ocr_service.job_payload(job))
+
     @action(
         detail=False,
         methods=['get'],
@@ -2300,23 +2201,12 @@ class ExamResultViewSet(viewsets.ModelViewSet):
             return Response({'detail': 'component not found'}, status=404)
 
         # School scope and teacher permission
-        school = getattr(getattr(request, 'user', None), 'school', None)
-        if school and exam.klass.school_id != getattr(school, 'id', None):
+        school_id = get_tenant(request).school_id
+        if school_id and exam.klass.school_id != school_id:
             return Response({'detail': 'Exam must belong to your school'}, status=403)
         user = getattr(request, 'user', None)
         if user and getattr(user, 'role', None) == 'teacher' and not (user.is_staff or user.is_superuser):
-            allowed = False
-            if exam and exam.klass and exam.klass.teacher_id == user.id:
-                allowed = True
-            if not allowed and subject:
-                if ClassSubjectTeacher.objects.filter(klass=exam.klass, teacher=user, subject=subject).exists():
-                    allowed = True
-                else:
-                    mapped_any = ClassSubjectTeacher.objects.filter(klass=exam.klass, teacher=user).exists()
-                    subject_in_class = exam.klass.subjects.filter(pk=getattr(subject, 'id', None)).exists()
-                    if mapped_any and subject_in_class:
-                        allowed = True
-            if not allowed:
+            if not teacher_scope(request).can_enter(exam.klass_id, getattr(subject, 'id', None)):
                 return Response({'detail': 'You are not assigned to this class/subject for this exam'}, status=403)
 
         # Build CSV
@@ -2363,18 +2253,17 @@ class StudentViewSet(viewsets.ModelViewSet):
         - mutations: admin only
         """
         act = getattr(self, 'action', None)
-        if act in ('my', 'my_update'):
+        if act in ('my', 'my_update', 'my_timeline'):
             return [permissions.IsAuthenticated()]
         if act in ('list', 'retrieve') or self.request.method in permissions.SAFE_METHODS:
             return [IsTeacherOrAdmin()]
         return [IsAdmin()]
     def get_queryset(self):
         qs = super().get_queryset()
-        user = getattr(self.request, 'user', None)
-        school = getattr(user, 'school', None)
-        if school:
+        school_id = get_tenant(self.request).school_id
+        if school_id:
             # Include students in classes of this school OR graduated students scoped by student.school
-            qs = qs.filter(Q(klass__school=school) | Q(school=school))
+            qs = qs.filter(Q(klass__school_id=school_id) | Q(school_id=school_id))
         # Optional grade filter via related class grade_level
         grade = self.request.query_params.get('grade')
         if grade:
@@ -2409,33 +2298,29 @@ class StudentViewSet(viewsets.ModelViewSet):
 
     def perform_create(self, serializer):
         """Ensure school scoping on create: derive school from klass or request.user.school."""
-        user = getattr(self.request, 'user', None)
-        school = getattr(user, 'school', None)
+        school_id = get_tenant(self.request).school_id
         klass = serializer.validated_data.get('klass')
         # If klass provided, ensure it belongs to the same school
-        if klass and school and klass.school_id != getattr(school, 'id', None):
+        if klass and school_id and klass.school_id != school_id:
             raise ValidationError({'klass': 'Class must belong to your school'})
         # Persist school for scoping (when klass is later cleared on graduation)
-        payload_school = getattr(klass, 'school', None) or school
-        serializer.save(school=payload_school)
+        serializer.save(school_id=getattr(klass, 'school_id', None) or school_id)
 
     def perform_update(self, serializer):
         """Validate admin edit and maintain school scoping when class changes.
         - If klass is set, it must belong to admin's school; set student.school from klass.school.
         - If klass is cleared (None), keep existing student.school or fallback to admin's school.
         """
-        user = getattr(self.request, 'user', None)
-        school = getattr(user, 'school', None)
+        school_id = get_tenant(self.request).school_id
         klass = serializer.validated_data.get('klass', serializer.instance.klass)
         # If setting a new class, validate school and update school field
         if klass is not None:
-            if school and getattr(klass, 'school_id', None) not in (None, getattr(school, 'id', None)):
+            if school_id and getattr(klass, 'school_id', None) not in (None, school_id):
                 raise ValidationError({'klass': 'Class must belong to your school'})
-            serializer.save(school=getattr(klass, 'school', None))
+            serializer.save(school_id=getattr(klass, 'school_id', None))
         else:
             # klass cleared (e.g., graduation or temporary unassignment)
-            current_school = getattr(serializer.instance, 'school', None)
-            serializer.save(school=current_school or school)
+            serializer.save(school_id=serializer.instance.school_id or school_id)
 
     @action(detail=False, methods=['get'], permission_classes=[permissions.IsAuthenticated], url_path='my')
     def my(self, request):
@@ -2473,6 +2358,54 @@ class StudentViewSet(viewsets.ModelViewSet):
         serializer.save()
         return Response(serializer.data)
 
+    def _timeline_year(self, request):
+        try:
+            return int(request.query_params.get('year')) if request.query_params.get('year') else None
+        except (TypeError, ValueError):
+            return None
+
+    @action(detail=True, methods=['get'], url_path='timeline')
+    def timeline(self, request, pk=None):
+        """Exam-by-exam performance of one student with deltas against the previous exam.
+        Query params: year (optional)
+        """
+        from .services.timeline import student_timeline
+        student = self.get_object()
+        return Response({
+            'student': {'id': student.id, 'name': student.name, 'admission_no': student.admission_no, 'klass': student.klass_id},
+            'timeline': student_timeline(student, year=self._timeline_year(request)),
+        })
+
+    @action(detail=False, methods=['get'], permission_classes=[permissions.IsAuthenticated], url_path='my/timeline')
+    def my_timeline(self, request):
+        """Timeline for the authenticated student; only published exams are included."""
+        from .services.timeline import student_timeline
+        student = self.get_queryset().filter(user=request.user).first()
+        if not student:
+            return Response({'detail': 'Student record not found for this user'}, status=404)
+        return Response({
+            'student': {'id': student.id, 'name': student.name, 'admission_no': student.admission_no, 'klass': student.klass_id},
+            'timeline': student_timeline(student, published_only=True, year=self._timeline_year(request)),
+        })
+
+    @action(detail=False, methods=['get'], url_path='timelines')
+    def timelines(self, request):
+        """Timelines for every student in a class, for teacher dashboards.
+        Query params: klass (required), year (optional)
+        """
+        from .services.timeline import timelines_for_students
+        klass_id = request.query_params.get('klass')
+        if not klass_id:
+            return Response({'detail': 'klass query parameter is required'}, status=400)
+        students = list(
+            self.get_queryset().filter(klass_id=klass_id).order_by('name').values('id', 'name', 'admission_no')
+        )
+        data = timelines_for_students([s['id'] for s in students], year=self._timeline_year(request))
+        return Response({
+            'klass': klass_id,
+            'students': [{**s, 'timeline': data.get(s['id'], [])} for s in students],
+        })
+
 class CompetencyViewSet(viewsets.ModelViewSet):
     queryset = Competency.objects.all()
     serializer_class = CompetencySerializer
@@ -2482,69 +2415,48 @@ class SubjectViewSet(viewsets.ModelViewSet):
     serializer_class = SubjectSerializer
     permission_classes = [IsAdmin]
     def perform_create(self, serializer):
-        school = getattr(self.request.user, 'school', None)
-        serializer.save(school=serializer.validated_data.get('school', school))
+        if 'school' in serializer.validated_data:
+            serializer.save()
+        else:
+            serializer.save(school_id=get_tenant(self.request).school_id)
     def get_queryset(self):
         qs = super().get_queryset()
-        school = getattr(getattr(self.request, 'user', None), 'school', None)
-        if school:
-            qs = qs.filter(Q(school=school) | Q(school__isnull=True))
+        school_id = get_tenant(self.request).school_id
+        if school_id:
+            qs = qs.filter(Q(school_id=school_id) | Q(school__isnull=True))
         return qs
 
     @action(detail=True, methods=['get'], permission_classes=[IsAdmin], url_path='stats')
     def stats(self, request, pk=None):
+        """Subject analytics for the admin's school.
+        - avg_by_grade: mean marks per grade over each class's latest exam
+        - trend: mean marks over the last N exam sittings per grade (?trend=N, default 5, max 20)
+        - grading: the subject's SubjectGradingBand rows (default A-E table when none configured)
+        Results sections are cached per (subject, school) until results change.
+        """
+        from .services.subject_stats import subject_stats
+        from .services.exam_analytics import grading_bands_for
         subject = self.get_object()
-        school = getattr(request.user, 'school', None)
-        classes_qs = Class.objects.all()
-        if school:
-            classes_qs = classes_qs.filter(school=school)
-        classes_qs = classes_qs.filter(subjects=subject)
-
-        # Latest exam per class
-        latest_exams = []
-        for c in classes_qs:
-            e = Exam.objects.filter(klass=c).order_by('-date','-id').first()
-            if e:
-                latest_exams.append((c, e))
-
-        # Compute avg per class for this subject
-        by_grade = {}
-        for c, e in latest_exams:
-            res = ExamResult.objects.filter(exam=e, subject=subject)
-            if res.exists():
-                avg = res.aggregate(m=Avg('marks'))['m'] or 0
-                g = c.grade_level
-                agg = by_grade.setdefault(g, {'grade_level': g, 'sum': 0.0, 'count': 0})
-                agg['sum'] += float(avg)
-                agg['count'] += 1
-
-        avg_by_grade = [
-            { 'grade_level': g, 'average': round(v['sum']/v['count'], 2) if v['count'] else 0.0, 'classes': v['count'] }
-            for g, v in by_grade.items()
-        ]
+        school_id = get_tenant(request).school_id
         try:
-            avg_by_grade.sort(key=lambda x: float(x['grade_level']))
-        except Exception:
-            avg_by_grade.sort(key=lambda x: str(x['grade_level']))
+            last_n = max(1, min(int(request.query_params.get('trend', 5)), 20))
+        except (TypeError, ValueError):
+            last_n = 5
+        data = subject_stats(subject, school_id, last_n=last_n)
 
         # Teachers
         teachers = TeacherProfile.objects.all()
-        if school:
-            teachers = teachers.filter(Q(user__school=school) | Q(klass__school=school))
+        if school_id:
+            teachers = teachers.filter(Q(user__school_id=school_id) | Q(klass__school_id=school_id))
         teachers = teachers.filter(Q(subjects__icontains=subject.code) | Q(subjects__icontains=subject.name))
         tser = TeacherProfileSerializer(teachers, many=True)
 
-        grading = [
-            {'grade':'A','min':80,'max':100},
-            {'grade':'B','min':70,'max':79},
-            {'grade':'C','min':60,'max':69},
-            {'grade':'D','min':50,'max':59},
-            {'grade':'E','min':0,'max':49},
-        ]
+        grading = sorted(grading_bands_for([subject.id])[subject.id], key=lambda b: b['min'], reverse=True)
 
         return Response({
             'subject': {'id': subject.id, 'code': subject.code, 'name': subject.name},
-            'avg_by_grade': avg_by_grade,
+            'avg_by_grade': data['avg_by_grade'],
+            'trend': data['trend'],
             'teachers': tser.data,
             'grading': grading,
         })
@@ -2560,9 +2472,9 @@ class SubjectComponentViewSet(viewsets.ModelViewSet):
     def get_queryset(self):
         qs = super().get_queryset().select_related('subject')
         # Optional scope by user's school via the parent subject
-        school = getattr(getattr(self.request, 'user', None), 'school', None)
-        if school:
-            qs = qs.filter(subject__school=school)
+        school_id = get_tenant(self.request).school_id
+        if school_id:
+            qs = qs.filter(subject__school_id=school_id)
         return qs
 
     def get_permissions(self):
@@ -2609,17 +2521,17 @@ class LessonPlanViewSet(viewsets.ModelViewSet):
         if user and getattr(user, 'role', None) == 'teacher' and not (user.is_staff or user.is_superuser):
             qs = qs.filter(teacher=user)
         else:
-            school = getattr(user, 'school', None)
-            if school:
-                qs = qs.filter(klass__school=school)
+            school_id = get_tenant(self.request).school_id
+            if school_id:
+                qs = qs.filter(klass__school_id=school_id)
         return qs
 
     def perform_create(self, serializer):
         # Default teacher to the requester; validate class belongs to their school
         user = self.request.user
         klass = serializer.validated_data.get('klass')
-        school = getattr(user, 'school', None)
-        if school and klass and klass.school_id != school.id and not (user.is_staff or user.is_superuser):
+        school_id = get_tenant(self.request).school_id
+        if school_id and klass and klass.school_id != school_id and not (user.is_staff or user.is_superuser):
             raise ValidationError({'klass': 'Class must belong to your school'})
         serializer.save(teacher=user)
 
@@ -2631,16 +2543,16 @@ class RoomViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         qs = super().get_queryset()
-        school = getattr(getattr(self.request, 'user', None), 'school', None)
-        if school:
-            qs = qs.filter(school=school)
+        school_id = get_tenant(self.request).school_id
+        if school_id:
+            qs = qs.filter(school_id=school_id)
         return qs
 
     def perform_create(self, serializer):
-        school = getattr(self.request.user, 'school', None)
-        if not school:
+        school_id = get_tenant(self.request).school_id
+        if not school_id:
             raise ValidationError({'school': 'School is required. Set your user.school in Django admin.'})
-        serializer.save(school=school)
+        serializer.save(school_id=school_id)
 
 
 class TimetableEntryViewSet(viewsets.ModelViewSet):
@@ -2652,19 +2564,19 @@ class TimetableEntryViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         qs = super().get_queryset().select_related('klass','subject','teacher','room','term','klass__stream')
-        school = getattr(getattr(self.request, 'user', None), 'school', None)
-        if school:
-            qs = qs.filter(klass__school=school)
+        school_id = get_tenant(self.request).school_id
+        if school_id:
+            qs = qs.filter(klass__school_id=school_id)
         return qs
 
     def perform_create(self, serializer):
         # Validate school scoping for klass/room consistency
-        school = getattr(self.request.user, 'school', None)
+        school_id = get_tenant(self.request).school_id
         klass = serializer.validated_data.get('klass')
         room = serializer.validated_data.get('room')
-        if school and klass and klass.school_id != school.id:
+        if school_id and klass and klass.school_id != school_id:
             raise ValidationError({'klass': 'Class must belong to your school'})
-        if school and room and room.school_id != school.id:
+        if school_id and room and room.school_id != school_id:
             raise ValidationError({'room': 'Room must belong to your school'})
         serializer.save()
 
@@ -2675,7 +2587,7 @@ class SubjectGradingBandViewSet(viewsets.ModelViewSet):
     filter_backends = [DjangoFilterBackend]
     filterset_fields = ['subject']
 
-class AttendanceViewSet(viewsets.ModelViewSet):
+class AttendanceViewSet(SchoolScopedMixin, viewsets.ModelViewSet):
     queryset = Attendance.objects.all()
     serializer_class = AttendanceSerializer
     permission_classes = [IsTeacherOrAdmin]
@@ -2718,11 +2630,11 @@ class TeacherProfileViewSet(viewsets.ModelViewSet):
         return Response(ser.data)
     def get_queryset(self):
         qs = super().get_queryset().select_related('user', 'klass')
-        school = getattr(getattr(self.request, 'user', None), 'school', None)
-        if school:
+        school_id = get_tenant(self.request).school_id
+        if school_id:
             # TeacherProfile does not have a direct school field; scope by either the user's school
             # or the assigned class's school
-            qs = qs.filter(Q(user__school=school) | Q(klass__school=school))
+            qs = qs.filter(Q(user__school_id=school_id) | Q(klass__school_id=school_id))
         # Optional filter: subject (id or code), matches teacher's subjects string by code or name
         subj_param = self.request.query_params.get('subject')
         if subj_param:
@@ -2746,28 +2658,24 @@ class AcademicYearViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         qs = super().get_queryset()
-        school = getattr(getattr(self.request, 'user', None), 'school', None)
-        if school:
-            qs = qs.filter(school=school)
+        school_id = get_tenant(self.request).school_id
+        if school_id:
+            qs = qs.filter(school_id=school_id)
         return qs
 
     def perform_create(self, serializer):
-        school = getattr(self.request.user, 'school', None)
-        if not school:
+        school_id = get_tenant(self.request).school_id
+        if not school_id:
             raise ValidationError({'school': 'No school associated with your account.'})
-        serializer.save(school=school)
+        serializer.save(school_id=school_id)
 
     @action(detail=False, methods=['get'], permission_classes=[IsTeacherOrAdmin], url_path='current')
     def current(self, request):
-        school = getattr(request.user, 'school', None)
-        if not school:
+        school_id = get_tenant(request).school_id
+        if not school_id:
             return Response({'detail': 'No school associated with user'}, status=400)
-        today = timezone.localdate()
-        # Prefer calendar-based detection
-        obj = AcademicYear.objects.filter(school=school, start_date__lte=today, end_date__gte=today).first()
-        # Fallback to flag if date-based not found
-        if not obj:
-            obj = AcademicYear.objects.filter(school=school, is_current=True).first()
+        # Prefer calendar-based detection; fallback to flag if date-based not found
+        obj = get_school_calendar(school_id).current_year()
         if not obj:
             return Response({'detail': 'Current academic year not found for today and no fallback set'}, status=404)
         return Response(self.get_serializer(obj).data)
@@ -2775,10 +2683,10 @@ class AcademicYearViewSet(viewsets.ModelViewSet):
     @action(detail=False, methods=['get'], permission_classes=[IsTeacherOrAdmin], url_path='mine')
     def mine(self, request):
         """List all academic years for the authenticated user's school (most recent first)."""
-        school = getattr(request.user, 'school', None)
-        if not school:
+        school_id = get_tenant(request).school_id
+        if not school_id:
             return Response({'detail': 'No school associated with user'}, status=400)
-        qs = AcademicYear.objects.filter(school=school).order_by('-start_date')
+        qs = AcademicYear.objects.filter(school_id=school_id).order_by('-start_date')
         page = self.paginate_queryset(qs)
         if page is not None:
             ser = self.get_serializer(page, many=True)
@@ -2804,11 +2712,13 @@ class AcademicYearViewSet(viewsets.ModelViewSet):
     def promote(self, request, pk=None):
         """Explicitly trigger promotion of classes/students for this academic year.
         Safe to call once per year; it creates next-grade classes and moves students accordingly.
+        Pass dry_run=true to preview the plan (moves, renames, graduations, fee holds) without applying it.
         """
         ay = self.get_object()
+        dry_run = str(request.data.get('dry_run', request.query_params.get('dry_run', 'false'))).lower() in ('1','true','yes')
         try:
-            summary = ay.promote_classes()
-            return Response({'detail': 'Promotion completed', 'summary': summary})
+            summary = ay.promote_classes(dry_run=dry_run)
+            return Response({'detail': 'Promotion plan' if dry_run else 'Promotion completed', 'summary': summary})
         except Exception as e:
             return Response({'detail': 'Promotion failed', 'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -2822,27 +2732,23 @@ class TermViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         qs = super().get_queryset().select_related('academic_year')
-        school = getattr(getattr(self.request, 'user', None), 'school', None)
-        if school:
-            qs = qs.filter(academic_year__school=school)
+        school_id = get_tenant(self.request).school_id
+        if school_id:
+            qs = qs.filter(academic_year__school_id=school_id)
         return qs
 
     @action(detail=False, methods=['get'], permission_classes=[IsTeacherOrAdmin], url_path='current')
     def current(self, request):
-        school = getattr(request.user, 'school', None)
-        if not school:
+        school_id = get_tenant(request).school_id
+        if not school_id:
             return Response({'detail': 'No school associated with user'}, status=400)
-        today = timezone.localdate()
+        cal = get_school_calendar(school_id)
         # Determine current AY by date, fallback to is_current
-        ay = AcademicYear.objects.filter(school=school, start_date__lte=today, end_date__gte=today).first()
-        if not ay:
-            ay = AcademicYear.objects.filter(school=school, is_current=True).first()
+        ay = cal.current_year()
         if not ay:
             return Response({'detail': 'Current academic year not found for today and no fallback set'}, status=404)
         # Determine current term by date, fallback to is_current
-        term = Term.objects.filter(academic_year=ay, start_date__lte=today, end_date__gte=today).first()
-        if not term:
-            term = Term.objects.filter(academic_year=ay, is_current=True).first()
+        term = cal.current_term()
         if not term:
             return Response({'detail': 'Current term not found for today and no fallback set'}, status=404)
         return Response(self.get_serializer(term).data)
@@ -2850,16 +2756,14 @@ class TermViewSet(viewsets.ModelViewSet):
     @action(detail=False, methods=['get'], permission_classes=[IsTeacherOrAdmin], url_path='of-current-year')
     def of_current_year(self, request):
         """List all terms for the current academic year for the user's school."""
-        school = getattr(request.user, 'school', None)
-        if not school:
+        school_id = get_tenant(request).school_id
+        if not school_id:
             return Response({'detail': 'No school associated with user'}, status=400)
-        today = timezone.localdate()
-        ay = AcademicYear.objects.filter(school=school, start_date__lte=today, end_date__gte=today).first()
-        if not ay:
-            ay = AcademicYear.objects.filter(school=school, is_current=True).first()
+        cal = get_school_calendar(school_id)
+        ay = cal.current_year()
         if not ay:
             return Response({'detail': 'Current academic year not found for today and no fallback set'}, status=404)
-        qs = Term.objects.filter(academic_year=ay).order_by('number')
+        qs = cal.terms_of(ay)
         page = self.paginate_queryset(qs)
         if page is not None:
             ser = self.get_serializer(page, many=True)
@@ -2942,16 +2846,16 @@ class TimetableTemplateViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         qs = super().get_queryset()
-        school = getattr(getattr(self.request, 'user', None), 'school', None)
-        if school:
-            qs = qs.filter(school=school)
+        school_id = get_tenant(self.request).school_id
+        if school_id:
+            qs = qs.filter(school_id=school_id)
         return qs
 
     def perform_create(self, serializer):
-        school = getattr(getattr(self.request, 'user', None), 'school', None)
-        if not school:
+        school_id = get_tenant(self.request).school_id
+        if not school_id:
             raise ValidationError({'school': 'School is required'})
-        serializer.save(school=school)
+        serializer.save(school_id=school_id)
 
 
 class PeriodSlotTemplateViewSet(viewsets.ModelViewSet):
@@ -2961,9 +2865,9 @@ class PeriodSlotTemplateViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         qs = super().get_queryset().select_related('template')
-        school = getattr(getattr(self.request, 'user', None), 'school', None)
-        if school:
-            qs = qs.filter(template__school=school)
+        school_id = get_tenant(self.request).school_id
+        if school_id:
+            qs = qs.filter(template__school_id=school_id)
         template_id = self.request.query_params.get('template')
         if template_id:
             qs = qs.filter(template_id=template_id)
@@ -2979,16 +2883,16 @@ class TimetablePlanViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         qs = super().get_queryset().select_related('term','template')
-        school = getattr(getattr(self.request, 'user', None), 'school', None)
-        if school:
-            qs = qs.filter(school=school)
+        school_id = get_tenant(self.request).school_id
+        if school_id:
+            qs = qs.filter(school_id=school_id)
         return qs
 
     def perform_create(self, serializer):
-        school = getattr(getattr(self.request, 'user', None), 'school', None)
-        if not school:
+        school_id = get_tenant(self.request).school_id
+        if not school_id:
             raise ValidationError({'school': 'School is required'})
-        serializer.save(school=school, created_by=getattr(self.request, 'user', None))
+        serializer.save(school_id=school_id, created_by=getattr(self.request, 'user', None))
 
     @action(detail=True, methods=['post'], url_path='generate', permission_classes=[IsAdmin])
     def generate(self, request, pk=None):
@@ -3024,9 +2928,9 @@ class TimetableClassConfigViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         qs = super().get_queryset().select_related('plan','klass','room_preference')
-        school = getattr(getattr(self.request, 'user', None), 'school', None)
-        if school:
-            qs = qs.filter(plan__school=school)
+        school_id = get_tenant(self.request).school_id
+        if school_id:
+            qs = qs.filter(plan__school_id=school_id)
         return qs
 
 
@@ -3039,9 +2943,9 @@ class ClassSubjectQuotaViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         qs = super().get_queryset().select_related('plan','klass','subject')
-        school = getattr(getattr(self.request, 'user', None), 'school', None)
-        if school:
-            qs = qs.filter(plan__school=school)
+        school_id = get_tenant(self.request).school_id
+        if school_id:
+            qs = qs.filter(plan__school_id=school_id)
         return qs
 
 
@@ -3066,9 +2970,9 @@ class TimetableVersionViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         qs = super().get_queryset().select_related('plan')
-        school = getattr(getattr(self.request, 'user', None), 'school', None)
-        if school:
-            qs = qs.filter(plan__school=school)
+        school_id = get_tenant(self.request).school_id
+        if school_id:
+            qs = qs.filter(plan__school_id=school_id)
         return qs
 
     @action(detail=True, methods=['post'], url_path='publish')
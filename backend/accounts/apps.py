@@ -29,3 +29,13 @@ class AccountsConfig(AppConfig):
                 print(f"Failed to create superuser '{username}': {e}")
 
         post_migrate.connect(ensure_superuser, sender=self)
+
+        from django.db.models.signals import post_save, post_delete
+        from .tenancy import invalidate_school_info
+
+        def drop_cached_school(sender, instance, **kwargs):
+            invalidate_school_info(instance.pk)
+
+        School = self.get_model('School')
+        post_save.connect(drop_cached_school, sender=School, dispatch_uid='accounts.drop_cached_school_save')
+        post_delete.connect(drop_cached_school, sender=School, dispatch_uid='accounts.drop_cached_school_delete')
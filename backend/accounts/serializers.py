@@ -26,6 +26,11 @@ class SchoolSerializer(serializers.ModelSerializer):
             return request.build_absolute_uri(url)
         return url
 
+class SchoolLiteSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = School
+        fields = ["id","name","code"]
+
 class UserSerializer(serializers.ModelSerializer):
     school = SchoolSerializer(read_only=True)
     profile_picture = serializers.ImageField(required=False, allow_null=True)
@@ -53,3 +58,8 @@ class UserSerializer(serializers.ModelSerializer):
             except Exception:
                 return url
         return url
+
+
+class UserListSerializer(UserSerializer):
+    """UserSerializer for listings: the school is embedded as {id, name, code} only."""
+    school = SchoolLiteSerializer(read_only=True)
@@ -0,0 +1,138 @@
+import threading
+import time
+
+from django.db import models
+
+# Tenant scoping. High-volume tables (Attendance, ExamResult, Invoice, Payment, Notification,
+# PocketMoneyTransaction) carry a denormalized school_id stamped on save, so scoping is a
+# single indexed column instead of joins such as invoice__student__klass__school, and rows of
+# graduated or unassigned students (klass is null) are still found.
+#
+# TenantMiddleware exposes request.tenant: role, school id, school feature flags and (for
+# teachers) the TeacherScope, resolved once per request from the authenticated user's row.
+# School details come from a small per-process cache, so hot endpoints never load School.
+
+SCHOOL_CACHE_TTL = 60  # seconds; a School save evicts it in this process, others catch up within the TTL
+SCHOOL_INFO_FIELDS = ('id', 'name', 'code', 'is_trial', 'trial_expires_at', 'trial_student_limit', 'feature_flags')
+
+_SCHOOLS = {}
+_SCHOOLS_LOCK = threading.Lock()
+
+
+def school_info(school_id):
+    """Cached {id, name, code, is_trial, ..., feature_flags} for a school, or None."""
+    if not school_id:
+        return None
+    now = time.monotonic()
+    entry = _SCHOOLS.get(school_id)
+    if entry and entry[0] > now:
+        return entry[1]
+    from .models import School
+    info = School.objects.filter(pk=school_id).values(*SCHOOL_INFO_FIELDS).first()
+    with _SCHOOLS_LOCK:
+        if len(_SCHOOLS) > 1024:
+            _SCHOOLS.clear()
+        _SCHOOLS[school_id] = (now + SCHOOL_CACHE_TTL, info)
+    return info
+
+
+def invalidate_school_info(school_id):
+    with _SCHOOLS_LOCK:
+        _SCHOOLS.pop(school_id, None)
+
+
+class Tenant:
+    __slots__ = ('user', 'user_id', 'role', 'school_id', 'is_staff', 'is_superuser', '_teacher_scope')
+
+    def __init__(self, user=None):
+        authenticated = bool(user is not None and getattr(user, 'is_authenticated', False))
+        self.user = user if authenticated else None
+        self.user_id = user.id if authenticated else None
+        self.role = getattr(user, 'role', None) if authenticated else None
+        # The FK column only: reading user.school would load the School row
+        self.school_id = getattr(user, 'school_id', None) if authenticated else None
+        self.is_staff = bool(authenticated and user.is_staff)
+        self.is_superuser = bool(authenticated and user.is_superuser)
+        self._teacher_scope = None
+
+    @property
+    def is_admin(self):
+        return self.role == 'admin' or self.is_staff or self.is_superuser
+
+    @property
+    def is_teacher(self):
+        """A teacher without staff rights, i.e. one whose access is limited to their classes."""
+        return self.role == 'teacher' and not (self.is_staff or self.is_superuser)
+
+    @property
+    def school(self):
+        return school_info(self.school_id)
+
+    @property
+    def feature_flags(self):
+        return (self.school or {}).get('feature_flags') or {}
+
+    def has_feature(self, name, default=False):
+        return bool(self.feature_flags.get(name, default))
+
+    @property
+    def teacher_scope(self):
+        if self._teacher_scope is None and self.user is not None:
+            from academics.services.teacher_scope import teacher_scope_for
+            self._teacher_scope = teacher_scope_for(self.user)
+        return self._teacher_scope
+
+
+def get_tenant(request):
+    """The tenant for request (a Django or DRF request), resolved at most once per user.
+    Resolution waits until first use so DRF's authentication has already set request.user.
+    """
+    req = getattr(request, '_request', request)
+    user = getattr(request, 'user', None)
+    tenant = getattr(req, '_tenant', None)
+    if tenant is None or tenant.user_id != getattr(user, 'id', None):
+        tenant = Tenant(user)
+        req._tenant = tenant
+    return tenant
+
+
+class LazyTenant:
+    """request.tenant: attribute reads go to the resolved Tenant."""
+
+    def __init__(self, request):
+        self._req = request
+
+    def __getattr__(self, name):
+        return getattr(get_tenant(self._req), name)
+
+
+class TenantMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.tenant = LazyTenant(request)
+        return self.get_response(request)
+
+
+def request_school_id(request):
+    """The requesting user's school id, or None for users without one (superusers)."""
+    return get_tenant(request).school_id
+
+
+def scope_to_school(qs, school, field='school'):
+    """Filter qs to one school (instance or id) through its denormalized column; no-op when None."""
+    if school is None:
+        return qs
+    school_id = school.pk if isinstance(school, models.Model) else school
+    return qs.filter(**{f'{field}_id': school_id})
+
+
+class SchoolScopedMixin:
+    """ViewSet mixin: scope get_queryset() to the requester's school.
+    school_field names the tenant column (a path such as 'exam__school' works too).
+    """
+    school_field = 'school'
+
+    def get_queryset(self):
+        return scope_to_school(super().get_queryset(), request_school_id(self.request), self.school_field)
@@ -5,8 +5,9 @@ from rest_framework.response import Response
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from django.contrib.auth import get_user_model
-from .serializers import UserSerializer, SchoolSerializer
+from .serializers import UserSerializer, UserListSerializer, SchoolSerializer
 from .permissions import IsAdminOrStaff
+from .tenancy import get_tenant
 from django.db import IntegrityError
 from django.db.models import Q
 from django.utils.text import slugify
@@ -66,7 +67,7 @@ def users(request):
     param_school_id = request.query_params.get('school')
     qs = User.objects.all().select_related('school')
     # Scope by school: default to the request user's school for all roles
-    user_school_id = getattr(getattr(request.user, 'school', None), 'id', None)
+    user_school_id = get_tenant(request).school_id
     if param_school_id:
         # Explicit override only for staff/superusers
         if request.user.is_superuser or request.user.is_staff:
@@ -98,12 +99,11 @@ def users(request):
     # Order by stable key
     qs = qs.order_by('id')
 
-    # Narrow fields to those used by UserSerializer and nested SchoolSerializer
+    # Narrow fields to those used by UserListSerializer and nested SchoolLiteSerializer
     try:
         qs = qs.only(
             'id','username','first_name','last_name','email','role','phone','is_staff','is_superuser','email_verified','profile_picture',
-            'school','school__id','school__name','school__code','school__address','school__motto','school__aim','school__logo','school__social_links',
-            'school__is_trial','school__trial_expires_at','school__trial_student_limit','school__feature_flags',
+            'school','school__id','school__name','school__code',
         )
     except Exception:
         # Fallback if .only causes issues
@@ -113,9 +113,9 @@ def users(request):
     paginator = PageNumberPagination()
     page = paginator.paginate_queryset(qs, request)
     if page is not None:
-        ser = UserSerializer(page, many=True, context={"request": request})
+        ser = UserListSerializer(page, many=True, context={"request": request})
         return paginator.get_paginated_response(ser.data)
-    return Response(UserSerializer(qs, many=True, context={"request": request}).data)
+    return Response(UserListSerializer(qs, many=True, context={"request": request}).data)
 
 
 @api_view(["POST"])
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Notification, Event, ArrearsMessageCampaign, Message, MessageRecipient
+from .models import Notification, Event, ArrearsMessageCampaign, Message, MessageRecipient, DeliveryAttempt
 
 @admin.register(Notification)
 class NotificationAdmin(admin.ModelAdmin):
@@ -16,8 +16,8 @@ class EventAdmin(admin.ModelAdmin):
 
 @admin.register(ArrearsMessageCampaign)
 class ArrearsMessageCampaignAdmin(admin.ModelAdmin):
-    list_display = ("id", "school", "klass", "min_balance", "sent_count", "created_by", "created_at")
-    list_filter = ("school", "klass")
+    list_display = ("id", "school", "klass", "min_balance", "status", "processed_count", "total_recipients", "sent_count", "repeat", "next_run_at", "created_by", "created_at")
+    list_filter = ("school", "klass", "status", "repeat")
     search_fields = ("message", "school__name")
 
 
@@ -34,3 +34,11 @@ class MessageRecipientAdmin(admin.ModelAdmin):
     list_display = ("id", "message", "user", "read", "read_at")
     list_filter = ("read",)
     search_fields = ("message__body", "user__username")
+
+
+@admin.register(DeliveryAttempt)
+class DeliveryAttemptAdmin(admin.ModelAdmin):
+    list_display = ("id", "school", "source", "source_id", "channel", "recipient", "status", "latency_ms", "attempt", "superseded", "created_at")
+    list_filter = ("source", "channel", "status", "superseded")
+    search_fields = ("recipient", "provider_message_id", "error")
+    date_hierarchy = "created_at"
@@ -0,0 +1,24 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from communications.services.arrears_campaigns import run_due_campaigns
+
+
+class Command(BaseCommand):
+    help = "Start scheduled arrears campaigns that are due and resume runs that lost their worker. Use --loop to keep polling (e.g. for weekly Monday 8am campaigns)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help='Keep running, checking for due campaigns')
+        parser.add_argument('--interval', type=float, default=60.0, help='Seconds between checks (with --loop)')
+
+    def handle(self, *args, **options):
+        while True:
+            started = run_due_campaigns()
+            if started:
+                self.stdout.write(f"Ran campaigns: {', '.join(str(i) for i in started)}")
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+        if not options['loop'] and not started:
+            self.stdout.write("No campaigns due.")
@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-19 08:38
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def backfill_school(apps, schema_editor):
+    User = apps.get_model('accounts', 'User')
+    Notification = apps.get_model('communications', 'Notification')
+    Notification.objects.filter(school__isnull=True).update(
+        school_id=Subquery(User.objects.filter(pk=OuterRef('user_id')).values('school_id')[:1])
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0010_user_profile_picture'),
+        ('communications', '0008_event_completed_event_completed_at_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='notification',
+            name='school',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='accounts.school'),
+        ),
+        migrations.RunPython(backfill_school, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['school', 'date'], name='notif_school_date'),
+        ),
+    ]
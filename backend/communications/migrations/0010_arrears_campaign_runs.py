@@ -0,0 +1,89 @@
+# Generated by Django 5.2.18 on 2026-10-19 09:18
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('academics', '0029_student_guardian_index'),
+        ('communications', '0009_notification_school'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='arrearsmessagecampaign',
+            name='heartbeat_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='arrearsmessagecampaign',
+            name='next_run_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='arrearsmessagecampaign',
+            name='processed_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='arrearsmessagecampaign',
+            name='repeat',
+            field=models.CharField(choices=[('none', 'Does not repeat'), ('daily', 'Daily'), ('weekly', 'Weekly'), ('monthly', 'Monthly')], default='none', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='arrearsmessagecampaign',
+            name='run_monthday',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='arrearsmessagecampaign',
+            name='run_number',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='arrearsmessagecampaign',
+            name='run_time',
+            field=models.TimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='arrearsmessagecampaign',
+            name='run_weekday',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='arrearsmessagecampaign',
+            name='total_recipients',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='ArrearsCampaignDelivery',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('run', models.PositiveIntegerField()),
+                ('balance', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('message', models.TextField()),
+                ('phone', models.CharField(blank=True, default='', max_length=32)),
+                ('email', models.CharField(blank=True, default='', max_length=254)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('processing', 'Processing'), ('done', 'Done')], default='pending', max_length=12)),
+                ('in_app', models.BooleanField(default=False)),
+                ('sms_status', models.CharField(blank=True, choices=[('', 'Not sent'), ('sent', 'Sent'), ('failed', 'Failed')], default='', max_length=10)),
+                ('email_status', models.CharField(blank=True, choices=[('', 'Not sent'), ('sent', 'Sent'), ('failed', 'Failed')], default='', max_length=10)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('claim_token', models.CharField(blank=True, default='', max_length=32)),
+                ('claimed_at', models.DateTimeField(blank=True, null=True)),
+                ('processed_at', models.DateTimeField(blank=True, null=True)),
+                ('error', models.TextField(blank=True, default='')),
+                ('campaign', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='deliveries', to='communications.arrearsmessagecampaign')),
+                ('student', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='academics.student')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['campaign', 'run', 'status'], name='arrears_delivery_claim')],
+                'constraints': [models.UniqueConstraint(fields=('campaign', 'run', 'student'), name='arrears_delivery_unique')],
+            },
+        ),
+    ]
@@ -8,6 +8,16 @@ class Notification(models.Model):
     type = models.CharField(max_length=20, choices=TYPE_CHOICES, default='in_app')
     date = models.DateTimeField(auto_now_add=True)
     read = models.BooleanField(default=False)
+    # Denormalized tenant column (see accounts.tenancy); set from the user on save
+    school = models.ForeignKey('accounts.School', null=True, blank=True, on_delete=models.CASCADE, related_name='+', db_index=False)
+
+    class Meta:
+        indexes = [models.Index(fields=['school', 'date'], name='notif_school_date')]
+
+    def save(self, *args, **kwargs):
+        if self.school_id is None and self.user_id:
+            self.school_id = self.user.school_id
+        super().save(*args, **kwargs)
 
 class Event(models.Model):
     AUDIENCE_CHOICES = (
@@ -68,6 +78,25 @@ class ArrearsMessageCampaign(models.Model):
     sms_failed = models.IntegerField(default=0)
     email_sent = models.IntegerField(default=0)
     email_failed = models.IntegerField(default=0)
+    # Live progress of the current run (see communications.services.arrears_campaigns)
+    run_number = models.PositiveIntegerField(default=0)
+    total_recipients = models.IntegerField(default=0)
+    processed_count = models.IntegerField(default=0)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+
+    # Scheduling: next_run_at alone is a one-off scheduled run; with repeat it is moved on to the
+    # next occurrence (run_time local, on run_weekday 0=Monday or run_monthday) each time it fires
+    class Repeat(models.TextChoices):
+        NONE = 'none', 'Does not repeat'
+        DAILY = 'daily', 'Daily'
+        WEEKLY = 'weekly', 'Weekly'
+        MONTHLY = 'monthly', 'Monthly'
+
+    repeat = models.CharField(max_length=10, choices=Repeat.choices, default=Repeat.NONE)
+    run_time = models.TimeField(null=True, blank=True)
+    run_weekday = models.PositiveSmallIntegerField(null=True, blank=True)
+    run_monthday = models.PositiveSmallIntegerField(null=True, blank=True)
+    next_run_at = models.DateTimeField(null=True, blank=True, db_index=True)
     # Async processing fields
     class Status(models.TextChoices):
         QUEUED = 'queued', 'Queued'
@@ -89,6 +118,46 @@ class ArrearsMessageCampaign(models.Model):
         return f"Arrears Campaign #{self.id} ({self.school})"
 
 
+class ArrearsCampaignDelivery(models.Model):
+    """One recipient of one campaign run, snapshotted (balance and rendered message) when the run
+    starts. Rows are claimed and delivered in chunks, so a run interrupted part-way resumes with
+    the rows that are not done instead of messaging everyone again.
+    """
+    class Status(models.TextChoices):
+        PENDING = 'pending', 'Pending'
+        PROCESSING = 'processing', 'Processing'
+        DONE = 'done', 'Done'
+
+    CHANNEL_STATUS_CHOICES = (('', 'Not sent'), ('sent', 'Sent'), ('failed', 'Failed'))
+
+    campaign = models.ForeignKey(ArrearsMessageCampaign, on_delete=models.CASCADE, related_name='deliveries')
+    run = models.PositiveIntegerField()
+    student = models.ForeignKey('academics.Student', on_delete=models.CASCADE, related_name='+')
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    balance = models.DecimalField(max_digits=12, decimal_places=2)
+    message = models.TextField()
+    phone = models.CharField(max_length=32, blank=True, default='')
+    email = models.CharField(max_length=254, blank=True, default='')
+    status = models.CharField(max_length=12, choices=Status.choices, default=Status.PENDING)
+    in_app = models.BooleanField(default=False)
+    sms_status = models.CharField(max_length=10, choices=CHANNEL_STATUS_CHOICES, blank=True, default='')
+    email_status = models.CharField(max_length=10, choices=CHANNEL_STATUS_CHOICES, blank=True, default='')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    claim_token = models.CharField(max_length=32, blank=True, default='')
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+    error = models.TextField(blank=True, default='')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['campaign', 'run', 'student'], name='arrears_delivery_unique'),
+        ]
+        indexes = [models.Index(fields=['campaign', 'run', 'status'], name='arrears_delivery_claim')]
+
+    def __str__(self):
+        return f"Campaign #{self.campaign_id} run {self.run} -> student {self.student_id}"
+
+
 # Messaging models: simple in-app messaging with role/user targeting within a school
 class Message(models.Model):
     """Represents a message authored by a user within a school.
@@ -142,3 +211,52 @@ class MessageRecipient(models.Model):
             models.Index(fields=['user', 'read']),
         ]
 
+
+
+class DeliveryAttempt(models.Model):
+    """One SMS or email send to one recipient, written in bulk by the dispatchers
+    (communications.services.delivery_log). `source`/`source_id` name what was being delivered:
+    a Message, an arrears campaign, a payment receipt notice or an exam's results.
+    """
+    class Source(models.TextChoices):
+        MESSAGE = 'message', 'Message'
+        CAMPAIGN = 'campaign', 'Arrears campaign'
+        PAYMENT = 'payment', 'Payment notice'
+        EXAM = 'exam', 'Exam results'
+
+    class Channel(models.TextChoices):
+        SMS = 'sms', 'SMS'
+        EMAIL = 'email', 'Email'
+
+    class Status(models.TextChoices):
+        SENT = 'sent', 'Sent'
+        FAILED = 'failed', 'Failed'
+
+    school = models.ForeignKey('accounts.School', null=True, blank=True, on_delete=models.CASCADE, related_name='+', db_index=False)
+    source = models.CharField(max_length=10, choices=Source.choices)
+    source_id = models.PositiveIntegerField()
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    channel = models.CharField(max_length=5, choices=Channel.choices)
+    recipient = models.CharField(max_length=254)
+    subject = models.CharField(max_length=255, blank=True, default='')
+    body = models.TextField()
+    provider_message_id = models.CharField(max_length=255, blank=True, default='', db_index=True)
+    status = models.CharField(max_length=10, choices=Status.choices)
+    latency_ms = models.PositiveIntegerField(null=True, blank=True)
+    error = models.TextField(blank=True, default='')
+    attempt = models.PositiveSmallIntegerField(default=1)
+    # Set once a failed attempt has been retried; stats count the latest attempt per recipient
+    superseded = models.BooleanField(default=False)
+    # Set while a retry is resending this failed attempt; a claim older than RETRY_CLAIM_TTL is retried again
+    retry_claimed_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-created_at', 'id']
+        indexes = [
+            models.Index(fields=['source', 'source_id', 'superseded', 'channel', 'status'], name='delivery_source_status'),
+            models.Index(fields=['school', 'created_at'], name='delivery_school_created'),
+        ]
+
+    def __str__(self):
+        return f"{self.channel} to {self.recipient} ({self.status})"
@@ -1,6 +1,7 @@
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
-from .models import Notification, Event, ArrearsMessageCampaign, Message, MessageRecipient
+from django.utils import timezone
+from .models import Notification, Event, ArrearsMessageCampaign, ArrearsCampaignDelivery, DeliveryAttempt, Message, MessageRecipient
 from accounts.models import School
 
 User = get_user_model()
@@ -40,15 +41,47 @@ class ArrearsMessageCampaignSerializer(serializers.ModelSerializer):
             'send_in_app', 'send_sms', 'send_email', 'email_subject',
             'status', 'started_at', 'finished_at', 'error_message',
             'sent_count', 'sms_sent', 'sms_failed', 'email_sent', 'email_failed',
+            'run_number', 'total_recipients', 'processed_count', 'heartbeat_at',
+            'repeat', 'run_time', 'run_weekday', 'run_monthday', 'next_run_at',
             'created_by', 'created_at'
         ]
-        read_only_fields = ['school', 'status', 'started_at', 'finished_at', 'error_message', 'sent_count', 'sms_sent', 'sms_failed', 'email_sent', 'email_failed', 'created_by', 'created_at']
+        read_only_fields = ['school', 'status', 'started_at', 'finished_at', 'error_message', 'sent_count', 'sms_sent', 'sms_failed', 'email_sent', 'email_failed', 'run_number', 'total_recipients', 'processed_count', 'heartbeat_at', 'created_by', 'created_at']
 
     def validate_message(self, value):
         if not value or not value.strip():
             raise serializers.ValidationError('Message cannot be empty')
         return value
 
+    def validate(self, attrs):
+        repeat = attrs.get('repeat', getattr(self.instance, 'repeat', ArrearsMessageCampaign.Repeat.NONE))
+        weekday = attrs.get('run_weekday', getattr(self.instance, 'run_weekday', None))
+        monthday = attrs.get('run_monthday', getattr(self.instance, 'run_monthday', None))
+        if weekday is not None and not 0 <= weekday <= 6:
+            raise serializers.ValidationError({'run_weekday': 'Use 0 (Monday) to 6 (Sunday).'})
+        if monthday is not None and not 1 <= monthday <= 28:
+            raise serializers.ValidationError({'run_monthday': 'Use a day from 1 to 28.'})
+        if repeat == ArrearsMessageCampaign.Repeat.WEEKLY and weekday is None:
+            raise serializers.ValidationError({'run_weekday': 'Weekly campaigns need a weekday.'})
+        schedule_changed = any(k in attrs for k in ('repeat', 'run_time', 'run_weekday', 'run_monthday'))
+        if repeat != ArrearsMessageCampaign.Repeat.NONE and schedule_changed and 'next_run_at' not in attrs:
+            from .services.arrears_campaigns import next_occurrence
+            attrs['next_run_at'] = next_occurrence(
+                repeat, attrs.get('run_time', getattr(self.instance, 'run_time', None)), weekday, monthday, timezone.now(),
+            )
+        return attrs
+
+
+class ArrearsCampaignDeliverySerializer(serializers.ModelSerializer):
+    student_name = serializers.CharField(source='student.name', read_only=True)
+
+    class Meta:
+        model = ArrearsCampaignDelivery
+        fields = [
+            'id', 'run', 'student', 'student_name', 'balance', 'message', 'phone', 'email',
+            'status', 'in_app', 'sms_status', 'email_status', 'attempts', 'processed_at', 'error',
+        ]
+        read_only_fields = fields
+
 
 class MessageRecipientSerializer(serializers.ModelSerializer):
     username = serializers.SerializerMethodField(read_only=True)
@@ -182,3 +215,13 @@ class MessageSerializer(serializers.ModelSerializer):
             MessageRecipient.objects.bulk_create(recipients, ignore_conflicts=True)
 
         return msg
+
+
+class DeliveryAttemptSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = DeliveryAttempt
+        fields = [
+            'id', 'source', 'source_id', 'user', 'channel', 'recipient', 'subject', 'provider_message_id',
+            'status', 'latency_ms', 'error', 'attempt', 'superseded', 'created_at',
+        ]
+        read_only_fields = fields
@@ -0,0 +1,385 @@
+from __future__ import annotations
+import logging
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, time, timedelta
+from time import monotonic
+from typing import Optional
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import DecimalField, F, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from ..utils import create_personalized_messages_for_users, render_template, resolve_default_sender_id
+from .delivery_log import DeliveryLog
+
+logger = logging.getLogger(__name__)
+
+# Arrears campaign runs. Starting a run snapshots the recipients (students over the balance
+# threshold, with their balance and rendered message) into ArrearsCampaignDelivery rows. Rows
+# are then claimed CHUNK_SIZE at a time with a single UPDATE; SMS and email for a chunk go out
+# on ARREARS_CAMPAIGN_CONCURRENCY threads, and the chunk's outcomes, in-app notifications,
+# DeliveryAttempt log and campaign counters are saved in one transaction, so `status` shows
+# live progress and a resumed chunk never notifies twice. While sending, the worker refreshes
+# the campaign heartbeat and its rows' claimed_at at least every HEARTBEAT_EVERY. A run that
+# stops part-way (worker killed, provider error) resumes with the rows not yet done; rows whose
+# claim is younger than STALE_AFTER are left to the worker that holds them. Scheduled campaigns
+# (next_run_at, optionally repeating) are started by `manage.py run_arrears_campaigns`, which
+# also resumes runs whose worker stopped sending heartbeats.
+
+CHUNK_SIZE = 50
+STALE_AFTER = timedelta(minutes=5)  # a running campaign without a heartbeat this long has lost its worker
+HEARTBEAT_EVERY = timedelta(seconds=30)
+DEFAULT_RUN_TIME = time(8, 0)
+
+
+def _get_models():
+    from academics.models import Student
+    from finance.models import Invoice, Payment
+    from ..models import ArrearsCampaignDelivery, ArrearsMessageCampaign, DeliveryAttempt, Notification
+    return {
+        'Campaign': ArrearsMessageCampaign,
+        'Delivery': ArrearsCampaignDelivery,
+        'DeliveryAttempt': DeliveryAttempt,
+        'Invoice': Invoice,
+        'Notification': Notification,
+        'Payment': Payment,
+        'Student': Student,
+    }
+
+
+# ===== Scheduling =====
+
+def next_occurrence(repeat: str, run_time: Optional[time], weekday: Optional[int], monthday: Optional[int],
+                    after: datetime) -> Optional[datetime]:
+    """First run strictly after `after` for a repeating schedule (local time), or None."""
+    if repeat not in ('daily', 'weekly', 'monthly'):
+        return None
+    at = run_time or DEFAULT_RUN_TIME
+    tz = timezone.get_current_timezone()
+    local = timezone.localtime(after, tz)
+    day = local.date()
+    if repeat == 'weekly':
+        day += timedelta(days=((weekday or 0) - day.weekday()) % 7)
+    elif repeat == 'monthly':
+        day = day.replace(day=min(max(monthday or 1, 1), 28))
+    candidate = timezone.make_aware(datetime.combine(day, at), tz)
+    if candidate <= after:
+        if repeat == 'daily':
+            day += timedelta(days=1)
+        elif repeat == 'weekly':
+            day += timedelta(days=7)
+        else:
+            day = (day.replace(day=1) + timedelta(days=32)).replace(day=day.day)
+        candidate = timezone.make_aware(datetime.combine(day, at), tz)
+    return candidate
+
+
+def is_stale(campaign) -> bool:
+    beat = campaign.heartbeat_at or campaign.started_at
+    return beat is None or beat < timezone.now() - STALE_AFTER
+
+
+# ===== Recipients =====
+
+def _recipients(campaign):
+    """Students of the campaign over its balance threshold, annotated with balance."""
+    models = _get_models()
+    money = DecimalField(max_digits=12, decimal_places=2)
+    students = models['Student'].objects.filter(klass__school_id=campaign.school_id)
+    if campaign.klass_id:
+        students = students.filter(klass_id=campaign.klass_id)
+    # Subqueries avoid the join multiplication between invoices and payments
+    billed_sq = (
+        models['Invoice'].objects.filter(student_id=OuterRef('pk'))
+        .values('student_id').annotate(s=Sum('amount')).values('s')[:1]
+    )
+    paid_sq = (
+        models['Payment'].objects.filter(invoice__student_id=OuterRef('pk'))
+        .values('invoice__student_id').annotate(s=Sum('amount')).values('s')[:1]
+    )
+    students = students.annotate(
+        billed=Coalesce(Subquery(billed_sq), Value(0, output_field=money)),
+        paid=Coalesce(Subquery(paid_sq), Value(0, output_field=money)),
+    ).annotate(balance=F('billed') - F('paid'))
+    # Strictly positive balances only: never notify 0 or credit balances
+    threshold = max(campaign.min_balance or 0, 0)
+    return students.filter(balance__gt=threshold).select_related('user', 'klass').order_by('id')
+
+
+def _render_message(campaign, stu) -> str:
+    currency = getattr(settings, 'CURRENCY', 'KES')
+    balance_str = f"{float(stu.balance or 0):,.2f}"
+    context = {
+        'student_name': stu.name or '',
+        'class': getattr(stu.klass, 'name', '') if stu.klass_id else '',
+        'balance': balance_str,
+        'balance_formatted': f"{currency} {balance_str}",
+        'currency': currency,
+    }
+    msg = render_template(campaign.message, context)
+    tpl = campaign.message or ''
+    if ('{balance' not in tpl) and ('{balance_formatted' not in tpl):
+        msg = f"{msg} Outstanding balance: {currency} {balance_str}."
+    return msg
+
+
+def snapshot_recipients(campaign) -> int:
+    """Create the delivery rows of the campaign's current run. Returns the recipient count."""
+    Delivery = _get_models()['Delivery']
+    rows = []
+    for stu in _recipients(campaign).iterator(chunk_size=500):
+        rows.append(Delivery(
+            campaign_id=campaign.id,
+            run=campaign.run_number,
+            student_id=stu.id,
+            user_id=stu.user_id,
+            balance=stu.balance,
+            message=_render_message(campaign, stu),
+            # SMS goes ONLY to the guardian phone
+            phone=stu.guardian_id or '',
+            email=stu.email or getattr(stu.user, 'email', '') or '',
+        ))
+    Delivery.objects.bulk_create(rows, batch_size=500)
+    return len(rows)
+
+
+# ===== Runs =====
+
+def _begin(campaign_id: int, new_run: bool = False):
+    """Lock the campaign and start (or resume) its run. None when another worker is running it."""
+    models = _get_models()
+    Campaign, Delivery = models['Campaign'], models['Delivery']
+    with transaction.atomic():
+        campaign = Campaign.objects.select_for_update().get(pk=campaign_id)
+        if campaign.status == Campaign.Status.RUNNING and not is_stale(campaign):
+            return None
+        unfinished = Delivery.objects.filter(campaign_id=campaign.id, run=campaign.run_number).exclude(status=Delivery.Status.DONE)
+        now = timezone.now()
+        if campaign.run_number and not new_run and unfinished.exists():
+            # Resume: rows claimed by the worker that stopped go back to pending; a claim that is
+            # still heartbeating belongs to a live worker and is left alone
+            unfinished.filter(status=Delivery.Status.PROCESSING).filter(
+                Q(claimed_at__lt=now - STALE_AFTER) | Q(claimed_at__isnull=True)
+            ).update(status=Delivery.Status.PENDING, claim_token='')
+            campaign.status = Campaign.Status.RUNNING
+            campaign.error_message = ''
+            campaign.heartbeat_at = now
+            campaign.save(update_fields=['status', 'error_message', 'heartbeat_at'])
+            return campaign
+        campaign.run_number += 1
+        campaign.status = Campaign.Status.RUNNING
+        campaign.started_at = now
+        campaign.finished_at = None
+        campaign.heartbeat_at = now
+        campaign.error_message = ''
+        campaign.sent_count = campaign.processed_count = 0
+        campaign.sms_sent = campaign.sms_failed = campaign.email_sent = campaign.email_failed = 0
+        campaign.total_recipients = snapshot_recipients(campaign)
+        campaign.save()
+        return campaign
+
+
+def _claim_chunk(campaign, limit: int = CHUNK_SIZE) -> list:
+    """Claim up to limit pending deliveries of the current run with a single UPDATE."""
+    Delivery = _get_models()['Delivery']
+    base = Delivery.objects.filter(campaign_id=campaign.id, run=campaign.run_number, status=Delivery.Status.PENDING)
+    ids = list(base.order_by('id').values_list('id', flat=True)[:limit])
+    if not ids:
+        return []
+    token = uuid.uuid4().hex
+    base.filter(id__in=ids).update(status=Delivery.Status.PROCESSING, claim_token=token, claimed_at=timezone.now())
+    return list(Delivery.objects.filter(claim_token=token, status=Delivery.Status.PROCESSING).order_by('id'))
+
+
+def _send(log: DeliveryLog, job) -> bool:
+    channel, target, subject, body, user_id = job
+    if channel == 'sms':
+        return log.sms(target, body, user_id=user_id)
+    return log.email(subject, body, target, user_id=user_id)
+
+
+def _heartbeat(campaign, rows: list) -> None:
+    """Mark the campaign and the chunk's claim as alive."""
+    models = _get_models()
+    now = timezone.now()
+    models['Campaign'].objects.filter(pk=campaign.id).update(heartbeat_at=now)
+    models['Delivery'].objects.filter(
+        id__in=[r.id for r in rows], claim_token=rows[0].claim_token, status=models['Delivery'].Status.PROCESSING,
+    ).update(claimed_at=now)
+
+
+def _deliver_chunk(campaign, rows: list, pool: ThreadPoolExecutor, sender_id) -> None:
+    models = _get_models()
+    Campaign, Delivery = models['Campaign'], models['Delivery']
+    subject = campaign.email_subject or 'School Fees Arrears'
+    counts = {'sent_count': 0, 'sms_sent': 0, 'sms_failed': 0, 'email_sent': 0, 'email_failed': 0}
+
+    # SMS and email, ARREARS_CAMPAIGN_CONCURRENCY at a time; channels already sent are skipped on resume
+    log = DeliveryLog(models['DeliveryAttempt'].Source.CAMPAIGN, campaign.id, school_id=campaign.school_id)
+    jobs, targets = [], []
+    for r in rows:
+        if campaign.send_sms and r.phone and r.sms_status != 'sent':
+            jobs.append(('sms', r.phone, subject, r.message, r.user_id))
+            targets.append((r, 'sms'))
+        if campaign.send_email and r.email and r.email_status != 'sent':
+            jobs.append(('email', r.email, subject, r.message, r.user_id))
+            targets.append((r, 'email'))
+    beat = monotonic()
+    for (r, channel), ok in zip(targets, pool.map(lambda job: _send(log, job), jobs)):
+        setattr(r, f'{channel}_status', 'sent' if ok else 'failed')
+        counts[f'{channel}_sent' if ok else f'{channel}_failed'] += 1
+        if ok:
+            counts['sent_count'] += 1
+        if monotonic() - beat >= HEARTBEAT_EVERY.total_seconds():
+            _heartbeat(campaign, rows)
+            beat = monotonic()
+
+    now = timezone.now()
+    # In-app notifications (and their chat mirror, so they show in the Messages UI) are written
+    # with the rows' in_app flag, so a chunk resumed after a crash does not create them again
+    in_app = [r for r in rows if campaign.send_in_app and r.user_id and not r.in_app]
+    for r in in_app:
+        r.in_app = True
+    counts['sent_count'] += len(in_app)
+    for r in rows:
+        r.status, r.claim_token, r.processed_at = Delivery.Status.DONE, '', now
+        r.attempts += 1
+    with transaction.atomic():
+        if in_app:
+            models['Notification'].objects.bulk_create([
+                models['Notification'](user_id=r.user_id, message=r.message, type='in_app', school_id=campaign.school_id)
+                for r in in_app
+            ])
+            if sender_id:
+                try:
+                    with transaction.atomic():
+                        create_personalized_messages_for_users(
+                            school_id=campaign.school_id, sender_id=sender_id,
+                            user_body_pairs=[(r.user_id, r.message) for r in in_app], system_tag='arrears',
+                            queue_delivery=False,  # channels are independent of the chat mirror
+                        )
+                except Exception:
+                    logger.exception("Failed to mirror arrears campaign %s to chat messages", campaign.id)
+        Delivery.objects.bulk_update(rows, ['status', 'claim_token', 'processed_at', 'attempts', 'in_app', 'sms_status', 'email_status'])
+        log.flush()
+        Campaign.objects.filter(pk=campaign.id).update(
+            processed_count=F('processed_count') + len(rows),
+            heartbeat_at=now,
+            **{k: F(k) + v for k, v in counts.items() if v},
+        )
+
+
+def _finish(campaign) -> None:
+    models = _get_models()
+    Campaign, Delivery = models['Campaign'], models['Delivery']
+    with transaction.atomic():
+        c = Campaign.objects.select_for_update().get(pk=campaign.id)
+        left = Delivery.objects.filter(campaign_id=c.id, run=c.run_number).exclude(status=Delivery.Status.DONE).exists()
+        if c.run_number != campaign.run_number or left:
+            return
+        c.status = Campaign.Status.COMPLETED
+        c.finished_at = timezone.now()
+        c.save(update_fields=['status', 'finished_at'])
+
+
+def record_retries(campaign_id: int, sent: list) -> None:
+    """Apply delivery retries that got through, [(channel, recipient)], to the current run:
+    the recipients' channel status becomes sent and the campaign counters move with it.
+    """
+    models = _get_models()
+    Campaign, Delivery = models['Campaign'], models['Delivery']
+    run = Campaign.objects.filter(pk=campaign_id).values_list('run_number', flat=True).first()
+    if not run or not sent:
+        return
+    counts = {'sent_count': 0, 'sms_sent': 0, 'sms_failed': 0, 'email_sent': 0, 'email_failed': 0}
+    for channel, field in (('sms', 'phone'), ('email', 'email')):
+        wanted = Counter(recipient for c, recipient in sent if c == channel)
+        if not wanted:
+            continue
+        ids = []
+        # One row per retried attempt: a guardian phone shared by siblings has a row (and attempt) each
+        for pk, recipient in Delivery.objects.filter(
+            campaign_id=campaign_id, run=run, **{f'{field}__in': list(wanted), f'{channel}_status': 'failed'},
+        ).order_by('id').values_list('id', field):
+            if wanted[recipient] > 0:
+                wanted[recipient] -= 1
+                ids.append(pk)
+        n = Delivery.objects.filter(id__in=ids).update(**{f'{channel}_status': 'sent'})
+        counts[f'{channel}_sent'] += n
+        counts[f'{channel}_failed'] -= n
+        counts['sent_count'] += n
+    if any(counts.values()):
+        Campaign.objects.filter(pk=campaign_id).update(**{k: F(k) + v for k, v in counts.items() if v})
+
+
+def run_campaign(campaign_id: int, new_run: bool = False) -> None:
+    """Background task: run (or resume) an arrears campaign. Failures are recorded on the
+    campaign and leave the undelivered rows pending for the next attempt.
+    """
+    models = _get_models()
+    Campaign, Delivery = models['Campaign'], models['Delivery']
+    close_old_connections()
+    rows = []
+    try:
+        campaign = _begin(campaign_id, new_run=new_run)
+        if campaign is None:
+            logger.info("Arrears campaign %s is already running", campaign_id)
+            return
+        sender_id = None
+        if campaign.send_in_app:
+            sender_id = campaign.created_by_id or resolve_default_sender_id(campaign.school_id)
+        workers = max(1, getattr(settings, 'ARREARS_CAMPAIGN_CONCURRENCY', 4))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f'arrears-{campaign_id}') as pool:
+            while True:
+                rows = _claim_chunk(campaign)
+                if not rows:
+                    break
+                _deliver_chunk(campaign, rows, pool, sender_id)
+                rows = []
+        _finish(campaign)
+    except Exception as e:
+        logger.exception("Arrears campaign %s failed", campaign_id)
+        try:
+            if rows:
+                Delivery.objects.filter(id__in=[r.id for r in rows], status=Delivery.Status.PROCESSING).update(
+                    status=Delivery.Status.PENDING, claim_token='', error=str(e)[:2000],
+                )
+            Campaign.objects.filter(pk=campaign_id).update(
+                status=Campaign.Status.FAILED, error_message=str(e), finished_at=timezone.now(),
+            )
+        except Exception:
+            logger.exception("Could not record the failure of arrears campaign %s", campaign_id)
+    finally:
+        # Runs on its own thread (or a management command); release its DB connection
+        connection.close()
+
+
+def run_due_campaigns() -> list:
+    """Start campaigns whose scheduled time has come and resume runs that lost their worker.
+    Returns the ids run. Repeating schedules move on to their next occurrence when picked up.
+    """
+    Campaign = _get_models()['Campaign']
+    now = timezone.now()
+    started = []
+    due = Campaign.objects.filter(next_run_at__lte=now).exclude(status=Campaign.Status.RUNNING).values_list('id', flat=True)
+    for campaign_id in list(due):
+        with transaction.atomic():
+            c = Campaign.objects.select_for_update().filter(pk=campaign_id, next_run_at__lte=now).first()
+            if c is None or c.status == Campaign.Status.RUNNING:
+                continue
+            c.next_run_at = next_occurrence(c.repeat, c.run_time, c.run_weekday, c.run_monthday, now)
+            c.status = Campaign.Status.QUEUED
+            c.save(update_fields=['next_run_at', 'status'])
+        run_campaign(campaign_id, new_run=True)
+        started.append(campaign_id)
+    stale = Campaign.objects.filter(status=Campaign.Status.RUNNING).filter(
+        Q(heartbeat_at__lt=now - STALE_AFTER) | Q(heartbeat_at__isnull=True, started_at__lt=now - STALE_AFTER)
+    ).values_list('id', flat=True)
+    for campaign_id in list(stale):
+        run_campaign(campaign_id)
+        started.append(campaign_id)
+    return started
@@ -0,0 +1,230 @@
+from __future__ import annotations
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Avg, Count, Q
+from django.utils import timezone
+
+from ..utils import send_email_detailed, send_email_with_attachment, send_sms_detailed
+
+logger = logging.getLogger(__name__)
+
+# Durable per-recipient delivery outcomes. Dispatchers send through a DeliveryLog, which times
+# each SMS/email, keeps the provider message id (Africa's Talking messageId, or the email's
+# Message-ID) and error, and writes all the attempts of the dispatch in one bulk INSERT on
+# flush(). retry_failed() resends only the failed attempts of a message/campaign/payment/exam:
+# a batch is claimed (retry_claimed_at) before sending, and each retry is written as a new
+# attempt row in the same transaction that marks the failed one superseded, so a retry that
+# dies part-way leaves its batch failed and claimable again after RETRY_CLAIM_TTL. Campaign
+# retries also update the recipients' ArrearsCampaignDelivery status and the campaign counters.
+# delivery_stats() counts the latest attempt per recipient from the (source, source_id,
+# superseded, channel, status) index.
+
+RETRY_BATCH = 50
+RETRY_CLAIM_TTL = timedelta(minutes=15)
+
+
+def _get_models():
+    from ..models import DeliveryAttempt
+    return {'DeliveryAttempt': DeliveryAttempt}
+
+
+class DeliveryLog:
+    """Send SMS/email and collect one DeliveryAttempt per send; flush() writes them in bulk.
+    Safe to share between the threads of one dispatch.
+    """
+
+    def __init__(self, source: str, source_id: int, school_id=None):
+        self.source = source
+        self.source_id = source_id
+        self.school_id = school_id
+        self.attempts = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+        return False
+
+    def sms(self, phone: str, body: str, user_id=None, attempt: int = 1) -> bool:
+        started = time.monotonic()
+        try:
+            result = send_sms_detailed(phone, body)
+        except Exception as e:
+            logger.exception("send_sms crashed for %s", phone)
+            result = {'ok': False, 'provider_id': '', 'error': str(e)[:500]}
+        return self._record('sms', phone, '', body, result, started, user_id, attempt)
+
+    def email(self, subject: str, body: str, recipient: str, user_id=None, attempt: int = 1, attachment=None) -> bool:
+        """attachment: optional (filename, content, mimetype); retries resend the body only."""
+        started = time.monotonic()
+        try:
+            if attachment:
+                filename, content, mimetype = attachment
+                ok = send_email_with_attachment(subject, body, recipient, filename, content, mimetype)
+                result = {'ok': ok, 'provider_id': '', 'error': '' if ok else 'Send with attachment failed'}
+            else:
+                result = send_email_detailed(subject, body, recipient)
+        except Exception as e:
+            logger.exception("send_email crashed for %s", recipient)
+            result = {'ok': False, 'provider_id': '', 'error': str(e)[:500]}
+        return self._record('email', recipient, subject, body, result, started, user_id, attempt)
+
+    def _record(self, channel, recipient, subject, body, result, started, user_id, attempt) -> bool:
+        DeliveryAttempt = _get_models()['DeliveryAttempt']
+        ok = bool(result.get('ok'))
+        row = DeliveryAttempt(
+            school_id=self.school_id,
+            source=self.source,
+            source_id=self.source_id,
+            user_id=user_id,
+            channel=channel,
+            recipient=str(recipient)[:254],
+            subject=(subject or '')[:255],
+            body=body or '',
+            provider_message_id=(result.get('provider_id') or '')[:255],
+            status=DeliveryAttempt.Status.SENT if ok else DeliveryAttempt.Status.FAILED,
+            latency_ms=int((time.monotonic() - started) * 1000),
+            error='' if ok else (result.get('error') or ''),
+            attempt=attempt,
+        )
+        with self._lock:
+            self.attempts.append(row)
+        return ok
+
+    def drain(self) -> list:
+        """The attempts collected so far, unsaved; the log is emptied."""
+        with self._lock:
+            rows, self.attempts = self.attempts, []
+        return rows
+
+    def flush(self) -> int:
+        DeliveryAttempt = _get_models()['DeliveryAttempt']
+        rows = self.drain()
+        if not rows:
+            return 0
+        try:
+            # Savepoint: a failed insert must not break the caller's transaction
+            with transaction.atomic():
+                DeliveryAttempt.objects.bulk_create(rows, batch_size=500)
+        except Exception:
+            # The sends already happened; losing their log must not fail the dispatcher
+            logger.exception("Could not record %s delivery attempts for %s %s", len(rows), self.source, self.source_id)
+            return 0
+        return len(rows)
+
+
+# ===== Retry =====
+
+def failed_attempts(source: str, source_id: int):
+    DeliveryAttempt = _get_models()['DeliveryAttempt']
+    return DeliveryAttempt.objects.filter(
+        source=source, source_id=source_id, superseded=False, status=DeliveryAttempt.Status.FAILED,
+    )
+
+
+def _retryable(source: str, source_id: int):
+    """Failed attempts not currently claimed by a running retry."""
+    return failed_attempts(source, source_id).filter(
+        Q(retry_claimed_at__isnull=True) | Q(retry_claimed_at__lt=timezone.now() - RETRY_CLAIM_TTL)
+    )
+
+
+def retry_failed(source: str, source_id: int) -> dict:
+    """Resend the failed (latest) attempts of one message/campaign/payment/exam.
+    Returns {'retried', 'sent', 'failed'}.
+    """
+    DeliveryAttempt = _get_models()['DeliveryAttempt']
+    totals = {'retried': 0, 'sent': 0, 'failed': 0}
+    while True:
+        # Claim a batch first, so a concurrent retry cannot pick the same rows
+        with transaction.atomic():
+            batch = list(_retryable(source, source_id).select_for_update().order_by('id')[:RETRY_BATCH])
+            if not batch:
+                break
+            DeliveryAttempt.objects.filter(id__in=[a.id for a in batch]).update(retry_claimed_at=timezone.now())
+        log = DeliveryLog(source, source_id, school_id=batch[0].school_id)
+        for a in batch:
+            if a.channel == DeliveryAttempt.Channel.SMS:
+                log.sms(a.recipient, a.body, user_id=a.user_id, attempt=a.attempt + 1)
+            else:
+                log.email(a.subject, a.body, a.recipient, user_id=a.user_id, attempt=a.attempt + 1)
+        retries = log.drain()
+        with transaction.atomic():
+            DeliveryAttempt.objects.filter(id__in=[a.id for a in batch]).update(superseded=True)
+            DeliveryAttempt.objects.bulk_create(retries, batch_size=500)
+            if source == DeliveryAttempt.Source.CAMPAIGN:
+                from .arrears_campaigns import record_retries
+                record_retries(source_id, [(r.channel, r.recipient) for r in retries if r.status == DeliveryAttempt.Status.SENT])
+        sent = sum(1 for r in retries if r.status == DeliveryAttempt.Status.SENT)
+        totals['sent'] += sent
+        totals['failed'] += len(retries) - sent
+        totals['retried'] += len(batch)
+    return totals
+
+
+def queue_retry_failed(source: str, source_id: int) -> int:
+    """Start retry_failed() on a daemon thread; returns how many attempts it will resend."""
+    count = _retryable(source, source_id).count()
+    if count:
+        threading.Thread(target=_retry_in_thread, args=(source, source_id), name='delivery-retry', daemon=True).start()
+    return count
+
+
+def _retry_in_thread(source: str, source_id: int) -> None:
+    close_old_connections()
+    try:
+        retry_failed(source, source_id)
+    except Exception:
+        logger.exception("Retrying failed deliveries of %s %s failed", source, source_id)
+    finally:
+        connection.close()
+
+
+# ===== Stats =====
+
+def delivery_stats(source: str, source_id: int) -> dict:
+    """Sent/failed per channel over each recipient's latest attempt, with average latency,
+    plus how many attempts were made in total (retries included). One grouped query.
+    """
+    DeliveryAttempt = _get_models()['DeliveryAttempt']
+    rows = (
+        DeliveryAttempt.objects.filter(source=source, source_id=source_id)
+        .values('superseded', 'channel', 'status')
+        .annotate(n=Count('id'), latency=Avg('latency_ms'))
+        .order_by()
+    )
+    channels = {c: {'sent': 0, 'failed': 0, 'avg_latency_ms': None} for c in DeliveryAttempt.Channel.values}
+    weighted = {c: [0.0, 0] for c in channels}
+    attempts = retried = 0
+    for r in rows:
+        attempts += r['n']
+        if r['superseded']:
+            retried += r['n']
+            continue
+        channels[r['channel']][r['status']] += r['n']
+        if r['latency'] is not None:
+            weighted[r['channel']][0] += float(r['latency']) * r['n']
+            weighted[r['channel']][1] += r['n']
+    for c, stats in channels.items():
+        total = stats['sent'] + stats['failed']
+        stats['total'] = total
+        stats['success_rate'] = round(stats['sent'] / total * 100, 2) if total else None
+        if weighted[c][1]:
+            stats['avg_latency_ms'] = round(weighted[c][0] / weighted[c][1])
+    sent = sum(s['sent'] for s in channels.values())
+    failed = sum(s['failed'] for s in channels.values())
+    return {
+        'source': source,
+        'source_id': source_id,
+        'sent': sent,
+        'failed': failed,
+        'attempts': attempts,
+        'retried': retried,
+        'channels': channels,
+    }
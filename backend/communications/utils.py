@@ -1,8 +1,9 @@
-from django.core.mail import send_mail, EmailMessage
+from django.core.mail import EmailMessage
+from django.core.mail.utils import DNS_NAME
+from email.utils import make_msgid
 from django.conf import settings
 import logging
 from datetime import datetime
-from django.db import transaction
 import threading
 import json
 import requests
@@ -11,7 +12,6 @@ from requests.adapters import HTTPAdapter
 from urllib3.util import ssl_  # type: ignore
 from urllib3.util.retry import Retry  # type: ignore
 import ssl as pyssl
-from django.utils import timezone
 import phonenumbers
 
 logger = logging.getLogger(__name__)
@@ -45,7 +45,7 @@ def render_template(template: str, context: dict) -> str:
     return msg
 
 
-def _send_sms_via_at_rest(username: str, api_key: str, phone: str, message: str, sender: str | None) -> bool:
+def _send_sms_via_at_rest(username: str, api_key: str, phone: str, message: str, sender: str | None) -> dict:
     """Send SMS using Africa's Talking REST API directly.
     This is used to circumvent the WhatsApp sandbox initialization error in the SDK.
     """
@@ -96,32 +96,32 @@ def _send_sms_via_at_rest(username: str, api_key: str, phone: str, message: str,
             status = recipients[0].get('status', '').lower()
             if 'success' in status:
                 logger.info("SMS sent via AT REST -> %s: %s", phone, status)
-                return True
+                return {'ok': True, 'provider_id': recipients[0].get('messageId') or '', 'error': ''}
         logger.warning("AT REST response did not confirm success: %s", payload)
-        return False
-    except Exception:
+        return {'ok': False, 'provider_id': '', 'error': f"Not confirmed: {payload}"[:500]}
+    except Exception as e:
         logger.exception("Failed to send SMS via AT REST to %s", phone)
-        return False
+        return {'ok': False, 'provider_id': '', 'error': str(e)[:500]}
 
 
-def send_sms(phone: str, message: str) -> bool:
+def send_sms_detailed(phone: str, message: str) -> dict:
     """
-    Send SMS via Africa's Talking. Returns True if accepted for delivery.
+    Send SMS via Africa's Talking. Returns {'ok', 'provider_id', 'error'}; ok when accepted for delivery.
     Uses sandbox or live based on credentials in settings.
     """
     if not phone or not message:
-        return False
+        return {'ok': False, 'provider_id': '', 'error': 'Missing phone or message'}
     # Immediate loopback: if SMS_LOOPBACK is enabled, do not attempt any network calls
     if getattr(settings, 'SMS_LOOPBACK', False):
         logger.info("SMS_LOOPBACK enabled: simulating SMS send to %s", phone)
-        return True
+        return {'ok': True, 'provider_id': '', 'error': ''}
 
     at_username = getattr(settings, 'AT_USERNAME', None)
     at_api_key = getattr(settings, 'AT_API_KEY', None)
     at_sender = getattr(settings, 'AT_SENDER_ID', None) or None
     if not at_username or not at_api_key:
         logger.warning("Africa's Talking credentials missing; skipping SMS to %s", phone)
-        return False
+        return {'ok': False, 'provider_id': '', 'error': "Africa's Talking credentials missing"}
     # Normalize phone into E.164 if possible (defaults to KE)
     # Normalize and validate phone (default region KE)
     valid_number = False
@@ -137,9 +137,9 @@ def send_sms(phone: str, message: str) -> bool:
         # If loopback is enabled, simulate success to avoid blocking user flows in dev/demo
         if getattr(settings, 'SMS_LOOPBACK', False):
             logger.info("SMS_LOOPBACK enabled: accepting invalid phone '%s' as sent", phone)
-            return True
+            return {'ok': True, 'provider_id': '', 'error': ''}
         logger.warning("SMS not sent: invalid phone '%s' and SMS_LOOPBACK is disabled", phone)
-        return False
+        return {'ok': False, 'provider_id': '', 'error': 'Invalid phone number'}
     try:
         use_rest_pref = getattr(settings, 'AT_USE_REST_FOR_SANDBOX', True)
         is_sandbox = str(at_username).lower() == 'sandbox'
@@ -149,9 +149,9 @@ def send_sms(phone: str, message: str) -> bool:
         # - If False: try SDK first, then REST fallback
         if is_sandbox:
             if use_rest_pref:
-                ok = _send_sms_via_at_rest(at_username, at_api_key, phone, message, at_sender)
-                if ok:
-                    return True
+                result = _send_sms_via_at_rest(at_username, at_api_key, phone, message, at_sender)
+                if result['ok']:
+                    return result
                 # Fallback to SDK once
                 try:
                     # Avoid system proxies for SDK if AT_TRUST_ENV is False (prevents TLS interception issues)
@@ -167,7 +167,7 @@ def send_sms(phone: str, message: str) -> bool:
                     recipients = (resp or {}).get('SMSMessageData', {}).get('Recipients', [])
                     if recipients and 'success' in (recipients[0].get('status','').lower()):
                         logger.info("SMS sent via AT SDK fallback -> %s", phone)
-                        return True
+                        return {'ok': True, 'provider_id': recipients[0].get('messageId') or '', 'error': ''}
                 except Exception:
                     logger.exception("AT SDK fallback failed on sandbox")
                 finally:
@@ -177,7 +177,7 @@ def send_sms(phone: str, message: str) -> bool:
                             os.environ[k] = v
                     except Exception:
                         pass
-                return False
+                return {'ok': False, 'provider_id': '', 'error': result['error'] or 'SDK fallback failed'}
             else:
                 # Prefer SDK first
                 try:
@@ -193,7 +193,7 @@ def send_sms(phone: str, message: str) -> bool:
                     recipients = (resp or {}).get('SMSMessageData', {}).get('Recipients', [])
                     if recipients and 'success' in (recipients[0].get('status','').lower()):
                         logger.info("SMS sent via AT SDK (sandbox) -> %s", phone)
-                        return True
+                        return {'ok': True, 'provider_id': recipients[0].get('messageId') or '', 'error': ''}
                 except Exception as e:
                     # Known WhatsApp sandbox error or TLS anomalies -> fallback to REST
                     logger.warning("AT SDK on sandbox error; falling back to REST: %s", e)
@@ -225,16 +225,16 @@ def send_sms(phone: str, message: str) -> bool:
             status = recipients[0].get('status', '').lower()
             if 'success' in status:
                 logger.info("SMS sent via AT (live) -> %s: %s", phone, status)
-                return True
+                return {'ok': True, 'provider_id': recipients[0].get('messageId') or '', 'error': ''}
         logger.warning("AT SDK (live) response did not confirm success: %s", resp)
-        return False
-    except Exception:
+        return {'ok': False, 'provider_id': '', 'error': f"Not confirmed: {resp}"[:500]}
+    except Exception as e:
         logger.exception("Failed to send SMS via Africa's Talking to %s", phone)
         # Final guard: allow loopback to simulate success in dev
         if getattr(settings, 'SMS_LOOPBACK', False):
             logger.info("SMS_LOOPBACK enabled: simulating success for %s after failure", phone)
-            return True
-        return False
+            return {'ok': True, 'provider_id': '', 'error': ''}
+        return {'ok': False, 'provider_id': '', 'error': str(e)[:500]}
     finally:
         # Restore proxies for live path if we cleared them
         try:
@@ -244,21 +244,38 @@ def send_sms(phone: str, message: str) -> bool:
             pass
 
 
+def send_sms(phone: str, message: str) -> bool:
+    """
+    Send SMS via Africa's Talking. Returns True if accepted for delivery.
+    Uses sandbox or live based on credentials in settings.
+    """
+    return send_sms_detailed(phone, message)['ok']
+
+
 def send_email_safe(subject: str, message: str, recipient: str) -> bool:
+    return send_email_detailed(subject, message, recipient)['ok']
+
+
+def send_email_detailed(subject: str, message: str, recipient: str) -> dict:
+    """Send an email, trying the configured SMTP settings, then TLS on 587, then SSL on 465.
+    Returns {'ok', 'provider_id' (the Message-ID header), 'error'}.
+    """
     if not recipient:
-        return False
+        return {'ok': False, 'provider_id': '', 'error': 'Missing recipient'}
     host_user = getattr(settings, 'EMAIL_HOST_USER', '')
     host_pass = getattr(settings, 'EMAIL_HOST_PASSWORD', '')
     if not host_user or not host_pass:
         logger.warning("Email credentials missing; skipping email to %s", recipient)
-        return False
+        return {'ok': False, 'provider_id': '', 'error': 'Email credentials missing'}
     from_email = getattr(settings, 'DEFAULT_FROM_EMAIL', host_user or 'no-reply@example.com')
+    message_id = make_msgid(domain=DNS_NAME)
+    headers = {'Message-ID': message_id}
 
     # 1) Try using current Django settings (usually TLS on 587)
     try:
-        sent = send_mail(subject or 'Notification', message, from_email, [recipient], fail_silently=False)
+        sent = EmailMessage(subject or 'Notification', message or '', from_email, [recipient], headers=headers).send(fail_silently=False)
         if sent > 0:
-            return True
+            return {'ok': True, 'provider_id': message_id, 'error': ''}
     except Exception as e:
         logger.warning("Primary SMTP send failed (TLS/port from settings): %s", e)
 
@@ -276,9 +293,9 @@ def send_email_safe(subject: str, message: str, recipient: str) -> bool:
         )
         conn.open()
         try:
-            email = EmailMessage(subject or 'Notification', message or '', from_email, [recipient], connection=conn)
+            email = EmailMessage(subject or 'Notification', message or '', from_email, [recipient], connection=conn, headers=headers)
             email.send(fail_silently=False)
-            return True
+            return {'ok': True, 'provider_id': message_id, 'error': ''}
         finally:
             try:
                 conn.close()
@@ -301,9 +318,9 @@ def send_email_safe(subject: str, message: str, recipient: str) -> bool:
         )
         conn.open()
         try:
-            email = EmailMessage(subject or 'Notification', message or '', from_email, [recipient], connection=conn)
+            email = EmailMessage(subject or 'Notification', message or '', from_email, [recipient], connection=conn, headers=headers)
             email.send(fail_silently=False)
-            return True
+            return {'ok': True, 'provider_id': message_id, 'error': ''}
         finally:
             try:
                 conn.close()
@@ -311,7 +328,7 @@ def send_email_safe(subject: str, message: str, recipient: str) -> bool:
                 pass
     except Exception as e:
         logger.exception("All SMTP attempts failed for %s: %s", recipient, e)
-        return False
+        return {'ok': False, 'provider_id': '', 'error': str(e)[:500]}
 
 
 def send_email_with_attachment(subject: str, message: str, recipient: str, filename: str, content: bytes, mimetype: str = 'application/pdf') -> bool:
@@ -328,176 +345,20 @@ def send_email_with_attachment(subject: str, message: str, recipient: str, filen
     except Exception as e:
         logger.exception("Failed to send email with attachment to %s: %s", recipient, e)
         return False
-def process_arrears_campaign(campaign_id: int):
-    """Background task: processes an arrears campaign by sending messages via selected channels.
-    Updates campaign status, timestamps, counts, and error message on failure.
+def process_arrears_campaign(campaign_id: int, new_run: bool = False):
+    """Background task: runs an arrears campaign, or resumes its interrupted run (unless new_run).
+    Delivery is per recipient and chunked; see communications.services.arrears_campaigns.
     """
-    from django.db.models import Sum, F, Value, DecimalField
-    from django.db.models.functions import Coalesce
-    from .models import ArrearsMessageCampaign, Notification
-    from academics.models import Student
-    try:
-        # Mark campaign as running
-        with transaction.atomic():
-            campaign = ArrearsMessageCampaign.objects.select_for_update().get(pk=campaign_id)
-            campaign.status = ArrearsMessageCampaign.Status.RUNNING
-            campaign.started_at = timezone.now()
-            campaign.error_message = ''
-            campaign.sent_count = 0
-            campaign.save(update_fields=['status', 'started_at', 'error_message', 'sent_count'])
-
-        students = Student.objects.filter(klass__school_id=campaign.school_id)
-        if campaign.klass_id:
-            students = students.filter(klass_id=campaign.klass_id)
-
-        # Compute balances per student using Subqueries to avoid join multiplication between invoices and payments
-        from django.db.models import OuterRef, Subquery
-        from finance.models import Invoice, Payment
-        billed_sq = (
-            Invoice.objects
-            .filter(student_id=OuterRef('pk'))
-            .values('student_id')
-            .annotate(s=Sum('amount'))
-            .values('s')[:1]
-        )
-        paid_sq = (
-            Payment.objects
-            .filter(invoice__student_id=OuterRef('pk'))
-            .values('invoice__student_id')
-            .annotate(s=Sum('amount'))
-            .values('s')[:1]
-        )
-        students = students.annotate(
-            billed=Coalesce(Subquery(billed_sq), Value(0, output_field=DecimalField(max_digits=12, decimal_places=2))),
-            paid=Coalesce(Subquery(paid_sq), Value(0, output_field=DecimalField(max_digits=12, decimal_places=2))),
-        ).annotate(balance=F('billed') - F('paid'))
-        # Enforce strictly positive balances: do not notify 0 or negative
-        try:
-            threshold = float(getattr(campaign, 'min_balance', 0) or 0)
-        except Exception:
-            threshold = 0.0
-        if threshold < 0:
-            threshold = 0.0
-        students = students.filter(balance__gt=threshold)
-
-        notifications = []
-        # Prepare personalized chat messages only if in-app is selected
-        personalized_pairs = [] if campaign.send_in_app else None
-        count = 0
-        sms_sent = 0
-        sms_failed = 0
-        email_sent = 0
-        email_failed = 0
-        for stu in students.select_related('user', 'klass'):
-            klass_name = getattr(getattr(stu, 'klass', None), 'name', '')
-            currency = getattr(settings, 'CURRENCY', 'KES')
-            try:
-                balance_val = float(getattr(stu, 'balance', 0) or 0)
-            except Exception:
-                balance_val = 0.0
-            balance_str = f"{balance_val:,.2f}"
-            context = {
-                'student_name': getattr(stu, 'name', ''),
-                'class': klass_name,
-                'balance': balance_str,
-                'balance_formatted': f"{currency} {balance_str}",
-                'currency': currency,
-            }
-            msg = render_template(campaign.message, context)
-            tpl = campaign.message or ''
-            if ('{balance' not in tpl) and ('{balance_formatted' not in tpl):
-                msg = f"{msg} Outstanding balance: {currency} {balance_str}."
-
-            # In-app
-            # Queue in-app notification if enabled
-            if campaign.send_in_app and getattr(stu, 'user_id', None):
-                notifications.append(Notification(user_id=stu.user_id, message=msg, type='in_app'))
-                count += 1
-
-            # Mirror to chat only when in-app selected, so it shows in Messages UI
-            if campaign.send_in_app and getattr(stu, 'user_id', None) and personalized_pairs is not None:
-                personalized_pairs.append((stu.user_id, msg))
-
-            # SMS: send ONLY to guardian phone
-            if campaign.send_sms:
-                phone = getattr(stu, 'guardian_id', None)
-                if phone:
-                    ok = False
-                    try:
-                        ok = send_sms(phone, msg)
-                    except Exception:
-                        logger.exception("send_sms crashed for %s", phone)
-                        ok = False
-                    if ok:
-                        sms_sent += 1
-                        count += 1
-                    else:
-                        sms_failed += 1
-
-            # Email
-            if campaign.send_email:
-                recipient = getattr(stu, 'email', None) or getattr(getattr(stu, 'user', None), 'email', None)
-                if recipient:
-                    ok = False
-                    try:
-                        ok = send_email_safe(campaign.email_subject or 'School Fees Arrears', msg, recipient)
-                    except Exception:
-                        logger.exception("send_email_safe crashed for %s", recipient)
-                        ok = False
-                    if ok:
-                        email_sent += 1
-                        count += 1
-                    else:
-                        email_failed += 1
-
-        if notifications:
-            Notification.objects.bulk_create(notifications)
-
-        # Also create chat messages (personalized per recipient) so these announcements appear in the unified Messages UI
-        try:
-            if personalized_pairs:
-                # Resolve a valid sender id (fallback to any admin in school if created_by is missing)
-                sender_id = getattr(campaign.created_by, 'id', None) or resolve_default_sender_id(campaign.school_id)
-                if sender_id:
-                    create_personalized_messages_for_users(
-                        school_id=campaign.school_id,
-                        sender_id=sender_id,
-                        user_body_pairs=personalized_pairs,
-                        system_tag='arrears',
-                        queue_delivery=False,  # do not trigger email/SMS from chat mirror; channels are independent
-                    )
-        except Exception:
-            logger.exception("Failed to mirror arrears campaign to chat messages")
-
-        # Mark as completed
-        with transaction.atomic():
-            campaign = ArrearsMessageCampaign.objects.select_for_update().get(pk=campaign_id)
-            campaign.sent_count = count
-            campaign.sms_sent = sms_sent
-            campaign.sms_failed = sms_failed
-            campaign.email_sent = email_sent
-            campaign.email_failed = email_failed
-            campaign.status = ArrearsMessageCampaign.Status.COMPLETED
-            campaign.finished_at = timezone.now()
-            campaign.save(update_fields=['sent_count', 'sms_sent', 'sms_failed', 'email_sent', 'email_failed', 'status', 'finished_at'])
-    except Exception as e:
-        logger.exception("Arrears campaign %s failed", campaign_id)
-        try:
-            # Update failure status
-            campaign = ArrearsMessageCampaign.objects.get(pk=campaign_id)
-            campaign.status = ArrearsMessageCampaign.Status.FAILED
-            campaign.error_message = str(e)
-            campaign.finished_at = timezone.now()
-            campaign.save(update_fields=['status', 'error_message', 'finished_at'])
-        except Exception:
-            pass
+    from .services.arrears_campaigns import run_campaign
+    run_campaign(campaign_id, new_run=new_run)
 
 
 def process_message_delivery(message_id: int):
     """Background task: forwards a Message to all recipients via SMS and Email.
     Uses user.phone and user.email if available. Errors are logged and do not stop delivery to others.
     """
-    from .models import Message, MessageRecipient
+    from .models import DeliveryAttempt, Message, MessageRecipient
+    from .services.delivery_log import DeliveryLog
     try:
         msg = Message.objects.select_related('sender', 'school').get(pk=message_id)
         # Iterate recipients
@@ -509,26 +370,20 @@ def process_message_delivery(message_id: int):
         sent_sms = 0
         sent_email = 0
         subject = f"New message from {getattr(msg.sender, 'username', 'user')}"
-        for r in recipients:
-            u = r.user
-            if not u:
-                continue
-            # SMS
-            phone = getattr(u, 'phone', '')
-            if phone:
-                try:
-                    if send_sms(phone, msg.body):
-                        sent_sms += 1
-                except Exception:
-                    logger.exception("Failed to SMS user %s", getattr(u, 'id', ''))
-            # Email
-            email = getattr(u, 'email', '')
-            if email:
-                try:
-                    if send_email_safe(subject, msg.body, email):
-                        sent_email += 1
-                except Exception:
-                    logger.exception("Failed to email user %s", getattr(u, 'id', ''))
+        # Outcomes are recorded per recipient (DeliveryAttempt) in one insert at the end
+        with DeliveryLog(DeliveryAttempt.Source.MESSAGE, msg.id, school_id=msg.school_id) as log:
+            for r in recipients:
+                u = r.user
+                if not u:
+                    continue
+                # SMS
+                phone = getattr(u, 'phone', '')
+                if phone and log.sms(phone, msg.body, user_id=u.id):
+                    sent_sms += 1
+                # Email
+                email = getattr(u, 'email', '')
+                if email and log.email(subject, msg.body, email, user_id=u.id):
+                    sent_email += 1
         logger.info("Message %s delivery complete: email=%s sms=%s", message_id, sent_email, sent_sms)
     except Exception:
         logger.exception("Message delivery %s failed", message_id)
@@ -551,7 +406,8 @@ def deliver_message_collect(message_id: int) -> dict:
     }
     Does not raise; logs errors and marks ok=False when applicable.
     """
-    from .models import Message, MessageRecipient
+    from .models import DeliveryAttempt, Message, MessageRecipient
+    from .services.delivery_log import DeliveryLog
     results = {
         'message_id': message_id,
         'in_app': {'created': False},
@@ -571,31 +427,22 @@ def deliver_message_collect(message_id: int) -> dict:
             .select_related('user')
         )
         subject = f"New message from {getattr(msg.sender, 'username', 'user')}"
-        for r in recipients:
-            u = r.user
-            if not u:
-                continue
-            # SMS
-            phone = getattr(u, 'phone', '')
-            if phone:
-                ok_sms = False
-                try:
-                    ok_sms = send_sms(phone, msg.body)
-                except Exception:
-                    logger.exception("Failed to SMS user %s", getattr(u, 'id', ''))
-                    ok_sms = False
-                results['sms'].append({'user_id': getattr(u, 'id', None), 'phone': phone, 'ok': bool(ok_sms)})
-
-            # Email
-            email = getattr(u, 'email', '')
-            if email:
-                ok_email = False
-                try:
-                    ok_email = send_email_safe(subject, msg.body, email)
-                except Exception:
-                    logger.exception("Failed to email user %s", getattr(u, 'id', ''))
-                    ok_email = False
-                results['email'].append({'user_id': getattr(u, 'id', None), 'email': email, 'ok': bool(ok_email)})
+        with DeliveryLog(DeliveryAttempt.Source.MESSAGE, msg.id, school_id=msg.school_id) as log:
+            for r in recipients:
+                u = r.user
+                if not u:
+                    continue
+                # SMS
+                phone = getattr(u, 'phone', '')
+                if phone:
+                    ok_sms = log.sms(phone, msg.body, user_id=u.id)
+                    results['sms'].append({'user_id': getattr(u, 'id', None), 'phone': phone, 'ok': bool(ok_sms)})
+
+                # Email
+                email = getattr(u, 'email', '')
+                if email:
+                    ok_email = log.email(subject, msg.body, email, user_id=u.id)
+                    results['email'].append({'user_id': getattr(u, 'id', None), 'email': email, 'ok': bool(ok_email)})
     except Exception:
         logger.exception("deliver_message_collect failed for message %s", message_id)
     return results
@@ -788,22 +635,19 @@ def notify_payment_received(invoice, payment) -> bool:
             except Exception:
                 pass
 
-        # SMS -> guardian phone only
-        phone = getattr(student, 'guardian_id', None)
-        if phone:
-            try:
-                send_sms(phone, body)
-            except Exception:
-                pass
+        from .models import DeliveryAttempt
+        from .services.delivery_log import DeliveryLog
+        with DeliveryLog(DeliveryAttempt.Source.PAYMENT, payment.id, school_id=school_id or getattr(payment, 'school_id', None)) as log:
+            # SMS -> guardian phone only
+            phone = getattr(student, 'guardian_id', None)
+            if phone:
+                log.sms(phone, body, user_id=getattr(student, 'user_id', None))
 
-        # Email
-        recipient = getattr(student, 'email', None) or getattr(getattr(student, 'user', None), 'email', None)
-        if recipient:
-            try:
+            # Email
+            recipient = getattr(student, 'email', None) or getattr(getattr(student, 'user', None), 'email', None)
+            if recipient:
                 subj = f"Fee payment received - Invoice {invoice.id}"
-                send_email_safe(subj, body, recipient)
-            except Exception:
-                pass
+                log.email(subj, body, recipient, user_id=getattr(student, 'user_id', None))
         return True
     except Exception:
         logger.exception("notify_payment_received failed for invoice %s payment %s", getattr(invoice, 'id', None), getattr(payment, 'id', None))
@@ -1,14 +1,18 @@
 from rest_framework import viewsets, permissions, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
+from rest_framework.exceptions import ValidationError
 from rest_framework.views import APIView
 from django.utils.dateparse import parse_datetime
 from django.db.models import Q
 from django.db.models import Sum, F, Value, DecimalField
 from django.db.models.functions import Coalesce
+from accounts.tenancy import SchoolScopedMixin
 from .models import Notification, Event
-from .serializers import NotificationSerializer, EventSerializer, ArrearsMessageCampaignSerializer
-from .models import ArrearsMessageCampaign, Message, MessageRecipient
+from .serializers import NotificationSerializer, EventSerializer, ArrearsMessageCampaignSerializer, ArrearsCampaignDeliverySerializer, DeliveryAttemptSerializer
+from .models import ArrearsMessageCampaign, ArrearsCampaignDelivery, DeliveryAttempt, Message, MessageRecipient
+from .services.arrears_campaigns import is_stale as campaign_is_stale
+from .services.delivery_log import delivery_stats, queue_retry_failed
 from .serializers import MessageSerializer
 from academics.models import Student
 from .utils import render_template, send_sms, send_email_safe, process_arrears_campaign, queue_message_delivery, deliver_message_collect
@@ -19,7 +23,7 @@ import logging
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
 
-class NotificationViewSet(viewsets.ModelViewSet):
+class NotificationViewSet(SchoolScopedMixin, viewsets.ModelViewSet):
     queryset = Notification.objects.all()
     serializer_class = NotificationSerializer
     permission_classes = [permissions.IsAuthenticated]
@@ -124,17 +128,18 @@ class ArrearsMessageCampaignViewSet(viewsets.ModelViewSet):
 
     @action(detail=True, methods=['post'])
     def send(self, request, pk=None):
+        """Run the campaign in the background. An interrupted run resumes where it stopped;
+        pass restart=true to start a fresh run (new recipient snapshot) instead.
+        """
         campaign = self.get_object()
-        # Mark queued/running and spawn background thread
-        if campaign.status in [ArrearsMessageCampaign.Status.RUNNING]:
+        if campaign.status == ArrearsMessageCampaign.Status.RUNNING and not campaign_is_stale(campaign):
             return Response({'detail': 'Campaign already running.'}, status=status.HTTP_409_CONFLICT)
+        restart = str(request.data.get('restart', '')).lower() in ('1', 'true', 'yes')
         campaign.status = ArrearsMessageCampaign.Status.QUEUED
-        campaign.started_at = timezone.now()
-        campaign.sent_count = 0
         campaign.error_message = ''
-        campaign.save(update_fields=['status','started_at','sent_count','error_message'])
+        campaign.save(update_fields=['status', 'error_message'])
 
-        t = threading.Thread(target=process_arrears_campaign, args=(campaign.id,), daemon=True)
+        t = threading.Thread(target=process_arrears_campaign, args=(campaign.id,), kwargs={'new_run': restart}, daemon=True)
         t.start()
 
         return Response({'status': 'queued', 'id': campaign.id}, status=status.HTTP_202_ACCEPTED)
@@ -145,6 +150,31 @@ class ArrearsMessageCampaignViewSet(viewsets.ModelViewSet):
         data = ArrearsMessageCampaignSerializer(campaign).data
         return Response(data)
 
+    @action(detail=True, methods=['get'])
+    def deliveries(self, request, pk=None):
+        """Recipients of the campaign's latest run (or ?run=N), optionally ?status=pending|processing|done."""
+        campaign = self.get_object()
+        qs = ArrearsCampaignDelivery.objects.filter(campaign=campaign, run=request.query_params.get('run') or campaign.run_number)
+        if request.query_params.get('status'):
+            qs = qs.filter(status=request.query_params['status'])
+        qs = qs.select_related('student').order_by('id')
+        page = self.paginate_queryset(qs)
+        if page is not None:
+            return self.get_paginated_response(ArrearsCampaignDeliverySerializer(page, many=True).data)
+        return Response(ArrearsCampaignDeliverySerializer(qs, many=True).data)
+
+    @action(detail=True, methods=['get'], url_path='delivery-stats')
+    def delivery_stats(self, request, pk=None):
+        campaign = self.get_object()
+        return Response(delivery_stats(DeliveryAttempt.Source.CAMPAIGN, campaign.id))
+
+    @action(detail=True, methods=['post'], url_path='retry-failed')
+    def retry_failed(self, request, pk=None):
+        """Resend only the SMS/emails of this campaign whose latest attempt failed."""
+        campaign = self.get_object()
+        queued = queue_retry_failed(DeliveryAttempt.Source.CAMPAIGN, campaign.id)
+        return Response({'queued': queued}, status=status.HTTP_202_ACCEPTED if queued else status.HTTP_200_OK)
+
 
 class MessageViewSet(viewsets.ModelViewSet):
     """Inbox-focused messages. Default list() returns current user's inbox.
@@ -190,6 +220,33 @@ class MessageViewSet(viewsets.ModelViewSet):
         results = deliver_message_collect(msg.id)
         return Response(results, status=status.HTTP_200_OK)
 
+    def _sent_message(self, request, pk):
+        """The message when the current user is its sender or an admin of its school, else an error Response."""
+        msg = Message.objects.filter(pk=pk).first()
+        if msg is None:
+            return Response({'detail': 'Not found'}, status=status.HTTP_404_NOT_FOUND)
+        user = request.user
+        is_school_admin = getattr(user, 'role', '') == 'admin' and msg.school_id == getattr(user, 'school_id', None)
+        if not is_school_admin and msg.sender_id != user.id:
+            return Response({'detail': 'Not allowed'}, status=status.HTTP_403_FORBIDDEN)
+        return msg
+
+    @action(detail=True, methods=['get'], url_path='delivery-stats')
+    def delivery_stats(self, request, pk=None):
+        msg = self._sent_message(request, pk)
+        if isinstance(msg, Response):
+            return msg
+        return Response(delivery_stats(DeliveryAttempt.Source.MESSAGE, msg.id))
+
+    @action(detail=True, methods=['post'], url_path='retry-failed')
+    def retry_failed(self, request, pk=None):
+        """Resend only the SMS/emails of this message whose latest attempt failed."""
+        msg = self._sent_message(request, pk)
+        if isinstance(msg, Response):
+            return msg
+        queued = queue_retry_failed(DeliveryAttempt.Source.MESSAGE, msg.id)
+        return Response({'queued': queued}, status=status.HTTP_202_ACCEPTED if queued else status.HTTP_200_OK)
+
     @action(detail=False, methods=['get'], url_path='system')
     def system(self, request):
         """Return system-tagged messages for the current user's inbox (system_tag not null)."""
@@ -230,6 +287,66 @@ class MessageViewSet(viewsets.ModelViewSet):
         return Response({'detail': 'ok'})
 
 
+class IsAdminOrFinance(permissions.BasePermission):
+    def has_permission(self, request, view):
+        return request.user and request.user.is_authenticated and request.user.role in ('admin', 'finance')
+
+
+class DeliveryAttemptViewSet(SchoolScopedMixin, viewsets.ReadOnlyModelViewSet):
+    """SMS/email delivery log of the school. Filters: source (message|campaign|payment|exam),
+    source_id, channel, status, latest=1 (only each recipient's latest attempt).
+    """
+    serializer_class = DeliveryAttemptSerializer
+    permission_classes = [IsAdminOrFinance]
+    queryset = DeliveryAttempt.objects.all()
+
+    def get_queryset(self):
+        qs = super().get_queryset()
+        params = self.request.query_params
+        for field in ('source', 'channel', 'status'):
+            if params.get(field):
+                qs = qs.filter(**{field: params[field]})
+        if params.get('source_id'):
+            try:
+                qs = qs.filter(source_id=int(params['source_id']))
+            except ValueError:
+                raise ValidationError({'source_id': 'source_id must be a number'})
+        if params.get('latest') in ('1', 'true'):
+            qs = qs.filter(superseded=False)
+        return qs
+
+    def _source(self, request):
+        """(source, source_id) from the query string or body, checked against the school's log."""
+        data = request.query_params if request.method == 'GET' else request.data
+        source = data.get('source')
+        if source not in DeliveryAttempt.Source.values:
+            return Response({'detail': f"source must be one of: {', '.join(DeliveryAttempt.Source.values)}"}, status=400)
+        try:
+            source_id = int(data.get('source_id'))
+        except (TypeError, ValueError):
+            return Response({'detail': 'source_id is required'}, status=400)
+        if not super().get_queryset().filter(source=source, source_id=source_id).exists():
+            return Response({'detail': 'No deliveries recorded for this source'}, status=404)
+        return source, source_id
+
+    @action(detail=False, methods=['get'])
+    def stats(self, request):
+        """Sent/failed per channel (latest attempt per recipient), latency and retry counts."""
+        parsed = self._source(request)
+        if isinstance(parsed, Response):
+            return parsed
+        return Response(delivery_stats(*parsed))
+
+    @action(detail=False, methods=['post'], url_path='retry-failed')
+    def retry_failed(self, request):
+        """Resend only the failed SMS/emails of one source in the background."""
+        parsed = self._source(request)
+        if isinstance(parsed, Response):
+            return parsed
+        queued = queue_retry_failed(*parsed)
+        return Response({'queued': queued}, status=status.HTTP_202_ACCEPTED if queued else status.HTTP_200_OK)
+
+
 # Africa's Talking SMS delivery/inbound callback handler
 logger = logging.getLogger(__name__)
 
@@ -251,6 +368,12 @@ class ATSMSCallbackView(APIView):
                 if isinstance(v, list) and len(v) == 1:
                     payload[k] = v[0]
             logger.info("AT SMS callback: %s", payload)
+            # Delivery report: a message the carrier could not deliver becomes a failed attempt (and retryable)
+            if payload.get('id') and str(payload.get('status', '')).lower() in ('failed', 'rejected'):
+                DeliveryAttempt.objects.filter(
+                    provider_message_id=str(payload['id']), channel=DeliveryAttempt.Channel.SMS,
+                    status=DeliveryAttempt.Status.SENT,
+                ).update(status=DeliveryAttempt.Status.FAILED, error=str(payload.get('failureReason') or payload.get('status'))[:500])
         except Exception:
             logger.exception("Failed to process AT SMS callback")
         # Always return 204 quickly to prevent AT retries
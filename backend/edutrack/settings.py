@@ -105,6 +105,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'accounts.tenancy.TenantMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -158,6 +159,34 @@ DATABASE_URL = os.getenv('DATABASE_URL')
 if DATABASE_URL:
     DATABASES['default'] = dj_database_url.parse(DATABASE_URL, conn_max_age=600, ssl_require=True)
 
+# Cache shared by every worker process: background job progress, upload tokens and the
+# invalidation tokens of per-process snapshots (calendars, teacher scopes, Daraja tokens).
+# REDIS_URL selects Redis; otherwise the database cache table is used (created by
+# `python manage.py createcachetable`). Local SQLite development keeps a per-process cache.
+REDIS_URL = os.getenv('REDIS_URL', '').strip()
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        }
+    }
+elif USE_SQLITE:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+            'LOCATION': os.getenv('CACHE_TABLE', 'edutrack_cache'),
+            # The default of 300 entries would cull live upload tokens and job states
+            'OPTIONS': {'MAX_ENTRIES': int(os.getenv('CACHE_MAX_ENTRIES', '20000'))},
+        }
+    }
+
 AUTH_USER_MODEL = 'accounts.User'
 
 REST_FRAMEWORK = {
@@ -269,3 +298,21 @@ MESSAGES_QUEUE_DELIVERY = os.getenv('MESSAGES_QUEUE_DELIVERY', 'True') == 'True'
 
 # Temporarily disable messaging on account creation/enrollment
 DISABLE_ACCOUNT_MESSAGING = True
+
+# OCR for marks uploads: Tesseract runs in a separate process pool, never in the request worker
+OCR_MAX_WORKERS = int(os.getenv('OCR_MAX_WORKERS', '2'))
+# Jobs waiting or running beyond this are rejected (HTTP 503) instead of piling up
+OCR_MAX_PENDING = int(os.getenv('OCR_MAX_PENDING', '8'))
+# Seconds Tesseract may spend on one image before it is killed
+OCR_TIMEOUT = int(os.getenv('OCR_TIMEOUT', '30'))
+
+# M-Pesa callbacks are queued in an inbox and applied by a worker: 'thread' runs it inside the
+# web process; 'off' leaves it to `manage.py process_mpesa_callbacks --loop`
+MPESA_CALLBACK_WORKER = os.getenv('MPESA_CALLBACK_WORKER', 'thread')
+
+# Term fee statements are rendered to PDF in a process pool of this many workers (0 renders in
+# the job's own thread)
+FEE_STATEMENT_WORKERS = int(os.getenv('FEE_STATEMENT_WORKERS', '2'))
+
+# Arrears campaigns send SMS/email to this many recipients at a time (threads per running campaign)
+ARREARS_CAMPAIGN_CONCURRENCY = int(os.getenv('ARREARS_CAMPAIGN_CONCURRENCY', '4'))
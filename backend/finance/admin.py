@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Invoice, Payment, FeeCategory, ClassFee, MpesaConfig
+from .models import Invoice, Payment, FeeCategory, ClassFee, MpesaConfig, StkRequest, MpesaCallback
 
 @admin.register(Invoice)
 class InvoiceAdmin(admin.ModelAdmin):
@@ -11,7 +11,7 @@ class InvoiceAdmin(admin.ModelAdmin):
 class PaymentAdmin(admin.ModelAdmin):
     list_display = ("id", "invoice", "amount", "method", "reference", "created_at", "recorded_by")
     list_filter = ("method", "created_at")
-    search_fields = ("invoice__student__name", "reference")
+    search_fields = ("invoice__student__name", "reference", "mpesa_receipt")
 
 @admin.register(FeeCategory)
 class FeeCategoryAdmin(admin.ModelAdmin):
@@ -29,3 +29,16 @@ class MpesaConfigAdmin(admin.ModelAdmin):
     list_display = ("id", "school", "short_code", "environment", "updated_at")
     list_filter = ("environment", "school")
     search_fields = ("school__name", "short_code")
+
+@admin.register(StkRequest)
+class StkRequestAdmin(admin.ModelAdmin):
+    list_display = ("id", "checkout_request_id", "invoice", "amount", "status", "receipt_number", "created_at")
+    list_filter = ("status",)
+    search_fields = ("checkout_request_id", "receipt_number", "phone")
+    raw_id_fields = ("invoice", "payment")
+
+@admin.register(MpesaCallback)
+class MpesaCallbackAdmin(admin.ModelAdmin):
+    list_display = ("id", "checkout_request_id", "status", "attempts", "received_at", "processed_at")
+    list_filter = ("status",)
+    search_fields = ("checkout_request_id",)
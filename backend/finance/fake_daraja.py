@@ -0,0 +1,150 @@
+import base64
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import requests
+
+# A local stand-in for the Safaricom Daraja API, for exercising the STK flow offline:
+#   GET  /oauth/v1/generate?grant_type=client_credentials   (HTTP basic auth)
+#   POST /mpesa/stkpush/v1/processrequest                   (Bearer token)
+# After a successful push it POSTs a stkCallback to the request's CallBackURL. Phone numbers
+# ending in 1 get a "cancelled by user" callback; everything else succeeds. Point the app at
+# it with MPESA_BASE_URL=http://127.0.0.1:<port> (see manage.py fake_daraja).
+
+
+class FakeDaraja:
+    def __init__(self, host='127.0.0.1', port=0, consumer_key='fake-key', consumer_secret='fake-secret',
+                 token_ttl=3599, callback_delay=0.5):
+        self.consumer_key = consumer_key
+        self.consumer_secret = consumer_secret
+        self.token_ttl = token_ttl
+        self.callback_delay = callback_delay
+        self.tokens = {}  # token -> expiry (epoch seconds)
+        self.token_requests = 0
+        self.stk_requests = []
+        self.callbacks = []  # (url, payload, status or error)
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def revoke_tokens(self):
+        with self._lock:
+            self.tokens.clear()
+
+    # ----- request handling -----
+
+    def _issue_token(self, auth_header):
+        expected = base64.b64encode(f"{self.consumer_key}:{self.consumer_secret}".encode()).decode()
+        if auth_header != f"Basic {expected}":
+            return 400, {'errorCode': '400.008.01', 'errorMessage': 'Invalid Authentication passed'}
+        token = uuid.uuid4().hex
+        with self._lock:
+            self.token_requests += 1
+            self.tokens[token] = time.time() + self.token_ttl
+        return 200, {'access_token': token, 'expires_in': str(self.token_ttl)}
+
+    def _stk_push(self, auth_header, payload):
+        token = (auth_header or '').replace('Bearer ', '', 1)
+        with self._lock:
+            valid = self.tokens.get(token, 0) > time.time()
+        if not valid:
+            return 401, {'errorCode': '404.001.03', 'errorMessage': 'Invalid Access Token'}
+        missing = [k for k in ('BusinessShortCode', 'Password', 'Timestamp', 'Amount', 'PhoneNumber', 'CallBackURL') if not payload.get(k)]
+        if missing:
+            return 400, {'errorCode': '400.002.02', 'errorMessage': f"Bad Request - Invalid {missing[0]}"}
+        checkout_id = f"ws_CO_{time.strftime('%d%m%Y%H%M%S')}{uuid.uuid4().hex[:8]}"
+        merchant_id = f"{uuid.uuid4().int % 100000}-{uuid.uuid4().int % 10000000}-1"
+        with self._lock:
+            self.stk_requests.append(dict(payload, CheckoutRequestID=checkout_id))
+        threading.Thread(target=self._send_callback, args=(payload, checkout_id, merchant_id), daemon=True).start()
+        return 200, {
+            'MerchantRequestID': merchant_id,
+            'CheckoutRequestID': checkout_id,
+            'ResponseCode': '0',
+            'ResponseDescription': 'Success. Request accepted for processing',
+            'CustomerMessage': 'Success. Request accepted for processing',
+        }
+
+    def callback_payload(self, payload, checkout_id, merchant_id):
+        phone = str(payload.get('PhoneNumber'))
+        if phone.endswith('1'):
+            return {'Body': {'stkCallback': {
+                'MerchantRequestID': merchant_id, 'CheckoutRequestID': checkout_id,
+                'ResultCode': 1032, 'ResultDesc': 'Request cancelled by user',
+            }}}
+        receipt = 'FK' + uuid.uuid4().hex[:8].upper()
+        return {'Body': {'stkCallback': {
+            'MerchantRequestID': merchant_id, 'CheckoutRequestID': checkout_id,
+            'ResultCode': 0, 'ResultDesc': 'The service request is processed successfully.',
+            'CallbackMetadata': {'Item': [
+                {'Name': 'Amount', 'Value': payload.get('Amount')},
+                {'Name': 'MpesaReceiptNumber', 'Value': receipt},
+                {'Name': 'TransactionDate', 'Value': int(time.strftime('%Y%m%d%H%M%S'))},
+                {'Name': 'PhoneNumber', 'Value': int(phone) if phone.isdigit() else phone},
+            ]},
+        }}}
+
+    def _send_callback(self, payload, checkout_id, merchant_id):
+        time.sleep(self.callback_delay)
+        url = payload.get('CallBackURL')
+        body = self.callback_payload(payload, checkout_id, merchant_id)
+        try:
+            status = requests.post(url, json=body, timeout=10).status_code
+        except Exception as e:
+            status = f'error: {e}'
+        with self._lock:
+            self.callbacks.append((url, body, status))
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _reply(self, status, data):
+                body = json.dumps(data).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if urlparse(self.path).path == '/oauth/v1/generate':
+                    return self._reply(*fake._issue_token(self.headers.get('Authorization')))
+                self._reply(404, {'errorMessage': 'Not found'})
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                try:
+                    payload = json.loads(self.rfile.read(length) or b'{}')
+                except ValueError:
+                    return self._reply(400, {'errorMessage': 'Invalid JSON'})
+                if urlparse(self.path).path == '/mpesa/stkpush/v1/processrequest':
+                    return self._reply(*fake._stk_push(self.headers.get('Authorization'), payload))
+                self._reply(404, {'errorMessage': 'Not found'})
+
+            def log_message(self, fmt, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from finance.fake_daraja import FakeDaraja
+
+
+class Command(BaseCommand):
+    help = "Run a local fake Daraja (M-Pesa) API for offline STK push testing. Set MPESA_BASE_URL to the printed URL."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--consumer-key', default='fake-key')
+        parser.add_argument('--consumer-secret', default='fake-secret')
+        parser.add_argument('--token-ttl', type=int, default=3599, help='Seconds before issued tokens expire')
+        parser.add_argument('--callback-delay', type=float, default=2.0, help='Seconds before the STK callback is sent')
+
+    def handle(self, *args, **options):
+        fake = FakeDaraja(
+            host=options['host'], port=options['port'],
+            consumer_key=options['consumer_key'], consumer_secret=options['consumer_secret'],
+            token_ttl=options['token_ttl'], callback_delay=options['callback_delay'],
+        )
+        self.stdout.write(self.style.SUCCESS(f"Fake Daraja listening on {fake.url}"))
+        self.stdout.write(f"  MPESA_BASE_URL={fake.url} MPESA_CONSUMER_KEY={fake.consumer_key} MPESA_CONSUMER_SECRET={fake.consumer_secret}")
+        try:
+            fake.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            fake.server.server_close()
@@ -0,0 +1,25 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from finance.services.mpesa_callbacks import BATCH_SIZE, drain
+
+
+class Command(BaseCommand):
+    help = "Apply queued M-Pesa STK callbacks from the inbox. Use --loop to keep polling (with MPESA_CALLBACK_WORKER=off)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+        parser.add_argument('--loop', action='store_true', help='Keep running, polling for new callbacks')
+        parser.add_argument('--interval', type=float, default=1.0, help='Seconds between polls when idle (with --loop)')
+
+    def handle(self, *args, **options):
+        while True:
+            counts = drain(batch_size=options['batch_size'])
+            if counts:
+                self.stdout.write(", ".join(f"{k}={v}" for k, v in sorted(counts.items())))
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+        if not options['loop'] and not counts:
+            self.stdout.write("No pending callbacks.")
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from finance.services.finance_cube import rebuild_all, refresh
+
+
+class Command(BaseCommand):
+    help = "Rebuild the finance cube from invoices, payments and expenses. Use --dirty to only rebuild flagged days."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--school', type=int, default=None, help='Only rebuild this school id')
+        parser.add_argument('--dirty', action='store_true', help='Only rebuild days flagged by recent writes')
+
+    def handle(self, *args, **options):
+        if options['dirty']:
+            days = refresh(school_id=options['school'])
+        else:
+            days = rebuild_all(school_id=options['school'])
+        self.stdout.write(f"Rebuilt {days} school-day(s).")
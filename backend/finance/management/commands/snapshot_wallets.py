@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from finance.services.wallet_ledger import take_snapshots
+
+
+class Command(BaseCommand):
+    help = "Snapshot pocket-money wallet balances so statements only sum recent transactions. Run periodically (e.g. nightly)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--school', type=int, default=None, help='Only snapshot wallets of this school id')
+
+    def handle(self, *args, **options):
+        created = take_snapshots(school_id=options['school'])
+        self.stdout.write(f"Created {created} wallet snapshot(s).")
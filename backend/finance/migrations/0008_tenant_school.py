@@ -0,0 +1,68 @@
+# Generated by Django 5.2.18 on 2026-10-19 08:38
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_school(apps, schema_editor):
+    # Student.school is kept for graduated students; fall back to the class's school
+    Student = apps.get_model('academics', 'Student')
+    Invoice = apps.get_model('finance', 'Invoice')
+    Payment = apps.get_model('finance', 'Payment')
+    PocketMoneyTransaction = apps.get_model('finance', 'PocketMoneyTransaction')
+
+    def school_of(students):
+        return Coalesce(Subquery(students.values('school_id')[:1]), Subquery(students.values('klass__school_id')[:1]))
+    Invoice.objects.filter(school__isnull=True).update(
+        school_id=school_of(Student.objects.filter(pk=OuterRef('student_id')))
+    )
+    Payment.objects.filter(school__isnull=True).update(
+        school_id=Subquery(Invoice.objects.filter(pk=OuterRef('invoice_id')).values('school_id')[:1])
+    )
+    PocketMoneyTransaction.objects.filter(school__isnull=True).update(
+        school_id=school_of(Student.objects.filter(pocket_money_wallet=OuterRef('wallet_id')))
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('academics', '0028_tenant_school'),
+        ('accounts', '0010_user_profile_picture'),
+        ('finance', '0007_alter_classfee_amount'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='invoice',
+            name='school',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='accounts.school'),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='school',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='accounts.school'),
+        ),
+        migrations.AddField(
+            model_name='pocketmoneytransaction',
+            name='school',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='accounts.school'),
+        ),
+        migrations.RunPython(backfill_school, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='invoice',
+            index=models.Index(fields=['school', 'status', 'created_at'], name='inv_school_status_created'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['school', 'created_at'], name='pay_school_created'),
+        ),
+        migrations.AddIndex(
+            model_name='pocketmoneytransaction',
+            index=models.Index(fields=['school', 'created_at'], name='pmt_school_created'),
+        ),
+    ]
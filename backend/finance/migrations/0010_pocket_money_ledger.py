@@ -0,0 +1,95 @@
+# Generated by Django 5.2.18 on 2026-10-19 08:53
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def seed_snapshots(apps, schema_editor):
+    # Start every wallet's ledger from its current balance, so statements agree with balances
+    # that were set or adjusted before transactions were posted through the ledger
+    Wallet = apps.get_model('finance', 'PocketMoneyWallet')
+    Snapshot = apps.get_model('finance', 'PocketMoneySnapshot')
+    Txn = apps.get_model('finance', 'PocketMoneyTransaction')
+    last = {
+        r['wallet_id']: r
+        for r in Txn.objects.values('wallet_id').annotate(last_id=Max('id'), as_of=Max('created_at'), school=Max('school_id'))
+    }
+    snapshots = []
+    for w in Wallet.objects.all().iterator():
+        r = last.get(w.id)
+        if r is None and not w.balance:
+            continue
+        snapshots.append(Snapshot(
+            wallet_id=w.id,
+            school_id=r['school'] if r else None,
+            last_transaction_id=r['last_id'] if r else 0,
+            as_of=r['as_of'] if r else w.created_at,
+            balance=w.balance,
+        ))
+    Snapshot.objects.bulk_create(snapshots, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0010_user_profile_picture'),
+        ('finance', '0009_mpesa_callback_inbox'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PocketMoneySnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_transaction_id', models.BigIntegerField()),
+                ('as_of', models.DateTimeField(help_text='created_at of the last included transaction')),
+                ('balance', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='pocketmoneytransaction',
+            name='balance_after',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True),
+        ),
+        migrations.AddField(
+            model_name='pocketmoneytransaction',
+            name='idempotency_key',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='pocketmoneytransaction',
+            name='terminal',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddIndex(
+            model_name='pocketmoneytransaction',
+            index=models.Index(fields=['wallet', 'created_at'], name='pmt_wallet_created'),
+        ),
+        migrations.AddConstraint(
+            model_name='pocketmoneytransaction',
+            constraint=models.UniqueConstraint(fields=('school', 'idempotency_key'), name='pmt_school_idem_key'),
+        ),
+        migrations.AddField(
+            model_name='pocketmoneysnapshot',
+            name='school',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='accounts.school'),
+        ),
+        migrations.AddField(
+            model_name='pocketmoneysnapshot',
+            name='wallet',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='snapshots', to='finance.pocketmoneywallet'),
+        ),
+        migrations.AddIndex(
+            model_name='pocketmoneysnapshot',
+            index=models.Index(fields=['wallet', 'as_of'], name='pms_wallet_asof'),
+        ),
+        migrations.AddConstraint(
+            model_name='pocketmoneysnapshot',
+            constraint=models.UniqueConstraint(fields=('wallet', 'last_transaction_id'), name='pms_wallet_last_tx'),
+        ),
+        migrations.RunPython(seed_snapshots, migrations.RunPython.noop),
+    ]
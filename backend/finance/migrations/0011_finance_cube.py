@@ -0,0 +1,56 @@
+# Generated by Django 5.2.18 on 2026-10-19 08:59
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def flag_existing_days(apps, schema_editor):
+    # Flag every day that already has invoices, payments or expenses; the first cube read
+    # (or `manage.py rebuild_finance_cube`) builds their buckets
+    from finance.services.finance_cube import all_days
+    DirtyDay = apps.get_model('finance', 'FinanceCubeDirtyDay')
+    models_ = {name: apps.get_model('finance', name) for name in ('Invoice', 'Payment', 'Expense')}
+    DirtyDay.objects.bulk_create(
+        [DirtyDay(school_id=school_id, day=day) for school_id, day in all_days(models=models_)],
+        batch_size=500, ignore_conflicts=True,
+    )
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0010_user_profile_picture'),
+        ('finance', '0010_pocket_money_ledger'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FinanceCubeBucket',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('kind', models.CharField(choices=[('billed', 'Billed'), ('payment', 'Payment'), ('expense', 'Expense')], max_length=10)),
+                ('method', models.CharField(blank=True, max_length=20)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('amount', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('expense_category', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='finance.expensecategory')),
+                ('fee_category', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='finance.feecategory')),
+                ('school', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='accounts.school')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['school', 'day'], name='fcube_school_day')],
+            },
+        ),
+        migrations.CreateModel(
+            name='FinanceCubeDirtyDay',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('marked_at', models.DateTimeField(auto_now_add=True)),
+                ('school', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='accounts.school')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('school', 'day'), name='fcube_dirty_school_day')],
+            },
+        ),
+        migrations.RunPython(flag_existing_days, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-19 09:02
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('academics', '0029_student_guardian_index'),
+        ('accounts', '0010_user_profile_picture'),
+        ('finance', '0011_finance_cube'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FeeStatement',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.IntegerField()),
+                ('term', models.IntegerField(choices=[(1, 'Term 1'), (2, 'Term 2'), (3, 'Term 3')])),
+                ('file', models.CharField(help_text='Storage path of the PDF', max_length=255)),
+                ('sha256', models.CharField(max_length=64)),
+                ('opening_balance', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('term_billed', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('term_paid', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('closing_balance', models.DecimalField(decimal_places=2, default=0, max_digits=12)),
+                ('generated_at', models.DateTimeField(auto_now=True)),
+                ('emailed_to', models.EmailField(blank=True, max_length=254)),
+                ('emailed_at', models.DateTimeField(blank=True, null=True)),
+                ('school', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='accounts.school')),
+                ('student', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='fee_statements', to='academics.student')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['school', 'year', 'term'], name='fstmt_school_period')],
+                'constraints': [models.UniqueConstraint(fields=('student', 'year', 'term'), name='fstmt_student_period')],
+            },
+        ),
+    ]
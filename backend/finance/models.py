@@ -80,9 +80,20 @@ class Invoice(models.Model):
     category = models.ForeignKey('finance.FeeCategory', null=True, blank=True, on_delete=models.SET_NULL, related_name='invoices')
     year = models.IntegerField(null=True, blank=True)
     term = models.IntegerField(choices=TERM_CHOICES, null=True, blank=True)
+    # CheckoutRequestID of the latest STK push (StkRequest is the lookup table for callbacks)
     mpesa_transaction_id = models.CharField(max_length=100, blank=True)
     due_date = models.DateField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Denormalized tenant column (see accounts.tenancy); set from the student on save
+    school = models.ForeignKey('accounts.School', null=True, blank=True, on_delete=models.CASCADE, related_name='+', db_index=False)
+
+    class Meta:
+        indexes = [models.Index(fields=['school', 'status', 'created_at'], name='inv_school_status_created')]
+
+    def save(self, *args, **kwargs):
+        if self.school_id is None and self.student_id:
+            self.school_id = self.student.tenant_school_id()
+        super().save(*args, **kwargs)
 
 class Payment(models.Model):
     invoice = models.ForeignKey(Invoice, related_name='payments', on_delete=models.CASCADE)
@@ -95,14 +106,85 @@ class Payment(models.Model):
     )
     method = models.CharField(max_length=20, choices=METHOD_CHOICES, default='mpesa')
     reference = models.CharField(max_length=100, blank=True)
+    # M-Pesa receipt number (e.g. QGH7XYZ123); unique so a retried callback can never record twice
+    mpesa_receipt = models.CharField(max_length=30, null=True, blank=True, unique=True)
     attachment = models.FileField(upload_to='payment_attachments/', null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     recorded_by = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, on_delete=models.SET_NULL)
+    # Denormalized tenant column (see accounts.tenancy); copied from the invoice on save
+    school = models.ForeignKey('accounts.School', null=True, blank=True, on_delete=models.CASCADE, related_name='+', db_index=False)
+
+    class Meta:
+        indexes = [models.Index(fields=['school', 'created_at'], name='pay_school_created')]
+
+    def save(self, *args, **kwargs):
+        if self.school_id is None and self.invoice_id:
+            self.school_id = self.invoice.school_id or self.invoice.student.tenant_school_id()
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return f"Payment {self.amount} for Invoice {self.invoice_id}"
 
 
+class StkRequest(models.Model):
+    """An STK push sent to Daraja, looked up by CheckoutRequestID when its callback arrives."""
+    STATUS_CHOICES = (
+        ('pending', 'Pending'),
+        ('success', 'Success'),
+        ('failed', 'Failed'),
+    )
+    checkout_request_id = models.CharField(max_length=100, unique=True)
+    merchant_request_id = models.CharField(max_length=100, blank=True)
+    invoice = models.ForeignKey(Invoice, null=True, on_delete=models.SET_NULL, related_name='stk_requests')
+    school = models.ForeignKey('accounts.School', null=True, blank=True, on_delete=models.CASCADE, related_name='+', db_index=False)
+    phone = models.CharField(max_length=20, blank=True)
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    result_code = models.IntegerField(null=True, blank=True)
+    result_desc = models.CharField(max_length=255, blank=True)
+    receipt_number = models.CharField(max_length=30, blank=True)
+    payment = models.ForeignKey(Payment, null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    initiated_by = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    created_at = models.DateTimeField(auto_now_add=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['school', 'created_at'], name='stk_school_created')]
+
+    def __str__(self):
+        return f"STK {self.checkout_request_id} ({self.status})"
+
+
+class MpesaCallback(models.Model):
+    """Inbox of raw Daraja callbacks. The webhook only inserts here; finance.services.mpesa_callbacks
+    applies them in batches.
+    """
+    STATUS_CHOICES = (
+        ('pending', 'Pending'),
+        ('processing', 'Processing'),
+        ('applied', 'Applied'),
+        ('duplicate', 'Duplicate'),
+        ('ignored', 'Ignored'),
+        ('error', 'Error'),
+    )
+    body = models.TextField()
+    checkout_request_id = models.CharField(max_length=100, blank=True)
+    status = models.CharField(max_length=12, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    error = models.TextField(blank=True)
+    received_at = models.DateTimeField(auto_now_add=True)
+    # Set by the worker that claimed the row, so a batch is claimed with one UPDATE
+    claim_token = models.CharField(max_length=32, blank=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'id'], name='mpesa_cb_status')]
+
+    def __str__(self):
+        return f"Callback {self.id} {self.checkout_request_id} ({self.status})"
+
+
 class ExpenseCategory(models.Model):
     """A category for expenses, e.g., Salaries, Utilities, Supplies."""
     name = models.CharField(max_length=100)
@@ -155,7 +237,111 @@ class PocketMoneyTransaction(models.Model):
     description = models.TextField(blank=True)
     recorded_by = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, on_delete=models.SET_NULL)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Denormalized tenant column (see accounts.tenancy); set from the wallet's student on save
+    school = models.ForeignKey('accounts.School', null=True, blank=True, on_delete=models.CASCADE, related_name='+', db_index=False)
+    # Client-supplied key (e.g. from a POS terminal) so a retried submission is applied once
+    idempotency_key = models.CharField(max_length=64, null=True, blank=True)
+    # Wallet balance right after this transaction (null for rows recorded before the ledger)
+    balance_after = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    terminal = models.CharField(max_length=64, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['school', 'created_at'], name='pmt_school_created'),
+            models.Index(fields=['wallet', 'created_at'], name='pmt_wallet_created'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['school', 'idempotency_key'], name='pmt_school_idem_key'),
+        ]
+
+    def save(self, *args, **kwargs):
+        if self.school_id is None and self.wallet_id:
+            self.school_id = self.wallet.student.tenant_school_id()
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return f"{self.transaction_type.capitalize()} of {self.amount} for {self.wallet.student.name}"
 
+
+
+class PocketMoneySnapshot(models.Model):
+    """Wallet balance as of a ledger position, so statements start from the nearest snapshot
+    instead of summing the wallet's whole history (see finance.services.wallet_ledger).
+    """
+    wallet = models.ForeignKey(PocketMoneyWallet, on_delete=models.CASCADE, related_name='snapshots')
+    school = models.ForeignKey('accounts.School', null=True, blank=True, on_delete=models.CASCADE, related_name='+', db_index=False)
+    # Balance including every transaction of the wallet with id <= last_transaction_id
+    last_transaction_id = models.BigIntegerField()
+    as_of = models.DateTimeField(help_text='created_at of the last included transaction')
+    balance = models.DecimalField(max_digits=12, decimal_places=2)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['wallet', 'as_of'], name='pms_wallet_asof')]
+        constraints = [models.UniqueConstraint(fields=['wallet', 'last_transaction_id'], name='pms_wallet_last_tx')]
+
+    def __str__(self):
+        return f"Snapshot of wallet {self.wallet_id} at {self.as_of:%Y-%m-%d}: {self.balance}"
+
+
+class FinanceCubeBucket(models.Model):
+    """One cell of the finance cube: what a school billed, received or spent on one day, split
+    by fee category, payment method and expense category. Buckets are rebuilt per (school, day)
+    from the raw rows by finance.services.finance_cube; never edit them directly.
+    """
+    KIND_CHOICES = (
+        ('billed', 'Billed'),
+        ('payment', 'Payment'),
+        ('expense', 'Expense'),
+    )
+    school = models.ForeignKey('accounts.School', on_delete=models.CASCADE, related_name='+', db_index=False)
+    day = models.DateField()
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    fee_category = models.ForeignKey(FeeCategory, null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    method = models.CharField(max_length=20, blank=True)
+    expense_category = models.ForeignKey(ExpenseCategory, null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
+    count = models.PositiveIntegerField(default=0)
+    amount = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        indexes = [models.Index(fields=['school', 'day'], name='fcube_school_day')]
+
+    def __str__(self):
+        return f"{self.kind} {self.day} school {self.school_id}: {self.amount}"
+
+
+class FinanceCubeDirtyDay(models.Model):
+    """A (school, day) whose invoices, payments or expenses changed since its buckets were built."""
+    school = models.ForeignKey('accounts.School', on_delete=models.CASCADE, related_name='+', db_index=False)
+    day = models.DateField()
+    marked_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['school', 'day'], name='fcube_dirty_school_day')]
+
+
+class FeeStatement(models.Model):
+    """A generated term fee statement PDF for a student (see finance.services.fee_statements).
+    The file is stored under media with its content hash as the name, so regenerating an
+    unchanged statement reuses the stored file.
+    """
+    school = models.ForeignKey('accounts.School', on_delete=models.CASCADE, related_name='+', db_index=False)
+    student = models.ForeignKey(Student, on_delete=models.CASCADE, related_name='fee_statements')
+    year = models.IntegerField()
+    term = models.IntegerField(choices=Invoice.TERM_CHOICES)
+    file = models.CharField(max_length=255, help_text='Storage path of the PDF')
+    sha256 = models.CharField(max_length=64)
+    opening_balance = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    term_billed = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    term_paid = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    closing_balance = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    generated_at = models.DateTimeField(auto_now=True)
+    emailed_to = models.EmailField(blank=True)
+    emailed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['school', 'year', 'term'], name='fstmt_school_period')]
+        constraints = [models.UniqueConstraint(fields=['student', 'year', 'term'], name='fstmt_student_period')]
+
+    def __str__(self):
+        return f"Fee statement {self.year} T{self.term} for student {self.student_id}"
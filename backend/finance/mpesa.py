@@ -1,7 +1,53 @@
 import os
 import base64
+import hashlib
+import logging
+import threading
+import time
 import requests
 from datetime import datetime
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+# Daraja access tokens live about an hour. They are cached in the Django cache (shared by all
+# workers, see settings.CACHES) until TOKEN_EXPIRY_MARGIN seconds before expiry, and one
+# worker refreshes while the others wait for its token. HTTP goes through one pooled
+# keep-alive session per process. MPESA_BASE_URL points every client at another Daraja host,
+# e.g. the local fake server (manage.py fake_daraja) for offline testing.
+
+TOKEN_EXPIRY_MARGIN = 120
+TOKEN_LOCK_TTL = 15
+TOKEN_WAIT_SECONDS = 5.0
+SANDBOX_URL = 'https://sandbox.safaricom.co.ke'
+PRODUCTION_URL = 'https://api.safaricom.co.ke'
+
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+_TOKEN_LOCKS = {}
+
+
+def http_session() -> requests.Session:
+    """Process-wide pooled session (keep-alive; idempotent GETs are retried on connect errors)."""
+    global _SESSION
+    if _SESSION is None:
+        with _SESSION_LOCK:
+            if _SESSION is None:
+                s = requests.Session()
+                retry = Retry(total=2, connect=2, read=0, backoff_factor=0.2, allowed_methods=frozenset(['GET']))
+                adapter = HTTPAdapter(pool_connections=8, pool_maxsize=32, max_retries=retry)
+                s.mount('https://', adapter)
+                s.mount('http://', adapter)
+                _SESSION = s
+    return _SESSION
+
+
+def _local_lock(key: str) -> threading.Lock:
+    with _SESSION_LOCK:
+        return _TOKEN_LOCKS.setdefault(key, threading.Lock())
 
 
 class MpesaClient:
@@ -14,11 +60,14 @@ class MpesaClient:
     - MPESA_PASSKEY (Lipa Na Mpesa Online passkey)
     - MPESA_ENV (sandbox|production), default sandbox
     - MPESA_CALLBACK_URL (public HTTPS callback)
+    Optional:
+    - MPESA_BASE_URL (override the Daraja host, e.g. http://127.0.0.1:8765 for fake_daraja)
     """
 
     def __init__(self, *, consumer_key: str | None = None, consumer_secret: str | None = None,
                  short_code: str | None = None, passkey: str | None = None,
-                 callback_url: str | None = None, environment: str | None = None):
+                 callback_url: str | None = None, environment: str | None = None,
+                 base_url: str | None = None):
         # Allow explicit overrides (per-school), otherwise fall back to env vars
         self.consumer_key = consumer_key or os.getenv('MPESA_CONSUMER_KEY')
         self.consumer_secret = consumer_secret or os.getenv('MPESA_CONSUMER_SECRET')
@@ -26,13 +75,61 @@ class MpesaClient:
         self.passkey = passkey or os.getenv('MPESA_PASSKEY')
         self.callback = callback_url or os.getenv('MPESA_CALLBACK_URL', 'https://example.com/mpesa/callback')
         env = (environment or os.getenv('MPESA_ENV', 'sandbox')).lower()
-        self.base = 'https://sandbox.safaricom.co.ke' if env != 'production' else 'https://api.safaricom.co.ke'
+        default_base = SANDBOX_URL if env != 'production' else PRODUCTION_URL
+        self.base = (base_url or os.getenv('MPESA_BASE_URL') or default_base).rstrip('/')
+        self.session = http_session()
+
+    # ----- OAuth tokens -----
 
-    def get_token(self):
+    def _token_key(self) -> str:
+        # Keyed by host and credentials so rotated secrets never reuse an old token
+        raw = f"{self.base}|{self.consumer_key}|{self.consumer_secret}".encode('utf-8')
+        return f"finance:mpesa_token:{hashlib.sha256(raw).hexdigest()[:32]}"
+
+    def _fetch_token(self):
         url = f"{self.base}/oauth/v1/generate?grant_type=client_credentials"
-        resp = requests.get(url, auth=(self.consumer_key, self.consumer_secret), timeout=15)
+        resp = self.session.get(url, auth=(self.consumer_key, self.consumer_secret), timeout=15)
         resp.raise_for_status()
-        return resp.json()['access_token']
+        data = resp.json()
+        try:
+            expires_in = int(data.get('expires_in') or 3599)
+        except (TypeError, ValueError):
+            expires_in = 3599
+        return data['access_token'], expires_in
+
+    def get_token(self, force_refresh: bool = False):
+        key = self._token_key()
+        if not force_refresh:
+            token = cache.get(key)
+            if token:
+                return token
+        # Single flight: one thread per process (local lock) and one worker across processes
+        # (cache lock) fetch; the rest wait for the cached token.
+        with _local_lock(key):
+            if not force_refresh:
+                token = cache.get(key)
+                if token:
+                    return token
+            lock_key = f"{key}:lock"
+            if not cache.add(lock_key, 1, TOKEN_LOCK_TTL):
+                deadline = time.monotonic() + TOKEN_WAIT_SECONDS
+                while time.monotonic() < deadline:
+                    time.sleep(0.1)
+                    token = cache.get(key)
+                    if token:
+                        return token
+                logger.warning("Daraja token refresh by another worker timed out; fetching directly")
+            try:
+                token, expires_in = self._fetch_token()
+                cache.set(key, token, max(expires_in - TOKEN_EXPIRY_MARGIN, 30))
+                return token
+            finally:
+                cache.delete(lock_key)
+
+    def invalidate_token(self):
+        cache.delete(self._token_key())
+
+    # ----- STK push -----
 
     def _timestamp(self):
         return datetime.now().strftime('%Y%m%d%H%M%S')
@@ -44,8 +141,6 @@ class MpesaClient:
     def stk_push(self, phone: str, amount: float, account_ref: str = 'EDU-TRACK', tx_desc: str = 'Fee Payment'):
         ts = self._timestamp()
         password = self._password(ts)
-        token = self.get_token()
-        headers = { 'Authorization': f'Bearer {token}', 'Content-Type': 'application/json' }
         payload = {
             "BusinessShortCode": int(self.short_code),
             "Password": password,
@@ -60,6 +155,61 @@ class MpesaClient:
             "TransactionDesc": tx_desc[:12] or 'Fees',
         }
         url = f"{self.base}/mpesa/stkpush/v1/processrequest"
-        resp = requests.post(url, json=payload, headers=headers, timeout=20)
+        resp = self.session.post(url, json=payload, headers=self._headers(self.get_token()), timeout=20)
+        if resp.status_code == 401:
+            # Token revoked or expired early: refresh once and retry
+            resp = self.session.post(url, json=payload, headers=self._headers(self.get_token(force_refresh=True)), timeout=20)
         resp.raise_for_status()
         return resp.json()
+
+    @staticmethod
+    def _headers(token):
+        return {'Authorization': f'Bearer {token}', 'Content-Type': 'application/json'}
+
+
+# ===== Per-school client registry =====
+# Each worker keeps its clients, keyed by school and checked against MpesaConfig.updated_at
+# on every lookup (one indexed query), so a config saved through any worker takes effect on
+# all of them at their next STK push.
+
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+def invalidate_school_client(school_id) -> None:
+    """Drop this process's cached client for a school (called when its MpesaConfig changes)."""
+    with _CLIENTS_LOCK:
+        _CLIENTS.pop(school_id, None)
+
+
+def client_for_school(school_id):
+    """(client, config) for a school: its MpesaConfig credentials, else the MPESA_* env vars.
+    Clients are reused across requests until the school's MpesaConfig is saved or deleted.
+    """
+    from .models import MpesaConfig
+    version = (
+        MpesaConfig.objects.filter(school_id=school_id).values_list('updated_at', flat=True).first()
+        if school_id else None
+    )
+    entry = _CLIENTS.get(school_id)
+    if entry and entry[0] == version:
+        return entry[1], entry[2]
+    config = MpesaConfig.objects.filter(school_id=school_id).first() if version else None
+    if config:
+        client = MpesaClient(
+            consumer_key=config.consumer_key,
+            consumer_secret=config.consumer_secret,
+            short_code=config.short_code,
+            passkey=config.passkey,
+            callback_url=(config.callback_url or os.getenv('MPESA_CALLBACK_URL')),
+            environment=config.environment,
+        )
+    else:
+        client = MpesaClient()
+    with _CLIENTS_LOCK:
+        _CLIENTS[school_id] = (config.updated_at if config else None, client, config)
+    return client, config
+
+
+def has_credentials(client: MpesaClient) -> bool:
+    return all([client.consumer_key, client.consumer_secret, client.short_code, client.passkey])
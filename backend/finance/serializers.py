@@ -1,5 +1,7 @@
+from decimal import Decimal
+
 from rest_framework import serializers
-from .models import Invoice, Payment, FeeCategory, ClassFee, MpesaConfig, ExpenseCategory, Expense, PocketMoneyWallet, PocketMoneyTransaction
+from .models import Invoice, Payment, FeeCategory, ClassFee, MpesaConfig, ExpenseCategory, Expense, PocketMoneyWallet, PocketMoneyTransaction, FeeStatement
 
 class PaymentSerializer(serializers.ModelSerializer):
     recorded_by_name = serializers.SerializerMethodField()
@@ -121,6 +123,8 @@ class PocketMoneyTransactionSerializer(serializers.ModelSerializer):
     class Meta:
         model = PocketMoneyTransaction
         fields = '__all__'
+        # Posted through finance.services.wallet_ledger, which fills these in
+        read_only_fields = ['school', 'recorded_by', 'balance_after', 'terminal']
 
 
 class PocketMoneyWalletSerializer(serializers.ModelSerializer):
@@ -129,3 +133,36 @@ class PocketMoneyWalletSerializer(serializers.ModelSerializer):
     class Meta:
         model = PocketMoneyWallet
         fields = '__all__'
+        # The balance only moves through ledger transactions
+        read_only_fields = ['balance']
+
+
+class PosTransactionSerializer(serializers.Serializer):
+    """One line of a POS batch; the wallet is given directly or by student id / admission number."""
+    key = serializers.CharField(max_length=64, required=False, allow_blank=True)
+    wallet = serializers.IntegerField(required=False)
+    student = serializers.IntegerField(required=False)
+    admission_no = serializers.CharField(max_length=50, required=False)
+    type = serializers.ChoiceField(choices=PocketMoneyTransaction.TRANSACTION_TYPE_CHOICES, default='withdrawal')
+    amount = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=Decimal('0.01'))
+    description = serializers.CharField(required=False, allow_blank=True, default='')
+
+    def validate(self, attrs):
+        if not (attrs.get('wallet') or attrs.get('student') or attrs.get('admission_no')):
+            raise serializers.ValidationError('wallet, student or admission_no is required')
+        return attrs
+
+
+class FeeStatementSerializer(serializers.ModelSerializer):
+    student_name = serializers.CharField(source='student.name', read_only=True)
+    admission_no = serializers.CharField(source='student.admission_no', read_only=True)
+    download_url = serializers.SerializerMethodField()
+
+    class Meta:
+        model = FeeStatement
+        exclude = ['file']
+
+    def get_download_url(self, obj):
+        url = f"/api/finance/fee-statements/{obj.id}/download/"
+        request = self.context.get('request')
+        return request.build_absolute_uri(url) if request else url
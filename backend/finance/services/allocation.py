@@ -0,0 +1,145 @@
+from __future__ import annotations
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Sum
+from django.utils import timezone
+
+from .finance_cube import mark_dirty
+
+# FIFO allocation of a lump sum across a student's open invoices (oldest first), shared by
+# pay_student, the batch pay_students endpoint and statement reconciliation. The students'
+# invoices are locked (in student, created_at, id order, so concurrent batches cannot
+# deadlock), balances come from one grouped query, allocation happens in memory, and the
+# payments and status changes are written with bulk_create/bulk_update in the same
+# transaction. Two concurrent payments for one student therefore allocate one after the
+# other instead of both seeing the same balance. allocate_fifo() mutates the balances, so
+# several lump sums for the same student in one batch see each other's allocations.
+
+ZERO = Decimal('0')
+
+
+def _get_models():
+    from finance.models import Invoice, Payment
+    return {'Invoice': Invoice, 'Payment': Payment}
+
+
+def to_decimal(value) -> Decimal:
+    return value if isinstance(value, Decimal) else Decimal(str(value or 0))
+
+
+def invoice_status(total_paid, amount) -> str:
+    total_paid, amount = to_decimal(total_paid), to_decimal(amount)
+    if total_paid >= amount:
+        return 'paid'
+    if total_paid > 0:
+        return 'partial'
+    return 'unpaid'
+
+
+def open_invoices_by_student(student_ids, school_id=None, lock: bool = False) -> dict:
+    """{student_id: [[invoice, balance], ...]} of invoices with a positive balance, oldest first.
+    Each invoice carries .paid (Decimal). With lock=True the invoice rows are locked
+    (SELECT ... FOR UPDATE) first; call it inside transaction.atomic.
+    """
+    models = _get_models()
+    Invoice, Payment = models['Invoice'], models['Payment']
+    student_ids = list({int(s) for s in student_ids if s})
+    if not student_ids:
+        return {}
+    qs = Invoice.objects.filter(student_id__in=student_ids)
+    if school_id:
+        qs = qs.filter(school_id=school_id)
+    if lock:
+        # FOR UPDATE cannot be combined with the aggregate, so lock first and sum separately
+        invoices = list(qs.select_for_update().order_by('student_id', 'created_at', 'id'))
+    else:
+        invoices = list(qs.order_by('student_id', 'created_at', 'id'))
+    paid = dict(
+        Payment.objects.filter(invoice_id__in=[i.id for i in invoices])
+        .values('invoice_id').annotate(s=Sum('amount')).values_list('invoice_id', 's')
+    ) if invoices else {}
+    out = {}
+    for inv in invoices:
+        inv.paid = to_decimal(paid.get(inv.id))
+        balance = to_decimal(inv.amount) - inv.paid
+        if balance > 0:
+            out.setdefault(inv.student_id, []).append([inv, balance])
+    return out
+
+
+def allocate_fifo(open_invoices: list, amount) -> tuple[list, Decimal]:
+    """Split amount over open_invoices ([[invoice, balance], ...], oldest first).
+    Returns ([(invoice, allocated)], unallocated) and reduces the balances in place.
+    """
+    remaining = to_decimal(amount)
+    allocations = []
+    for entry in open_invoices:
+        if remaining <= 0:
+            break
+        inv, balance = entry
+        if balance <= 0:
+            continue
+        alloc = min(remaining, balance)
+        allocations.append((inv, alloc))
+        entry[1] = balance - alloc
+        inv.paid = getattr(inv, 'paid', ZERO) + alloc
+        remaining -= alloc
+    return allocations, remaining
+
+
+def student_balance(open_invoices: list) -> Decimal:
+    return sum((b for _, b in open_invoices), ZERO)
+
+
+def save_allocations(payments: list) -> int:
+    """bulk_create payments built from allocate_fifo() results and bulk_update the statuses of
+    their invoices (from invoice.paid). Returns the number of invoices whose status changed.
+    Call inside the transaction that locked the invoices.
+    """
+    models = _get_models()
+    models['Payment'].objects.bulk_create(payments, batch_size=500)
+    # bulk_create skips post_save, so flag the finance cube here
+    mark_dirty((p.school_id, p.created_at or timezone.now()) for p in payments)
+    touched = {p.invoice.id: p.invoice for p in payments}
+    changed = []
+    for inv in touched.values():
+        status = invoice_status(inv.paid, inv.amount)
+        if inv.status != status:
+            inv.status = status
+            changed.append(inv)
+    if changed:
+        models['Invoice'].objects.bulk_update(changed, ['status'], batch_size=500)
+    return len(changed)
+
+
+def record_lump_sums(entries: list, school_id=None, user=None) -> list:
+    """Allocate lump sums FIFO and record them atomically.
+    entries: [{'student': id, 'amount': number, 'method': str, 'reference': str}], applied in order.
+    Returns per entry {'student', 'created_payments', 'amount_allocated', 'amount_unallocated'}.
+    """
+    Payment = _get_models()['Payment']
+    with transaction.atomic():
+        open_invoices = open_invoices_by_student([e['student'] for e in entries], school_id=school_id, lock=True)
+        payments, results = [], []
+        for e in entries:
+            amount = to_decimal(e['amount'])
+            allocations, remaining = allocate_fifo(open_invoices.get(int(e['student']), []), amount)
+            pays = [
+                Payment(
+                    invoice=inv,
+                    amount=alloc,
+                    method=e.get('method') or 'cash',
+                    reference=e.get('reference') or '',
+                    recorded_by=user,
+                    school_id=inv.school_id,
+                )
+                for inv, alloc in allocations
+            ]
+            payments.extend(pays)
+            results.append({'student': int(e['student']), 'payments': pays,
+                            'amount_allocated': amount - remaining, 'amount_unallocated': remaining})
+        save_allocations(payments)
+    for r in results:
+        r['created_payments'] = [p.id for p in r.pop('payments')]
+    return results
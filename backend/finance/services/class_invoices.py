@@ -0,0 +1,81 @@
+from __future__ import annotations
+from typing import Iterable
+
+from django.utils import timezone
+
+from .finance_cube import mark_dirty
+
+# Set-based counterpart of the Student post_save receiver ensure_invoices_for_assigned_class:
+# for students moved by queryset UPDATEs (promotion), create the invoices of every ClassFee of
+# their class in the current period and bring existing ones in line with the fee amount and
+# due date. Boarding-fee categories only apply to boarders, as in the receiver.
+
+
+def _get_models():
+    from academics.models import Student, Term
+    from finance.models import ClassFee, Invoice
+    return {'ClassFee': ClassFee, 'Invoice': Invoice, 'Student': Student, 'Term': Term}
+
+
+def _current_period(school_id: int) -> tuple:
+    """(year, term) the receiver bills under: the current term, else the term containing
+    today, else (this year, 1)."""
+    Term = _get_models()['Term']
+    today = timezone.localdate()
+    terms = Term.objects.filter(academic_year__school_id=school_id).select_related('academic_year')
+    t = terms.filter(is_current=True).first() or terms.filter(start_date__lte=today, end_date__gte=today).first()
+    if t:
+        ay = t.academic_year
+        return int(getattr(ay.end_date, 'year', None) or ay.start_date.year), int(t.number)
+    return today.year, 1
+
+
+def sync_class_invoices(school_id: int, student_ids: Iterable[int]) -> dict:
+    """Ensure the current-period class fee invoices of the given students. A handful of
+    queries whatever the number of students. Returns {'created', 'updated'}.
+    """
+    models = _get_models()
+    ClassFee, Invoice = models['ClassFee'], models['Invoice']
+    student_ids = list(student_ids)
+    if not student_ids:
+        return {'created': 0, 'updated': 0}
+    year, term = _current_period(school_id)
+
+    students = list(
+        models['Student'].objects.filter(pk__in=student_ids, klass_id__isnull=False)
+        .values_list('id', 'klass_id', 'boarding_status')
+    )
+    fees = {}
+    for cf in ClassFee.objects.filter(klass_id__in={k for _, k, _ in students}, year=year, term=term).select_related('fee_category'):
+        fees.setdefault(cf.klass_id, []).append(cf)
+    if not fees:
+        return {'created': 0, 'updated': 0}
+
+    existing = {
+        (inv.student_id, inv.category_id): inv
+        for inv in Invoice.objects.filter(
+            student_id__in=[sid for sid, _, _ in students], year=year, term=term,
+            category_id__in={cf.fee_category_id for items in fees.values() for cf in items},
+        ).order_by('id')
+    }
+    to_create, to_update = [], []
+    for sid, klass_id, boarding_status in students:
+        for cf in fees.get(klass_id, []):
+            is_boarding_category = 'board' in str(cf.fee_category.name or '').strip().lower()
+            if is_boarding_category and str(boarding_status or 'day').lower() != 'boarding':
+                continue
+            inv = existing.get((sid, cf.fee_category_id))
+            if inv is None:
+                to_create.append(Invoice(
+                    student_id=sid, category_id=cf.fee_category_id, year=year, term=term,
+                    amount=cf.amount, due_date=cf.due_date, status='unpaid', school_id=school_id,
+                ))
+            elif inv.amount != cf.amount or inv.due_date != cf.due_date:
+                inv.amount, inv.due_date = cf.amount, cf.due_date
+                to_update.append(inv)
+    Invoice.objects.bulk_create(to_create, batch_size=500)
+    Invoice.objects.bulk_update(to_update, ['amount', 'due_date'], batch_size=500)
+    # Bulk writes skip the finance cube receivers
+    if to_create or to_update:
+        mark_dirty([(school_id, timezone.now())] + [(school_id, inv.created_at) for inv in to_update])
+    return {'created': len(to_create), 'updated': len(to_update)}
@@ -0,0 +1,207 @@
+from __future__ import annotations
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+from typing import Iterable, Optional
+
+import numpy as np
+from django.db.models import DecimalField, F, Q, Sum, Value
+from django.db.models.functions import Coalesce, TruncDate
+from django.utils import timezone
+
+# Collections forecast. Outstanding invoices come from one grouped query (amount minus the sum
+# of their payments) and are aged in days past their due date (Invoice.due_date, which the
+# class fee copies in; else the day the invoice was raised) into cohorts, totalled per class,
+# fee category and boarding status with bincount. The projection uses the payment curve of
+# the last `history` terms before the current one: C(d) = share of the billed amount paid
+# within d days of the due date. An invoice aged a days with o outstanding is expected to
+# collect o * (C(a + h) - C(a)) / (1 - C(a)) over the next h days.
+
+COHORTS = ('current', '0-30', '31-60', '61-90', '90+')
+COHORT_EDGES = np.array([0, 31, 61, 91])  # days past due; below 0 is not yet due
+HORIZONS = (30, 60, 90)
+HISTORY_TERMS = 6
+CURVE_START, CURVE_END = -120, 365  # payment offsets (days from due date) outside are clipped
+CURVE_SAMPLES = (-60, -30, 0, 30, 60, 90, 180, 365)
+
+
+def _get_models():
+    from finance.models import Invoice, Payment
+    return {'Invoice': Invoice, 'Payment': Payment}
+
+
+def _days(values) -> np.ndarray:
+    return np.array(values, dtype='datetime64[D]').astype(np.int64)
+
+
+def _money(value) -> float:
+    return round(float(value), 2)
+
+
+# ===== Payment curve =====
+
+def history_terms(school_id: int, year: int, term: int, count: int = HISTORY_TERMS) -> list:
+    """The last `count` (year, term) periods billed before the given one, newest first."""
+    Invoice = _get_models()['Invoice']
+    return list(
+        Invoice.objects.filter(school_id=school_id, year__isnull=False, term__isnull=False)
+        .filter(Q(year__lt=year) | Q(year=year, term__lt=term))
+        .values_list('year', 'term').distinct().order_by('-year', '-term')[:count]
+    )
+
+
+def payment_curve(school_id: int, terms: Iterable[tuple]) -> Optional[dict]:
+    """Cumulative share of the billed amount collected by day offset from the due date,
+    pooled over the terms (so each term weighs by what it billed). None without history.
+    """
+    models = _get_models()
+    terms = list(terms)
+    if not terms:
+        return None
+    tz = timezone.get_current_timezone()
+    in_terms = Q()
+    for y, t in terms:
+        in_terms |= Q(year=y, term=t)
+    billed = models['Invoice'].objects.filter(in_terms, school_id=school_id).aggregate(s=Sum('amount'))['s'] or Decimal('0')
+    if billed <= 0:
+        return None
+    paid_in_terms = Q()
+    for y, t in terms:
+        paid_in_terms |= Q(invoice__year=y, invoice__term=t)
+    rows = list(
+        models['Payment'].objects.filter(paid_in_terms, school_id=school_id)
+        .annotate(
+            paid_on=TruncDate('created_at', tzinfo=tz),
+            anchor=Coalesce('invoice__due_date', TruncDate('invoice__created_at', tzinfo=tz)),
+        )
+        .values_list('amount', 'paid_on', 'anchor')
+    )
+    size = CURVE_END - CURVE_START + 1
+    collected = np.zeros(size)
+    if rows:
+        amounts = np.array([r[0] for r in rows], dtype=float)
+        offsets = _days([r[1] for r in rows]) - _days([r[2] for r in rows])
+        collected = np.bincount(np.clip(offsets, CURVE_START, CURVE_END) - CURVE_START, weights=amounts, minlength=size)
+    curve = np.minimum(np.cumsum(collected) / float(billed), 1.0)
+    return {'terms': terms, 'billed': billed, 'curve': curve}
+
+
+def expected_share(curve: np.ndarray, ages: np.ndarray, horizon: int) -> np.ndarray:
+    """Share of what is still outstanding at each age expected to be paid within `horizon` days."""
+    now = curve[np.clip(ages, CURVE_START, CURVE_END) - CURVE_START]
+    later = curve[np.clip(ages + horizon, CURVE_START, CURVE_END) - CURVE_START]
+    remaining = 1.0 - now
+    with np.errstate(invalid='ignore', divide='ignore'):
+        share = np.where(remaining > 1e-9, (later - now) / remaining, 0.0)
+    return np.clip(share, 0.0, 1.0)
+
+
+# ===== Forecast =====
+
+def _group(keys: np.ndarray, labels: dict, cohort: np.ndarray, outstanding: np.ndarray,
+           students: np.ndarray, expected: dict) -> list:
+    """Cohort totals, invoice/student counts and expected collections per distinct key."""
+    uniq, idx = np.unique(keys, return_inverse=True)
+    n, k = len(uniq), len(COHORTS)
+    grid = np.bincount(idx * k + cohort, weights=outstanding, minlength=n * k).reshape(n, k)
+    invoices = np.bincount(idx, minlength=n)
+    pairs = np.unique(np.stack([idx, students]), axis=1)
+    student_counts = np.bincount(pairs[0], minlength=n)
+    sums = {h: np.bincount(idx, weights=v, minlength=n) for h, v in expected.items()}
+    out = []
+    for g, key in enumerate(uniq.tolist()):
+        out.append({
+            'key': key,
+            'label': labels.get(key, key),
+            'invoices': int(invoices[g]),
+            'students': int(student_counts[g]),
+            'outstanding': _money(grid[g].sum()),
+            'cohorts': {name: _money(grid[g, c]) for c, name in enumerate(COHORTS)},
+            'expected': {str(h): _money(sums[h][g]) for h in sums},
+        })
+    out.sort(key=lambda r: -r['outstanding'])
+    return out
+
+
+def collections_forecast(school_id: int, as_of: Optional[date] = None, klass_id=None,
+                         history: int = HISTORY_TERMS, horizons: Iterable[int] = HORIZONS) -> dict:
+    """Outstanding balances by overdue cohort (overall and per class, fee category and boarding
+    status) with the collections expected over each horizon from the historical payment curve.
+    Balances are as they stood at the end of `as_of`: later invoices and payments are left out.
+    """
+    from .fee_statements import current_period
+    Invoice = _get_models()['Invoice']
+    tz = timezone.get_current_timezone()
+    as_of = as_of or timezone.localdate()
+    horizons = sorted({int(h) for h in horizons if int(h) > 0})
+    money = DecimalField(max_digits=14, decimal_places=2)
+    cutoff = timezone.make_aware(datetime.combine(as_of + timedelta(days=1), time.min), tz)
+
+    qs = Invoice.objects.filter(school_id=school_id, created_at__lt=cutoff)
+    if klass_id:
+        qs = qs.filter(student__klass_id=klass_id)
+    rows = list(
+        qs.annotate(
+            paid=Coalesce(
+                Sum('payments__amount', filter=Q(payments__created_at__lt=cutoff)), Value(0, output_field=money),
+            ),
+            anchor=Coalesce('due_date', TruncDate('created_at', tzinfo=tz)),
+        )
+        .annotate(balance=F('amount') - F('paid'))
+        .filter(balance__gt=0)
+        .values_list(
+            'balance', 'anchor', 'student_id', 'student__klass_id', 'student__klass__name',
+            'category_id', 'category__name', 'student__boarding_status',
+        )
+        .order_by()
+    )
+
+    year, term = current_period(school_id)
+    terms = history_terms(school_id, year, term, history)
+    curve = payment_curve(school_id, terms)
+    result = {
+        'as_of': as_of,
+        'current_period': {'year': year, 'term': term},
+        'cohorts': list(COHORTS),
+        'horizons': horizons,
+        'history': {
+            'terms': [f'{y} T{t}' for y, t in terms],
+            'billed': _money(curve['billed']) if curve else 0.0,
+            'curve': [
+                {'day': d, 'collected_pct': round(float(curve['curve'][d - CURVE_START]) * 100, 2)}
+                for d in CURVE_SAMPLES
+            ] if curve else [],
+        },
+    }
+    if not rows:
+        result.update({
+            'total': {'invoices': 0, 'students': 0, 'outstanding': 0.0,
+                      'cohorts': {c: 0.0 for c in COHORTS}, 'expected': {str(h): 0.0 for h in horizons}},
+            'by_class': [], 'by_fee_category': [], 'by_boarding_status': [],
+        })
+        return result
+
+    outstanding = np.array([r[0] for r in rows], dtype=float)
+    ages = _days([as_of])[0] - _days([r[1] for r in rows])
+    cohort = np.searchsorted(COHORT_EDGES, ages, side='right')
+    students = np.array([r[2] for r in rows], dtype=np.int64)
+    expected = {
+        h: outstanding * expected_share(curve['curve'], ages, h) if curve else np.zeros_like(outstanding)
+        for h in horizons
+    }
+
+    klass_keys = np.array([r[3] or 0 for r in rows], dtype=np.int64)
+    klass_labels = {r[3] or 0: r[4] or 'No class' for r in rows}
+    category_keys = np.array([r[5] or 0 for r in rows], dtype=np.int64)
+    category_labels = {r[5] or 0: r[6] or 'Uncategorised' for r in rows}
+    boarding_keys = np.array([r[7] or 'day' for r in rows])
+    boarding_labels = {'day': 'Day', 'boarding': 'Boarding'}
+
+    total = _group(np.zeros(len(rows), dtype=np.int64), {}, cohort, outstanding, students, expected)[0]
+    del total['key'], total['label']
+    result.update({
+        'total': total,
+        'by_class': _group(klass_keys, klass_labels, cohort, outstanding, students, expected),
+        'by_fee_category': _group(category_keys, category_labels, cohort, outstanding, students, expected),
+        'by_boarding_status': _group(boarding_keys, boarding_labels, cohort, outstanding, students, expected),
+    })
+    return result
@@ -0,0 +1,309 @@
+from __future__ import annotations
+import hashlib
+import logging
+import multiprocessing
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from decimal import Decimal
+from typing import Optional
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, connection
+from django.db.models import Q, Sum
+from django.utils import timezone
+
+from .statement_worker import render_many, render_statement
+
+logger = logging.getLogger(__name__)
+
+# Term fee statements for a whole school (or class, or list of students). The data for every
+# student comes from a handful of grouped queries: balances brought forward from earlier
+# periods (billed and paid), then the term's invoices and the payments on them. Rendering runs
+# in a spawn-context process pool (FEE_STATEMENT_WORKERS) in chunks, driven by a background
+# thread; job progress lives in the Django cache (shared by all workers, see settings.CACHES)
+# for polling, and a job whose worker was restarted mid-run stops heartbeating and is then
+# reported as failed. PDFs are stored as
+# statements/<school>/<year>-T<term>/<sha256>.pdf, so an unchanged statement maps to the file
+# already stored, and FeeStatement keeps the latest per student and term for re-download.
+# With email=True each statement goes to the student's email address.
+
+JOB_TTL = 60 * 60 * 24
+JOB_STALE_AFTER = 60 * 10
+RENDER_CHUNK = 20
+ZERO = Decimal('0.00')
+
+_LOCK = threading.Lock()
+_EXECUTOR: Optional[ProcessPoolExecutor] = None
+
+
+def _get_models():
+    from academics.models import Student
+    from accounts.models import School
+    from finance.models import FeeStatement, Invoice, Payment
+    return {'FeeStatement': FeeStatement, 'Invoice': Invoice, 'Payment': Payment, 'School': School, 'Student': Student}
+
+
+def _executor() -> ProcessPoolExecutor:
+    global _EXECUTOR
+    with _LOCK:
+        if _EXECUTOR is None:
+            # spawn: forking a threaded web worker is unsafe
+            _EXECUTOR = ProcessPoolExecutor(
+                max_workers=max(1, getattr(settings, 'FEE_STATEMENT_WORKERS', 2)),
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+        return _EXECUTOR
+
+
+def current_period(school_id) -> tuple:
+    """(year, term) invoices are billed under right now; same rules as the class fee invoicing."""
+    today = timezone.localdate()
+    try:
+        from academics.services.calendar import get_school_calendar
+        cal = get_school_calendar(school_id)
+        t = (cal.flagged_term() or cal.resolve(today)[1]) if cal else None
+        if t:
+            ay = t.academic_year
+            return int(getattr(ay.end_date, 'year', None) or ay.start_date.year), int(t.number)
+    except Exception:
+        logger.exception("Could not resolve the current term for school %s", school_id)
+    return today.year, 1
+
+
+# ===== Data =====
+
+def statement_data(school_id: int, year: int, term: int, klass_id=None, student_ids=None) -> list:
+    """Statement payloads (plain dicts, ready for the render pool) for the school's students."""
+    models = _get_models()
+    Invoice, Payment = models['Invoice'], models['Payment']
+    school = models['School'].objects.get(pk=school_id)
+
+    students = models['Student'].objects.filter(Q(school_id=school_id) | Q(klass__school_id=school_id))
+    inv_scope, pay_scope = Q(school_id=school_id), Q(school_id=school_id)
+    if student_ids:
+        students = students.filter(id__in=student_ids)
+        inv_scope &= Q(student_id__in=student_ids)
+        pay_scope &= Q(invoice__student_id__in=student_ids)
+    elif klass_id:
+        students = students.filter(klass_id=klass_id)
+        inv_scope &= Q(student__klass_id=klass_id)
+        pay_scope &= Q(invoice__student__klass_id=klass_id)
+    else:
+        students = students.filter(is_graduated=False)
+    students = list(students.select_related('klass', 'user').order_by('klass__name', 'name', 'id'))
+    if not students:
+        return []
+
+    # Everything billed before this term is brought forward (undated invoices included)
+    earlier = Q(year__lt=year) | Q(year=year, term__lt=term) | Q(year__isnull=True) | Q(term__isnull=True)
+    earlier_pay = Q(invoice__year__lt=year) | Q(invoice__year=year, invoice__term__lt=term) | Q(invoice__year__isnull=True) | Q(invoice__term__isnull=True)
+    billed_before = dict(
+        Invoice.objects.filter(inv_scope).filter(earlier).values('student_id').annotate(s=Sum('amount')).values_list('student_id', 's')
+    )
+    paid_before = dict(
+        Payment.objects.filter(pay_scope).filter(earlier_pay).values('invoice__student_id').annotate(s=Sum('amount'))
+        .values_list('invoice__student_id', 's')
+    )
+    invoices, payments = {}, {}
+    for row in (
+        Invoice.objects.filter(inv_scope, year=year, term=term)
+        .order_by('student_id', 'due_date', 'id').values('student_id', 'category__name', 'amount', 'due_date', 'created_at')
+    ):
+        invoices.setdefault(row['student_id'], []).append(row)
+    for row in (
+        Payment.objects.filter(pay_scope, invoice__year=year, invoice__term=term)
+        .order_by('invoice__student_id', 'created_at', 'id')
+        .values('invoice__student_id', 'amount', 'method', 'reference', 'created_at')
+    ):
+        payments.setdefault(row['invoice__student_id'], []).append(row)
+
+    logo_path = None
+    try:
+        logo_path = school.logo.path if school.logo else None
+    except Exception:
+        logo_path = None
+    school_info = {'name': school.name, 'address': school.address, 'motto': school.motto, 'logo_path': logo_path}
+
+    out = []
+    for stu in students:
+        inv_rows, pay_rows = invoices.get(stu.id, []), payments.get(stu.id, [])
+        opening = (billed_before.get(stu.id) or ZERO) - (paid_before.get(stu.id) or ZERO)
+        term_billed = sum((r['amount'] for r in inv_rows), ZERO)
+        term_paid = sum((r['amount'] for r in pay_rows), ZERO)
+        # Dated by the last activity on it, so an unchanged statement renders byte-identical
+        stamps = [r['created_at'] for r in inv_rows] + [r['created_at'] for r in pay_rows]
+        out.append({
+            'student_id': stu.id,
+            'email': stu.email or getattr(stu.user, 'email', '') or '',
+            'school': school_info,
+            'student': {
+                'name': stu.name,
+                'admission_no': stu.admission_no,
+                'class': str(stu.klass) if stu.klass_id else '',
+                'guardian': stu.guardian_name,
+            },
+            'period': f'Term {term}, {year}',
+            'generated_on': timezone.localdate(max(stamps)).isoformat() if stamps else '',
+            'opening_balance': opening,
+            'invoices': [
+                {'category': r['category__name'], 'amount': r['amount'], 'due_date': r['due_date'].isoformat() if r['due_date'] else ''}
+                for r in inv_rows
+            ],
+            'payments': [
+                {'date': timezone.localdate(r['created_at']).isoformat(), 'method': r['method'], 'reference': r['reference'], 'amount': r['amount']}
+                for r in pay_rows
+            ],
+            'term_billed': term_billed,
+            'term_paid': term_paid,
+            'closing_balance': opening + term_billed - term_paid,
+        })
+    return out
+
+
+# ===== Jobs =====
+
+def _job_key(job_id: str) -> str:
+    return f'finance:statement_job:{job_id}'
+
+
+def get_job(job_id: str) -> Optional[dict]:
+    return cache.get(_job_key(job_id)) if job_id else None
+
+
+def _save_job(job: dict) -> None:
+    job['heartbeat_at'] = timezone.now().isoformat()
+    cache.set(_job_key(job['id']), job, JOB_TTL)
+
+
+def _orphaned(job: dict) -> bool:
+    if job.get('status') not in ('queued', 'running') or not job.get('heartbeat_at'):
+        return False
+    age = timezone.now() - datetime.fromisoformat(job['heartbeat_at'])
+    return age.total_seconds() > JOB_STALE_AFTER
+
+
+def job_payload(job: dict) -> dict:
+    if _orphaned(job):
+        job = {**job, 'status': 'failed', 'error': 'Statement generation stopped before finishing; please start it again'}
+    data = {k: job.get(k) for k in (
+        'id', 'status', 'year', 'term', 'total', 'rendered', 'stored', 'reused', 'emailed', 'email_failed',
+        'error', 'created_at', 'finished_at',
+    )}
+    data['status_url'] = f"/api/finance/fee-statements/jobs/{job['id']}/"
+    return data
+
+
+def start_job(school_id: int, year: int, term: int, klass_id=None, student_ids=None, email: bool = False, user=None) -> dict:
+    job = {
+        'id': uuid.uuid4().hex, 'status': 'queued', 'school_id': school_id, 'year': year, 'term': term,
+        'klass_id': klass_id, 'student_ids': student_ids or None, 'email': bool(email),
+        'user_id': getattr(user, 'id', None), 'total': None, 'rendered': 0, 'stored': 0, 'reused': 0,
+        'emailed': 0, 'email_failed': 0, 'error': None,
+        'created_at': timezone.now().isoformat(), 'finished_at': None,
+    }
+    _save_job(job)
+    threading.Thread(target=run_job, args=(job['id'],), name='fee-statements', daemon=True).start()
+    return job
+
+
+def _render(items: list):
+    """Yield PDFs in order, from the process pool when configured."""
+    global _EXECUTOR
+    if getattr(settings, 'FEE_STATEMENT_WORKERS', 2) <= 0:
+        for data in items:
+            yield render_statement(data)
+        return
+    chunks = [items[i:i + RENDER_CHUNK] for i in range(0, len(items), RENDER_CHUNK)]
+    try:
+        for pdfs in _executor().map(render_many, chunks):
+            yield from pdfs
+    except BrokenProcessPool:
+        with _LOCK:
+            _EXECUTOR = None  # a crashed worker breaks the pool; start a fresh one next time
+        raise
+
+
+def _store(school_id, year, term, pdf: bytes) -> tuple:
+    """(path, sha256, reused) for a PDF, saved under its content hash unless already stored."""
+    digest = hashlib.sha256(pdf).hexdigest()
+    path = f'statements/{school_id}/{year}-T{term}/{digest}.pdf'
+    if default_storage.exists(path):
+        return path, digest, True
+    return default_storage.save(path, ContentFile(pdf)), digest, False
+
+
+def run_job(job_id: str) -> dict:
+    job = get_job(job_id)
+    if job is None:
+        return {}
+    close_old_connections()
+    try:
+        job['status'] = 'running'
+        _save_job(job)
+        items = statement_data(job['school_id'], job['year'], job['term'], job.get('klass_id'), job.get('student_ids'))
+        job['total'] = len(items)
+        _save_job(job)
+        FeeStatement = _get_models()['FeeStatement']
+        existing = {
+            s.student_id: s
+            for s in FeeStatement.objects.filter(
+                year=job['year'], term=job['term'], student_id__in=[i['student_id'] for i in items],
+            )
+        }
+        to_create, to_update = [], []
+        now = timezone.now()
+        for data, pdf in zip(items, _render(items)):
+            path, digest, reused = _store(job['school_id'], job['year'], job['term'], pdf)
+            job['rendered'] += 1
+            job['reused' if reused else 'stored'] += 1
+            st = existing.get(data['student_id']) or FeeStatement(student_id=data['student_id'], year=job['year'], term=job['term'])
+            st.school_id = job['school_id']
+            st.file, st.sha256 = path, digest
+            st.opening_balance, st.term_billed = data['opening_balance'], data['term_billed']
+            st.term_paid, st.closing_balance = data['term_paid'], data['closing_balance']
+            st.generated_at = now
+            if job['email'] and data['email']:
+                if _email(data, pdf):
+                    st.emailed_to, st.emailed_at = data['email'], timezone.now()
+                    job['emailed'] += 1
+                else:
+                    job['email_failed'] += 1
+            (to_update if st.pk else to_create).append(st)
+            if job['rendered'] % 20 == 0:
+                _save_job(job)
+        FeeStatement.objects.bulk_create(to_create, batch_size=500)
+        FeeStatement.objects.bulk_update(
+            to_update,
+            ['school', 'file', 'sha256', 'opening_balance', 'term_billed', 'term_paid', 'closing_balance',
+             'generated_at', 'emailed_to', 'emailed_at'],
+            batch_size=500,
+        )
+        job['status'] = 'done'
+    except Exception as e:
+        logger.exception('Fee statement job %s failed', job_id)
+        job.update({'status': 'failed', 'error': str(e)})
+    finally:
+        job['finished_at'] = timezone.now().isoformat()
+        _save_job(job)
+        # Worker threads get their own DB connection; release it
+        connection.close()
+    return job
+
+
+def _email(data: dict, pdf: bytes) -> bool:
+    from communications.utils import send_email_with_attachment
+    stu = data['student']
+    message = (
+        f"Dear Parent/Guardian,\n\nPlease find attached the fee statement of {stu['name']} ({stu['admission_no']}) "
+        f"for {data['period']}. Balance due: KES {float(data['closing_balance']):,.2f}.\n\n{data['school']['name']}"
+    )
+    return send_email_with_attachment(
+        f"Fee statement — {data['period']}", message, data['email'],
+        f"fee_statement_{stu['admission_no']}_{data['period'].replace(', ', '_').replace(' ', '')}.pdf", pdf,
+    )
@@ -0,0 +1,211 @@
+from __future__ import annotations
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from typing import Iterable
+
+from django.db import transaction
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import TruncDate, TruncMonth, TruncYear
+from django.utils import timezone
+
+# Finance cube: FinanceCubeBucket holds per school x day x kind (billed/payment/expense) x fee
+# category x payment method x expense category the row count and amount, so summaries, trends
+# and breakdowns over any date range read a few hundred buckets instead of the raw
+# invoice/payment/expense rows. Writes only mark their (school, day) dirty (one upsert, in the
+# writer's transaction; the signals in finance.signals and save_allocations() for bulk
+# payments), and refresh() rebuilds the dirty days before a read. Days are local dates
+# (TIME_ZONE) of Invoice/Payment.created_at and Expense.date; rows without a school are not
+# counted. `manage.py rebuild_finance_cube` rebuilds everything.
+
+DIMENSIONS = ('kind', 'fee_category', 'method', 'expense_category')
+GRANULARITIES = ('day', 'month', 'year', 'total')
+ZERO = Decimal('0')
+
+
+def _get_models():
+    from finance.models import Expense, FinanceCubeBucket, FinanceCubeDirtyDay, Invoice, Payment
+    return {
+        'Bucket': FinanceCubeBucket,
+        'DirtyDay': FinanceCubeDirtyDay,
+        'Invoice': Invoice,
+        'Payment': Payment,
+        'Expense': Expense,
+    }
+
+
+def day_of(value) -> date:
+    if isinstance(value, datetime):
+        return timezone.localdate(value) if timezone.is_aware(value) else value.date()
+    return value
+
+
+def mark_dirty(pairs: Iterable) -> None:
+    """Flag (school_id, day) pairs for rebuild; day may be a date or a datetime.
+
+    An upsert rather than ON CONFLICT DO NOTHING: bumping marked_at on an existing flag locks
+    it until the writer commits, so refresh() cannot clear it while the write is in flight.
+    """
+    DirtyDay = _get_models()['DirtyDay']
+    rows = {(int(school_id), day_of(day)) for school_id, day in pairs if school_id and day}
+    if rows:
+        DirtyDay.objects.bulk_create(
+            [DirtyDay(school_id=s, day=d) for s, d in sorted(rows)], batch_size=500,
+            update_conflicts=True, unique_fields=['school', 'day'], update_fields=['marked_at'],
+        )
+
+
+# ===== Rebuild =====
+
+def _day_rows(qs, field):
+    return qs.annotate(cube_day=TruncDate(field, tzinfo=timezone.get_current_timezone()))
+
+
+def _rebuild_days(school_id: int, days: set) -> int:
+    """Recompute the buckets of one school's days from the raw rows. Returns buckets written."""
+    models = _get_models()
+    Bucket = models['Bucket']
+    lo, hi = min(days), max(days)
+    tz = timezone.get_current_timezone()
+    start = timezone.make_aware(datetime.combine(lo, datetime.min.time()), tz)
+    end = timezone.make_aware(datetime.combine(hi + timedelta(days=1), datetime.min.time()), tz)
+
+    billed = (
+        _day_rows(models['Invoice'].objects.filter(school_id=school_id, created_at__gte=start, created_at__lt=end), 'created_at')
+        .values('cube_day', 'category_id').annotate(n=Count('id'), s=Sum('amount')).order_by()
+    )
+    paid = (
+        _day_rows(models['Payment'].objects.filter(school_id=school_id, created_at__gte=start, created_at__lt=end), 'created_at')
+        .values('cube_day', 'invoice__category_id', 'method').annotate(n=Count('id'), s=Sum('amount')).order_by()
+    )
+    spent = (
+        models['Expense'].objects.filter(school_id=school_id, date__gte=lo, date__lte=hi)
+        .values('date', 'category_id').annotate(n=Count('id'), s=Sum('amount')).order_by()
+    )
+    buckets = []
+    for r in billed:
+        if r['cube_day'] in days:
+            buckets.append(Bucket(school_id=school_id, day=r['cube_day'], kind='billed', fee_category_id=r['category_id'],
+                                  count=r['n'], amount=r['s'] or ZERO))
+    for r in paid:
+        if r['cube_day'] in days:
+            buckets.append(Bucket(school_id=school_id, day=r['cube_day'], kind='payment', fee_category_id=r['invoice__category_id'],
+                                  method=r['method'] or '', count=r['n'], amount=r['s'] or ZERO))
+    for r in spent:
+        if r['date'] in days:
+            buckets.append(Bucket(school_id=school_id, day=r['date'], kind='expense', expense_category_id=r['category_id'],
+                                  count=r['n'], amount=r['s'] or ZERO))
+    Bucket.objects.filter(school_id=school_id, day__in=days).delete()
+    Bucket.objects.bulk_create(buckets, batch_size=500)
+    return len(buckets)
+
+
+def refresh(school_id=None) -> int:
+    """Rebuild every dirty day (of one school, or all). Returns the number of days rebuilt."""
+    DirtyDay = _get_models()['DirtyDay']
+    qs = DirtyDay.objects.all()
+    if school_id:
+        qs = qs.filter(school_id=school_id)
+    if not qs.exists():
+        return 0
+    with transaction.atomic():
+        dirty = list(qs.select_for_update().values_list('id', 'school_id', 'day'))
+        if not dirty:
+            return 0
+        # The flags are locked, so a writer that flagged one of these days has committed and
+        # its rows are rebuilt below; one that flags a day from now on waits for this
+        # transaction and then inserts a fresh flag for the next refresh.
+        DirtyDay.objects.filter(id__in=[d[0] for d in dirty]).delete()
+        by_school = {}
+        for _, sid, day in dirty:
+            by_school.setdefault(sid, set()).add(day)
+        for sid, days in by_school.items():
+            _rebuild_days(sid, days)
+    return len(dirty)
+
+
+def rebuild_all(school_id=None) -> int:
+    """Flag every day with invoices, payments or expenses, then rebuild. Returns days rebuilt."""
+    mark_dirty(all_days(school_id))
+    return refresh(school_id)
+
+
+def all_days(school_id=None, models=None) -> set:
+    """Every (school_id, day) with invoices, payments or expenses."""
+    models = models or _get_models()
+    pairs = set()
+    for name in ('Invoice', 'Payment'):
+        qs = models[name].objects.filter(school_id__isnull=False)
+        if school_id:
+            qs = qs.filter(school_id=school_id)
+        pairs.update(_day_rows(qs, 'created_at').values_list('school_id', 'cube_day').distinct().order_by())
+    qs = models['Expense'].objects.all()
+    if school_id:
+        qs = qs.filter(school_id=school_id)
+    pairs.update(qs.values_list('school_id', 'date').distinct().order_by())
+    return pairs
+
+
+# ===== Queries =====
+
+def buckets(school_id=None, start: date | None = None, end: date | None = None, fresh: bool = False):
+    """Up-to-date buckets of a school (all schools when None), days start..end inclusive.
+    fresh=True skips the refresh when the caller has just run one.
+    """
+    if not fresh:
+        refresh(school_id)
+    qs = _get_models()['Bucket'].objects.all()
+    if school_id:
+        qs = qs.filter(school_id=school_id)
+    if start:
+        qs = qs.filter(day__gte=start)
+    if end:
+        qs = qs.filter(day__lte=end)
+    return qs
+
+
+def period_totals(school_id, periods: dict, fresh: bool = False) -> dict:
+    """Billed/received/spent per named period in one query.
+    periods: {name: (first_day, last_day)} -> {name: {'billed', 'payment', 'expense'}}
+    """
+    lo = min(p[0] for p in periods.values())
+    hi = max(p[1] for p in periods.values())
+    aggregates = {}
+    for name, (first, last) in periods.items():
+        for kind in ('billed', 'payment', 'expense'):
+            aggregates[f'{name}_{kind}'] = Sum('amount', filter=Q(kind=kind, day__gte=first, day__lte=last))
+    row = buckets(school_id, lo, hi, fresh=fresh).aggregate(**aggregates)
+    return {
+        name: {kind: row[f'{name}_{kind}'] or ZERO for kind in ('billed', 'payment', 'expense')}
+        for name in periods
+    }
+
+
+def slice_cube(school_id, start: date | None, end: date | None, granularity: str = 'day', dims=DIMENSIONS, fresh: bool = False):
+    """Cube rows rolled up to granularity over the chosen dimensions, ordered by period.
+    Each row: {'period', <dims>..., 'count', 'amount'} with category names resolved.
+    """
+    qs = buckets(school_id, start, end, fresh=fresh)
+    if granularity == 'month':
+        qs = qs.annotate(period=TruncMonth('day'))
+    elif granularity == 'year':
+        qs = qs.annotate(period=TruncYear('day'))
+    elif granularity == 'day':
+        qs = qs.annotate(period=F('day'))
+    fields = ['period'] if granularity != 'total' else []
+    for dim in dims:
+        if dim in ('fee_category', 'expense_category'):
+            fields += [f'{dim}_id', f'{dim}__name']
+        else:
+            fields.append(dim)
+    rows = qs.values(*fields).annotate(count=Sum('count'), total=Sum('amount')).order_by(*fields)
+    for r in rows:
+        out = {'period': r['period'] if granularity != 'total' else None}
+        for dim in dims:
+            if dim in ('fee_category', 'expense_category'):
+                out[dim] = r[f'{dim}__name']
+                out[f'{dim}_id'] = r[f'{dim}_id']
+            else:
+                out[dim] = r[dim]
+        out['count'] = r['count'] or 0
+        out['amount'] = r['total'] or ZERO
+        yield out
@@ -0,0 +1,292 @@
+from __future__ import annotations
+import json
+import logging
+import threading
+import uuid
+from datetime import timedelta
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, connection, transaction
+from django.db.models import F, Q, Sum
+from django.utils import timezone
+
+from .allocation import invoice_status
+
+logger = logging.getLogger(__name__)
+
+# Daraja STK callbacks go through an inbox: the webhook stores the raw body (one INSERT) and
+# acknowledges, and a worker applies pending rows in batches. Payments are deduplicated by
+# receipt number (Payment.mpesa_receipt is unique), so a callback retried by Daraja or
+# replayed from the inbox never records twice. By default the worker is a daemon thread in
+# the web process, woken after each insert; set MPESA_CALLBACK_WORKER=off and run
+# `manage.py process_mpesa_callbacks --loop` to apply callbacks out of process instead.
+
+BATCH_SIZE = 100
+STALE_CLAIM = timedelta(minutes=5)  # a claim older than this is assumed to be from a dead worker
+MAX_ATTEMPTS = 5
+IDLE_SECONDS = 30  # the worker thread exits after this long without new callbacks
+
+
+def _get_models():
+    from finance.models import Invoice, MpesaCallback, Payment, StkRequest
+    return {'Invoice': Invoice, 'MpesaCallback': MpesaCallback, 'Payment': Payment, 'StkRequest': StkRequest}
+
+
+def parse_callback(body: str) -> dict | None:
+    """Fields of an stkCallback body, or None when it is not one."""
+    try:
+        data = json.loads(body or '{}')
+    except ValueError:
+        return None
+    stk_cb = (data.get('Body') or {}).get('stkCallback') if isinstance(data, dict) else None
+    if not isinstance(stk_cb, dict) or not stk_cb.get('CheckoutRequestID'):
+        return None
+    metadata = stk_cb.get('CallbackMetadata')
+    items = metadata.get('Item', []) if isinstance(metadata, dict) else []
+    meta = {item.get('Name'): item.get('Value') for item in items if isinstance(item, dict)}
+    try:
+        result_code = int(stk_cb.get('ResultCode'))
+    except (TypeError, ValueError):
+        result_code = None
+    try:
+        amount = Decimal(str(meta['Amount'])) if meta.get('Amount') is not None else None
+    except (InvalidOperation, ValueError):
+        amount = None
+    receipt = meta.get('MpesaReceiptNumber') or meta.get('M-PESAReceiptNumber')
+    return {
+        'checkout_request_id': str(stk_cb['CheckoutRequestID']),
+        'merchant_request_id': str(stk_cb.get('MerchantRequestID') or ''),
+        'result_code': result_code,
+        'result_desc': str(stk_cb.get('ResultDesc') or '')[:255],
+        'receipt': str(receipt).strip().upper()[:30] if receipt else None,
+        'amount': amount,
+        'phone': str(meta.get('PhoneNumber') or meta.get('MSISDN') or ''),
+    }
+
+
+def enqueue_callback(body: str):
+    """Store a raw callback and wake the worker once the row is committed."""
+    models = _get_models()
+    checkout_id = ''
+    try:
+        data = json.loads(body or '{}')
+        checkout_id = str(((data.get('Body') or {}).get('stkCallback') or {}).get('CheckoutRequestID') or '')[:100]
+    except (ValueError, AttributeError):
+        pass
+    cb = models['MpesaCallback'].objects.create(body=body, checkout_request_id=checkout_id)
+    if getattr(settings, 'MPESA_CALLBACK_WORKER', 'thread') == 'thread':
+        transaction.on_commit(wake_worker)
+    return cb
+
+
+# ===== Batch processing =====
+
+def _claim_batch(limit: int):
+    """Claim up to limit pending (or stale) callbacks with a single UPDATE; returns the rows.
+
+    Every claim counts as an attempt, so a callback that keeps killing its worker stops being
+    reclaimed after MAX_ATTEMPTS and is parked as an error instead.
+    """
+    MpesaCallback = _get_models()['MpesaCallback']
+    now = timezone.now()
+    stale = Q(status='processing', claimed_at__lt=now - STALE_CLAIM)
+    MpesaCallback.objects.filter(stale, attempts__gte=MAX_ATTEMPTS).update(
+        status='error', claim_token='', error='Abandoned by a worker too many times',
+    )
+    claimable = Q(status='pending') | (stale & Q(attempts__lt=MAX_ATTEMPTS))
+    ids = list(MpesaCallback.objects.filter(claimable).order_by('id').values_list('id', flat=True)[:limit])
+    if not ids:
+        return []
+    token = uuid.uuid4().hex
+    MpesaCallback.objects.filter(claimable, id__in=ids).update(
+        status='processing', claim_token=token, claimed_at=now, attempts=F('attempts') + 1,
+    )
+    return list(MpesaCallback.objects.filter(claim_token=token, status='processing').order_by('id'))
+
+
+def process_pending_callbacks(batch_size: int = BATCH_SIZE) -> dict:
+    """Apply one batch of inbox callbacks. Returns counts by outcome (empty when idle)."""
+    rows = _claim_batch(batch_size)
+    if not rows:
+        return {}
+    try:
+        counts, new_payments = _apply_batch(rows)
+    except Exception as e:
+        # Leave the rows claimable again (up to MAX_ATTEMPTS) rather than losing them
+        logger.exception("M-Pesa callback batch failed")
+        _release(rows, str(e))
+        return {'error': len(rows)}
+    _notify(new_payments)
+    return counts
+
+
+def _release(rows, error: str):
+    MpesaCallback = _get_models()['MpesaCallback']
+    for cb in rows:
+        # attempts was already counted when the row was claimed
+        cb.error = error[:2000]
+        cb.status = 'error' if cb.attempts >= MAX_ATTEMPTS else 'pending'
+        cb.claim_token = ''
+    MpesaCallback.objects.bulk_update(rows, ['error', 'status', 'claim_token'])
+
+
+@transaction.atomic
+def _apply_batch(rows):
+    models = _get_models()
+    Payment, StkRequest, Invoice = models['Payment'], models['StkRequest'], models['Invoice']
+    now = timezone.now()
+    parsed = {cb.id: parse_callback(cb.body) for cb in rows}
+    checkout_ids = {p['checkout_request_id'] for p in parsed.values() if p}
+
+    # One query each: the STK requests, legacy pushes tracked only on the invoice, and receipts
+    # already recorded
+    stk_by_checkout = {
+        s.checkout_request_id: s
+        for s in StkRequest.objects.select_for_update().filter(checkout_request_id__in=checkout_ids).select_related('invoice')
+    }
+    missing = checkout_ids - set(stk_by_checkout)
+    legacy_invoices = {}
+    if missing:
+        for inv in Invoice.objects.filter(mpesa_transaction_id__in=missing):
+            legacy_invoices.setdefault(inv.mpesa_transaction_id, inv)
+    receipts = {p['receipt'] for p in parsed.values() if p and p['receipt']}
+    seen_receipts = set(Payment.objects.filter(mpesa_receipt__in=receipts).values_list('mpesa_receipt', flat=True)) if receipts else set()
+
+    counts = {}
+    new_payments = []
+    touched_invoices = {}
+    stk_updates = []
+    for cb in rows:
+        p = parsed[cb.id]
+        cb.processed_at = now
+        cb.claim_token = ''
+        cb.error = ''
+        stk = stk_by_checkout.get(p['checkout_request_id']) if p else None
+        invoice = stk.invoice if stk else (legacy_invoices.get(p['checkout_request_id']) if p else None)
+
+        if p is None:
+            cb.status, cb.error = 'ignored', 'Not an stkCallback body'
+        elif stk is not None and stk.status != 'pending':
+            cb.status = 'duplicate'
+        elif p['result_code'] != 0:
+            cb.status = 'applied'
+        elif invoice is None or not p['amount']:
+            cb.status, cb.error = 'ignored', 'No matching STK request or invoice' if invoice is None else 'No amount'
+        elif p['receipt'] and p['receipt'] in seen_receipts:
+            cb.status = 'duplicate'
+        else:
+            pay = Payment(
+                invoice=invoice,
+                amount=p['amount'],
+                method='mpesa',
+                reference=p['receipt'] or p['checkout_request_id'],
+                mpesa_receipt=p['receipt'],
+                recorded_by=None,
+                school_id=invoice.school_id,
+            )
+            try:
+                with transaction.atomic():
+                    pay.save()
+            except IntegrityError:
+                # Recorded concurrently by another worker or a manual entry with this receipt
+                cb.status = 'duplicate'
+            else:
+                cb.status = 'applied'
+                new_payments.append((invoice, pay))
+                touched_invoices[invoice.id] = invoice
+                if stk is not None:
+                    stk.payment = pay
+            if p['receipt']:
+                seen_receipts.add(p['receipt'])
+        if stk is not None and stk.status == 'pending' and cb.status != 'duplicate':
+            stk.status = 'success' if p['result_code'] == 0 else 'failed'
+            stk.result_code = p['result_code']
+            stk.result_desc = p['result_desc']
+            stk.receipt_number = p['receipt'] or ''
+            stk.completed_at = now
+            stk_updates.append(stk)
+        counts[cb.status] = counts.get(cb.status, 0) + 1
+
+    if stk_updates:
+        StkRequest.objects.bulk_update(stk_updates, ['status', 'result_code', 'result_desc', 'receipt_number', 'payment', 'completed_at'])
+    if touched_invoices:
+        totals = dict(
+            Payment.objects.filter(invoice_id__in=list(touched_invoices))
+            .values_list('invoice_id').annotate(s=Sum('amount')).values_list('invoice_id', 's')
+        )
+        changed = []
+        for inv_id, inv in touched_invoices.items():
+            status = invoice_status(totals.get(inv_id) or 0, inv.amount)
+            if inv.status != status:
+                inv.status = status
+                changed.append(inv)
+        if changed:
+            Invoice.objects.bulk_update(changed, ['status'])
+    models['MpesaCallback'].objects.bulk_update(rows, ['status', 'processed_at', 'claim_token', 'error'])
+    logger.info("M-Pesa callbacks applied", extra={'counts': counts})
+    return counts, new_payments
+
+
+def _notify(new_payments):
+    if not new_payments:
+        return
+    from communications.utils import notify_payment_received
+    for invoice, pay in new_payments:
+        try:
+            notify_payment_received(invoice, pay)
+        except Exception:
+            logger.exception("Payment notification failed for payment %s", pay.id)
+
+
+def drain(batch_size: int = BATCH_SIZE, max_batches: int | None = None) -> dict:
+    """Process batches until the inbox is empty (or max_batches); returns summed counts."""
+    totals = {}
+    n = 0
+    while max_batches is None or n < max_batches:
+        counts = process_pending_callbacks(batch_size)
+        if not counts:
+            break
+        for k, v in counts.items():
+            totals[k] = totals.get(k, 0) + v
+        n += 1
+    return totals
+
+
+# ===== In-process worker =====
+
+_WAKE = threading.Event()
+_WORKER_LOCK = threading.Lock()
+_WORKER: threading.Thread | None = None
+
+
+def wake_worker():
+    """Start the worker thread if it is not running, and make it look at the inbox."""
+    global _WORKER
+    _WAKE.set()
+    with _WORKER_LOCK:
+        if _WORKER is None or not _WORKER.is_alive():
+            _WORKER = threading.Thread(target=_run_worker, name='mpesa-callbacks', daemon=True)
+            _WORKER.start()
+
+
+def _run_worker():
+    global _WORKER
+    try:
+        while True:
+            _WAKE.clear()
+            close_old_connections()
+            try:
+                drain()
+            except Exception:
+                logger.exception("M-Pesa callback worker error")
+            if _WAKE.wait(IDLE_SECONDS):
+                continue
+            with _WORKER_LOCK:
+                # A wake that raced the timeout keeps this thread going
+                if _WAKE.is_set():
+                    continue
+                _WORKER = None
+                return
+    finally:
+        connection.close()
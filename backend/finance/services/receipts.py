@@ -0,0 +1,222 @@
+from __future__ import annotations
+from io import BytesIO
+from xml.sax.saxutils import escape
+
+from django.db.models import Sum
+
+# Payment receipts. build_receipts() takes payments (with invoice, student, class, school and
+# recorded_by select_related) and computes every balance on them from a single grouped query:
+# one row per invoice of the students involved, with the invoice amount and its payments
+# summed. Invoice paid, student billed/paid and term billed/paid all fold out of those rows in
+# Python, and the class fee assignments for all (class, year, term) periods come from one more
+# query. A single receipt and a day's batch therefore cost the same number of queries.
+
+MAX_BATCH_RECEIPTS = 500
+
+
+def _get_models():
+    from finance.models import ClassFee, Invoice
+    return {'ClassFee': ClassFee, 'Invoice': Invoice}
+
+
+def _user_name(user):
+    if not user:
+        return None
+    for attr in ('name', 'full_name'):
+        val = getattr(user, attr, None)
+        if val:
+            return str(val)
+    return user.get_full_name() or user.get_username() or str(user)
+
+
+def _school_payload(school, request=None):
+    if not school:
+        return {'id': None, 'name': None}
+    try:
+        logo_url = school.logo.url if getattr(school, 'logo', None) else None
+        if logo_url and request:
+            logo_url = request.build_absolute_uri(logo_url)
+    except Exception:
+        logo_url = None
+    return {
+        'id': school.id,
+        'name': str(school),
+        'address': getattr(school, 'address', None),
+        'motto': getattr(school, 'motto', None),
+        'logo_url': logo_url,
+    }
+
+
+def build_receipts(payments: list, request=None) -> list:
+    """Receipt data for each payment, in order (the payload of PaymentViewSet.receipt)."""
+    models = _get_models()
+    student_ids = {p.invoice.student_id for p in payments if p.invoice_id}
+    invoices = {}
+    if student_ids:
+        invoices = {
+            row['id']: row
+            for row in models['Invoice'].objects.filter(student_id__in=student_ids)
+            .values('id', 'student_id', 'year', 'term', 'amount')
+            .annotate(paid=Sum('payments__amount'))
+        }
+    billed, paid, term_billed, term_paid = {}, {}, {}, {}
+    for row in invoices.values():
+        sid, period = row['student_id'], (row['student_id'], row['year'], row['term'])
+        amount, row_paid = float(row['amount'] or 0), float(row['paid'] or 0)
+        billed[sid] = billed.get(sid, 0.0) + amount
+        paid[sid] = paid.get(sid, 0.0) + row_paid
+        term_billed[period] = term_billed.get(period, 0.0) + amount
+        term_paid[period] = term_paid.get(period, 0.0) + row_paid
+
+    # Fee assignments of every (class, year, term) on these receipts
+    periods = {
+        (p.invoice.student.klass_id, p.invoice.year, p.invoice.term)
+        for p in payments
+        if p.invoice_id and p.invoice.student.klass_id and p.invoice.year and p.invoice.term
+    }
+    fees = {}
+    if periods:
+        qs = models['ClassFee'].objects.filter(
+            klass_id__in={k for k, _, _ in periods},
+            year__in={y for _, y, _ in periods},
+            term__in={t for _, _, t in periods},
+        ).select_related('fee_category').order_by('id')
+        for cf in qs:
+            fees.setdefault((cf.klass_id, cf.year, cf.term), []).append({
+                'category': getattr(cf.fee_category, 'name', None),
+                'amount': float(cf.amount or 0),
+                'year': cf.year,
+                'term': cf.term,
+                'due_date': cf.due_date,
+            })
+
+    schools = {}
+    out = []
+    for pay in payments:
+        inv = pay.invoice
+        stu = inv.student if inv else None
+        school = getattr(getattr(stu, 'klass', None), 'school', None)
+        if school is not None and school.id not in schools:
+            schools[school.id] = _school_payload(school, request)
+
+        inv_row = invoices.get(inv.id) if inv else None
+        invoice_amount = float(getattr(inv, 'amount', 0) or 0)
+        paid_on_invoice = float(inv_row['paid'] or 0) if inv_row else 0.0
+        stu_total_billed = billed.get(getattr(stu, 'id', None), 0.0)
+        stu_total_paid = paid.get(getattr(stu, 'id', None), 0.0)
+        student_balance = max(0.0, stu_total_billed - stu_total_paid)
+
+        current_term_billed = current_term_paid = current_term_balance = arrears_balance = 0.0
+        if inv and stu and inv.year and inv.term:
+            period = (stu.id, inv.year, inv.term)
+            current_term_billed = term_billed.get(period, 0.0)
+            current_term_paid = term_paid.get(period, 0.0)
+            current_term_balance = max(0.0, current_term_billed - current_term_paid)
+            arrears_balance = max(0.0, student_balance - current_term_balance)
+
+        data = {
+            'receipt_no': f"RCPT-{pay.id}",
+            'date': pay.created_at,
+            'amount': float(pay.amount),
+            'method': pay.method,
+            'reference': pay.reference,
+            'recorded_by': pay.recorded_by_id,
+            'recorded_by_name': _user_name(pay.recorded_by),
+            'invoice': inv.id if inv else None,
+            'invoice_amount': invoice_amount if inv else None,
+            'invoice_paid': paid_on_invoice,
+            'invoice_balance': max(0.0, invoice_amount - paid_on_invoice),
+            'student': {
+                'id': getattr(stu, 'id', None),
+                'name': getattr(stu, 'name', None),
+                'class': str(getattr(stu, 'klass', '') or ''),
+                'admission_no': getattr(stu, 'admission_no', None),
+            },
+            'school': schools.get(school.id) if school is not None else _school_payload(None),
+            'student_total_billed': stu_total_billed,
+            'student_total_paid': stu_total_paid,
+            'student_balance': student_balance,
+            'current_term_billed': current_term_billed,
+            'current_term_paid': current_term_paid,
+            'current_term_balance': current_term_balance,
+            'arrears_balance': arrears_balance,
+        }
+        if inv and stu and stu.klass_id and inv.year and inv.term:
+            data['fee_assignments'] = fees.get((stu.klass_id, inv.year, inv.term), [])
+        out.append(data)
+    return out
+
+
+# ===== PDF =====
+
+def render_receipts_pdf(receipts: list, logos: dict | None = None) -> bytes:
+    """One A4 page per receipt. logos maps school id -> local logo path."""
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.styles import getSampleStyleSheet
+    from reportlab.lib.units import mm
+    from reportlab.platypus import Image, PageBreak, Paragraph, SimpleDocTemplate, Spacer, Table, TableStyle
+
+    logos = logos or {}
+    buffer = BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=A4, leftMargin=15*mm, rightMargin=15*mm, topMargin=15*mm, bottomMargin=15*mm,
+                            title='Payment receipts')
+    styles = getSampleStyleSheet()
+    money = lambda v: f"{float(v or 0):,.2f}"
+    grid = TableStyle([
+        ('GRID', (0, 0), (-1, -1), 0.25, colors.grey),
+        ('BACKGROUND', (0, 0), (-1, 0), colors.Color(0.93, 0.96, 1)),
+        ('ALIGN', (1, 0), (-1, -1), 'RIGHT'),
+        ('FONTSIZE', (0, 0), (-1, -1), 9),
+    ])
+    elements = []
+    for i, r in enumerate(receipts):
+        if i:
+            elements.append(PageBreak())
+        school, stu = r['school'] or {}, r['student'] or {}
+        heading = Paragraph(
+            f"<b>{escape(school.get('name') or '')}</b><br/>"
+            f"<font size=9 color=grey>{escape(school.get('address') or '')}<br/>{escape(school.get('motto') or '')}</font>",
+            styles['Normal'],
+        )
+        logo = logos.get(school.get('id'))
+        if logo:
+            head = Table([[Image(logo, width=16*mm, height=16*mm), heading]], colWidths=[20*mm, 160*mm])
+            head.setStyle(TableStyle([('VALIGN', (0, 0), (-1, -1), 'MIDDLE'), ('LEFTPADDING', (0, 0), (-1, -1), 0)]))
+            elements.append(head)
+        else:
+            elements.append(heading)
+        elements.append(Spacer(1, 8))
+        elements.append(Paragraph(f"<b>PAYMENT RECEIPT {escape(r['receipt_no'])}</b>", styles['Heading3']))
+        date = r['date'].strftime('%Y-%m-%d %H:%M') if r['date'] else ''
+        info = Table([
+            ['Student', f"{stu.get('name') or ''} ({stu.get('admission_no') or ''})", 'Date', date],
+            ['Class', stu.get('class') or '', 'Method', (r['method'] or '').upper()],
+            ['Invoice', f"#{r['invoice']}" if r['invoice'] else '', 'Reference', r['reference'] or ''],
+            ['Received by', r['recorded_by_name'] or '', '', ''],
+        ], colWidths=[25*mm, 75*mm, 22*mm, 58*mm])
+        info.setStyle(TableStyle([('FONTSIZE', (0, 0), (-1, -1), 9), ('TEXTCOLOR', (0, 0), (0, -1), colors.grey),
+                                  ('TEXTCOLOR', (2, 0), (2, -1), colors.grey)]))
+        elements.append(info)
+        elements.append(Spacer(1, 8))
+        elements.append(Paragraph(f"<b>Amount received: KES {money(r['amount'])}</b>", styles['Heading4']))
+        totals = Table([
+            ['', 'Billed', 'Paid', 'Balance'],
+            ['This invoice', money(r['invoice_amount']), money(r['invoice_paid']), money(r['invoice_balance'])],
+            ['Current term', money(r['current_term_billed']), money(r['current_term_paid']), money(r['current_term_balance'])],
+            ['All terms', money(r['student_total_billed']), money(r['student_total_paid']), money(r['student_balance'])],
+            ['Arrears', '', '', money(r['arrears_balance'])],
+        ], colWidths=[45*mm, 45*mm, 45*mm, 45*mm])
+        totals.setStyle(grid)
+        elements.append(totals)
+        if r.get('fee_assignments'):
+            elements.append(Spacer(1, 8))
+            rows = [['Fee', 'Amount', 'Due']] + [
+                [f['category'] or '', money(f['amount']), f['due_date'].isoformat() if f['due_date'] else '']
+                for f in r['fee_assignments']
+            ]
+            fees = Table(rows, colWidths=[90*mm, 45*mm, 45*mm])
+            fees.setStyle(grid)
+            elements.append(fees)
+    doc.build(elements)
+    return buffer.getvalue()
@@ -0,0 +1,470 @@
+from __future__ import annotations
+import csv
+import hashlib
+import json
+import re
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation
+from io import BytesIO, StringIO
+from typing import Optional
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Max, Q
+
+from .allocation import allocate_fifo, open_invoices_by_student, save_allocations, student_balance
+
+# Statement reconciliation: an M-Pesa (paybill/till) or bank statement export is parsed once
+# into credit lines and kept under a statement token (like marks uploads). Lines are matched to
+# students by account reference (admission number, or INV<id> as sent by STK pushes), then by
+# guardian phone (Student.guardian_id) with the amount as tie-breaker among siblings. All
+# lookups are batched: one indexed query per key type for the whole file. Apply re-runs the
+# match with the invoices locked and records every allocation in one transaction, FIFO per
+# student (services/allocation.py). Money left over once a student's open invoices are paid is
+# recorded as an overpayment on their latest invoice (a credit on their balance), so every
+# applied line leaves a Payment carrying its reference; a student with no invoice at all has
+# nothing to credit and the line is reported as 'unallocated' for a manual decision. References
+# already on a Payment, or repeated in the file, are reported as duplicates and never applied.
+
+STATEMENT_TTL = 60 * 30
+KINDS = ('mpesa', 'bank')
+CENTS = Decimal('0.00')
+HEADER_SCAN_ROWS = 30  # statements often start with a title/summary block before the header
+
+COLUMN_ALIASES = {
+    'reference': ('receipt no.', 'receipt no', 'receipt', 'transaction id', 'trans id', 'transid', 'reference',
+                  'reference no', 'ref', 'ref no', 'ref no.', 'transaction ref', 'bank reference', 'cheque no'),
+    'date': ('completion time', 'transaction date', 'trans date', 'date', 'value date', 'trans time', 'transtime',
+             'initiation time', 'posting date'),
+    'account': ('a/c no.', 'a/c no', 'account no.', 'account no', 'account number', 'account', 'bill ref number',
+                'billrefnumber', 'account reference', 'acc no', 'acc no.'),
+    'amount': ('paid in', 'credit', 'credit amount', 'amount', 'deposit', 'deposits', 'cr', 'trans amount',
+               'transamount', 'money in'),
+    'withdrawn': ('withdrawn', 'debit', 'debit amount', 'dr', 'withdrawals', 'paid out'),
+    'details': ('details', 'narration', 'description', 'particulars', 'transaction details', 'remarks'),
+    'party': ('other party info', 'other party', 'customer', 'customer name', 'msisdn', 'phone', 'payer',
+              'sender', 'name', 'first name'),
+}
+DATE_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d', '%d-%m-%Y %H:%M:%S', '%d-%m-%Y', '%d/%m/%Y %H:%M:%S',
+                '%d/%m/%Y %H:%M', '%d/%m/%Y', '%Y%m%d%H%M%S', '%d.%m.%Y', '%d %b %Y')
+
+_PHONE_RE = re.compile(r'(?<!\d)(?:\+?254|0)?([71]\d{8})(?!\d)')
+_INVOICE_RE = re.compile(r'^INV[-\s#]?(\d+)$', re.I)
+_TOKEN_RE = re.compile(r'[A-Za-z0-9][A-Za-z0-9/\-]*[A-Za-z0-9]|\d')
+
+
+class StatementError(Exception):
+    def __init__(self, detail: str, status: int = 400):
+        super().__init__(detail)
+        self.detail = detail
+        self.status = status
+
+
+def _get_models():
+    from academics.models import Student
+    from finance.models import Invoice, Payment
+    return {'Student': Student, 'Invoice': Invoice, 'Payment': Payment}
+
+
+# ===== Parsing =====
+
+def _decode(raw: bytes) -> str:
+    for enc in ('utf-8-sig', 'utf-8'):
+        try:
+            return raw.decode(enc)
+        except UnicodeDecodeError:
+            continue
+    return raw.decode('latin1', errors='ignore')
+
+
+def _csv_rows(raw: bytes) -> list:
+    text = _decode(raw)
+    try:
+        delim = csv.Sniffer().sniff(text[:4096], delimiters=',;\t|').delimiter
+    except csv.Error:
+        delim = ','
+    return list(csv.reader(StringIO(text), delimiter=delim))
+
+
+def _excel_rows(raw: bytes) -> list:
+    try:
+        from openpyxl import load_workbook
+    except Exception:
+        raise StatementError('openpyxl is required to parse Excel files. Please install it on the server.', status=500)
+    try:
+        wb = load_workbook(BytesIO(raw), read_only=True, data_only=True)
+    except Exception:
+        raise StatementError('Could not read the Excel file.')
+    return [list(r) for r in wb.active.iter_rows(values_only=True)]
+
+
+def _find_header(rows):
+    """(index, {field: column}) of the first row that names an amount column."""
+    for idx, row in enumerate(rows[:HEADER_SCAN_ROWS]):
+        names = [str(c).strip().lower() if c is not None else '' for c in row]
+        cols = {}
+        for field, aliases in COLUMN_ALIASES.items():
+            for alias in aliases:
+                if alias in names:
+                    cols[field] = names.index(alias)
+                    break
+        if 'amount' in cols and ({'reference', 'details', 'account'} & set(cols)):
+            return idx, cols
+    raise StatementError('Could not find the statement header (expected columns such as Receipt No., Details, Paid In).')
+
+
+def parse_amount(value) -> Optional[Decimal]:
+    if value is None or value == '':
+        return None
+    if isinstance(value, (int, float, Decimal)):
+        return Decimal(str(value))
+    s = str(value).strip().upper().replace('KES', '').replace('KSH', '').replace(',', '').replace(' ', '')
+    negative = s.startswith('(') and s.endswith(')')
+    s = s.strip('()')
+    try:
+        amount = Decimal(s)
+    except InvalidOperation:
+        return None
+    return -amount if negative else amount
+
+
+def _parse_date(value) -> Optional[str]:
+    if isinstance(value, datetime):
+        return value.date().isoformat()
+    if isinstance(value, date):
+        return value.isoformat()
+    s = str(value or '').strip()
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(s, fmt).date().isoformat()
+        except ValueError:
+            continue
+    return s[:10] or None
+
+
+def normalize_phone(value) -> Optional[str]:
+    """Kenyan mobile number as 2547XXXXXXXX/2541XXXXXXXX, or None (masked numbers never match)."""
+    m = _PHONE_RE.search(re.sub(r'[\s\-()]', '', str(value or '')))
+    return f"254{m.group(1)}" if m else None
+
+
+def phone_variants(phone: str) -> list:
+    """Ways a normalized phone may be stored in Student.guardian_id."""
+    local = phone[3:]
+    return [phone, f"+{phone}", f"0{local}", local]
+
+
+def parse_statement(filename: str, raw: bytes) -> list:
+    """Credit lines of a statement: [{line, date, reference, account, phone, party, details, amount}]."""
+    fname = (filename or '').lower()
+    if fname.endswith('.csv') or fname.endswith('.txt'):
+        rows = _csv_rows(raw)
+    elif fname.endswith('.xlsx') or fname.endswith('.xls'):
+        rows = _excel_rows(raw)
+    else:
+        raise StatementError('Unsupported file type. Use CSV or XLSX.')
+    header_idx, cols = _find_header(rows)
+
+    def get(row, field):
+        i = cols.get(field)
+        return row[i] if i is not None and i < len(row) else None
+
+    lines = []
+    for n, row in enumerate(rows[header_idx + 1:], start=header_idx + 2):
+        if not row or all(c in (None, '') for c in row):
+            continue
+        amount = parse_amount(get(row, 'amount'))
+        if amount is None or amount <= 0:
+            continue  # withdrawals, charges and summary rows
+        withdrawn = parse_amount(get(row, 'withdrawn'))
+        if withdrawn and withdrawn > 0:
+            continue
+        details = str(get(row, 'details') or '').strip()
+        party = str(get(row, 'party') or '').strip()
+        lines.append({
+            'line': n,
+            'date': _parse_date(get(row, 'date')),
+            'reference': str(get(row, 'reference') or '').strip()[:100],
+            'account': str(get(row, 'account') or '').strip()[:100],
+            'phone': normalize_phone(party) or normalize_phone(details),
+            'party': party[:255],
+            'details': details[:255],
+            'amount': str(amount.quantize(Decimal('0.01'))),
+        })
+    if not lines:
+        raise StatementError('No credit (money in) lines found in the statement.')
+    return lines
+
+
+# ===== Statement tokens =====
+
+def _cache_key(user_id, token: str) -> str:
+    return f"finance:statement:{user_id}:{token}"
+
+
+def store_statement(user_id, school_id, kind: str, filename: str, raw: bytes) -> tuple[str, dict]:
+    """Parse a statement (once per content while cached) and keep it under a token."""
+    h = hashlib.sha256(raw)
+    h.update(f"\0{kind}\0{school_id}".encode())
+    token = h.hexdigest()[:40]
+    statement = cache.get(_cache_key(user_id, token))
+    if statement is None:
+        statement = {'kind': kind, 'school_id': school_id, 'filename': filename, 'lines': parse_statement(filename, raw)}
+    cache.set(_cache_key(user_id, token), statement, STATEMENT_TTL)
+    return token, statement
+
+
+def load_statement(user_id, token: str) -> Optional[dict]:
+    return cache.get(_cache_key(user_id, token)) if token else None
+
+
+def drop_statement(user_id, token: str) -> None:
+    cache.delete(_cache_key(user_id, token))
+
+
+# ===== Matching =====
+
+def parse_assignments(value) -> dict:
+    """{line: student_id or None} from the request's assignments (a dict, or it as a JSON string)."""
+    if value in (None, ''):
+        return {}
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            raise StatementError('assignments must be a JSON object of {line: student_id|null}')
+    if not isinstance(value, dict):
+        raise StatementError('assignments must be an object of {line: student_id|null}')
+    out = {}
+    for k, v in value.items():
+        try:
+            out[int(k)] = int(v) if v not in (None, '') else None
+        except (TypeError, ValueError):
+            raise StatementError(f'Invalid assignment {k!r}: {v!r}; expected a line number and a student id or null')
+    return out
+
+
+def _account_tokens(line: dict) -> list:
+    """Candidate admission numbers / invoice refs for a line, best first."""
+    tokens = []
+    account = line.get('account') or ''
+    if account:
+        tokens.append(account.strip())
+        tokens.extend(t for t in account.replace(',', ' ').split() if t != account.strip())
+    if not account:
+        # Paybill statements put the account in the details ("... Acc. ADM123"), banks in the
+        # narration; admission numbers and invoice refs contain digits, words never do
+        tokens.extend(t for t in _TOKEN_RE.findall(line.get('details') or '') if any(c.isdigit() for c in t))
+    seen, out = set(), []
+    for t in tokens:
+        key = t.upper()
+        if key and key not in seen:
+            seen.add(key)
+            out.append(t)
+    return out
+
+
+def _chunks(values, size=500):
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def _school_q(school_id, prefix=''):
+    return Q(**{f'{prefix}school_id': school_id}) | Q(**{f'{prefix}klass__school_id': school_id})
+
+
+def _student_dict(s, open_invoices=None) -> dict:
+    return {
+        'id': s.id, 'name': s.name, 'admission_no': s.admission_no,
+        'balance': str(student_balance(open_invoices or [])),
+    }
+
+
+def match_statement(statement: dict, school_id, assignments: Optional[dict] = None, lock: bool = False) -> dict:
+    """Match every line and plan its FIFO allocation. assignments ({line: student_id or None})
+    override the automatic match (None skips the line). Returns {'lines': [...], 'plan': [...], 'summary': {...}}.
+    """
+    models = _get_models()
+    Student, Invoice, Payment = models['Student'], models['Invoice'], models['Payment']
+    lines = statement['lines']
+    assignments = parse_assignments(assignments)
+
+    # --- batched lookups ---
+    adm_keys, inv_ids, phones = set(), set(), set()
+    for line in lines:
+        for t in _account_tokens(line):
+            m = _INVOICE_RE.match(t)
+            if m:
+                inv_ids.add(int(m.group(1)))
+            else:
+                adm_keys.update({t, t.upper(), t.lower()})
+        if line['phone']:
+            phones.update(phone_variants(line['phone']))
+    student_qs = Student.objects.only('id', 'name', 'admission_no', 'guardian_id', 'school_id', 'klass_id')
+    if school_id:
+        student_qs = student_qs.filter(_school_q(school_id))
+    by_adm = {}
+    for chunk in _chunks(adm_keys):
+        by_adm.update({s.admission_no.upper(): s for s in student_qs.filter(admission_no__in=chunk)})
+    by_phone = {}
+    for chunk in _chunks(phones):
+        for s in student_qs.filter(guardian_id__in=chunk):
+            p = normalize_phone(s.guardian_id)
+            if p and s not in by_phone.get(p, []):
+                by_phone.setdefault(p, []).append(s)
+    inv_student = {}
+    for chunk in _chunks(inv_ids):
+        inv_qs = Invoice.objects.filter(id__in=chunk)
+        if school_id:
+            inv_qs = inv_qs.filter(school_id=school_id)
+        inv_student.update(inv_qs.values_list('id', 'student_id'))
+    assigned = {}
+    manual_ids = {v for v in assignments.values() if v}
+    if manual_ids:
+        assigned = {s.id: s for s in student_qs.filter(id__in=manual_ids)}
+    students = {s.id: s for s in by_adm.values()}
+    students.update({s.id: s for group in by_phone.values() for s in group})
+    students.update(assigned)
+    missing = set(inv_student.values()) - set(students)
+    if missing:
+        students.update({s.id: s for s in student_qs.filter(id__in=missing)})
+
+    refs = {line['reference'] for line in lines if line['reference']}
+    existing_refs = set()
+    for chunk in _chunks(refs, 250):
+        pay_qs = Payment.objects.filter(Q(reference__in=chunk) | Q(mpesa_receipt__in=[r.upper() for r in chunk]))
+        if school_id:
+            pay_qs = pay_qs.filter(school_id=school_id)
+        for ref, receipt in pay_qs.values_list('reference', 'mpesa_receipt'):
+            existing_refs.update(r.upper() for r in (ref, receipt) if r)
+
+    open_invoices = open_invoices_by_student(students, school_id=school_id, lock=lock)
+    # Latest invoice per student, where any remainder is credited as an overpayment
+    latest_qs = Invoice.objects.filter(student_id__in=list(students))
+    if school_id:
+        latest_qs = latest_qs.filter(school_id=school_id)
+    latest_ids = dict(latest_qs.values('student_id').annotate(last=Max('id')).values_list('student_id', 'last'))
+    open_by_id = {inv.id: inv for items in open_invoices.values() for inv, _ in items}
+    closed_ids = [i for i in latest_ids.values() if i not in open_by_id]
+    latest_closed = {}
+    if closed_ids:
+        closed_qs = Invoice.objects.filter(id__in=closed_ids)
+        if lock:
+            closed_qs = closed_qs.select_for_update()
+        for inv in closed_qs:
+            inv.paid = inv.amount  # not open, so fully paid; only its status is derived from this
+            latest_closed[inv.id] = inv
+
+    # --- per line, in file order so FIFO sees earlier lines' allocations ---
+    out_lines, plan = [], []
+    seen_refs = set()
+    summary = {'lines': len(lines), 'matched': 0, 'unallocated': 0, 'ambiguous': 0, 'unmatched': 0, 'duplicate': 0,
+               'skipped': 0, 'amount_total': CENTS, 'amount_allocated': CENTS, 'amount_overpaid': CENTS,
+               'amount_unallocated': CENTS}
+    for line in lines:
+        amount = Decimal(line['amount'])
+        summary['amount_total'] += amount
+        result = dict(line, status='unmatched', match_by=None, student=None, candidates=[], allocations=[],
+                      overpayment=None, unallocated=line['amount'])
+        ref_key = (line['reference'] or '').upper()
+        student, match_by, candidates = None, None, []
+
+        if ref_key and (ref_key in existing_refs or ref_key in seen_refs):
+            result['status'] = 'duplicate'
+            result['duplicate_of'] = 'existing payment' if ref_key in existing_refs else 'earlier line in this file'
+        elif line['line'] in assignments:
+            sid = assignments[line['line']]
+            if sid is None:
+                result['status'] = 'skipped'
+            elif sid in assigned:
+                student, match_by = assigned[sid], 'manual'
+            else:
+                result['error'] = 'Assigned student not found in this school'
+        else:
+            for t in _account_tokens(line):
+                m = _INVOICE_RE.match(t)
+                if m and int(m.group(1)) in inv_student:
+                    student, match_by = students.get(inv_student[int(m.group(1))]), 'invoice'
+                elif t.upper() in by_adm:
+                    student, match_by = by_adm[t.upper()], 'admission'
+                if student:
+                    break
+            if student is None and line['phone'] in by_phone:
+                group = by_phone[line['phone']]
+                if len(group) == 1:
+                    student, match_by = group[0], 'guardian_phone'
+                else:
+                    # Siblings share a guardian: pick the one whose balance or an open invoice equals the amount
+                    fits = [s for s in group if student_balance(open_invoices.get(s.id, [])) == amount
+                            or any(b == amount for _, b in open_invoices.get(s.id, []))]
+                    if len(fits) == 1:
+                        student, match_by = fits[0], 'guardian_phone+amount'
+                    else:
+                        candidates = group
+        if ref_key and result['status'] != 'skipped':
+            seen_refs.add(ref_key)
+
+        if student is not None:
+            result['status'] = 'matched'
+            result['match_by'] = match_by
+            student_open = open_invoices.get(student.id, [])
+            result['student'] = _student_dict(student, student_open)
+            allocations, remaining = allocate_fifo(student_open, amount)
+            result['allocations'] = [{'invoice': inv.id, 'amount': str(a)} for inv, a in allocations]
+            summary['amount_allocated'] += amount - remaining
+            if remaining > 0:
+                last_id = latest_ids.get(student.id)
+                last = open_by_id.get(last_id) or latest_closed.get(last_id)
+                if last is None:
+                    # The student has no invoice to credit: leave the line for a manual decision
+                    result['status'] = 'unallocated'
+                    result['unallocated'] = line['amount']
+                    summary['amount_unallocated'] += amount
+                else:
+                    last.paid = getattr(last, 'paid', CENTS) + remaining
+                    if allocations and allocations[-1][0] is last:
+                        allocations[-1] = (last, allocations[-1][1] + remaining)
+                    else:
+                        allocations.append((last, remaining))
+                    result['overpayment'] = {'invoice': last.id, 'amount': str(remaining)}
+                    result['unallocated'] = str(CENTS)
+                    summary['amount_overpaid'] += remaining
+            else:
+                result['unallocated'] = str(remaining)
+            if result['status'] == 'matched':
+                plan.append((line, student, allocations))
+        elif candidates:
+            result['status'] = 'ambiguous'
+            result['candidates'] = [_student_dict(s, open_invoices.get(s.id, [])) for s in candidates]
+        summary[result['status']] += 1
+        out_lines.append(result)
+
+    for k in ('amount_total', 'amount_allocated', 'amount_overpaid', 'amount_unallocated'):
+        summary[k] = str(summary[k])
+    return {'lines': out_lines, 'plan': plan, 'summary': summary}
+
+
+def apply_statement(statement: dict, school_id, user=None, assignments: Optional[dict] = None) -> dict:
+    """Record the planned allocations of every matched line in one transaction."""
+    Payment = _get_models()['Payment']
+    method = 'mpesa' if statement.get('kind') == 'mpesa' else 'bank'
+    with transaction.atomic():
+        result = match_statement(statement, school_id, assignments=assignments, lock=True)
+        payments = []
+        for line, student, allocations in result['plan']:
+            receipt = (line['reference'] or '').upper() if method == 'mpesa' else ''
+            for n, (inv, alloc) in enumerate(allocations):
+                payments.append(Payment(
+                    invoice=inv,
+                    amount=alloc,
+                    method=method,
+                    reference=line['reference'] or line['account'] or f"Statement line {line['line']}",
+                    # The receipt is unique; it goes on the first part of a split allocation
+                    mpesa_receipt=(receipt[:30] or None) if n == 0 else None,
+                    recorded_by=user,
+                    school_id=inv.school_id,
+                ))
+        changed = save_allocations(payments)
+    summary = dict(result['summary'], payments_created=len(payments), invoices_updated=changed)
+    return {'lines': result['lines'], 'summary': summary}
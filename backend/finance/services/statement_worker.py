@@ -0,0 +1,90 @@
+from __future__ import annotations
+from io import BytesIO
+from xml.sax.saxutils import escape
+
+# Runs inside the fee statement process pool (spawned interpreters), so this module must not
+# touch Django settings, models or storage; finance.services.fee_statements handles all of that
+# and passes plain dicts in.
+
+
+def _money(value) -> str:
+    return f"{float(value or 0):,.2f}"
+
+
+def render_statement(data: dict) -> bytes:
+    """One student's term fee statement as a PDF."""
+    from reportlab.lib import colors
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.styles import getSampleStyleSheet
+    from reportlab.lib.units import mm
+    from reportlab.platypus import Image, Paragraph, SimpleDocTemplate, Spacer, Table, TableStyle
+
+    buffer = BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=A4, leftMargin=15*mm, rightMargin=15*mm, topMargin=15*mm, bottomMargin=15*mm,
+                            title=f"Fee statement {data['student']['admission_no']}",
+                            invariant=1)  # no timestamps in the file, so its hash tracks its content
+    styles = getSampleStyleSheet()
+    school, stu = data['school'], data['student']
+    grid = TableStyle([
+        ('GRID', (0, 0), (-1, -1), 0.25, colors.grey),
+        ('BACKGROUND', (0, 0), (-1, 0), colors.Color(0.93, 0.96, 1)),
+        ('ALIGN', (-1, 0), (-1, -1), 'RIGHT'),
+        ('FONTSIZE', (0, 0), (-1, -1), 9),
+    ])
+    elements = []
+
+    heading = Paragraph(
+        f"<b>{escape(school.get('name') or '')}</b><br/>"
+        f"<font size=9 color=grey>{escape(school.get('address') or '')}<br/>{escape(school.get('motto') or '')}</font>",
+        styles['Normal'],
+    )
+    if school.get('logo_path'):
+        head = Table([[Image(school['logo_path'], width=16*mm, height=16*mm), heading]], colWidths=[20*mm, 160*mm])
+        head.setStyle(TableStyle([('VALIGN', (0, 0), (-1, -1), 'MIDDLE'), ('LEFTPADDING', (0, 0), (-1, -1), 0)]))
+        elements.append(head)
+    else:
+        elements.append(heading)
+    elements.append(Spacer(1, 8))
+    elements.append(Paragraph(f"<b>FEE STATEMENT — {escape(data['period'])}</b>", styles['Heading3']))
+    info = Table([
+        ['Student', f"{stu['name']} ({stu['admission_no']})", 'Date', data['generated_on']],
+        ['Class', stu.get('class') or '', 'Guardian', stu.get('guardian') or ''],
+    ], colWidths=[22*mm, 78*mm, 22*mm, 58*mm])
+    info.setStyle(TableStyle([('FONTSIZE', (0, 0), (-1, -1), 9), ('TEXTCOLOR', (0, 0), (0, -1), colors.grey),
+                              ('TEXTCOLOR', (2, 0), (2, -1), colors.grey)]))
+    elements.append(info)
+    elements.append(Spacer(1, 8))
+
+    elements.append(Paragraph('<b>Fees this term</b>', styles['Heading4']))
+    rows = [['Item', 'Due date', 'Amount']]
+    rows.append(['Balance brought forward', '', _money(data['opening_balance'])])
+    rows += [[i['category'] or 'Fees', i['due_date'] or '', _money(i['amount'])] for i in data['invoices']]
+    rows.append(['Total due', '', _money(data['opening_balance'] + data['term_billed'])])
+    fees = Table(rows, colWidths=[100*mm, 40*mm, 40*mm])
+    fees.setStyle(grid)
+    fees.setStyle(TableStyle([('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold')]))
+    elements.append(fees)
+    elements.append(Spacer(1, 8))
+
+    elements.append(Paragraph('<b>Payments received</b>', styles['Heading4']))
+    rows = [['Date', 'Method', 'Reference', 'Amount']]
+    rows += [[p['date'], (p['method'] or '').upper(), p['reference'] or '', _money(p['amount'])] for p in data['payments']]
+    if not data['payments']:
+        rows.append(['—', '', '', _money(0)])
+    rows.append(['Total paid', '', '', _money(data['term_paid'])])
+    pays = Table(rows, colWidths=[35*mm, 30*mm, 75*mm, 40*mm])
+    pays.setStyle(grid)
+    pays.setStyle(TableStyle([('FONTNAME', (0, -1), (-1, -1), 'Helvetica-Bold')]))
+    elements.append(pays)
+    elements.append(Spacer(1, 10))
+
+    elements.append(Paragraph(f"<b>Balance due: KES {_money(data['closing_balance'])}</b>", styles['Heading3']))
+    if data.get('note'):
+        elements.append(Paragraph(escape(data['note']), styles['Normal']))
+    doc.build(elements)
+    return buffer.getvalue()
+
+
+def render_many(items: list) -> list:
+    """Render a chunk of statements; one task per chunk keeps pool overhead low."""
+    return [render_statement(data) for data in items]
@@ -0,0 +1,235 @@
+from __future__ import annotations
+from datetime import datetime
+from decimal import Decimal
+from typing import Optional
+
+from django.db import IntegrityError, transaction
+from django.db.models import Case, DecimalField, F, Max, OuterRef, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+# Pocket-money ledger. Deposits and withdrawals are posted in batches (one from the
+# transactions endpoint, hundreds from a POS terminal): the wallets are locked once (in id
+# order), the items are applied in order in memory, with a withdrawal larger than the balance
+# rejected, and then the transactions are bulk-inserted and each wallet gets a single
+# UPDATE balance = balance + delta, guarded in SQL with balance >= -delta so a balance can
+# never go negative even if a write slips past the lock. Items may carry an idempotency key
+# (unique per school): a retried POS upload returns the original transaction instead of
+# charging twice.
+#
+# Every transaction records balance_after. Snapshots (take_snapshots, run periodically via
+# `manage.py snapshot_wallets`) store the locked wallet balance at a ledger position, so a
+# statement sums only the transactions after the nearest snapshot.
+
+MAX_BATCH = 500
+CENTS = Decimal('0.01')
+
+
+class LedgerError(Exception):
+    def __init__(self, detail: str, status: int = 400):
+        super().__init__(detail)
+        self.detail = detail
+        self.status = status
+
+
+def _get_models():
+    from finance.models import PocketMoneySnapshot, PocketMoneyTransaction, PocketMoneyWallet
+    return {
+        'Wallet': PocketMoneyWallet,
+        'Transaction': PocketMoneyTransaction,
+        'Snapshot': PocketMoneySnapshot,
+    }
+
+
+def signed_amount():
+    """Deposits count up, withdrawals down."""
+    return Case(
+        When(transaction_type='deposit', then=F('amount')),
+        default=F('amount') * -1,
+        output_field=DecimalField(max_digits=12, decimal_places=2),
+    )
+
+
+def _chunks(values, size=500):
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+# ===== Posting =====
+
+def post_transactions(items: list, school_id=None, user=None, terminal: str = '') -> list:
+    """Apply items in order; all of a batch commits together.
+    items: [{'wallet': id, 'type': 'deposit'|'withdrawal', 'amount': Decimal, 'description': str, 'key': str|None}]
+    Returns per item {'key', 'status': 'applied'|'duplicate'|'insufficient_funds', 'transaction', 'balance'}.
+    """
+    if len(items) > MAX_BATCH:
+        raise LedgerError(f'At most {MAX_BATCH} transactions per batch')
+    try:
+        with transaction.atomic():
+            return _post(items, school_id, user, terminal)
+    except IntegrityError:
+        # A concurrent upload inserted one of our idempotency keys first; those items are
+        # duplicates now, so one retry settles it
+        with transaction.atomic():
+            return _post(items, school_id, user, terminal)
+
+
+def _post(items, school_id, user, terminal):
+    models = _get_models()
+    Wallet, Txn = models['Wallet'], models['Transaction']
+    keys = {i['key'] for i in items if i.get('key')}
+    existing = {}
+    for chunk in _chunks(keys):
+        qs = Txn.objects.filter(idempotency_key__in=chunk)
+        qs = qs.filter(school_id=school_id) if school_id else qs
+        existing.update({t.idempotency_key: t for t in qs})
+
+    wallet_ids = sorted({int(i['wallet']) for i in items if i.get('key') not in existing})
+    balances = {}
+    for chunk in _chunks(wallet_ids):
+        balances.update(Wallet.objects.select_for_update().filter(id__in=chunk).order_by('id').values_list('id', 'balance'))
+    start = dict(balances)
+    schools = {}
+    if not school_id:
+        for w in Wallet.objects.filter(id__in=wallet_ids).select_related('student', 'student__klass'):
+            schools[w.id] = w.student.tenant_school_id()
+
+    results, new_txns, batch_keys = [], [], {}
+    for item in items:
+        key = item.get('key') or None
+        wallet_id = int(item['wallet'])
+        amount = Decimal(str(item['amount'])).quantize(CENTS)
+        if key in existing:
+            t = existing[key]
+            results.append({'key': key, 'status': 'duplicate', 'transaction': t, 'balance': t.balance_after})
+            continue
+        if key in batch_keys:
+            t = batch_keys[key]
+            results.append({'key': key, 'status': 'duplicate', 'transaction': t, 'balance': t.balance_after})
+            continue
+        if wallet_id not in balances:
+            raise LedgerError(f'Wallet {wallet_id} not found', status=404)
+        if item['type'] == 'withdrawal':
+            if balances[wallet_id] < amount:
+                results.append({'key': key, 'status': 'insufficient_funds', 'transaction': None, 'balance': balances[wallet_id]})
+                continue
+            balances[wallet_id] -= amount
+        else:
+            balances[wallet_id] += amount
+        t = Txn(
+            wallet_id=wallet_id,
+            transaction_type=item['type'],
+            amount=amount,
+            description=item.get('description') or '',
+            recorded_by=user,
+            school_id=school_id or schools.get(wallet_id),
+            idempotency_key=key,
+            balance_after=balances[wallet_id],
+            terminal=terminal or '',
+        )
+        new_txns.append(t)
+        if key:
+            batch_keys[key] = t
+        results.append({'key': key, 'status': 'applied', 'transaction': t, 'balance': balances[wallet_id]})
+
+    Txn.objects.bulk_create(new_txns, batch_size=500)
+    now = timezone.now()
+    for wallet_id, balance in balances.items():
+        delta = balance - start[wallet_id]
+        if not delta:
+            continue
+        qs = Wallet.objects.filter(pk=wallet_id)
+        if delta < 0:
+            qs = qs.filter(balance__gte=-delta)
+        if qs.update(balance=F('balance') + delta, updated_at=now) != 1:
+            raise LedgerError('Wallet balance changed concurrently; retry', status=409)
+    return results
+
+
+def post_one(wallet_id, txn_type: str, amount, user=None, description: str = '', key: Optional[str] = None,
+             school_id=None, terminal: str = '') -> dict:
+    return post_transactions([{
+        'wallet': wallet_id, 'type': txn_type, 'amount': amount, 'description': description, 'key': key,
+    }], school_id=school_id, user=user, terminal=terminal)[0]
+
+
+# ===== Snapshots and statements =====
+
+def take_snapshots(school_id=None) -> int:
+    """Snapshot every wallet with transactions since its latest snapshot. Returns the number created.
+    Each chunk of wallets is locked (in id order, like posting) before its ledger position is read:
+    a posting batch inserts its transactions only while holding the wallet lock, so once we hold
+    it every transaction of the wallet is committed and the wallet balance matches the highest
+    transaction id. A cutoff read without the lock could skip a lower-id transaction that commits
+    after the snapshot, and no statement would ever include it.
+    """
+    models = _get_models()
+    Wallet, Txn, Snapshot = models['Wallet'], models['Transaction'], models['Snapshot']
+    latest = Snapshot.objects.filter(wallet_id=OuterRef('wallet_id')).order_by('-last_transaction_id')
+    pending = Txn.objects.annotate(
+        after=Coalesce(Subquery(latest.values('last_transaction_id')[:1]), Value(0)),
+    ).filter(id__gt=F('after'))
+    if school_id:
+        pending = pending.filter(school_id=school_id)
+    wallet_ids = sorted(set(pending.values_list('wallet_id', flat=True).distinct()))
+    created = 0
+    for chunk in _chunks(wallet_ids):
+        with transaction.atomic():
+            balances = dict(
+                Wallet.objects.select_for_update().filter(id__in=chunk).order_by('id').values_list('id', 'balance')
+            )
+            rows = (
+                Txn.objects.filter(wallet_id__in=list(balances))
+                .values('wallet_id').annotate(last_id=Max('id'), as_of=Max('created_at'), school=Max('school_id'))
+            )
+            done = dict(
+                Snapshot.objects.filter(wallet_id__in=list(balances))
+                .values('wallet_id').annotate(last=Max('last_transaction_id')).values_list('wallet_id', 'last')
+            )
+            snapshots = [
+                Snapshot(
+                    wallet_id=r['wallet_id'],
+                    school_id=r['school'],
+                    last_transaction_id=r['last_id'],
+                    as_of=r['as_of'],
+                    balance=balances[r['wallet_id']],
+                )
+                for r in rows if r['last_id'] > (done.get(r['wallet_id']) or 0)
+            ]
+            Snapshot.objects.bulk_create(snapshots, batch_size=500, ignore_conflicts=True)
+            created += len(snapshots)
+    return created
+
+
+def balance_at(wallet_id, at: datetime) -> Decimal:
+    """Balance before `at`: the latest snapshot before it plus the transactions in between."""
+    models = _get_models()
+    snap = (
+        models['Snapshot'].objects.filter(wallet_id=wallet_id, as_of__lt=at)
+        .order_by('-as_of', '-last_transaction_id').values('balance', 'last_transaction_id').first()
+    )
+    base, after_id = (snap['balance'], snap['last_transaction_id']) if snap else (Decimal('0'), 0)
+    delta = models['Transaction'].objects.filter(
+        wallet_id=wallet_id, id__gt=after_id, created_at__lt=at,
+    ).aggregate(s=Sum(signed_amount()))['s']
+    return base + (delta or Decimal('0'))
+
+
+def wallet_statement(wallet, start: datetime, end: datetime) -> dict:
+    """Opening balance, transactions in [start, end) and closing balance for a wallet."""
+    Txn = _get_models()['Transaction']
+    opening = balance_at(wallet.id, start).quantize(CENTS)
+    txns = list(
+        Txn.objects.filter(wallet_id=wallet.id, created_at__gte=start, created_at__lt=end)
+        .order_by('created_at', 'id')
+    )
+    deposits = sum((t.amount for t in txns if t.transaction_type == 'deposit'), Decimal('0'))
+    withdrawals = sum((t.amount for t in txns if t.transaction_type != 'deposit'), Decimal('0'))
+    return {
+        'opening_balance': opening,
+        'deposits': deposits,
+        'withdrawals': withdrawals,
+        'closing_balance': opening + deposits - withdrawals,
+        'transactions': txns,
+    }
@@ -1,9 +1,10 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete, pre_save
 from django.dispatch import receiver
 
 from academics.models import Student
 from accounts.models import School
-from .models import PocketMoneyWallet, ClassFee, Invoice, FeeCategory
+from .models import PocketMoneyWallet, ClassFee, Invoice, Payment, Expense, FeeCategory, MpesaConfig
+from .services.finance_cube import mark_dirty
 from django.utils import timezone
 
 
@@ -76,11 +77,14 @@ def ensure_invoices_for_assigned_class(sender, instance: Student, created, **kwa
 
         # Resolve current term for the student's school
         try:
-            from academics.models import Term, AcademicYear
-            t = Term.objects.filter(academic_year__school_id=school_id, is_current=True).first()
-            if not t:
-                # Try by date containment
-                t = Term.objects.filter(academic_year__school_id=school_id, start_date__lte=today, end_date__gte=today).first()
+            from academics.services.calendar import get_school_calendar
+            cal = get_school_calendar(school_id)
+            t = None
+            if cal:
+                t = cal.flagged_term()
+                if not t:
+                    # Try by date containment
+                    _, t = cal.resolve(today)
             if t:
                 term_number = int(t.number)
                 # Prefer AY end year; fallback to start year
@@ -130,3 +134,42 @@ def ensure_invoices_for_assigned_class(sender, instance: Student, created, **kwa
     except Exception:
         # Silent fail to avoid blocking student saves
         pass
+
+
+@receiver(post_save, sender=MpesaConfig)
+@receiver(post_delete, sender=MpesaConfig)
+def drop_cached_mpesa_client(sender, instance: MpesaConfig, **kwargs):
+    """Rebuild the school's Daraja client (and token cache key) with the new credentials."""
+    from .mpesa import invalidate_school_client
+    invalidate_school_client(instance.school_id)
+
+
+# ===== Finance cube =====
+# Every write flags its (school, day) for the finance cube; the next cube read rebuilds it.
+# Bulk payment writes bypass these and flag their days in allocation.save_allocations().
+
+@receiver(post_save, sender=Invoice)
+@receiver(post_delete, sender=Invoice)
+@receiver(post_save, sender=Payment)
+@receiver(post_delete, sender=Payment)
+def flag_finance_cube_day(sender, instance, **kwargs):
+    if kwargs.get('update_fields') and set(kwargs['update_fields']) <= {'status', 'mpesa_transaction_id', 'due_date'}:
+        return
+    mark_dirty([(instance.school_id, instance.created_at)])
+
+
+@receiver(pre_save, sender=Expense)
+def remember_expense_day(sender, instance: Expense, **kwargs):
+    instance._cube_previous = (
+        Expense.objects.filter(pk=instance.pk).values_list('school_id', 'date').first() if instance.pk else None
+    )
+
+
+@receiver(post_save, sender=Expense)
+@receiver(post_delete, sender=Expense)
+def flag_finance_cube_expense_day(sender, instance: Expense, **kwargs):
+    pairs = [(instance.school_id, instance.date)]
+    previous = getattr(instance, '_cube_previous', None)
+    if previous:
+        pairs.append(previous)
+    mark_dirty(pairs)
@@ -1,6 +1,6 @@
 from rest_framework.routers import DefaultRouter
 from django.urls import path
-from .views import InvoiceViewSet, PaymentViewSet, FeeCategoryViewSet, ClassFeeViewSet, mpesa_callback, MpesaConfigViewSet, ExpenseCategoryViewSet, ExpenseViewSet, PocketMoneyWalletViewSet, PocketMoneyTransactionViewSet
+from .views import InvoiceViewSet, PaymentViewSet, FeeCategoryViewSet, ClassFeeViewSet, mpesa_callback, MpesaConfigViewSet, ExpenseCategoryViewSet, ExpenseViewSet, PocketMoneyWalletViewSet, PocketMoneyTransactionViewSet, FeeStatementViewSet
 
 router = DefaultRouter()
 router.register('invoices', InvoiceViewSet)
@@ -12,6 +12,7 @@ router.register('expense-categories', ExpenseCategoryViewSet)
 router.register('expenses', ExpenseViewSet)
 router.register('pocket-money-wallets', PocketMoneyWalletViewSet)
 router.register('pocket-money-transactions', PocketMoneyTransactionViewSet)
+router.register('fee-statements', FeeStatementViewSet)
 
 urlpatterns = [
     # Public callback URL for Daraja STK push
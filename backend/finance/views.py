@@ -2,26 +2,78 @@ from rest_framework import viewsets, permissions
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from django_filters.rest_framework import DjangoFilterBackend
-from django.db.models import Sum
-from django.db.models.functions import TruncMonth
+from django.db import IntegrityError
+from django.db.models import Q, Sum
 from datetime import datetime, timedelta
+from decimal import Decimal
 from django.utils import timezone
 from rest_framework.parsers import MultiPartParser, JSONParser, FormParser
-from django.http import JsonResponse
+from django.core.files.storage import default_storage
+from django.http import FileResponse, HttpResponse, JsonResponse
 from django.views.decorators.csrf import csrf_exempt
-import json
-import os
 import logging
-from .mpesa import MpesaClient
-from .models import Invoice, Payment, FeeCategory, ClassFee, MpesaConfig, ExpenseCategory, Expense, PocketMoneyWallet, PocketMoneyTransaction
-from .serializers import InvoiceSerializer, PaymentSerializer, FeeCategorySerializer, ClassFeeSerializer, MpesaConfigSerializer, ExpenseCategorySerializer, ExpenseSerializer, PocketMoneyWalletSerializer, PocketMoneyTransactionSerializer
+from .mpesa import client_for_school, has_credentials
+from .services.allocation import record_lump_sums, to_decimal
+from .services import fee_statements
+from .services.collections_forecast import HISTORY_TERMS as FORECAST_HISTORY_TERMS, collections_forecast as build_collections_forecast
+from .services.finance_cube import DIMENSIONS as CUBE_DIMENSIONS, GRANULARITIES as CUBE_GRANULARITIES, period_totals as cube_period_totals, refresh as refresh_cube, slice_cube
+from .services.mpesa_callbacks import enqueue_callback
+from .services.receipts import MAX_BATCH_RECEIPTS, build_receipts, render_receipts_pdf
+from .services.wallet_ledger import MAX_BATCH as POS_MAX_BATCH, LedgerError, post_one, post_transactions, wallet_statement
+from .services.reconciliation import (
+    KINDS as RECONCILE_KINDS, StatementError, apply_statement, drop_statement, load_statement, match_statement,
+    parse_assignments, store_statement,
+)
+from .models import Invoice, Payment, StkRequest, FeeCategory, ClassFee, MpesaConfig, ExpenseCategory, Expense, PocketMoneyWallet, PocketMoneyTransaction, FeeStatement
+from .serializers import InvoiceSerializer, PaymentSerializer, FeeCategorySerializer, ClassFeeSerializer, MpesaConfigSerializer, ExpenseCategorySerializer, ExpenseSerializer, PocketMoneyWalletSerializer, PocketMoneyTransactionSerializer, PosTransactionSerializer, FeeStatementSerializer
 from academics.models import Student
+from accounts.tenancy import SchoolScopedMixin, get_tenant, scope_to_school
 
 class IsFinanceOrAdmin(permissions.BasePermission):
     def has_permission(self, request, view):
         return request.user and request.user.is_authenticated and request.user.role in ('finance','admin')
 
-class InvoiceViewSet(viewsets.ModelViewSet):
+MAX_BATCH_PAYMENTS = 1000
+PAYMENT_METHODS = {m for m, _ in Payment.METHOD_CHOICES}
+_amount_field = Payment._meta.get_field('amount')
+MAX_PAYMENT_AMOUNT = Decimal(10) ** (_amount_field.max_digits - _amount_field.decimal_places)
+
+
+def _lump_sum_entry(data):
+    """({student, amount, method, reference}, None) from request data, or (None, error)."""
+    try:
+        student_id = int(data.get('student'))
+    except (TypeError, ValueError):
+        return None, 'student is required'
+    try:
+        amount = to_decimal(data.get('amount', 0))
+        if not amount.is_finite():
+            return None, 'Invalid amount'
+        # Only quantize what fits the column; quantizing a huge value raises InvalidOperation
+        if abs(amount) < MAX_PAYMENT_AMOUNT:
+            amount = amount.quantize(Decimal('0.01'))
+    except (ArithmeticError, ValueError):
+        return None, 'Invalid amount'
+    if amount <= 0:
+        return None, 'Amount must be greater than 0'
+    if amount >= MAX_PAYMENT_AMOUNT:
+        return None, 'Amount is too large'
+    method = data.get('method') or 'cash'
+    if method not in PAYMENT_METHODS:
+        return None, f'Invalid method: {method}'
+    return {'student': student_id, 'amount': amount, 'method': method,
+            'reference': str(data.get('reference') or '')[:100]}, None
+
+
+def _school_students(student_ids, school_id):
+    """The ids among student_ids that belong to the school (any school when school_id is None)."""
+    qs = Student.objects.filter(id__in=set(student_ids))
+    if school_id:
+        qs = qs.filter(Q(school_id=school_id) | Q(klass__school_id=school_id))
+    return set(qs.values_list('id', flat=True))
+
+
+class InvoiceViewSet(SchoolScopedMixin, viewsets.ModelViewSet):
     queryset = Invoice.objects.all()
     serializer_class = InvoiceSerializer
     permission_classes = [IsFinanceOrAdmin]
@@ -30,13 +82,8 @@ class InvoiceViewSet(viewsets.ModelViewSet):
     parser_classes = [MultiPartParser, FormParser, JSONParser]
 
     def get_queryset(self):
-        qs = super().get_queryset().select_related('student')
-        # Scope to user's school if available
-        school = getattr(getattr(self.request, 'user', None), 'school', None)
-        if school:
-            qs = qs.filter(student__klass__school=school)
-        # Optional filter by student provided by filterset_fields
-        return qs
+        # Scoped to the user's school by SchoolScopedMixin
+        return super().get_queryset().select_related('student')
 
     @action(detail=False, methods=['get'], url_path='student-summary')
     def student_summary(self, request):
@@ -49,12 +96,10 @@ class InvoiceViewSet(viewsets.ModelViewSet):
         # Scope to school
         school = getattr(getattr(request, 'user', None), 'school', None)
         inv_qs = Invoice.objects.filter(student_id=student_id)
-        if school:
-            inv_qs = inv_qs.filter(student__klass__school=school)
+        inv_qs = scope_to_school(inv_qs, school)
         total_billed = inv_qs.aggregate(s=Sum('amount'))['s'] or 0
         pay_qs = Payment.objects.filter(invoice__student_id=student_id)
-        if school:
-            pay_qs = pay_qs.filter(invoice__student__klass__school=school)
+        pay_qs = scope_to_school(pay_qs, school)
         total_paid = pay_qs.aggregate(s=Sum('amount'))['s'] or 0
         balance = (total_billed or 0) - (total_paid or 0)
         return Response({
@@ -90,14 +135,12 @@ class InvoiceViewSet(viewsets.ModelViewSet):
         inv_qs = Invoice.objects.all()
         if student_id:
             inv_qs = inv_qs.filter(student_id=student_id)
-        if school:
-            inv_qs = inv_qs.filter(student__klass__school=school)
+        inv_qs = scope_to_school(inv_qs, school)
         total_billed = inv_qs.aggregate(s=Sum('amount'))['s'] or 0
         pay_qs = Payment.objects.all()
         if student_id:
             pay_qs = pay_qs.filter(invoice__student_id=student_id)
-        if school:
-            pay_qs = pay_qs.filter(invoice__student__klass__school=school)
+        pay_qs = scope_to_school(pay_qs, school)
         total_paid = pay_qs.aggregate(s=Sum('amount'))['s'] or 0
         balance = (total_billed or 0) - (total_paid or 0)
         return Response({
@@ -124,12 +167,10 @@ class InvoiceViewSet(viewsets.ModelViewSet):
         data = []
         for stu in stu_qs:
             inv_qs = Invoice.objects.filter(student=stu)
-            if school:
-                inv_qs = inv_qs.filter(student__klass__school=school)
+            inv_qs = scope_to_school(inv_qs, school)
             total_billed = inv_qs.aggregate(s=Sum('amount'))['s'] or 0
             pay_qs = Payment.objects.filter(invoice__student=stu)
-            if school:
-                pay_qs = pay_qs.filter(invoice__student__klass__school=school)
+            pay_qs = scope_to_school(pay_qs, school)
             total_paid = pay_qs.aggregate(s=Sum('amount'))['s'] or 0
             balance = float(total_billed or 0) - float(total_paid or 0)
             if balance > min_balance:
@@ -147,9 +188,12 @@ class InvoiceViewSet(viewsets.ModelViewSet):
 
     @action(detail=False, methods=['get'], url_path='arrears/export')
     def arrears_export(self, request):
-        """Export arrears data as CSV. Accepts same filters as arrears: klass, min_balance."""
-        import csv
-        from django.http import HttpResponse
+        """Export arrears data. Accepts same filters as arrears: klass, min_balance.
+        ?export=csv (default) or xlsx; ?background=1 writes the file to media and returns a job to poll.
+        """
+        from django.db.models import DecimalField, F, OuterRef, Subquery, Value
+        from django.db.models.functions import Coalesce
+        from reports.exports import CHUNK_SIZE, export_response
         school = getattr(getattr(request, 'user', None), 'school', None)
         klass_id = request.query_params.get('klass')
         try:
@@ -163,88 +207,71 @@ class InvoiceViewSet(viewsets.ModelViewSet):
         if klass_id:
             stu_qs = stu_qs.filter(klass_id=klass_id)
 
-        rows = []
-        for stu in stu_qs:
-            inv_qs = Invoice.objects.filter(student=stu)
-            if school:
-                inv_qs = inv_qs.filter(student__klass__school=school)
-            total_billed = inv_qs.aggregate(s=Sum('amount'))['s'] or 0
-            pay_qs = Payment.objects.filter(invoice__student=stu)
-            if school:
-                pay_qs = pay_qs.filter(invoice__student__klass__school=school)
-            total_paid = pay_qs.aggregate(s=Sum('amount'))['s'] or 0
-            balance = float(total_billed or 0) - float(total_paid or 0)
-            if balance > min_balance:
-                rows.append([
-                    stu.id,
-                    stu.name,
-                    str(getattr(stu, 'klass', '') or ''),
-                    float(total_billed or 0),
-                    float(total_paid or 0),
-                    float(balance or 0),
-                ])
-
-        resp = HttpResponse(content_type='text/csv')
-        resp['Content-Disposition'] = 'attachment; filename="arrears.csv"'
-        w = csv.writer(resp)
-        w.writerow(['Student ID','Student Name','Class','Total Billed','Total Paid','Balance'])
-        for r in rows:
-            w.writerow(r)
-        return resp
+        # Billed/paid as correlated subqueries: one statement instead of two aggregates per student
+        money = DecimalField(max_digits=14, decimal_places=2)
+        billed = (
+            Invoice.objects.filter(student=OuterRef('pk')).order_by()
+            .values('student').annotate(s=Sum('amount')).values('s')
+        )
+        paid = (
+            Payment.objects.filter(invoice__student=OuterRef('pk')).order_by()
+            .values('invoice__student').annotate(s=Sum('amount')).values('s')
+        )
+        stu_qs = (
+            stu_qs
+            .annotate(
+                total_billed=Coalesce(Subquery(billed, output_field=money), Value(0, output_field=money)),
+                total_paid=Coalesce(Subquery(paid, output_field=money), Value(0, output_field=money)),
+            )
+            .annotate(balance=F('total_billed') - F('total_paid'))
+            .filter(balance__gt=min_balance)
+            .order_by('-balance', 'id')
+            .values_list('id', 'name', 'klass__name', 'total_billed', 'total_paid', 'balance')
+        )
+
+        def rows():
+            yield ['Student ID', 'Student Name', 'Class', 'Total Billed', 'Total Paid', 'Balance']
+            for sid, name, klass_name, billed_amt, paid_amt, balance in stu_qs.iterator(chunk_size=CHUNK_SIZE):
+                yield [sid, name, klass_name or '', float(billed_amt or 0), float(paid_amt or 0), float(balance or 0)]
+
+        return export_response(request, rows, 'arrears', sheet_title='Arrears')
 
     @action(detail=False, methods=['get'], url_path='summary')
     def summary(self, request):
         """
         Provides a high-level summary of school finances for the dashboard.
-        Accepts `start_date` and `end_date` query parameters.
+        Accepts `start_date` and `end_date` query parameters (whole days, inclusive).
+        Totals, trends and breakdowns come from the finance cube.
         """
-        school = getattr(getattr(request, 'user', None), 'school', None)
-        
+        school_id = get_tenant(request).school_id
+        today = timezone.localdate()
+
         # Date range filtering
-        end_date = request.query_params.get('end_date')
-        start_date = request.query_params.get('start_date')
         try:
-            if end_date:
-                end_date = timezone.make_aware(datetime.strptime(end_date, '%Y-%m-%d'))
-            else:
-                end_date = timezone.now()
-            
-            if start_date:
-                start_date = timezone.make_aware(datetime.strptime(start_date, '%Y-%m-%d'))
-            else:
-                start_date = end_date - timedelta(days=30)
+            end_day = datetime.strptime(request.query_params['end_date'], '%Y-%m-%d').date() if request.query_params.get('end_date') else today
+            start_day = datetime.strptime(request.query_params['start_date'], '%Y-%m-%d').date() if request.query_params.get('start_date') else end_day - timedelta(days=30)
         except (ValueError, TypeError):
-            end_date = timezone.now()
-            start_date = end_date - timedelta(days=30)
-
-        # Previous period for trend calculation
-        prev_start_date = start_date - (end_date - start_date)
-        prev_end_date = start_date
-
-        # Helper to calculate totals for a given period
-        def get_period_totals(start, end):
-            invoice_qs = Invoice.objects.filter(created_at__range=(start, end))
-            payment_qs = Payment.objects.filter(created_at__range=(start, end))
-            expense_qs = Expense.objects.filter(date__range=(start, end))
-            if school:
-                invoice_qs = invoice_qs.filter(student__klass__school=school)
-                payment_qs = payment_qs.filter(invoice__student__klass__school=school)
-                expense_qs = expense_qs.filter(school=school)
-
-            total_billed = invoice_qs.aggregate(total=Sum('amount'))['total'] or 0
-            total_revenue = payment_qs.aggregate(total=Sum('amount'))['total'] or 0
-            total_expenses = expense_qs.aggregate(total=Sum('amount'))['total'] or 0
-            outstanding_fees = total_billed - total_revenue
-            collection_rate = (total_revenue / total_billed * 100) if total_billed > 0 else 100
+            end_day, start_day = today, today - timedelta(days=30)
+
+        # Previous period of the same length, for trends
+        length = (end_day - start_day).days + 1
+        refresh_cube(school_id)
+        totals = cube_period_totals(school_id, {
+            'current': (start_day, end_day),
+            'previous': (start_day - timedelta(days=length), start_day - timedelta(days=1)),
+        }, fresh=True)
+
+        def period(t):
+            billed, revenue = t['billed'], t['payment']
             return {
-                'total_revenue': total_revenue,
-                'outstanding_fees': outstanding_fees,
-                'collection_rate': collection_rate,
-                'total_expenses': total_expenses,
+                'total_revenue': revenue,
+                'outstanding_fees': billed - revenue,
+                'collection_rate': (revenue / billed * 100) if billed > 0 else 100,
+                'total_expenses': t['expense'],
             }
 
-        current_period = get_period_totals(start_date, end_date)
-        previous_period = get_period_totals(prev_start_date, prev_end_date)
+        current_period = period(totals['current'])
+        previous_period = period(totals['previous'])
 
         # Trend calculation
         def calculate_trend(current, previous):
@@ -259,28 +286,26 @@ class InvoiceViewSet(viewsets.ModelViewSet):
         }
 
         # Other data (not date-range dependent for now)
-        payment_qs = Payment.objects.all()
-        if school:
-            payment_qs = payment_qs.filter(invoice__student__klass__school=school)
-
-        twelve_months_ago = timezone.now() - timedelta(days=365)
-        revenue_trend_qs = payment_qs.filter(created_at__gte=twelve_months_ago) \
-            .annotate(month=TruncMonth('created_at')) \
-            .values('month') \
-            .annotate(amount=Sum('amount')) \
-            .order_by('month')
-        revenue_trend = [{'month': r['month'].strftime('%b %Y'), 'amount': float(r['amount'])} for r in revenue_trend_qs]
+        revenue_trend = [
+            {'month': r['period'].strftime('%b %Y'), 'amount': float(r['amount'])}
+            for r in slice_cube(school_id, today - timedelta(days=365), today, granularity='month', dims=('kind',), fresh=True)
+            if r['kind'] == 'payment'
+        ]
 
-        recent_transactions = payment_qs.order_by('-created_at')[:10]
+        recent_transactions = scope_to_school(Payment.objects.all(), school_id).order_by('-created_at')[:10]
         recent_transactions_data = [
             {'id': p.id, 'date': p.created_at, 'amount': p.amount, 'type': p.method, 'status': 'completed'}
             for p in recent_transactions
         ]
 
-        expense_qs = Expense.objects.all()
-        if school: expense_qs = expense_qs.filter(school=school)
-        expense_breakdown_qs = expense_qs.values('category__name').annotate(amount=Sum('amount')).order_by('-amount')
-        expense_breakdown = [{'category': item['category__name'], 'amount': float(item['amount'])} for item in expense_breakdown_qs]
+        expense_breakdown = sorted(
+            (
+                {'category': r['expense_category'], 'amount': float(r['amount'])}
+                for r in slice_cube(school_id, None, None, granularity='total', dims=('kind', 'expense_category'), fresh=True)
+                if r['kind'] == 'expense'
+            ),
+            key=lambda r: -r['amount'],
+        )
 
         return Response({
             'totalRevenue': current_period['total_revenue'],
@@ -293,6 +318,88 @@ class InvoiceViewSet(viewsets.ModelViewSet):
             'recentTransactions': recent_transactions_data,
         })
 
+    def _cube_params(self, request):
+        """(start, end, granularity, dims) from the query string, or an error Response."""
+        params = request.query_params
+        today = timezone.localdate()
+        try:
+            end = datetime.strptime(params['end_date'], '%Y-%m-%d').date() if params.get('end_date') else today
+            start = datetime.strptime(params['start_date'], '%Y-%m-%d').date() if params.get('start_date') else end.replace(day=1)
+        except ValueError:
+            return Response({'detail': 'start_date/end_date must be YYYY-MM-DD'}, status=400)
+        if end < start:
+            return Response({'detail': 'end_date must not be before start_date'}, status=400)
+        granularity = params.get('granularity') or 'day'
+        if granularity not in CUBE_GRANULARITIES:
+            return Response({'detail': f"granularity must be one of: {', '.join(CUBE_GRANULARITIES)}"}, status=400)
+        dims = [d.strip() for d in (params.get('dims') or ','.join(CUBE_DIMENSIONS)).split(',') if d.strip()]
+        unknown = [d for d in dims if d not in CUBE_DIMENSIONS]
+        if unknown:
+            return Response({'detail': f"Unknown dims: {', '.join(unknown)}. Use: {', '.join(CUBE_DIMENSIONS)}"}, status=400)
+        return start, end, granularity, tuple(dims)
+
+    @action(detail=False, methods=['get'], url_path='cube')
+    def cube(self, request):
+        """Finance cube slice: billed, received and spent amounts rolled up by period and dimensions.
+        Params: start_date, end_date (default: this month), granularity=day|month|year|total,
+        dims=comma list of kind,fee_category,method,expense_category (default: all).
+        """
+        parsed = self._cube_params(request)
+        if isinstance(parsed, Response):
+            return parsed
+        start, end, granularity, dims = parsed
+        rows = list(slice_cube(get_tenant(request).school_id, start, end, granularity=granularity, dims=dims))
+        return Response({'start_date': start, 'end_date': end, 'granularity': granularity, 'dims': dims, 'rows': rows})
+
+    @action(detail=False, methods=['get'], url_path='cube/export')
+    def cube_export(self, request):
+        """Export a finance cube slice for accountants. Same params as cube.
+        ?export=csv (default) or xlsx; ?background=1 writes the file to media and returns a job to poll.
+        """
+        from reports.exports import export_response
+        parsed = self._cube_params(request)
+        if isinstance(parsed, Response):
+            return parsed
+        start, end, granularity, dims = parsed
+        school_id = get_tenant(request).school_id
+        labels = {'kind': 'Type', 'fee_category': 'Fee Category', 'method': 'Payment Method', 'expense_category': 'Expense Category'}
+
+        def rows():
+            yield (['Period'] if granularity != 'total' else []) + [labels[d] for d in dims] + ['Count', 'Amount']
+            for r in slice_cube(school_id, start, end, granularity=granularity, dims=dims):
+                period = [r['period']] if granularity != 'total' else []
+                yield period + [r[d] or '' for d in dims] + [r['count'], float(r['amount'])]
+
+        return export_response(request, rows, f'finance_{start:%Y%m%d}_{end:%Y%m%d}', sheet_title='Finance')
+
+    @action(detail=False, methods=['get'], url_path='collections-forecast')
+    def collections_forecast(self, request):
+        """Outstanding balances by days-overdue cohort (overall, per class, fee category and boarding
+        status) and the collections expected over the next 30/60/90 days from past payment curves.
+        Params: as_of (YYYY-MM-DD, default today), klass, history (prior terms, default 6),
+        horizons (comma list of days, default 30,60,90).
+        """
+        params = request.query_params
+        try:
+            as_of = datetime.strptime(params['as_of'], '%Y-%m-%d').date() if params.get('as_of') else None
+        except ValueError:
+            return Response({'detail': 'as_of must be YYYY-MM-DD'}, status=400)
+        try:
+            history = max(1, min(int(params.get('history') or FORECAST_HISTORY_TERMS), 24))
+            horizons = [int(h) for h in (params.get('horizons') or '30,60,90').split(',') if h.strip()]
+        except ValueError:
+            return Response({'detail': 'history and horizons must be whole numbers'}, status=400)
+        if not horizons or any(h <= 0 or h > 365 for h in horizons):
+            return Response({'detail': 'horizons must be between 1 and 365 days'}, status=400)
+        try:
+            klass_id = int(params['klass']) if params.get('klass') else None
+        except ValueError:
+            return Response({'detail': 'klass must be a class id'}, status=400)
+        return Response(build_collections_forecast(
+            get_tenant(request).school_id, as_of=as_of, klass_id=klass_id,
+            history=history, horizons=horizons,
+        ))
+
     @action(detail=True, methods=['post'], url_path='pay', permission_classes=[permissions.IsAuthenticated])
     def pay(self, request, pk=None):
         """Record a payment against this invoice.
@@ -361,72 +468,123 @@ class InvoiceViewSet(viewsets.ModelViewSet):
         Body: { student: <id>, amount: number, method?: 'mpesa'|'bank'|'cash', reference?: string }
         Returns { created_payments: [ids], amount_allocated, amount_unallocated }
         """
-        try:
-            student_id = int(request.data.get('student'))
-        except (TypeError, ValueError):
-            return Response({'detail': 'student is required'}, status=400)
-        # Ensure student exists and (if applicable) belongs to the same school
-        school = getattr(getattr(request, 'user', None), 'school', None)
-        stu_qs = Student.objects.filter(id=student_id)
-        if school:
-            stu_qs = stu_qs.filter(klass__school=school)
-        if not stu_qs.exists():
+        entry, error = _lump_sum_entry(request.data)
+        if error:
+            return Response({'detail': error}, status=400)
+        school_id = get_tenant(request).school_id
+        if not _school_students([entry['student']], school_id):
             return Response({'detail': 'Student not found'}, status=404)
-        try:
-            amount = float(request.data.get('amount', 0))
-        except (TypeError, ValueError):
-            return Response({'detail': 'Invalid amount'}, status=400)
-        if amount <= 0:
-            return Response({'detail': 'Amount must be greater than 0'}, status=400)
-
-        method = request.data.get('method') or 'cash'
-        reference = request.data.get('reference') or ''
+        # Locks the student's invoices, so concurrent payments allocate one after the other
+        result = record_lump_sums([entry], school_id=school_id, user=request.user)[0]
+        return Response({
+            'created_payments': result['created_payments'],
+            'amount_allocated': float(result['amount_allocated']),
+            'amount_unallocated': float(result['amount_unallocated']),
+        }, status=201)
 
-        inv_qs = Invoice.objects.filter(student_id=student_id).order_by('created_at', 'id')
-        if school:
-            inv_qs = inv_qs.filter(student__klass__school=school)
-
-        remaining = amount
-        created_ids = []
-
-        for inv in inv_qs:
-            if remaining <= 0:
-                break
-            # compute remaining on invoice
-            paid_so_far = float(inv.payments.aggregate(s=Sum('amount'))['s'] or 0)
-            inv_balance = float(inv.amount) - paid_so_far
-            if inv_balance <= 0:
-                # already settled
-                continue
-            alloc = min(remaining, inv_balance)
-            try:
-                pay = Payment.objects.create(
-                    invoice=inv,
-                    amount=float(alloc),
-                    method=method,
-                    reference=reference,
-                    recorded_by=request.user if getattr(request, 'user', None) and request.user.is_authenticated else None,
-                )
-            except Exception as e:
-                return Response({'detail': f'Failed to create payment: {e}'}, status=500)
-            created_ids.append(pay.id)
-            remaining -= alloc
-            # update invoice status
-            new_paid = paid_so_far + float(alloc)
-            if new_paid >= float(inv.amount):
-                inv.status = 'paid'
-            elif new_paid > 0:
-                inv.status = 'partial'
+    @action(detail=False, methods=['post'], url_path='pay_students', permission_classes=[IsFinanceOrAdmin])
+    def pay_students(self, request):
+        """Apply many lump sums at once (e.g. the bursar's end-of-day entry), all or nothing.
+        Body: { payments: [{ student, amount, method?, reference? }, ...], method?, reference? }
+        (top-level method/reference are defaults for rows without their own).
+        Returns { results: [{ student, created_payments, amount_allocated, amount_unallocated }], totals }
+        """
+        rows = request.data.get('payments')
+        if not isinstance(rows, list) or not rows:
+            return Response({'detail': 'payments must be a non-empty list'}, status=400)
+        if len(rows) > MAX_BATCH_PAYMENTS:
+            return Response({'detail': f'At most {MAX_BATCH_PAYMENTS} payments per batch'}, status=400)
+        defaults = {'method': request.data.get('method'), 'reference': request.data.get('reference')}
+        entries, errors = [], []
+        for idx, row in enumerate(rows):
+            entry, error = _lump_sum_entry({**defaults, **row} if isinstance(row, dict) else {})
+            if error:
+                errors.append({'index': idx, 'detail': error})
             else:
-                inv.status = 'unpaid'
-            inv.save(update_fields=['status'])
-
+                entries.append(entry)
+        school_id = get_tenant(request).school_id
+        if not errors:
+            known = _school_students([e['student'] for e in entries], school_id)
+            errors = [{'index': idx, 'detail': 'Student not found'} for idx, e in enumerate(entries) if e['student'] not in known]
+        if errors:
+            return Response({'detail': 'Invalid payments; nothing was recorded', 'errors': errors}, status=400)
+        results = record_lump_sums(entries, school_id=school_id, user=request.user)
         return Response({
-            'created_payments': created_ids,
-            'amount_allocated': float(amount - remaining),
-            'amount_unallocated': float(remaining),
+            'results': [dict(r, amount_allocated=float(r['amount_allocated']), amount_unallocated=float(r['amount_unallocated'])) for r in results],
+            'totals': {
+                'payments_created': sum(len(r['created_payments']) for r in results),
+                'amount_allocated': float(sum(r['amount_allocated'] for r in results)),
+                'amount_unallocated': float(sum(r['amount_unallocated'] for r in results)),
+            },
         }, status=201)
 
+    @action(detail=False, methods=['post'], url_path='reconcile-preview')
+    def reconcile_preview(self, request):
+        """Match an M-Pesa/bank statement export to students without recording anything.
+        Multipart: file (CSV/XLSX), kind ('mpesa'|'bank'). Or JSON { token, assignments? } to re-match
+        a statement previewed earlier. assignments: { <line>: <student_id>|null } (null skips the line).
+        Returns { token, kind, filename, summary, lines }. A matched line's money beyond the student's
+        open invoices shows as its overpayment (credited on their latest invoice); a student with no
+        invoice at all leaves the line 'unallocated' until it is assigned elsewhere or skipped.
+        """
+        school_id = get_tenant(request).school_id
+        if not school_id:
+            return Response({'detail': 'Your account is not linked to a school'}, status=400)
+        token = request.data.get('token')
+        try:
+            if token:
+                statement = load_statement(request.user.id, token)
+                if statement is None:
+                    return Response({'detail': 'Statement expired; upload the file again', 'code': 'statement_expired'}, status=410)
+            else:
+                f = request.FILES.get('file')
+                if not f:
+                    return Response({'detail': 'file is required'}, status=400)
+                kind = (request.data.get('kind') or 'mpesa').lower()
+                if kind not in RECONCILE_KINDS:
+                    return Response({'detail': 'kind must be mpesa or bank'}, status=400)
+                token, statement = store_statement(request.user.id, school_id, kind, f.name, f.read())
+        except StatementError as e:
+            return Response({'detail': e.detail}, status=e.status)
+        try:
+            result = match_statement(statement, school_id, assignments=parse_assignments(request.data.get('assignments')))
+        except StatementError as e:
+            return Response({'detail': e.detail}, status=e.status)
+        return Response({
+            'token': token,
+            'kind': statement['kind'],
+            'filename': statement.get('filename'),
+            'summary': result['summary'],
+            'lines': result['lines'],
+        })
+
+    @action(detail=False, methods=['post'], url_path='reconcile-apply')
+    def reconcile_apply(self, request):
+        """Record payments for every matched line of a previewed statement in one transaction.
+        Body: { token, assignments?: { <line>: <student_id>|null } }. Lines are matched again with the
+        invoices locked; duplicates (references already recorded) are never applied.
+        """
+        school_id = get_tenant(request).school_id
+        if not school_id:
+            return Response({'detail': 'Your account is not linked to a school'}, status=400)
+        token = request.data.get('token')
+        statement = load_statement(request.user.id, token)
+        if statement is None:
+            return Response({'detail': 'Statement expired; upload the file again', 'code': 'statement_expired'}, status=410)
+        if statement.get('school_id') != school_id:
+            return Response({'detail': 'Forbidden'}, status=403)
+        try:
+            assignments = parse_assignments(request.data.get('assignments'))
+        except StatementError as e:
+            return Response({'detail': e.detail}, status=e.status)
+        try:
+            result = apply_statement(statement, school_id, user=request.user, assignments=assignments)
+        except IntegrityError:
+            # An M-Pesa receipt was recorded meanwhile (e.g. by the callback worker); re-preview
+            return Response({'detail': 'Some receipts were recorded while applying; preview the statement again', 'code': 'conflict'}, status=409)
+        drop_statement(request.user.id, token)
+        return Response(result, status=201)
+
     @action(detail=True, methods=['post'], url_path='stk_push', permission_classes=[permissions.IsAuthenticated])
     def stk_push(self, request, pk=None):
         """Initiate an Mpesa STK push for this invoice.
@@ -451,16 +609,10 @@ class InvoiceViewSet(viewsets.ModelViewSet):
             amount = float(request.data.get('amount') or invoice.amount)
         except (TypeError, ValueError):
             return Response({'detail': 'Invalid amount'}, status=400)
-        # Determine credentials: prefer per-school config; fallback to env vars
-        school = getattr(getattr(invoice.student.klass, 'school', None), 'id', None)
-        config = None
-        if school:
-            config = MpesaConfig.objects.filter(school_id=invoice.student.klass.school_id).first()
-        if config:
-            have_creds = all([config.consumer_key, config.consumer_secret, config.short_code, config.passkey])
-        else:
-            required = ('MPESA_CONSUMER_KEY','MPESA_CONSUMER_SECRET','MPESA_SHORT_CODE','MPESA_PASSKEY')
-            have_creds = all(os.getenv(k) for k in required)
+        # Determine credentials: prefer per-school config; fallback to env vars.
+        # Clients (and their cached OAuth tokens) are reused per school across requests.
+        client, config = client_for_school(invoice.school_id)
+        have_creds = has_credentials(config if config else client)
         default_sim = 'false' if have_creds else 'true'
         simulate = str(request.data.get('simulate', default_sim)).lower() in ('1','true','yes')
 
@@ -483,21 +635,19 @@ class InvoiceViewSet(viewsets.ModelViewSet):
         # If not simulating, try real Daraja if credentials present (school-specific or env)
         if have_creds:
             try:
-                if config:
-                    client = MpesaClient(
-                        consumer_key=config.consumer_key,
-                        consumer_secret=config.consumer_secret,
-                        short_code=config.short_code,
-                        passkey=config.passkey,
-                        callback_url=(config.callback_url or os.getenv('MPESA_CALLBACK_URL')),
-                        environment=config.environment,
-                    )
-                else:
-                    client = MpesaClient()
                 resp = client.stk_push(phone=str(phone), amount=amount, account_ref=f"INV{invoice.id}")
-                # Save CheckoutRequestID on the invoice to reconcile on callback
+                # Record the CheckoutRequestID so the callback worker can match it to this invoice
                 checkout_id = resp.get('CheckoutRequestID') or ''
                 if checkout_id:
+                    StkRequest.objects.create(
+                        checkout_request_id=checkout_id,
+                        merchant_request_id=resp.get('MerchantRequestID') or '',
+                        invoice=invoice,
+                        school_id=invoice.school_id,
+                        phone=str(phone),
+                        amount=amount,
+                        initiated_by=request.user if request.user.is_authenticated else None,
+                    )
                     invoice.mpesa_transaction_id = checkout_id
                     invoice.save(update_fields=['mpesa_transaction_id'])
                 logger.info("STK initiated", extra={'invoice_id': invoice.id, 'checkout_request_id': checkout_id})
@@ -512,7 +662,7 @@ class InvoiceViewSet(viewsets.ModelViewSet):
         # Fallback mocked when credentials missing
         return Response({'status':'pending','message':'STK credentials not configured; set MPESA_* env vars or use simulate=true.'}, status=202)
 
-class PaymentViewSet(viewsets.ModelViewSet):
+class PaymentViewSet(SchoolScopedMixin, viewsets.ModelViewSet):
     queryset = Payment.objects.all()
     serializer_class = PaymentSerializer
     permission_classes = [IsFinanceOrAdmin]
@@ -520,10 +670,7 @@ class PaymentViewSet(viewsets.ModelViewSet):
     filterset_fields = ['invoice__student', 'invoice']
 
     def get_queryset(self):
-        qs = super().get_queryset().select_related('invoice', 'invoice__student')
-        school = getattr(getattr(self.request, 'user', None), 'school', None)
-        if school:
-            qs = qs.filter(invoice__student__klass__school=school)
+        qs = super().get_queryset().select_related('invoice', 'invoice__student', 'invoice__student__klass', 'recorded_by')
         # Optional filters via query params
         params = self.request.query_params
         # Filter by class id
@@ -558,161 +705,87 @@ class PaymentViewSet(viewsets.ModelViewSet):
 
     @action(detail=False, methods=['get'], url_path='export')
     def export_csv(self, request):
-        """Export filtered payments as CSV for download/print.
+        """Export filtered payments for download/print.
         Accepts same query params as list plus: klass, start_date, end_date.
+        ?export=csv (default) or xlsx; ?background=1 writes the file to media and returns a job to poll.
         """
-        import csv
-        from django.http import HttpResponse
-        qs = self.filter_queryset(self.get_queryset()).order_by('created_at')
-        resp = HttpResponse(content_type='text/csv')
-        resp['Content-Disposition'] = 'attachment; filename="payments.csv"'
-        w = csv.writer(resp)
-        w.writerow(['Payment ID','Date','Amount','Method','Reference','Invoice ID','Student ID','Student Name','Class'])
-        for p in qs:
-            stu = getattr(p.invoice, 'student', None)
-            w.writerow([
-                p.id,
-                getattr(p, 'created_at', ''),
-                float(getattr(p, 'amount', 0) or 0),
-                getattr(p, 'method', ''),
-                getattr(p, 'reference', ''),
-                getattr(p.invoice, 'id', ''),
-                getattr(stu, 'id', ''),
-                getattr(stu, 'name', ''),
-                str(getattr(stu, 'klass', '') or ''),
-            ])
-        return resp
+        from reports.exports import CHUNK_SIZE, export_response
+        qs = (
+            self.filter_queryset(self.get_queryset())
+            .order_by('created_at', 'id')
+            .values_list(
+                'id', 'created_at', 'amount', 'method', 'reference', 'invoice_id',
+                'invoice__student_id', 'invoice__student__name', 'invoice__student__klass__name',
+            )
+        )
+
+        def rows():
+            yield ['Payment ID','Date','Amount','Method','Reference','Invoice ID','Student ID','Student Name','Class']
+            for pid, created_at, amount, method, reference, invoice_id, student_id, student_name, klass_name in qs.iterator(chunk_size=CHUNK_SIZE):
+                yield [pid, created_at, float(amount or 0), method, reference, invoice_id, student_id or '', student_name or '', klass_name or '']
+
+        return export_response(request, rows, 'payments', sheet_title='Payments')
 
     @action(detail=True, methods=['get'], url_path='receipt')
     def receipt(self, request, pk=None):
         """Return structured data suitable for rendering/printing a payment receipt.
         Frontend can format this as a printable page.
         """
-        try:
-            pay = self.get_queryset().get(pk=pk)
-        except Payment.DoesNotExist:
+        pay = self._receipt_queryset().filter(pk=pk).first()
+        if pay is None:
             return Response({'detail': 'Payment not found'}, status=404)
-        inv = pay.invoice
-        stu = inv.student if inv else None
-        school = getattr(getattr(stu, 'klass', None), 'school', None)
-        # Compute invoice and student balances
-        paid_on_invoice = 0.0
-        if inv:
-            from django.db.models import Sum as _Sum
-            paid_on_invoice = float(inv.payments.aggregate(s=_Sum('amount'))['s'] or 0)
-        invoice_amount = float(getattr(inv, 'amount', 0) or 0)
-        invoice_balance = max(0.0, invoice_amount - paid_on_invoice)
-
-        stu_total_billed = 0.0
-        stu_total_paid = 0.0
-        if stu:
-            from django.db.models import Sum as _Sum
-            stu_total_billed = float(Invoice.objects.filter(student=stu).aggregate(s=_Sum('amount'))['s'] or 0)
-            stu_total_paid = float(Payment.objects.filter(invoice__student=stu).aggregate(s=_Sum('amount'))['s'] or 0)
-        student_balance = max(0.0, stu_total_billed - stu_total_paid)
-
-        # Current term billed/paid and balances to compute arrears
-        current_term_billed = 0.0
-        current_term_paid = 0.0
-        current_term_balance = 0.0
-        arrears_balance = 0.0
-        try:
-            if inv and stu and inv.year and inv.term:
-                from django.db.models import Sum as _Sum
-                invs_this_term = Invoice.objects.filter(student=stu, year=inv.year, term=inv.term)
-                current_term_billed = float(invs_this_term.aggregate(s=_Sum('amount'))['s'] or 0)
-                pays_this_term = Payment.objects.filter(invoice__in=invs_this_term)
-                current_term_paid = float(pays_this_term.aggregate(s=_Sum('amount'))['s'] or 0)
-                current_term_balance = max(0.0, current_term_billed - current_term_paid)
-                arrears_balance = max(0.0, student_balance - current_term_balance)
-        except Exception:
-            pass
+        return Response(build_receipts([pay], request=request)[0])
 
-        # Prepare school details (including absolute logo URL if available)
-        def school_payload(school_obj):
-            if not school_obj:
-                return {'id': None, 'name': None}
+    @action(detail=False, methods=['get'], url_path='receipts-pdf')
+    def receipts_pdf(self, request):
+        """Print several receipts as one PDF (one page each).
+        Params: ids=1,2,3, or the list filters with a date range (start_date/end_date, klass, method).
+        At most MAX_BATCH_RECEIPTS receipts per document.
+        """
+        params = request.query_params
+        qs = self._receipt_queryset()
+        if params.get('ids'):
             try:
-                logo_url = school_obj.logo.url if getattr(school_obj, 'logo', None) else None
-                if logo_url and request:
-                    try:
-                        logo_url = request.build_absolute_uri(logo_url)
-                    except Exception:
-                        pass
-            except Exception:
-                logo_url = None
-            return {
-                'id': getattr(school_obj, 'id', None),
-                'name': str(school_obj) if school_obj else None,
-                'address': getattr(school_obj, 'address', None),
-                'motto': getattr(school_obj, 'motto', None),
-                'logo_url': logo_url,
-            }
-
-        data = {
-            'receipt_no': f"RCPT-{pay.id}",
-            'date': getattr(pay, 'created_at', None),
-            'amount': float(pay.amount),
-            'method': pay.method,
-            'reference': pay.reference,
-            'recorded_by': getattr(getattr(pay, 'recorded_by', None), 'id', None),
-            'recorded_by_name': (lambda u: (
-                (getattr(u, 'name', None) or getattr(u, 'full_name', None) or
-                 (getattr(u, 'get_full_name', lambda: '')() or getattr(u, 'get_username', lambda: '')()) or str(u))
-                if u else None))(getattr(pay, 'recorded_by', None)),
-            'invoice': inv.id if inv else None,
-            'invoice_amount': invoice_amount if inv else None,
-            'invoice_paid': paid_on_invoice,
-            'invoice_balance': invoice_balance,
-            'student': {
-                'id': getattr(stu, 'id', None),
-                'name': getattr(stu, 'name', None),
-                'class': str(getattr(stu, 'klass', '') or ''),
-                'admission_no': getattr(stu, 'admission_no', None),
-            },
-            'school': school_payload(school),
-            'student_total_billed': stu_total_billed,
-            'student_total_paid': stu_total_paid,
-            'student_balance': student_balance,
-            'current_term_billed': current_term_billed,
-            'current_term_paid': current_term_paid,
-            'current_term_balance': current_term_balance,
-            'arrears_balance': arrears_balance,
-        }
-
-        # Include fee assignments for the student's class for the invoice's period
+                ids = [int(x) for x in str(params['ids']).split(',') if x.strip()]
+            except ValueError:
+                return Response({'detail': 'ids must be a comma-separated list of payment ids'}, status=400)
+            qs = qs.filter(pk__in=ids)
+        elif not (params.get('start_date') or params.get('date_from')):
+            return Response({'detail': 'Provide ids or a start_date'}, status=400)
+        else:
+            qs = self.filter_queryset(qs)
+        payments = list(qs.order_by('created_at', 'id')[:MAX_BATCH_RECEIPTS + 1])
+        if not payments:
+            return Response({'detail': 'No payments found'}, status=404)
+        if len(payments) > MAX_BATCH_RECEIPTS:
+            return Response({'detail': f'At most {MAX_BATCH_RECEIPTS} receipts per document; narrow the date range'}, status=400)
+        logos = {}
+        for pay in payments:
+            school = getattr(pay.invoice.student.klass, 'school', None) if pay.invoice.student.klass_id else None
+            if school is not None and school.id not in logos:
+                try:
+                    logos[school.id] = school.logo.path if school.logo else None
+                except Exception:
+                    logos[school.id] = None
         try:
-            if inv and stu and getattr(stu, 'klass_id', None) and inv.year and inv.term:
-                qs = ClassFee.objects.filter(klass_id=stu.klass_id, year=inv.year, term=inv.term).select_related('fee_category')
-                data['fee_assignments'] = [
-                    {
-                        'category': getattr(cf.fee_category, 'name', None),
-                        'amount': float(cf.amount or 0),
-                        'year': cf.year,
-                        'term': cf.term,
-                        'due_date': cf.due_date,
-                    }
-                    for cf in qs
-                ]
-        except Exception:
-            pass
-        return Response(data)
+            pdf = render_receipts_pdf(build_receipts(payments, request=request), logos=logos)
+        except ImportError:
+            return Response({'detail': 'PDF generation library not installed. Please install reportlab.'}, status=500)
+        resp = HttpResponse(pdf, content_type='application/pdf')
+        resp['Content-Disposition'] = f'attachment; filename="receipts_{timezone.localdate():%Y%m%d}.pdf"'
+        return resp
+
+    def _receipt_queryset(self):
+        return self.get_queryset().select_related('invoice__student__klass__school', 'recorded_by')
 
 
-class FeeCategoryViewSet(viewsets.ModelViewSet):
+class FeeCategoryViewSet(SchoolScopedMixin, viewsets.ModelViewSet):
     queryset = FeeCategory.objects.all()
     serializer_class = FeeCategorySerializer
     permission_classes = [IsFinanceOrAdmin]
     filter_backends = [DjangoFilterBackend]
     filterset_fields = ['school', 'name']
 
-    def get_queryset(self):
-        qs = super().get_queryset()
-        school = getattr(getattr(self.request, 'user', None), 'school', None)
-        if school:
-            qs = qs.filter(school=school)
-        return qs
-
     def perform_create(self, serializer):
         school = getattr(getattr(self.request, 'user', None), 'school', None)
         serializer.save(school=school)
@@ -737,9 +810,9 @@ class ClassFeeViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         qs = super().get_queryset().select_related('fee_category', 'klass')
-        school = getattr(getattr(self.request, 'user', None), 'school', None)
-        if school:
-            qs = qs.filter(klass__school=school, fee_category__school=school)
+        school_id = get_tenant(self.request).school_id
+        if school_id:
+            qs = qs.filter(klass__school_id=school_id, fee_category__school_id=school_id)
         return qs
 
     def perform_create(self, serializer):
@@ -856,55 +929,14 @@ class ClassFeeViewSet(viewsets.ModelViewSet):
 # Public endpoint for Safaricom Daraja STK callback
 @csrf_exempt
 def mpesa_callback(request):
-    logger = logging.getLogger(__name__)
+    """Store the raw callback in the inbox and acknowledge at once; payments are applied by
+    finance.services.mpesa_callbacks (idempotent on the M-Pesa receipt number).
+    """
     if request.method != 'POST':
         return JsonResponse({'detail': 'Method not allowed'}, status=405)
-    try:
-        data = json.loads(request.body.decode('utf-8') or '{}')
-    except Exception:
-        data = {}
-
-    # Expected structure: { Body: { stkCallback: { CheckoutRequestID, ResultCode, ResultDesc, CallbackMetadata: { Item: [ {Name, Value}, ... ] } } } }
-    stk_cb = (
-        data.get('Body', {})
-            .get('stkCallback', {})
-    )
-    checkout_id = stk_cb.get('CheckoutRequestID')
-    result_code = stk_cb.get('ResultCode')
-    # Build a lookup for metadata items
-    meta_items = stk_cb.get('CallbackMetadata', {}).get('Item', []) if isinstance(stk_cb.get('CallbackMetadata', {}), dict) else []
-    meta = {item.get('Name'): item.get('Value') for item in meta_items if isinstance(item, dict)}
-    receipt = meta.get('MpesaReceiptNumber') or meta.get('M-PESAReceiptNumber')
-    amount = meta.get('Amount')
-    phone = meta.get('PhoneNumber') or meta.get('MSISDN')
-
-    # Find invoice by previously saved CheckoutRequestID
-    invoice = None
-    if checkout_id:
-        invoice = Invoice.objects.filter(mpesa_transaction_id=checkout_id).first()
-
-    logger.info("STK callback received", extra={'checkout_request_id': checkout_id, 'result_code': result_code})
-    # If payment successful, record it
-    if result_code == 0 and invoice and amount:
-        pay = Payment.objects.create(
-            invoice=invoice,
-            amount=float(amount),
-            method='mpesa',
-            reference=receipt or (checkout_id or ''),
-            recorded_by=None,
-        )
-        logger.info("Payment recorded from callback", extra={'invoice_id': invoice.id, 'payment_id': pay.id, 'receipt': receipt})
-        # Update invoice status
-        totals = invoice.payments.aggregate(s=Sum('amount'))
-        total_paid = float(totals['s'] or 0)
-        if total_paid >= float(invoice.amount):
-            invoice.status = 'paid'
-        elif 0 < total_paid < float(invoice.amount):
-            invoice.status = 'partial'
-        else:
-            invoice.status = 'unpaid'
-        invoice.save(update_fields=['status'])
-
+    body = request.body.decode('utf-8', errors='replace')
+    cb = enqueue_callback(body)
+    logging.getLogger(__name__).info("STK callback received", extra={'checkout_request_id': cb.checkout_request_id, 'callback_id': cb.id})
     # Respond to Daraja per spec
     return JsonResponse({'ResultCode': 0, 'ResultDesc': 'Accepted'})
 
@@ -919,9 +951,9 @@ class MpesaConfigViewSet(viewsets.ModelViewSet):
     def get_queryset(self):
         qs = super().get_queryset()
         # Scope to the admin/finance user's school
-        school = getattr(getattr(self.request, 'user', None), 'school', None)
-        if school:
-            qs = qs.filter(school=school)
+        school_id = get_tenant(self.request).school_id
+        if school_id:
+            qs = qs.filter(school_id=school_id)
         else:
             # No school: empty queryset for safety
             qs = qs.none()
@@ -932,39 +964,25 @@ class MpesaConfigViewSet(viewsets.ModelViewSet):
         serializer.save(school=school)
 
 
-class ExpenseCategoryViewSet(viewsets.ModelViewSet):
+class ExpenseCategoryViewSet(SchoolScopedMixin, viewsets.ModelViewSet):
     queryset = ExpenseCategory.objects.all()
     serializer_class = ExpenseCategorySerializer
     permission_classes = [IsFinanceOrAdmin]
     filter_backends = [DjangoFilterBackend]
     filterset_fields = ['school', 'name']
 
-    def get_queryset(self):
-        qs = super().get_queryset()
-        school = getattr(getattr(self.request, 'user', None), 'school', None)
-        if school:
-            qs = qs.filter(school=school)
-        return qs
-
     def perform_create(self, serializer):
         school = getattr(getattr(self.request, 'user', None), 'school', None)
         serializer.save(school=school)
 
 
-class ExpenseViewSet(viewsets.ModelViewSet):
+class ExpenseViewSet(SchoolScopedMixin, viewsets.ModelViewSet):
     queryset = Expense.objects.all()
     serializer_class = ExpenseSerializer
     permission_classes = [IsFinanceOrAdmin]
     filter_backends = [DjangoFilterBackend]
     filterset_fields = ['school', 'category', 'date']
 
-    def get_queryset(self):
-        qs = super().get_queryset()
-        school = getattr(getattr(self.request, 'user', None), 'school', None)
-        if school:
-            qs = qs.filter(school=school)
-        return qs
-
     def perform_create(self, serializer):
         school = getattr(getattr(self.request, 'user', None), 'school', None)
         serializer.save(school=school, recorded_by=self.request.user)
@@ -979,31 +997,204 @@ class PocketMoneyWalletViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         qs = super().get_queryset()
-        school = getattr(getattr(self.request, 'user', None), 'school', None)
-        if school:
-            qs = qs.filter(student__klass__school=school)
+        school_id = get_tenant(self.request).school_id
+        if school_id:
+            qs = qs.filter(student__klass__school_id=school_id)
         return qs
 
+    @action(detail=True, methods=['get'], url_path='statement')
+    def statement(self, request, pk=None):
+        """Wallet statement. Params: start=YYYY-MM-DD (default: first of this month), end=YYYY-MM-DD (inclusive, default today).
+        The opening balance comes from the nearest snapshot, not the full history.
+        """
+        wallet = self.get_object()
+        today = timezone.localdate()
+        try:
+            start = datetime.strptime(request.query_params.get('start'), '%Y-%m-%d').date() if request.query_params.get('start') else today.replace(day=1)
+            end = datetime.strptime(request.query_params.get('end'), '%Y-%m-%d').date() if request.query_params.get('end') else today
+        except ValueError:
+            return Response({'detail': 'start/end must be YYYY-MM-DD'}, status=400)
+        if end < start:
+            return Response({'detail': 'end must not be before start'}, status=400)
+        tz = timezone.get_current_timezone()
+        st = wallet_statement(
+            wallet,
+            timezone.make_aware(datetime.combine(start, datetime.min.time()), tz),
+            timezone.make_aware(datetime.combine(end + timedelta(days=1), datetime.min.time()), tz),
+        )
+        return Response({
+            'wallet': wallet.id,
+            'student': wallet.student_id,
+            'start': start,
+            'end': end,
+            'opening_balance': str(st['opening_balance']),
+            'deposits': str(st['deposits']),
+            'withdrawals': str(st['withdrawals']),
+            'closing_balance': str(st['closing_balance']),
+            'balance': str(wallet.balance),
+            'transactions': PocketMoneyTransactionSerializer(st['transactions'], many=True).data,
+        })
+
 
-class PocketMoneyTransactionViewSet(viewsets.ModelViewSet):
+class PocketMoneyTransactionViewSet(SchoolScopedMixin, viewsets.ModelViewSet):
     queryset = PocketMoneyTransaction.objects.all()
     serializer_class = PocketMoneyTransactionSerializer
     permission_classes = [IsFinanceOrAdmin]
     filter_backends = [DjangoFilterBackend]
     filterset_fields = ['wallet', 'transaction_type']
-
-    def get_queryset(self):
-        qs = super().get_queryset()
-        school = getattr(getattr(self.request, 'user', None), 'school', None)
-        if school:
-            qs = qs.filter(wallet__student__klass__school=school)
+    # The ledger is append-only: corrections are posted as new transactions
+    http_method_names = ['get', 'post', 'head', 'options']
+
+    def _wallets(self, **lookup):
+        qs = PocketMoneyWallet.objects.filter(**lookup)
+        school_id = get_tenant(self.request).school_id
+        if school_id:
+            qs = qs.filter(Q(student__school_id=school_id) | Q(student__klass__school_id=school_id))
         return qs
 
-    def perform_create(self, serializer):
-        transaction = serializer.save(recorded_by=self.request.user)
-        wallet = transaction.wallet
-        if transaction.transaction_type == 'deposit':
-            wallet.balance += transaction.amount
-        elif transaction.transaction_type == 'withdrawal':
-            wallet.balance -= transaction.amount
-        wallet.save()
+    def create(self, request, *args, **kwargs):
+        """Post one deposit/withdrawal through the ledger. An Idempotency-Key header (or
+        idempotency_key field) makes retries return the original transaction.
+        """
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+        wallet = data['wallet']
+        if not self._wallets(pk=wallet.pk).exists():
+            return Response({'detail': 'Wallet not found'}, status=404)
+        if data['amount'] <= 0:
+            return Response({'detail': 'Amount must be greater than 0'}, status=400)
+        key = request.headers.get('Idempotency-Key') or data.get('idempotency_key') or None
+        try:
+            result = post_one(
+                wallet.pk, data['transaction_type'], data['amount'], user=request.user,
+                description=data.get('description') or '', key=key,
+                school_id=get_tenant(request).school_id,
+            )
+        except LedgerError as e:
+            return Response({'detail': e.detail}, status=e.status)
+        if result['status'] == 'insufficient_funds':
+            return Response({'detail': 'Insufficient funds', 'code': 'insufficient_funds', 'balance': str(result['balance'])}, status=400)
+        return Response(self.get_serializer(result['transaction']).data, status=201 if result['status'] == 'applied' else 200)
+
+    @action(detail=False, methods=['post'], url_path='pos-batch')
+    def pos_batch(self, request):
+        """Post a batch of tuck-shop/POS transactions (requires the school's "pos" feature).
+        Body: { terminal?: string, transactions: [{ key, wallet|student|admission_no, type?: 'withdrawal'|'deposit',
+        amount, description? }, ...] } (up to 500, applied in order in one transaction).
+        Returns { results: [{ key, status: applied|duplicate|insufficient_funds, transaction, balance }], summary }
+        """
+        tenant = get_tenant(request)
+        if not tenant.has_feature('pos'):
+            return Response({'detail': 'POS is not enabled for this school', 'code': 'feature_disabled'}, status=403)
+        rows = request.data.get('transactions')
+        if not isinstance(rows, list) or not rows:
+            return Response({'detail': 'transactions must be a non-empty list'}, status=400)
+        if len(rows) > POS_MAX_BATCH:
+            return Response({'detail': f'At most {POS_MAX_BATCH} transactions per batch'}, status=400)
+        lines, errors = [], []
+        for idx, row in enumerate(rows):
+            ser = PosTransactionSerializer(data=row)
+            if ser.is_valid():
+                lines.append(ser.validated_data)
+            else:
+                errors.append({'index': idx, 'detail': ser.errors})
+        if errors:
+            return Response({'detail': 'Invalid transactions; nothing was posted', 'errors': errors}, status=400)
+
+        # Resolve wallets in three queries at most, scoped to the school
+        wallet_ids = {l['wallet'] for l in lines if l.get('wallet')}
+        student_ids = {l['student'] for l in lines if l.get('student') and not l.get('wallet')}
+        adm_nos = {l['admission_no'] for l in lines if l.get('admission_no') and not l.get('wallet') and not l.get('student')}
+        by_wallet = set(self._wallets(id__in=wallet_ids).values_list('id', flat=True)) if wallet_ids else set()
+        by_student = dict(self._wallets(student_id__in=student_ids).values_list('student_id', 'id')) if student_ids else {}
+        by_adm = dict(self._wallets(student__admission_no__in=adm_nos).values_list('student__admission_no', 'id')) if adm_nos else {}
+        items, errors = [], []
+        for i, l in enumerate(lines):
+            if l.get('wallet'):
+                wid = l['wallet'] if l['wallet'] in by_wallet else None
+            elif l.get('student'):
+                wid = by_student.get(l['student'])
+            else:
+                wid = by_adm.get(l['admission_no'])
+            if wid is None:
+                errors.append({'index': i, 'detail': 'Wallet not found'})
+                continue
+            items.append({'wallet': wid, 'type': l['type'], 'amount': l['amount'], 'description': l.get('description') or '', 'key': l.get('key') or None})
+        if errors:
+            return Response({'detail': 'Invalid transactions; nothing was posted', 'errors': errors}, status=400)
+        try:
+            results = post_transactions(items, school_id=tenant.school_id, user=request.user, terminal=str(request.data.get('terminal') or '')[:64])
+        except LedgerError as e:
+            return Response({'detail': e.detail}, status=e.status)
+        summary = {'applied': 0, 'duplicate': 0, 'insufficient_funds': 0}
+        out = []
+        for r in results:
+            summary[r['status']] += 1
+            t = r['transaction']
+            out.append({
+                'key': r['key'],
+                'status': r['status'],
+                'transaction': t.id if t is not None else None,
+                'wallet': t.wallet_id if t is not None else None,
+                'balance': str(r['balance']) if r['balance'] is not None else None,
+            })
+        return Response({'results': out, 'summary': summary}, status=201 if summary['applied'] else 200)
+
+
+class FeeStatementViewSet(SchoolScopedMixin, viewsets.ReadOnlyModelViewSet):
+    """Generated term fee statements. Filter by student, year, term; download/ returns the PDF."""
+    queryset = FeeStatement.objects.all()
+    serializer_class = FeeStatementSerializer
+    permission_classes = [IsFinanceOrAdmin]
+    filter_backends = [DjangoFilterBackend]
+    filterset_fields = ['student', 'year', 'term']
+
+    def get_queryset(self):
+        qs = super().get_queryset().select_related('student')
+        klass_id = self.request.query_params.get('klass')
+        if klass_id:
+            qs = qs.filter(student__klass_id=klass_id)
+        return qs.order_by('-year', '-term', 'student__name')
+
+    @action(detail=False, methods=['post'], url_path='generate')
+    def generate(self, request):
+        """Generate fee statements in the background.
+        Body: { year?, term? (default: current term), klass?: id, students?: [ids], email?: bool }
+        Without klass/students every enrolled student of the school gets one.
+        Returns 202 with a job; poll status_url.
+        """
+        school_id = get_tenant(request).school_id
+        if not school_id:
+            return Response({'detail': 'No school associated with this account'}, status=400)
+        data = request.data
+        year, term = fee_statements.current_period(school_id)
+        try:
+            year = int(data.get('year') or year)
+            term = int(data.get('term') or term)
+            klass_id = int(data['klass']) if data.get('klass') else None
+            student_ids = [int(s) for s in (data.get('students') or [])]
+        except (TypeError, ValueError):
+            return Response({'detail': 'year, term, klass and students must be integers'}, status=400)
+        if term not in (1, 2, 3):
+            return Response({'detail': 'term must be 1, 2 or 3'}, status=400)
+        email = str(data.get('email', '')).lower() in ('1', 'true', 'yes', 'on')
+        job = fee_statements.start_job(school_id, year, term, klass_id=klass_id, student_ids=student_ids, email=email, user=request.user)
+        return Response(fee_statements.job_payload(job), status=202)
+
+    @action(detail=False, methods=['get'], url_path=r'jobs/(?P<job_id>[0-9a-f]+)')
+    def job(self, request, job_id=None):
+        job = fee_statements.get_job(job_id)
+        if not job or job.get('school_id') != get_tenant(request).school_id:
+            return Response({'detail': 'Job not found or expired'}, status=404)
+        return Response(fee_statements.job_payload(job))
+
+    @action(detail=True, methods=['get'], url_path='download')
+    def download(self, request, pk=None):
+        st = self.get_object()
+        try:
+            fh = default_storage.open(st.file, 'rb')
+        except (FileNotFoundError, OSError):
+            return Response({'detail': 'Statement file is missing; generate it again'}, status=410)
+        return FileResponse(fh, as_attachment=True, filename=f'fee_statement_{st.student.admission_no}_{st.year}_T{st.term}.pdf',
+                            content_type='application/pdf')
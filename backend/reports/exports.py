@@ -0,0 +1,224 @@
+import csv
+import logging
+import os
+import tempfile
+import threading
+import uuid
+from datetime import datetime, timedelta
+
+from django.core.cache import cache
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.http import FileResponse, StreamingHttpResponse
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.response import Response
+
+logger = logging.getLogger(__name__)
+
+# Shared export helpers. A view hands over a zero-argument callable returning an iterable of
+# rows (header first); rows are pulled lazily so querysets should use .iterator(chunk_size=...).
+#   ?export=csv|xlsx   pick the format (not ?format, which DRF reserves for renderers)
+#   ?background=1      write the file to media storage in a thread and poll
+#                      /api/reports/exports/<job>/ for the download link
+# Job state lives in the Django cache (settings.CACHES, shared by all workers), so the poll can
+# land on any worker. The job heartbeats as it writes; one that stops heartbeating (its worker
+# was restarted mid-export) is reported as failed instead of running forever. Finished files
+# are only served through /api/reports/exports/<job>/download/ to the user (and school) that
+# started the job, never as a public media URL, and are deleted once older than JOB_TTL.
+
+EXPORT_FORMATS = ('csv', 'xlsx')
+CHUNK_SIZE = 2000
+JOB_TTL = 60 * 60 * 24
+JOB_STALE_AFTER = 60 * 10
+EXPORTS_DIR = 'exports'
+XLSX_CONTENT_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+
+class Echo:
+    """File-like object whose write() hands the formatted line back to the caller."""
+
+    def write(self, value):
+        return value
+
+
+def iter_csv(rows):
+    writer = csv.writer(Echo())
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def csv_response(rows, filename):
+    resp = StreamingHttpResponse(iter_csv(rows), content_type='text/csv; charset=utf-8')
+    resp['Content-Disposition'] = f'attachment; filename="{filename}.csv"'
+    return resp
+
+
+def _xlsx_cell(value):
+    # openpyxl rejects timezone-aware datetimes
+    if isinstance(value, datetime) and timezone.is_aware(value):
+        return timezone.localtime(value).replace(tzinfo=None)
+    return value
+
+
+def write_xlsx(rows, fh, sheet_title='Export'):
+    """Write rows into fh with openpyxl's write-only workbook (rows are not kept in memory)."""
+    from openpyxl import Workbook
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(title=(sheet_title or 'Export')[:31])
+    for row in rows:
+        ws.append([_xlsx_cell(v) for v in row])
+    wb.save(fh)
+
+
+def xlsx_response(rows, filename, sheet_title='Export'):
+    # The xlsx zip is assembled on disk and streamed from there, not from a BytesIO
+    tmp = tempfile.TemporaryFile()
+    write_xlsx(rows, tmp, sheet_title)
+    tmp.seek(0)
+    return FileResponse(tmp, as_attachment=True, filename=f'{filename}.xlsx', content_type=XLSX_CONTENT_TYPE)
+
+
+def requested_format(request, default='csv'):
+    fmt = str(request.query_params.get('export') or default).lower()
+    return fmt if fmt in EXPORT_FORMATS else None
+
+
+def wants_background(request):
+    return str(request.query_params.get('background', '')).lower() in ('1', 'true', 'yes')
+
+
+def export_response(request, rows_factory, filename, sheet_title='Export', default='csv'):
+    """Stream rows_factory() as CSV/XLSX, or queue a background job when ?background=1."""
+    fmt = requested_format(request, default)
+    if fmt is None:
+        return Response({'detail': f"export must be one of: {', '.join(EXPORT_FORMATS)}"}, status=status.HTTP_400_BAD_REQUEST)
+    if wants_background(request):
+        job = start_export_job(request.user, rows_factory, filename, fmt, sheet_title)
+        return Response(job_payload(job, request), status=status.HTTP_202_ACCEPTED)
+    if fmt == 'xlsx':
+        return xlsx_response(rows_factory(), filename, sheet_title)
+    return csv_response(rows_factory(), filename)
+
+
+# ===== Background jobs =====
+
+def _job_key(job_id):
+    return f'reports:export_job:{job_id}'
+
+
+def get_export_job(job_id):
+    return cache.get(_job_key(job_id))
+
+
+def _save_job(job):
+    job['heartbeat_at'] = timezone.now().isoformat()
+    cache.set(_job_key(job['id']), job, JOB_TTL)
+
+
+def _orphaned(job) -> bool:
+    if job.get('status') not in ('queued', 'running') or not job.get('heartbeat_at'):
+        return False
+    age = timezone.now() - datetime.fromisoformat(job['heartbeat_at'])
+    return age.total_seconds() > JOB_STALE_AFTER
+
+
+def job_payload(job, request=None):
+    if _orphaned(job):
+        job = {**job, 'status': 'failed', 'error': 'The export stopped before finishing; please start it again'}
+    data = {k: job.get(k) for k in ('id', 'status', 'format', 'filename', 'rows', 'error', 'created_at', 'finished_at')}
+    url = f"/api/reports/exports/{job['id']}/download/" if job.get('status') == 'done' and job.get('path') else None
+    if url and request is not None:
+        url = request.build_absolute_uri(url)
+    data['download_url'] = url
+    data['status_url'] = f"/api/reports/exports/{job['id']}/"
+    return data
+
+
+def run_export_job(job_id, rows_factory, filename, fmt, sheet_title='Export'):
+    from django.db import connection
+    job = get_export_job(job_id) or {'id': job_id}
+    job['status'] = 'running'
+    _save_job(job)
+    count = 0
+    try:
+        def counted(rows):
+            nonlocal count
+            for row in rows:
+                count += 1
+                if count % CHUNK_SIZE == 0:
+                    job['rows'] = count - 1
+                    _save_job(job)
+                yield row
+        with tempfile.TemporaryFile(mode='w+b') as tmp:
+            if fmt == 'xlsx':
+                write_xlsx(counted(rows_factory()), tmp, sheet_title)
+            else:
+                for line in iter_csv(counted(rows_factory())):
+                    tmp.write(line.encode('utf-8'))
+            tmp.seek(0)
+            path = default_storage.save(os.path.join(EXPORTS_DIR, job_id, f'{filename}.{fmt}'), File(tmp))
+        job.update({'status': 'done', 'path': path, 'rows': max(count - 1, 0)})
+    except Exception as e:
+        logger.exception('Export job %s failed', job_id)
+        job.update({'status': 'failed', 'error': str(e)})
+    finally:
+        job['finished_at'] = timezone.now().isoformat()
+        _save_job(job)
+        # Worker threads get their own DB connection; release it
+        connection.close()
+    try:
+        purge_expired_exports()
+    except Exception:
+        logger.exception('Could not purge expired exports')
+    return job
+
+
+def open_export_file(job):
+    """Open a finished job's file for reading; raises FileNotFoundError once it is gone."""
+    if job.get('status') != 'done' or not job.get('path'):
+        raise FileNotFoundError(job.get('path'))
+    return default_storage.open(job['path'], 'rb')
+
+
+def purge_expired_exports(max_age=JOB_TTL) -> int:
+    """Delete export files older than max_age seconds (their job has expired). Returns the count."""
+    try:
+        job_dirs, _ = default_storage.listdir(EXPORTS_DIR)
+    except (FileNotFoundError, NotADirectoryError):
+        return 0
+    cutoff = timezone.now() - timedelta(seconds=max_age)
+    deleted = 0
+    for job_dir in job_dirs:
+        _, files = default_storage.listdir(os.path.join(EXPORTS_DIR, job_dir))
+        for name in files:
+            path = os.path.join(EXPORTS_DIR, job_dir, name)
+            if default_storage.get_modified_time(path) < cutoff:
+                default_storage.delete(path)
+                deleted += 1
+        # Local storage leaves the emptied job directory behind
+        try:
+            os.rmdir(default_storage.path(os.path.join(EXPORTS_DIR, job_dir)))
+        except (NotImplementedError, OSError):
+            pass
+    return deleted
+
+
+def start_export_job(user, rows_factory, filename, fmt, sheet_title='Export'):
+    job = {
+        'id': uuid.uuid4().hex,
+        'status': 'queued',
+        'format': fmt,
+        'filename': f'{filename}.{fmt}',
+        'user_id': getattr(user, 'id', None),
+        'school_id': getattr(user, 'school_id', None),
+        'rows': None,
+        'error': None,
+        'path': None,
+        'created_at': timezone.now().isoformat(),
+        'finished_at': None,
+    }
+    _save_job(job)
+    t = threading.Thread(target=run_export_job, args=(job['id'], rows_factory, filename, fmt, sheet_title), daemon=True)
+    t.start()
+    return job
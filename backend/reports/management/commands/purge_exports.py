@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from reports.exports import JOB_TTL, purge_expired_exports
+
+
+class Command(BaseCommand):
+    help = "Delete background export files whose job has expired. Run periodically (e.g. nightly)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-age', type=int, default=JOB_TTL, help='Delete files older than this many seconds')
+
+    def handle(self, *args, **options):
+        deleted = purge_expired_exports(max_age=options['max_age'])
+        self.stdout.write(f"Deleted {deleted} export file(s).")
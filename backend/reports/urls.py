@@ -1,7 +1,9 @@
 from django.urls import path
-from .views import summary, clear_cache
+from .views import summary, clear_cache, export_job_status, export_job_download
 
 urlpatterns = [
     path('summary/', summary, name='reports-summary'),
     path('clear-cache/', clear_cache, name='reports-clear-cache'),
+    path('exports/<str:job_id>/', export_job_status, name='reports-export-job'),
+    path('exports/<str:job_id>/download/', export_job_download, name='reports-export-download'),
 ]
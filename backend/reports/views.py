@@ -1,3 +1,4 @@
+import os
 from datetime import datetime, timedelta
 from django.db.models import Sum, Avg, Count, Q, Case, When, IntegerField
 from django.db.models.functions import TruncDate, TruncMonth
@@ -6,10 +7,12 @@ from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework import status
 from django.core.cache import cache
+from django.http import FileResponse
 
 from academics.models import Student, Class as Klass, Attendance, Assessment, ExamResult
 from finance.models import Invoice, Payment
 from accounts.models import User
+from accounts.tenancy import get_tenant, scope_to_school
 
 @api_view(["GET"])
 @permission_classes([IsAuthenticated])
@@ -36,12 +39,12 @@ def summary(request):
     if school:
         cl_qs = cl_qs.filter(school=school)
         st_qs = st_qs.filter(klass__school=school)
-        att_qs = att_qs.filter(student__klass__school=school)
-        inv_qs = inv_qs.filter(student__klass__school=school)
-        pay_qs = pay_qs.filter(invoice__student__klass__school=school)
+        att_qs = scope_to_school(att_qs, school)
+        inv_qs = scope_to_school(inv_qs, school)
+        pay_qs = scope_to_school(pay_qs, school)
         teach_qs = teach_qs.filter(school=school)
         assess_qs = assess_qs.filter(student__klass__school=school)
-        exam_results_qs = exam_results_qs.filter(student__klass__school=school)
+        exam_results_qs = scope_to_school(exam_results_qs, school)
 
     # Exclude non-examinable subjects from all exam results based analytics
     exam_results_qs = exam_results_qs.filter(subject__is_examinable=True)
@@ -255,3 +258,35 @@ def clear_cache(request):
     cache_key = f'reports_summary_{request.user.id}'
     cache.delete(cache_key)
     return Response({"message": "Cache cleared successfully"}, status=status.HTTP_200_OK)
+
+
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def export_job_status(request, job_id):
+    """Status of a background export started with ?background=1; includes the download link when done"""
+    from .exports import get_export_job, job_payload
+    job = get_export_job(job_id)
+    if not _owns_export_job(request, job):
+        return Response({"detail": "Export job not found"}, status=status.HTTP_404_NOT_FOUND)
+    return Response(job_payload(job, request))
+
+
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def export_job_download(request, job_id):
+    """The file of a finished background export, for the user who started it"""
+    from .exports import get_export_job, open_export_file
+    job = get_export_job(job_id)
+    if not _owns_export_job(request, job):
+        return Response({"detail": "Export job not found"}, status=status.HTTP_404_NOT_FOUND)
+    if job.get('status') != 'done':
+        return Response({"detail": "Export is not finished"}, status=status.HTTP_409_CONFLICT)
+    try:
+        fh = open_export_file(job)
+    except (FileNotFoundError, OSError):
+        return Response({"detail": "Export file has expired; please start it again"}, status=status.HTTP_410_GONE)
+    return FileResponse(fh, as_attachment=True, filename=job.get('filename') or os.path.basename(job['path']))
+
+
+def _owns_export_job(request, job):
+    return bool(job) and job.get('user_id') == request.user.id and job.get('school_id') == get_tenant(request).school_id
@@ -195,6 +195,23 @@ function PaymentHistory({ showError, onCount, onLoading }){
     }
   }
 
+  const printReceipts = async () => {
+    try {
+      const params = {}
+      if (filters.startDate) params.start_date = filters.startDate
+      else params.start_date = new Date().toISOString().slice(0,10)
+      if (filters.endDate) params.end_date = filters.endDate
+      const { data } = await api.get('/finance/payments/receipts-pdf/', { params, responseType: 'blob' })
+      const url = window.URL.createObjectURL(new Blob([data], { type: 'application/pdf' }))
+      window.open(url, '_blank')
+      setTimeout(() => window.URL.revokeObjectURL(url), 60000)
+    } catch (err) {
+      let detail = err?.message || 'Failed'
+      try { detail = JSON.parse(await err?.response?.data?.text())?.detail || detail } catch (_) {}
+      showError?.('Failed to Print Receipts', detail)
+    }
+  }
+
   const viewReceipt = async (payment) => {
     setReceiptOpen(true)
     setReceiptLoading(true)
@@ -312,6 +329,7 @@ function PaymentHistory({ showError, onCount, onLoading }){
             </select>
             <button onClick={()=>setSortDir(d=>d==='asc'?'desc':'asc')} className="hidden sm:inline-flex px-2 py-1 text-sm border border-gray-300 rounded-md bg-white hover:bg-gray-50" title="Toggle sort direction">{sortDir==='asc'?'Asc':'Desc'}</button>
             <button onClick={printResults} className="px-3 py-2 text-sm font-medium bg-white border border-gray-300 rounded-md hover:bg-gray-50">Print Results</button>
+            <button onClick={printReceipts} title="One PDF with a receipt per payment in the date range (today if none)" className="px-3 py-2 text-sm font-medium bg-white border border-gray-300 rounded-md hover:bg-gray-50">Print Receipts</button>
             <div className="text-sm text-gray-500">
               {loading ? (
                 <span className="inline-flex items-center gap-2"><div className="w-4 h-4 border-2 border-gray-300 border-t-indigo-500 rounded-full animate-spin"></div> Loading...</span>
@@ -27,6 +27,15 @@ export default function FinancePayments(){
   const [studentSearch, setStudentSearch] = useState('')
   const [studentResults, setStudentResults] = useState([])
   const [searchingStudents, setSearchingStudents] = useState(false)
+  // Statement reconciliation (M-Pesa / bank export)
+  const [showRecon, setShowRecon] = useState(false)
+  const [reconKind, setReconKind] = useState('mpesa')
+  const [reconFile, setReconFile] = useState(null)
+  const [reconPreview, setReconPreview] = useState(null)
+  const [reconAssign, setReconAssign] = useState({})
+  const [reconBusy, setReconBusy] = useState(false)
+  const [reconError, setReconError] = useState('')
+  const [reconResult, setReconResult] = useState(null)
 
   useEffect(()=>{ load() }, [tab])
 
@@ -98,6 +107,52 @@ export default function FinancePayments(){
     }
   }
 
+  async function previewStatement(e){
+    e?.preventDefault?.()
+    setReconError(''); setReconResult(null)
+    if (!reconFile) { setReconError('Choose a statement file (CSV or XLSX)'); return }
+    setReconBusy(true)
+    try{
+      const fd = new FormData()
+      fd.append('file', reconFile)
+      fd.append('kind', reconKind)
+      const { data } = await api.post('/finance/invoices/reconcile-preview/', fd, { headers: { 'Content-Type': 'multipart/form-data' } })
+      setReconPreview(data)
+      setReconAssign({})
+    }catch(err){
+      setReconError(err?.response?.data?.detail || err?.message || 'Failed to read statement')
+    }finally{
+      setReconBusy(false)
+    }
+  }
+
+  async function applyStatement(){
+    if (!reconPreview?.token) return
+    setReconError('')
+    setReconBusy(true)
+    try{
+      const { data } = await api.post('/finance/invoices/reconcile-apply/', { token: reconPreview.token, assignments: reconAssign })
+      setReconResult(data.summary)
+      setReconPreview(null)
+      setReconFile(null)
+      await load()
+    }catch(err){
+      const code = err?.response?.data?.code
+      if (code === 'statement_expired') setReconPreview(null)
+      setReconError(err?.response?.data?.detail || err?.message || 'Failed to apply statement')
+    }finally{
+      setReconBusy(false)
+    }
+  }
+
+  const reconBadge = (status)=>{
+    const base = 'px-2 py-0.5 rounded text-xs font-semibold border'
+    if (status==='matched') return `${base} bg-green-50 text-green-700 border-green-200`
+    if (status==='ambiguous') return `${base} bg-yellow-50 text-yellow-700 border-yellow-200`
+    if (status==='duplicate') return `${base} bg-gray-100 text-gray-600 border-gray-200`
+    return `${base} bg-rose-50 text-rose-700 border-rose-200`
+  }
+
   const filtered = useMemo(()=>{
     let list = payments
     if (tab !== 'all') {
@@ -160,10 +215,100 @@ export default function FinancePayments(){
         <div className="flex gap-2">
           <input value={q} onChange={e=>setQ(e.target.value)} placeholder="Search name, admno, ref, invoice" className="px-3 py-2 border rounded-lg w-72 text-sm shadow-sm focus:outline-none focus:ring-2 focus:ring-gray-900/20"/>
           <button onClick={printList} className="px-3 py-2 bg-gray-900 text-white rounded-lg text-sm shadow-sm hover:bg-gray-800">Print</button>
+          <button onClick={()=>setShowRecon(s=>!s)} className="px-3 py-2 bg-white border rounded-lg text-sm shadow-sm hover:bg-gray-50">{showRecon? 'Close Reconcile' : 'Reconcile Statement'}</button>
           <button onClick={()=>setShowForm(s=>!s)} className="px-3 py-2 bg-emerald-600 text-white rounded-lg text-sm shadow-sm hover:bg-emerald-700">{showForm? 'Close' : 'Record Payment'}</button>
         </div>
       </div>
 
+      {showRecon && (
+        <div className="bg-white rounded-xl border shadow-md p-4 space-y-3">
+          <div className="flex items-center justify-between">
+            <div className="text-sm font-semibold text-gray-800">Reconcile Statement</div>
+            <div className="text-xs text-gray-500">Matches by account/admission no, invoice ref (INV123) or guardian phone</div>
+          </div>
+          {reconError && <div className="text-sm text-rose-600 bg-rose-50 border border-rose-200 rounded px-3 py-2">{reconError}</div>}
+          {reconResult && (
+            <div className="text-sm text-emerald-700 bg-emerald-50 border border-emerald-200 rounded px-3 py-2">
+              Recorded {reconResult.payments_created} payments ({Number(reconResult.amount_allocated||0).toLocaleString()}) from {reconResult.matched} lines.
+              {Number(reconResult.amount_unallocated||0) > 0 && ` Unallocated (no open invoices): ${Number(reconResult.amount_unallocated).toLocaleString()}.`}
+            </div>
+          )}
+          <form onSubmit={previewStatement} className="flex flex-wrap gap-3 items-end">
+            <div>
+              <label className="block text-xs text-gray-600 mb-1">Statement</label>
+              <select value={reconKind} onChange={e=>setReconKind(e.target.value)} className="px-3 py-2 border rounded text-sm">
+                <option value="mpesa">M-Pesa (paybill/till)</option>
+                <option value="bank">Bank</option>
+              </select>
+            </div>
+            <div>
+              <label className="block text-xs text-gray-600 mb-1">File (CSV/XLSX)</label>
+              <input type="file" accept=".csv,.xlsx,.xls" onChange={e=>{ setReconFile(e.target.files?.[0]||null); setReconPreview(null) }} className="text-sm" />
+            </div>
+            <button type="submit" disabled={reconBusy} className={`px-3 py-2 rounded-lg text-sm text-white ${reconBusy? 'bg-gray-400' : 'bg-gray-900 hover:bg-gray-800'}`}>{reconBusy && !reconPreview ? 'Reading...' : 'Preview'}</button>
+          </form>
+          {reconPreview && (
+            <>
+              <div className="flex flex-wrap gap-2 text-xs">
+                {['matched','ambiguous','unmatched','duplicate'].map(k=> (
+                  <span key={k} className={reconBadge(k)}>{k}: {reconPreview.summary?.[k] ?? 0}</span>
+                ))}
+                <span className="px-2 py-0.5 rounded text-xs border bg-white">Total: {Number(reconPreview.summary?.amount_total||0).toLocaleString()}</span>
+                <span className="px-2 py-0.5 rounded text-xs border bg-white">To allocate: {Number(reconPreview.summary?.amount_allocated||0).toLocaleString()}</span>
+              </div>
+              <div className="overflow-auto max-h-96 border rounded">
+                <table className="w-full text-sm">
+                  <thead className="sticky top-0 bg-gray-50 text-left text-gray-700">
+                    <tr>
+                      <th className="px-3 py-2">Line</th>
+                      <th className="px-3 py-2">Date</th>
+                      <th className="px-3 py-2">Reference</th>
+                      <th className="px-3 py-2">Account / Payer</th>
+                      <th className="px-3 py-2 text-right">Amount</th>
+                      <th className="px-3 py-2">Status</th>
+                      <th className="px-3 py-2">Student</th>
+                    </tr>
+                  </thead>
+                  <tbody>
+                    {reconPreview.lines.map(l=> (
+                      <tr key={l.line} className="border-t align-top">
+                        <td className="px-3 py-2 text-gray-500">{l.line}</td>
+                        <td className="px-3 py-2">{l.date || '-'}</td>
+                        <td className="px-3 py-2 font-mono text-xs">{l.reference || '-'}</td>
+                        <td className="px-3 py-2 text-xs">{l.account || '-'}<div className="text-gray-500">{l.party || l.details}</div></td>
+                        <td className="px-3 py-2 text-right tabular-nums">{Number(l.amount||0).toLocaleString()}</td>
+                        <td className="px-3 py-2"><span className={reconBadge(l.status)}>{l.status}</span>{l.match_by && <div className="text-xs text-gray-500 mt-1">{l.match_by.replace(/_/g,' ')}</div>}</td>
+                        <td className="px-3 py-2 text-xs">
+                          {l.status==='matched' && (
+                            <div>
+                              <div className="font-medium text-gray-800">{l.student?.name} ({l.student?.admission_no})</div>
+                              <div className="text-gray-500">{l.allocations.map(a=>`INV ${a.invoice}: ${Number(a.amount).toLocaleString()}`).join(', ') || 'No open invoices'}</div>
+                              {Number(l.unallocated||0) > 0 && <div className="text-amber-600">Unallocated {Number(l.unallocated).toLocaleString()}</div>}
+                            </div>
+                          )}
+                          {l.status==='ambiguous' && (
+                            <select value={reconAssign[l.line] ?? ''} onChange={e=>setReconAssign(m=>{ const next = { ...m }; if (e.target.value) next[l.line] = Number(e.target.value); else delete next[l.line]; return next })} className="px-2 py-1 border rounded text-xs">
+                              <option value="">Choose student (or leave to skip)</option>
+                              {l.candidates.map(c=> <option key={c.id} value={c.id}>{c.name} ({c.admission_no}) · bal {Number(c.balance||0).toLocaleString()}</option>)}
+                            </select>
+                          )}
+                          {l.status==='duplicate' && <span className="text-gray-500">Already recorded ({l.duplicate_of})</span>}
+                          {l.status==='unmatched' && <span className="text-gray-500">{l.error || 'No student found; record manually'}</span>}
+                        </td>
+                      </tr>
+                    ))}
+                  </tbody>
+                </table>
+              </div>
+              <div className="flex gap-2">
+                <button type="button" onClick={applyStatement} disabled={reconBusy} className={`px-3 py-2 rounded-lg text-sm text-white ${reconBusy? 'bg-gray-400' : 'bg-emerald-600 hover:bg-emerald-700'}`}>{reconBusy? 'Applying...' : 'Apply matched lines'}</button>
+                <button type="button" onClick={()=>setReconPreview(null)} className="px-3 py-2 rounded-lg text-sm border bg-white">Discard</button>
+              </div>
+            </>
+          )}
+        </div>
+      )}
+
       {showForm && (
         <div className="bg-white rounded-xl border shadow-md p-4">
           <div className="flex items-center justify-between mb-3">
@@ -317,6 +317,7 @@ export default function FinancePocketMoney() {
             setStudentQuery('');
         } catch (error) {
             console.error("Failed to create transaction:", error);
+            alert(error?.response?.data?.detail || 'Failed to save transaction');
         }
     };
 
@@ -134,6 +134,7 @@ export default function FinanceStudentWallet() {
       setFormData({ amount: '', description: '' });
     } catch (err) {
       console.error('Failed to save transaction:', err);
+      alert(err?.response?.data?.detail || 'Failed to save transaction');
     }
   };
 
@@ -34,6 +34,7 @@ export default function TeacherGrades(){
   const [uploading, setUploading] = useState(false)
   const [commitUploading, setCommitUploading] = useState(false)
   const [uploadError, setUploadError] = useState('')
+  const [uploadToken, setUploadToken] = useState('') // from the last preview; lets commit skip re-parsing
 
   const getMySubjectsFromClass = (klassObj, meObj) => {
     if (!klassObj) return []
@@ -86,6 +87,23 @@ export default function TeacherGrades(){
     }
   }
 
+  // Images are OCR'd in the background: poll the job, then ask for the preview by job id
+  const waitForOcr = async (jobId, form) => {
+    const deadline = Date.now() + 120000
+    while (Date.now() < deadline){
+      await new Promise(r => setTimeout(r, 1500))
+      const st = await api.get(`/academics/exam_results/ocr-jobs/${jobId}/`)
+      const status = st?.data?.status
+      if (status === 'failed') throw new Error(st?.data?.error || 'OCR failed')
+      if (status === 'done'){
+        form.delete('file')
+        form.append('ocr_job', jobId)
+        return api.post('/academics/exam_results/upload/', form, { headers: { 'Content-Type': 'multipart/form-data' } })
+      }
+    }
+    throw new Error('OCR is taking too long. Try a smaller or clearer image.')
+  }
+
   // Preview upload
   const previewUpload = async () => {
     try{
@@ -106,8 +124,12 @@ export default function TeacherGrades(){
       form.append('commit', 'false')
       // Temporary: request backend to include OCR debug info for images
       form.append('debug', 'true')
-      const res = await api.post('/academics/exam_results/upload/', form, { headers: { 'Content-Type': 'multipart/form-data' } })
+      let res = await api.post('/academics/exam_results/upload/', form, { headers: { 'Content-Type': 'multipart/form-data' } })
+      if (res?.status === 202 && res?.data?.ocr_job){
+        res = await waitForOcr(res.data.ocr_job, form)
+      }
       const data = res?.data || {}
+      setUploadToken(data.upload_token || '')
       const rows = Array.isArray(data.rows) ? data.rows : []
       if (data.ocr_lines) {
         try { console.debug('OCR lines sample:', data.ocr_lines.slice(0, 12)) } catch {}
@@ -168,7 +190,9 @@ export default function TeacherGrades(){
       if (!examId || !subjectId) throw new Error('Select Exam and Subject first')
       if (!uploadFile) throw new Error('Choose a file or photo to upload')
       const form = new FormData()
-      form.append('file', uploadFile)
+      // Reuse the preview's parsed rows when we have them; otherwise send the file again
+      if (uploadToken) form.append('upload_token', uploadToken)
+      else form.append('file', uploadFile)
       form.append('exam', String(examId))
       form.append('subject', String(subjectId))
       if (selectedComponentId) form.append('component', String(selectedComponentId))
@@ -176,6 +200,7 @@ export default function TeacherGrades(){
       if (out) form.append('out_of', String(out))
       form.append('commit', 'true')
       const res = await api.post('/academics/exam_results/upload/', form, { headers: { 'Content-Type': 'multipart/form-data' } })
+      if (res?.status === 202) throw new Error('The photo is still being read. Click Preview first, then Commit.')
       const failed = Number(res?.data?.failed || 0)
       if (failed === 0){
         showSuccess('Upload saved', 'All parsed marks were saved.', 3000)
@@ -187,7 +212,9 @@ export default function TeacherGrades(){
       // Refresh table values after commit
       try{ await submit() } catch {}
       setUploadFile(null)
+      setUploadToken('')
     }catch(e){
+      if (e?.response?.data?.code === 'upload_expired') setUploadToken('')
       const msg = e?.response?.data?.detail || e?.message || 'Commit failed'
       setUploadError(msg)
       showError('Commit failed', msg, 5000)
@@ -790,7 +817,7 @@ export default function TeacherGrades(){
           </div>
           {uploadError && <div className="bg-red-50 text-red-700 p-2 rounded border border-red-200 text-sm mb-2">{uploadError}</div>}
           <div className="flex flex-col md:flex-row gap-2 md:items-center">
-            <input type="file" accept=".csv,.xlsx,.xls,.png,.jpg,.jpeg,.bmp,.webp,.tif,.tiff" onChange={e=>setUploadFile(e.target.files?.[0]||null)} />
+            <input type="file" accept=".csv,.xlsx,.xls,.png,.jpg,.jpeg,.bmp,.webp,.tif,.tiff" onChange={e=>{ setUploadFile(e.target.files?.[0]||null); setUploadToken('') }} />
             <div className="flex gap-2">
               <button type="button" onClick={previewUpload} disabled={uploading || !uploadFile || !selectedExamId || !selectedSubject} className="px-3 py-1.5 rounded-lg bg-gradient-to-r from-sky-500 to-blue-600 text-white disabled:opacity-60">{uploading ? 'Uploading…' : 'Preview'}</button>
               <button type="button" onClick={commitUpload} disabled={commitUploading || !uploadFile || !selectedExamId || !selectedSubject} className="px-3 py-1.5 rounded-lg bg-gradient-to-r from-emerald-600 to-teal-600 text-white disabled:opacity-60">{commitUploading ? 'Saving…' : 'Commit'}</button>